@@ -0,0 +1,189 @@
+from datetime import datetime, timedelta, timezone
+from pymongo import ASCENDING, DeleteMany, IndexModel, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+DUPLICATE_KEY = 11000
+
+GRANULARITIES = ('day', 'week', 'month')
+
+
+def day_of(value):
+    return datetime(value.year, value.month, value.day)
+
+
+def parse_date(value):
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+# ?from=&to= as ISO dates, defaulting to the last 30 days
+def parse_range(args, default_days=30):
+    try:
+        end = parse_date(args['to']) if args.get('to') else datetime.utcnow()
+        start = parse_date(args['from']) if args.get('from') else end - timedelta(days=default_days)
+    except ValueError:
+        raise ValueError('Invalid date range')
+    if start > end:
+        raise ValueError('Invalid date range')
+    return start, end
+
+
+# Daily mood rollups: one document per (user, day, mood) with the number of
+# logs and the sum of their ratings. Creates are applied with $inc; updates
+# and deletes recompute the affected day from the raw logs.
+class MoodRollup:
+    COLLECTION = 'mood_daily'
+    INDEXES = [IndexModel([('user_id', ASCENDING), ('day', ASCENDING), ('mood', ASCENDING)], name='user_day_mood', unique=True)]
+
+    @classmethod
+    def record(cls, mongo, mood):
+        mongo.db[cls.COLLECTION].update_one(
+            {'user_id': mood['user_id'], 'day': day_of(mood['date']), 'mood': mood['mood']},
+            {'$inc': {'count': 1, 'rating_sum': mood.get('rating') or 0}},
+            upsert=True,
+        )
+
+    # Backfill all rollups from the raw mood logs
+    @classmethod
+    def rebuild(cls, mongo):
+        mongo.db[cls.COLLECTION].delete_many({})
+        mongo.db.moods.aggregate([
+            {'$group': {
+                '_id': {
+                    'user_id': '$user_id',
+                    'day': {'$dateTrunc': {'date': '$date', 'unit': 'day'}},
+                    'mood': '$mood',
+                },
+                'count': {'$sum': 1},
+                'rating_sum': {'$sum': {'$ifNull': ['$rating', 0]}},
+            }},
+            {'$project': {
+                '_id': 0,
+                'user_id': '$_id.user_id',
+                'day': '$_id.day',
+                'mood': '$_id.mood',
+                'count': 1,
+                'rating_sum': 1,
+            }},
+            {'$merge': {'into': cls.COLLECTION}},
+        ])
+
+    # Recompute one day from the raw logs. Each mood's row is replaced in
+    # place (upserted), so a record() for the same day running concurrently
+    # never meets a gap to insert into; a duplicate key from two upserts
+    # racing is retried.
+    @classmethod
+    def refresh(cls, mongo, user_id, day, attempts=3):
+        day = day_of(day)
+        groups = mongo.db.moods.aggregate([
+            {'$match': {'user_id': user_id, 'date': {'$gte': day, '$lt': day + timedelta(days=1)}}},
+            {'$group': {'_id': '$mood', 'count': {'$sum': 1}, 'rating_sum': {'$sum': {'$ifNull': ['$rating', 0]}}}},
+        ])
+        rows = [
+            {'user_id': user_id, 'day': day, 'mood': group['_id'], 'count': group['count'], 'rating_sum': group['rating_sum']}
+            for group in groups
+        ]
+        requests = [ReplaceOne({'user_id': user_id, 'day': day, 'mood': row['mood']}, row, upsert=True) for row in rows]
+        # Moods no longer logged that day
+        requests.append(DeleteMany({'user_id': user_id, 'day': day, 'mood': {'$nin': [row['mood'] for row in rows]}}))
+        for attempt in range(attempts):
+            try:
+                mongo.db[cls.COLLECTION].bulk_write(requests, ordered=True)
+                return
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', [])
+                if attempt == attempts - 1 or any(error.get('code') != DUPLICATE_KEY for error in errors):
+                    raise
+
+    @classmethod
+    def stats(cls, mongo, user_id, start, end, granularity='day'):
+        match = {'user_id': user_id, 'day': {'$gte': day_of(start), '$lte': end}}
+        return next(mongo.db[cls.COLLECTION].aggregate([
+            {'$match': match},
+            {'$facet': {
+                'series': [
+                    {'$group': {
+                        '_id': {'$dateTrunc': {'date': '$day', 'unit': granularity}},
+                        'count': {'$sum': '$count'},
+                        'rating_sum': {'$sum': '$rating_sum'},
+                    }},
+                    {'$sort': {'_id': 1}},
+                    {'$project': {
+                        '_id': 0,
+                        'period': '$_id',
+                        'count': 1,
+                        'average_rating': {'$divide': ['$rating_sum', '$count']},
+                    }},
+                ],
+                'distribution': [
+                    {'$group': {'_id': '$mood', 'count': {'$sum': '$count'}}},
+                    {'$sort': {'count': -1}},
+                    {'$project': {'_id': 0, 'mood': '$_id', 'count': 1}},
+                ],
+            }},
+        ]), {'series': [], 'distribution': []})
+
+
+# Daily habit check-in counts, one document per (user, habit, day)
+class HabitRollup:
+    COLLECTION = 'habit_daily'
+    INDEXES = [IndexModel([('user_id', ASCENDING), ('habit_id', ASCENDING), ('day', ASCENDING)], name='user_habit_day', unique=True)]
+
+    @classmethod
+    def record(cls, mongo, user_id, habit_id, amount, when=None):
+        mongo.db[cls.COLLECTION].update_one(
+            {'user_id': user_id, 'habit_id': habit_id, 'day': day_of(when or datetime.utcnow())},
+            {'$inc': {'checkins': amount}},
+            upsert=True,
+        )
+
+    @classmethod
+    def forget(cls, mongo, user_id, habit_id):
+        mongo.db[cls.COLLECTION].delete_many({'user_id': user_id, 'habit_id': habit_id})
+
+    # Streaks over sorted, distinct period numbers (days or weeks since start)
+    @staticmethod
+    def _streaks(periods, current_period):
+        longest = run = 0
+        previous = None
+        for period in periods:
+            run = run + 1 if previous is not None and period == previous + 1 else 1
+            longest = max(longest, run)
+            previous = period
+        current = run if previous is not None and current_period - previous <= 1 else 0
+        return current, longest
+
+    @classmethod
+    def stats(cls, mongo, user_id, start, end):
+        rows = mongo.db[cls.COLLECTION].aggregate([
+            {'$match': {'user_id': user_id, 'day': {'$gte': day_of(start), '$lte': end}, 'checkins': {'$gt': 0}}},
+            {'$sort': {'day': 1}},
+            {'$group': {'_id': '$habit_id', 'days': {'$push': '$day'}, 'checkins': {'$sum': '$checkins'}}},
+        ])
+        by_habit = {row['_id']: row for row in rows}
+
+        first = day_of(start)
+        span_days = (day_of(end) - first).days + 1
+        today = (day_of(min(end, datetime.utcnow())) - first).days
+        output = []
+        habits = mongo.db.habits.find({'user_id': user_id}, {'title': 1, 'frequency': 1, 'progress': 1, 'goal': 1})
+        for habit in habits:
+            row = by_habit.get(habit['_id'], {'days': [], 'checkins': 0})
+            width = 7 if habit.get('frequency') == 'weekly' else 1
+            periods = sorted({(day - first).days // width for day in row['days']})
+            total = -(-span_days // width)
+            current, longest = cls._streaks(periods, today // width)
+            output.append({
+                'habit_id': habit['_id'],
+                'title': habit.get('title'),
+                'checkins': row['checkins'],
+                'active_periods': len(periods),
+                'completion_ratio': len(periods) / total,
+                'current_streak': current,
+                'longest_streak': longest,
+                'progress': habit.get('progress', 0),
+                'goal': habit.get('goal', 0),
+            })
+        return output
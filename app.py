@@ -1,20 +1,268 @@
+import json
+import logging
+import os
+import threading
+import click
+from datetime import timedelta
+from functools import partial
 from flask import Flask
 from flask_jwt_extended import JWTManager
-from flask_pymongo import PyMongo
+from pymongo.errors import PyMongoError
+from werkzeug.middleware.proxy_fix import ProxyFix
+from analytics import MoodRollup
+from archive import Archive, Archiver
+from attachments import AttachmentStore
+from auth import Authenticator
+from cache import create_cache
+from capsules import CapsuleScheduler, backfill
 from config import Config
+from database import create_store
+from encoding import BSONJSONProvider
+from indexes import ensure_indexes, ensure_validators, find_collscans
+from jobs import JobQueue
+from keystore import KeyStore, load_master_keys
+import metrics
+import negotiation
+from models import Entry, Gratitude, Mood, write_listeners
+from reminders import ReminderEngine
 from routes import create_routes
+from search import SearchIndex
+from tasks import register_tasks
+from timeline import backfill_due_dates
 
-app = Flask(__name__)
-app.config.from_object(Config)
 
-# Initialize MongoDB connection
-mongo = PyMongo(app)
+# Background threads: the time capsule scheduler, job workers and reminder
+# engine. create_app only registers them; each process starts its own with
+# the first request it serves (asgi.py: at startup), so 'flask <command>'
+# starts none.
+class BackgroundServices:
+    def __init__(self):
+        self.starters = []
+        self._pid = None
+        self._lock = threading.Lock()
 
-# Initialize JWT
-jwt = JWTManager(app)
+    def add(self, start):
+        self.starters.append(start)
 
-# Register API routes
-app.register_blueprint(create_routes(mongo))
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                for start in self.starters:
+                    start()
+                self._pid = os.getpid()
+
+
+# App factory: flask --app app run, or gunicorn 'app:create_app()'. The Mongo
+# client is created lazily and background threads are started in each worker,
+# so the app can be built before fork. Benchmarks can pass their own mongo
+# (anything with .db), or a factory called like create_store (asgi.py).
+def create_app(config=Config, mongo=None):
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.json = BSONJSONProvider(app)
+    background = BackgroundServices()
+    app.before_request(background.start)
+
+    # Request, Mongo command and crypto instrumentation behind /metrics
+    listeners = []
+    if app.config['METRICS_ENABLED']:
+        metrics.init_app(app)
+        listeners.append(metrics.CommandMetrics())
+
+    # MessagePack and compressed request bodies, compressed responses.
+    # Registered after metrics so its size histogram sees the wire size.
+    negotiation.init_app(app)
+
+    # Initialize the storage backend (MongoDB unless STORAGE_BACKEND says otherwise)
+    if mongo is None:
+        mongo = create_store(app.config, listeners)
+    elif not hasattr(mongo, 'db'):
+        mongo = mongo(app.config, listeners)
+
+    # Per-user data keys wrapped by the configured master key
+    keystore = KeyStore(
+        mongo,
+        load_master_keys(app.config),
+        app.config['KEY_CACHE_SIZE'],
+        app.config['KEY_CACHE_TTL'],
+        {
+            'workers': app.config['DECRYPT_WORKERS'],
+            'executor': app.config['DECRYPT_EXECUTOR'],
+            'chunk_size': app.config['DECRYPT_CHUNK_SIZE'],
+            'min_parallel': app.config['DECRYPT_MIN_PARALLEL'],
+        },
+    )
+
+    # Keyed-hash inverted index for /search
+    search_index = SearchIndex(mongo, app.config['SEARCH_KEY'])
+
+    # Per-user response cache, invalidated by model writes
+    cache = create_cache(app.config, mongo)
+    if cache is not None:
+        write_listeners.append(cache.invalidate)
+
+    # Reconcile model indexes and schema validators (idempotent)
+    if app.config['ENSURE_INDEXES']:
+        try:
+            ensure_indexes(mongo.db)
+            if app.config['SCHEMA_VALIDATION'] != 'off':
+                ensure_validators(mongo.db, level=app.config['SCHEMA_VALIDATION'])
+        except PyMongoError:
+            logging.getLogger(__name__).exception('Could not reconcile indexes at startup')
+
+    # Opens time capsules as their open_date passes
+    scheduler = CapsuleScheduler(mongo, reload_interval=app.config['CAPSULE_RELOAD_SECONDS'])
+    if app.config['CAPSULE_SCHEDULER']:
+        background.add(scheduler.start)
+
+    # Search indexing, rollup and reminder refreshes, off the request path
+    jobs = JobQueue.from_config(mongo, app.config)
+    reminders = ReminderEngine.from_config(mongo, app.config)
+    # Chunked, per-user encrypted entry attachments; thumbnails are made by a job
+    attachments = AttachmentStore.from_config(mongo, keystore, app.config)
+    register_tasks(jobs, mongo, keystore, search_index, reminders, attachments)
+    background.add(partial(jobs.start, app.config['JOB_WORKERS']))
+
+    # Reminders follow writes to their sources and fire from a timing wheel
+    if app.config['REMINDERS_ENABLED']:
+        write_listeners.append(reminders.listener(jobs))
+        if app.config['REMINDER_ENGINE']:
+            background.add(reminders.start)
+
+    # Password checks, user lookup cache and login rate limits. Behind
+    # PROXY_FIX_X_FOR trusted proxies, request.remote_addr is the client's.
+    auth = Authenticator.from_config(mongo, app.config)
+    if app.config['PROXY_FIX_X_FOR']:
+        hops = app.config['PROXY_FIX_X_FOR']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops)
+
+    # Initialize JWT
+    JWTManager(app)
+
+    # Register API routes
+    app.register_blueprint(create_routes(mongo, keystore, cache, search_index, auth, scheduler, jobs, reminders, attachments))
+
+    app.extensions.update(
+        mongo=mongo, mongo_listeners=listeners, keystore=keystore, cache=cache, search_index=search_index, auth=auth,
+        scheduler=scheduler, jobs=jobs, reminders=reminders, attachments=attachments, background=background,
+    )
+    register_commands(app, mongo, keystore, search_index, scheduler, jobs, reminders, attachments)
+    return app
+
+
+def register_commands(app, mongo, keystore, search_index, scheduler, jobs, reminders, attachments):
+    @app.cli.command('ensure-indexes')
+    def ensure_indexes_command():
+        click.echo(json.dumps(ensure_indexes(mongo.db), indent=2))
+
+    @app.cli.command('ensure-validators')
+    @click.option('--level', default=None)
+    def ensure_validators_command(level):
+        level = level or app.config['SCHEMA_VALIDATION']
+        click.echo(json.dumps(ensure_validators(mongo.db, level=level), indent=2))
+
+    @app.cli.command('check-indexes')
+    def check_indexes_command():
+        collscans = find_collscans(mongo.db)
+        click.echo(json.dumps(collscans, indent=2))
+        if collscans:
+            raise SystemExit(1)
+
+    @app.cli.command('reencrypt-entries')
+    @click.option('--user-id', default=None)
+    @click.option('--batch-size', default=500)
+    def reencrypt_entries_command(user_id, batch_size):
+        click.echo(json.dumps(keystore.reencrypt_entries(user_id, batch_size)))
+
+    # Archived entries are re-encrypted too, so old keys can be purged
+    def reencrypt_user(user_id):
+        Archive.rehydrate(mongo, Entry, user_id)
+        click.echo(json.dumps(keystore.reencrypt_entries(user_id)))
+        click.echo(f'Re-encrypted {attachments.reencrypt(user_id)} attachment chunks')
+
+    # Web workers keep encrypting with the old key until their key cache
+    # expires, so old keys are dropped later by purge-old-keys
+    @app.cli.command('rotate-user-key')
+    @click.argument('user_id')
+    def rotate_user_key_command(user_id):
+        click.echo(f'Active key for {user_id}: {keystore.rotate_user_key(user_id)}')
+        reencrypt_user(user_id)
+        click.echo(f"Run 'flask purge-old-keys {user_id}' in {app.config['KEY_CACHE_TTL']}s or later")
+
+    # Re-encrypts whatever was written under an older key since the rotation,
+    # then drops the old keys once KEY_CACHE_TTL has passed
+    @app.cli.command('purge-old-keys')
+    @click.argument('user_id')
+    def purge_old_keys_command(user_id):
+        reencrypt_user(user_id)
+        if not keystore.purge_old_keys(user_id):
+            click.echo(f'Old keys for {user_id} kept: rotated less than {app.config["KEY_CACHE_TTL"]}s ago or still in use')
+            raise SystemExit(1)
+        click.echo(f'Purged old keys for {user_id}')
+
+    @app.cli.command('rotate-master-key')
+    def rotate_master_key_command():
+        click.echo(f'Re-wrapped {keystore.rotate_master_key()} data key documents')
+
+    @app.cli.command('rebuild-rollups')
+    def rebuild_rollups_command():
+        MoodRollup.rebuild(mongo)
+        for mood in Archive.documents(mongo, Mood.COLLECTION):
+            MoodRollup.record(mongo, mood)
+        click.echo('Mood rollups rebuilt')
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command():
+        click.echo(f'Indexed {search_index.rebuild(keystore)} documents')
+
+    @app.cli.command('backfill-time-capsules')
+    def backfill_time_capsules_command():
+        migrated, invalid = backfill(mongo)
+        click.echo(f'Normalised {migrated} time capsules, {invalid} with unparseable open_date')
+
+    @app.cli.command('backfill-due-dates')
+    def backfill_due_dates_command():
+        click.echo(f'Set due_at on {backfill_due_dates(mongo)} tasks and goals')
+
+    # Run the scheduler in the foreground, e.g. as its own process with
+    # CAPSULE_SCHEDULER=0 on the web workers
+    @app.cli.command('run-capsule-scheduler')
+    def run_capsule_scheduler_command():
+        scheduler.run()
+
+    # Fire reminders in the foreground, e.g. with REMINDER_ENGINE=0 on the
+    # web workers
+    @app.cli.command('run-reminders')
+    def run_reminders_command():
+        reminders.run()
+
+    # Recompute every user's reminders, e.g. after changing the defaults
+    @app.cli.command('rebuild-reminders')
+    def rebuild_reminders_command():
+        click.echo(json.dumps(reminders.rebuild(), indent=2))
+
+    @app.cli.command('purge-attachment-uploads')
+    def purge_attachment_uploads_command():
+        max_age = timedelta(hours=app.config['ATTACHMENT_UPLOAD_EXPIRE_HOURS'])
+        click.echo(f'Purged {attachments.purge_stale_uploads(max_age)} incomplete attachment uploads')
+
+    @app.cli.command('run-jobs')
+    @click.option('--concurrency', default=4)
+    def run_jobs_command(concurrency):
+        jobs.run(concurrency)
+
+    # Move old entries, moods and gratitude logs into monthly archives, e.g.
+    # nightly from cron
+    @app.cli.command('archive-old-data')
+    def archive_old_data_command():
+        archiver = Archiver.from_config(mongo, app.config)
+        click.echo(json.dumps(archiver.run([Entry, Mood, Gratitude]), indent=2))
+
+    @app.cli.command('job-stats')
+    def job_stats_command():
+        click.echo(json.dumps(jobs.broker.counts(), indent=2))
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
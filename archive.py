@@ -0,0 +1,218 @@
+import zlib
+from datetime import datetime, timedelta
+from itertools import groupby
+import bson
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, DeleteOne, IndexModel
+from pymongo.errors import BulkWriteError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DUPLICATE_KEY = 11000
+
+CODECS = {'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress)}
+if zstandard is not None:
+    CODECS['zstd'] = (
+        lambda data: zstandard.ZstdCompressor(level=10).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+
+def month_of(value):
+    return datetime(value.year, value.month, 1)
+
+
+def next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _insert_ignoring_duplicates(collection, docs):
+    try:
+        collection.insert_many(docs, ordered=False, bypass_document_validation=True)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+            raise
+
+
+# Cold storage for old documents of the ArchivedDocument models: one
+# compressed blob of BSON documents per (collection, user, month), split
+# into parts so no archive document nears the 16MB limit. Restoring a month
+# copies its documents back into the collection and marks its parts
+# restored; Archiver re-archives the month once it has been left alone.
+class Archive:
+    COLLECTION = 'archives'
+    INDEXES = [
+        IndexModel(
+            [('collection', ASCENDING), ('user_id', ASCENDING), ('restored_at', ASCENDING), ('month', DESCENDING)],
+            name='collection_user_restored_month',
+        ),
+    ]
+
+    @classmethod
+    def _parts(cls, mongo, model, user_id, months=None, before=None, projection=None):
+        query = {'collection': model.COLLECTION, 'user_id': user_id, 'restored_at': None}
+        if months is not None:
+            query['month'] = {'$in': list(months)}
+        elif before is not None:
+            query['month'] = {'$lte': before}
+        return mongo.db[cls.COLLECTION].find(query, projection).sort('month', DESCENDING)
+
+    @staticmethod
+    def decode(part):
+        return bson.decode_all(CODECS[part['codec']][1](part['data']))
+
+    @classmethod
+    def restore_parts(cls, mongo, model, parts):
+        docs = [doc for part in parts for doc in cls.decode(part)]
+        if docs:
+            _insert_ignoring_duplicates(mongo.db[model.COLLECTION], docs)
+        mongo.db[cls.COLLECTION].update_many(
+            {'_id': {'$in': [part['_id'] for part in parts]}}, {'$set': {'restored_at': datetime.utcnow()}},
+        )
+        return len(docs)
+
+    # Make sure a newest-first page of at most limit documents older than
+    # before (a cursor's sort value) can be read from the collection alone.
+    # Months are restored newest first until the collection holds enough
+    # documents ahead of the next archived month; without a limit every
+    # archived month older than before is restored.
+    @classmethod
+    def rehydrate(cls, mongo, model, user_id, limit=None, before=None):
+        collection = mongo.db[model.COLLECTION]
+        months = cls._parts(mongo, model, user_id, before=before, projection={'month': 1}).distinct('month')
+        restored = 0
+        for month in sorted(months, reverse=True):
+            if limit:
+                query = {'user_id': user_id, model.SORT_FIELD: {'$gte': next_month(month)}}
+                if before is not None:
+                    query[model.SORT_FIELD]['$lt'] = before
+                if collection.count_documents(query, limit=limit + 1) > limit:
+                    break
+            restored += cls.restore_parts(mongo, model, list(cls._parts(mongo, model, user_id, months=[month])))
+        return restored
+
+    # Every document still archived in a collection, e.g. for rebuilding
+    # rollups or the search index alongside the collection itself
+    @classmethod
+    def documents(cls, mongo, collection, batch_size=10):
+        parts = mongo.db[cls.COLLECTION].find({'collection': collection, 'restored_at': None}).batch_size(batch_size)
+        for part in parts:
+            yield from cls.decode(part)
+
+    # Restore the archived months holding any of ids. Parts list their ids,
+    # and the user's parts are few, so this needs no index of its own.
+    @classmethod
+    def restore_ids(cls, mongo, model, user_id, ids):
+        query = {'collection': model.COLLECTION, 'user_id': user_id, 'restored_at': None,
+                 'ids': {'$in': [ObjectId(object_id) for object_id in ids]}}
+        months = mongo.db[cls.COLLECTION].find(query, {'month': 1}).distinct('month')
+        parts = list(cls._parts(mongo, model, user_id, months=months)) if months else []
+        return cls.restore_parts(mongo, model, parts) if parts else 0
+
+    # Restore the archived months overlapping [start, end)
+    @classmethod
+    def restore_range(cls, mongo, model, user_id, start, end):
+        months, month = [], month_of(start)
+        while month < end:
+            months.append(month)
+            month = next_month(month)
+        parts = list(cls._parts(mongo, model, user_id, months=months))
+        return cls.restore_parts(mongo, model, parts) if parts else 0
+
+
+# Moves documents of whole months older than after_days out of the hot
+# collections into Archive parts. New parts are written before the
+# originals are deleted, and a document is only deleted if its version is
+# unchanged, so a crash or a concurrent edit never loses a write. Months
+# restored within hold_days are left in place.
+class Archiver:
+    def __init__(self, mongo, after_days=180, hold_days=30, part_bytes=4 * 1024 * 1024, codec=None):
+        self.mongo = mongo
+        self.after = timedelta(days=after_days)
+        self.hold = timedelta(days=hold_days)
+        self.part_bytes = part_bytes
+        self.codec = codec or ('zstd' if 'zstd' in CODECS else 'zlib')
+
+    @classmethod
+    def from_config(cls, mongo, config):
+        return cls(mongo, config['ARCHIVE_AFTER_DAYS'], config['ARCHIVE_HOLD_DAYS'], config['ARCHIVE_PART_BYTES'])
+
+    def _write_parts(self, model, user_id, month, docs):
+        compress = CODECS[self.codec][0]
+        generation, now = ObjectId(), datetime.utcnow()
+        parts, chunk, size = [], [], 0
+        for doc in docs:
+            encoded = bson.encode(doc)
+            chunk.append((doc['_id'], encoded))
+            size += len(encoded)
+            if size >= self.part_bytes:
+                parts.append(chunk)
+                chunk, size = [], 0
+        if chunk:
+            parts.append(chunk)
+        result = self.mongo.db[Archive.COLLECTION].insert_many([
+            {
+                'collection': model.COLLECTION,
+                'user_id': user_id,
+                'month': month,
+                'generation': generation,
+                'part': number,
+                'ids': [doc_id for doc_id, _ in chunk],
+                'codec': self.codec,
+                'data': compress(b''.join(encoded for _, encoded in chunk)),
+                'archived_at': now,
+                'restored_at': None,
+            }
+            for number, chunk in enumerate(parts)
+        ])
+        return result.inserted_ids
+
+    # Archive one user's month: merges in any parts already archived for it
+    # (documents still in the collection win) and replaces them
+    def archive_month(self, model, user_id, month, docs):
+        archives = self.mongo.db[Archive.COLLECTION]
+        collection = self.mongo.db[model.COLLECTION]
+        old = list(archives.find({'collection': model.COLLECTION, 'user_id': user_id, 'month': month}))
+        if any(part['restored_at'] and part['restored_at'] > datetime.utcnow() - self.hold for part in old):
+            return 0
+
+        # A restored month's documents are all in the collection already,
+        # including any deletes since; only unrestored parts add anything
+        hot = {doc['_id'] for doc in docs}
+        merged = docs + [
+            doc for part in old if not part['restored_at'] for doc in Archive.decode(part) if doc['_id'] not in hot
+        ]
+        new = self._write_parts(model, user_id, month, merged)
+
+        deleted = collection.bulk_write([DeleteOne({'_id': doc['_id'], 'version': doc.get('version')}) for doc in docs],
+                                        ordered=False).deleted_count
+        if deleted < len(docs):
+            # Edited while being archived: keep those in the collection only
+            kept = {doc['_id'] for doc in collection.find({'_id': {'$in': list(hot)}}, {'_id': 1})}
+            merged = [doc for doc in merged if doc['_id'] not in kept]
+            stale, new = new, self._write_parts(model, user_id, month, merged) if merged else []
+            archives.delete_many({'_id': {'$in': stale}})
+        archives.delete_many({'_id': {'$in': [part['_id'] for part in old]}})
+        # A read restored the new parts before the originals were deleted
+        if archives.count_documents({'_id': {'$in': new}, 'restored_at': {'$ne': None}}, limit=1):
+            Archive.restore_parts(self.mongo, model, list(archives.find({'_id': {'$in': new}})))
+        return deleted
+
+    # Archive every user's whole months before the cutoff; returns the
+    # number of documents moved per collection
+    def run(self, models, now=None):
+        cutoff = month_of((now or datetime.utcnow()) - self.after)
+        moved = {}
+        for model in models:
+            collection = self.mongo.db[model.COLLECTION]
+            field = model.SORT_FIELD
+            moved[model.COLLECTION] = 0
+            users = collection.aggregate([{'$match': {field: {'$lt': cutoff}}}, {'$group': {'_id': '$user_id'}}])
+            for user in users:
+                docs = collection.find({'user_id': user['_id'], field: {'$lt': cutoff}}).sort([(field, 1), ('_id', 1)])
+                for month, group in groupby(docs, key=lambda doc: month_of(doc[field])):
+                    moved[model.COLLECTION] += self.archive_month(model, user['_id'], month, list(group))
+        return moved
@@ -0,0 +1,140 @@
+# ASGI entry point: uvicorn asgi:app --workers 4
+#
+# Serves the whole Flask app (same routes, models, JWT checks, cache, error
+# handlers and hooks) on the event loop. Each request runs in a greenlet
+# (bridge.py) whose database calls are awaited on Motor, so a slow Mongo
+# round-trip parks the request instead of pinning a thread; decryption and
+# password hashing go to a thread pool. Background services and CLI
+# commands keep using the sync PyMongo client. With STORAGE_BACKEND=sqlite
+# the SQLite store is driven through ThreadedClient instead of Motor.
+import time
+from io import BytesIO
+import pymongo
+from asgiref.wsgi import WsgiToAsgiInstance
+from motor.motor_asyncio import AsyncIOMotorClient
+from app import create_app
+from bridge import BridgedMongo, ThreadedClient, await_only, spawn
+from config import Config
+from database import PoolStats, create_store, mongo_options
+
+
+# Motor counterpart of database.Mongo. The client is created on first use,
+# inside the server's event loop.
+class AsyncMongo:
+    def __init__(self, config, listeners=()):
+        self.uri = config['MONGO_URI']
+        self.options = mongo_options(config)
+        self.listeners = list(listeners)
+        self.client = None
+        self.stats = PoolStats(self.options.get('maxPoolSize', 100))
+
+    @property
+    def db(self):
+        if self.client is None:
+            self.client = AsyncIOMotorClient(self.uri, event_listeners=[self.stats] + self.listeners, **self.options)
+        return self.client.get_default_database()
+
+    def pool_stats(self):
+        return self.stats.snapshot()
+
+    # Round-trip a ping; returns the latency in milliseconds
+    async def ping(self, timeout=1.0):
+        start = time.perf_counter()
+        with pymongo.timeout(timeout):
+            await self.db.command('ping')
+        return (time.perf_counter() - start) * 1000
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+
+# create_app's store for the ASGI server: Motor on MongoDB, the SQLite store
+# on threads otherwise, with the sync store for everything off the loop
+def create_bridged_store(config, listeners=()):
+    store = create_store(config, listeners)
+    if config['STORAGE_BACKEND'] == 'mongo':
+        return BridgedMongo(store, AsyncMongo(config, listeners))
+    return BridgedMongo(store, ThreadedClient(store))
+
+
+class AsgiApp:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.mongo = flask_app.extensions['mongo']
+
+    # Runs in the request's greenlet. The response is sent as the app
+    # yields it, so NDJSON streams are not buffered.
+    def run_wsgi(self, environ, send):
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        def send_start():
+            status, headers = started
+            await_only(send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+            }))
+
+        body = self.flask_app(environ, start_response)
+        try:
+            for chunk in body:
+                if chunk:
+                    if started:
+                        send_start()
+                        started.clear()
+                    await_only(send({'type': 'http.response.body', 'body': chunk, 'more_body': True}))
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        if started:
+            send_start()
+        await_only(send({'type': 'http.response.body', 'body': b''}))
+
+    # Request bodies are small (attachments come in chunks), so read in full
+    async def http(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        instance = WsgiToAsgiInstance(self.flask_app)
+        instance.scope = scope
+        environ = instance.build_environ(scope, BytesIO(bytes(body)))
+        # Known even for a chunked upload, now that it has been read
+        environ['CONTENT_LENGTH'] = str(len(body))
+        await spawn(self.run_wsgi, environ, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                # In each worker, after uvicorn has forked it
+                self.flask_app.extensions['background'].start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.mongo.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http':
+            return await self.http(scope, receive, send)
+
+
+# uvicorn asgi:app; built on first access, so importing this module builds
+# no app
+def __getattr__(name):
+    if name == 'app':
+        globals()['app'] = AsgiApp(create_app(Config, create_bridged_store))
+        return globals()['app']
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
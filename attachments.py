@@ -0,0 +1,299 @@
+import io
+from datetime import datetime, timedelta
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from cryptography.fernet import InvalidToken
+from pymongo import ASCENDING, IndexModel, ReturnDocument, UpdateOne
+from models import Entry, update_owned
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Chunk n of the thumbnail, kept apart from the file's own chunks (0..)
+THUMBNAIL = -1
+# Chunks read per query while streaming, bounding memory per download
+READ_AHEAD = 8
+
+
+class AttachmentError(ValueError):
+    pass
+
+
+# One document per attachment, laid out like GridFS's files collection.
+# status is 'uploading' until every chunk is in, then 'complete'.
+class Attachment:
+    COLLECTION = 'attachments'
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING), ('entry_id', ASCENDING)], name='user_entry'),
+        IndexModel([('status', ASCENDING), ('created_at', ASCENDING)], name='status_created_at'),
+    ]
+
+
+# Encrypted chunks, like GridFS's chunks collection: (attachment_id, n) is
+# unique, so re-sending a chunk replaces it. Each is a Fernet token under
+# the user's data key key_id; size is the plaintext length.
+class AttachmentChunk:
+    COLLECTION = 'attachment_chunks'
+    INDEXES = [
+        IndexModel([('attachment_id', ASCENDING), ('n', ASCENDING)], name='attachment_n', unique=True),
+        IndexModel([('user_id', ASCENDING), ('key_id', ASCENDING)], name='user_key_id'),
+    ]
+
+
+# Photos and voice notes on diary entries. Files are uploaded as numbered
+# chunks of chunk_size bytes that can be sent in any order and re-sent, so
+# an interrupted upload resumes from the chunks still missing. Each chunk
+# is encrypted on its own, which lets a range read decrypt only the chunks
+# it covers. Entries carry a small metadata map (attachments.<id>) once an
+# upload completes, so listing entries never touches the chunks.
+class AttachmentStore:
+    def __init__(self, mongo, keystore, chunk_size=256 * 1024, max_bytes=50 * 1024 * 1024,
+                 types=('image/', 'audio/'), thumbnail_size=256):
+        self.mongo = mongo
+        self.keystore = keystore
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.types = types
+        self.thumbnail_size = thumbnail_size
+
+    @classmethod
+    def from_config(cls, mongo, keystore, config):
+        types = tuple(t.strip() for t in config['ATTACHMENT_TYPES'].split(',') if t.strip())
+        return cls(mongo, keystore, config['ATTACHMENT_CHUNK_BYTES'], config['ATTACHMENT_MAX_BYTES'], types,
+                   config['ATTACHMENT_THUMBNAIL_SIZE'])
+
+    @property
+    def collection(self):
+        return self.mongo.db[Attachment.COLLECTION]
+
+    @property
+    def chunks(self):
+        return self.mongo.db[AttachmentChunk.COLLECTION]
+
+    # The user's attachment, or None
+    def get(self, user_id, attachment_id, projection=None):
+        try:
+            return self.collection.find_one({'_id': ObjectId(attachment_id), 'user_id': user_id}, projection)
+        except (InvalidId, TypeError):
+            return None
+
+    @staticmethod
+    def metadata(attachment):
+        return {
+            'filename': attachment['filename'],
+            'content_type': attachment['content_type'],
+            'size': attachment['size'],
+            'thumbnail': False,
+        }
+
+    @staticmethod
+    def chunk_count(attachment):
+        return -(-attachment['size'] // attachment['chunk_size'])
+
+    # Start an upload for one of the user's entries: {filename,
+    # content_type, size}. Returns None if the entry is not the user's.
+    def create(self, user_id, entry_id, data):
+        filename, content_type, size = data.get('filename'), data.get('content_type'), data.get('size')
+        if not isinstance(filename, str) or not filename.strip() or len(filename) > 255:
+            raise AttachmentError('Invalid filename')
+        if not isinstance(content_type, str) or not content_type.lower().startswith(self.types):
+            raise AttachmentError('Unsupported content_type')
+        if isinstance(size, bool) or not isinstance(size, int) or not 0 < size <= self.max_bytes:
+            raise AttachmentError('Invalid size')
+
+        try:
+            entry = Entry.find_by_id(self.mongo, entry_id, user_id)
+        except (InvalidId, TypeError):
+            return None
+        if entry is None or entry['user_id'] != user_id:
+            return None
+        now = datetime.utcnow()
+        attachment = {
+            'user_id': user_id,
+            'entry_id': entry['_id'],
+            'filename': filename.strip(),
+            'content_type': content_type.lower(),
+            'size': size,
+            'chunk_size': self.chunk_size,
+            'status': 'uploading',
+            'thumbnail_type': None,
+            'created_at': now,
+            'updated_at': now,
+        }
+        attachment['_id'] = self.collection.insert_one(attachment).inserted_id
+        return attachment
+
+    # Store chunk n; every chunk but the last must be exactly chunk_size
+    def put_chunk(self, attachment, n, data):
+        if attachment['status'] != 'uploading':
+            raise AttachmentError('Upload already complete')
+        count = self.chunk_count(attachment)
+        if not 0 <= n < count:
+            raise AttachmentError('Invalid chunk number')
+        expected = attachment['size'] - n * attachment['chunk_size'] if n == count - 1 else attachment['chunk_size']
+        if len(data) != expected:
+            raise AttachmentError(f'Chunk {n} must be {expected} bytes')
+
+        key_id, cipher = self.keystore.cipher(attachment['user_id'])
+        self.chunks.update_one(
+            {'attachment_id': attachment['_id'], 'n': n},
+            {'$set': {'user_id': attachment['user_id'], 'key_id': key_id, 'size': len(data),
+                      'data': cipher.encrypt(data)}},
+            upsert=True,
+        )
+
+    def received(self, attachment):
+        return sorted(chunk['n'] for chunk in self.chunks.find({'attachment_id': attachment['_id']}, {'n': 1})
+                      if chunk['n'] >= 0)
+
+    def status(self, attachment):
+        return {
+            'id': str(attachment['_id']),
+            'status': attachment['status'],
+            'size': attachment['size'],
+            'chunk_size': attachment['chunk_size'],
+            'chunks': self.chunk_count(attachment),
+            'received': self.received(attachment) if attachment['status'] == 'uploading' else None,
+        }
+
+    # Finish an upload once every chunk is in and add it to the entry.
+    # Returns the chunk numbers still missing, or [] once complete.
+    def complete(self, attachment):
+        if attachment['status'] == 'complete':
+            return []
+        received = set(self.received(attachment))
+        missing = [n for n in range(self.chunk_count(attachment)) if n not in received]
+        if missing:
+            return missing
+
+        now = datetime.utcnow()
+        done = self.collection.find_one_and_update(
+            {'_id': attachment['_id'], 'status': 'uploading'},
+            {'$set': {'status': 'complete', 'completed_at': now, 'updated_at': now}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if done is not None:
+            entry = update_owned(self.mongo, Entry, attachment['entry_id'], attachment['user_id'],
+                                 {f'attachments.{attachment["_id"]}': self.metadata(attachment)})
+            if entry is None:
+                # The entry was deleted while the upload ran
+                self.delete(attachment, update_entry=False)
+                raise AttachmentError('Entry not found')
+        return []
+
+    def _decrypt(self, chunks):
+        _, cipher = self.keystore.cipher(chunks[0]['user_id'], {chunk['key_id'] for chunk in chunks})
+        for chunk in chunks:
+            yield self._decrypt_chunk(cipher, chunk)
+
+    def _decrypt_chunk(self, cipher, chunk):
+        try:
+            return cipher.decrypt(chunk['data'])
+        except InvalidToken:
+            raise AttachmentError(f'Chunk {chunk["n"]} of {chunk["attachment_id"]} cannot be decrypted')
+
+    # Plaintext bytes [start, stop) as a generator of chunk-sized pieces,
+    # fetching READ_AHEAD chunks per query
+    def read(self, attachment, start=0, stop=None):
+        stop = attachment['size'] if stop is None else stop
+        size = attachment['chunk_size']
+
+        def pieces():
+            first, last = start // size, (stop - 1) // size
+            for batch in range(first, last + 1, READ_AHEAD):
+                batch_last = min(batch + READ_AHEAD - 1, last)
+                query = {'attachment_id': attachment['_id'], 'n': {'$gte': batch, '$lte': batch_last}}
+                chunks = list(self.chunks.find(query).sort('n', ASCENDING))
+                numbers = [chunk['n'] for chunk in chunks]
+                if numbers != list(range(batch, batch_last + 1)):
+                    missing = min(set(range(batch, batch_last + 1)) - set(numbers))
+                    raise AttachmentError(f'Chunk {missing} of {attachment["_id"]} is missing')
+                for chunk, data in zip(chunks, self._decrypt(chunks)):
+                    offset = chunk['n'] * size
+                    yield data[max(start - offset, 0):stop - offset]
+
+        return pieces() if stop > start else iter(())
+
+    def thumbnail(self, attachment):
+        chunk = self.chunks.find_one({'attachment_id': attachment['_id'], 'n': THUMBNAIL})
+        if chunk is None:
+            return None
+        return next(self._decrypt([chunk]))
+
+    def _render_thumbnail(self, data):
+        image = Image.open(io.BytesIO(data))
+        # Lets JPEG decode at a fraction of full size
+        image.draft('RGB', (self.thumbnail_size, self.thumbnail_size))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=80)
+        return output.getvalue()
+
+    # Background job: a JPEG thumbnail for image attachments, stored as an
+    # extra encrypted chunk and flagged on the entry. Needs Pillow;
+    # without it, or for other types, entries simply show no thumbnail.
+    def generate_thumbnail(self, attachment_id):
+        attachment = self.collection.find_one({'_id': ObjectId(attachment_id), 'status': 'complete'})
+        if attachment is None or Image is None or not attachment['content_type'].startswith('image/'):
+            return False
+        try:
+            thumbnail = self._render_thumbnail(b''.join(self.read(attachment)))
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return False
+
+        user_id = attachment['user_id']
+        key_id, cipher = self.keystore.cipher(user_id)
+        self.chunks.update_one(
+            {'attachment_id': attachment['_id'], 'n': THUMBNAIL},
+            {'$set': {'user_id': user_id, 'key_id': key_id, 'size': len(thumbnail), 'data': cipher.encrypt(thumbnail)}},
+            upsert=True,
+        )
+        self.collection.update_one({'_id': attachment['_id']}, {'$set': {'thumbnail_type': 'image/jpeg'}})
+        update_owned(self.mongo, Entry, attachment['entry_id'], user_id,
+                     {f'attachments.{attachment["_id"]}.thumbnail': True})
+        return True
+
+    def delete(self, attachment, update_entry=True):
+        self.chunks.delete_many({'attachment_id': attachment['_id']})
+        self.collection.delete_one({'_id': attachment['_id']})
+        if update_entry and attachment['status'] == 'complete':
+            update_owned(self.mongo, Entry, attachment['entry_id'], attachment['user_id'], None,
+                         unset=[f'attachments.{attachment["_id"]}'])
+
+    # Every attachment of a deleted entry
+    def purge_entry(self, user_id, entry_id):
+        attachments = list(self.collection.find({'user_id': user_id, 'entry_id': ObjectId(entry_id)}, {'_id': 1}))
+        ids = [attachment['_id'] for attachment in attachments]
+        if ids:
+            self.chunks.delete_many({'attachment_id': {'$in': ids}})
+            self.collection.delete_many({'_id': {'$in': ids}})
+        return len(ids)
+
+    # Uploads never completed within max_age, e.g. nightly from cron. Each is
+    # removed only while still uploading, and its chunks only once it is
+    # gone, so an upload completed meanwhile keeps its data.
+    def purge_stale_uploads(self, max_age=timedelta(hours=24)):
+        query = {'status': 'uploading', 'created_at': {'$lt': datetime.utcnow() - max_age}}
+        ids = [attachment['_id'] for attachment in self.collection.find(query, {'_id': 1})]
+        purged = [object_id for object_id in ids if self.collection.find_one_and_delete(dict(query, _id=object_id), {'_id': 1})]
+        if purged:
+            self.chunks.delete_many({'attachment_id': {'$in': purged}})
+        return len(purged)
+
+    # Move chunks written under an older data key onto the active one (see
+    # KeyStore.rotate_user_key), in batches
+    def reencrypt(self, user_id, batch_size=100):
+        key_id, cipher = self.keystore.cipher(user_id)
+        query = {'user_id': user_id, 'key_id': {'$ne': key_id}}
+        ops, migrated = [], 0
+        for chunk in self.chunks.find(query, {'data': 1}).batch_size(batch_size):
+            ops.append(UpdateOne({'_id': chunk['_id']}, {'$set': {'data': cipher.rotate(chunk['data']), 'key_id': key_id}}))
+            if len(ops) >= batch_size:
+                migrated += self.chunks.bulk_write(ops, ordered=False).modified_count
+                ops = []
+        if ops:
+            migrated += self.chunks.bulk_write(ops, ordered=False).modified_count
+        return migrated
@@ -0,0 +1,129 @@
+import threading
+import time
+from pymongo.errors import DuplicateKeyError
+from werkzeug.security import check_password_hash, generate_password_hash
+from bridge import run_blocking
+from cache import MemoryBackend
+from models import User
+
+_MISSING = object()
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__('Too many login attempts')
+        self.retry_after = retry_after
+
+
+# Fixed-window counters per key, in process. Each worker limits on its own,
+# so the effective limit scales with the number of workers.
+class RateLimiter:
+    def __init__(self, limit, window=60, max_keys=100000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def _current(self, key, now):
+        started, count = self._windows.get(key, (now, 0))
+        if now - started >= self.window:
+            started, count = now, 0
+        return started, count
+
+    # Seconds until key may try again, or 0 if it is under the limit
+    def blocked(self, key):
+        now = time.monotonic()
+        with self._lock:
+            started, count = self._current(key, now)
+            return started + self.window - now if count >= self.limit else 0
+
+    def hit(self, key):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._windows) >= self.max_keys:
+                self._windows = {k: v for k, v in self._windows.items() if now - v[0] < self.window}
+            started, count = self._current(key, now)
+            self._windows[key] = (started, count + 1)
+
+    def reset(self, key):
+        with self._lock:
+            self._windows.pop(key, None)
+
+
+# Login and registration. Passwords are checked against the stored hash
+# directly, and hashes made with other parameters than hash_method are
+# upgraded on the next successful login. Username lookups go through a
+# short-lived cache (misses are cached for less time than hits), and
+# failed attempts are limited per client IP and per username, both checked
+# before any hash is computed. Successful logins count against neither, so
+# many users behind one address are not locked out by their own logins.
+class Authenticator:
+    def __init__(self, mongo, hash_method='scrypt', cache_size=10000, cache_ttl=30, negative_ttl=5,
+                 ip_limit=20, user_limit=10, window=60):
+        self.mongo = mongo
+        self.hash_method = hash_method
+        # Normalised parameters, e.g. 'scrypt' -> 'scrypt:32768:8:1'
+        self.hash_params = generate_password_hash('', hash_method).split('$', 1)[0]
+        self.users = MemoryBackend(cache_size)
+        self.cache_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+        self.ip_limiter = RateLimiter(ip_limit, window)
+        self.user_limiter = RateLimiter(user_limit, window)
+
+    @classmethod
+    def from_config(cls, mongo, config):
+        return cls(
+            mongo,
+            config['PASSWORD_HASH_METHOD'],
+            config['AUTH_USER_CACHE_SIZE'],
+            config['AUTH_USER_CACHE_TTL'],
+            config['AUTH_NEGATIVE_CACHE_TTL'],
+            config['LOGIN_IP_LIMIT'],
+            config['LOGIN_USER_LIMIT'],
+            config['LOGIN_RATE_WINDOW'],
+        )
+
+    def find_user(self, username):
+        user = self.users.get(f'user:{username}')
+        if user is None:
+            user = User.find_by_username(self.mongo, username) or _MISSING
+            self.users.set(f'user:{username}', user, self.cache_ttl if user is not _MISSING else self.negative_ttl)
+        return None if user is _MISSING else user
+
+    def forget(self, username):
+        self.users.delete(f'user:{username}')
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.hash_params
+
+    # Returns the user document, or None for bad credentials
+    def authenticate(self, username, password, remote_addr=None):
+        ip_key, user_key = f'ip:{remote_addr}', f'user:{username}'
+        retry_after = max(self.ip_limiter.blocked(ip_key), self.user_limiter.blocked(user_key))
+        if retry_after:
+            raise RateLimited(retry_after)
+
+        user = self.find_user(username) if username and password else None
+        if not user or not run_blocking(check_password_hash, user['password'], password):
+            self.ip_limiter.hit(ip_key)
+            self.user_limiter.hit(user_key)
+            return None
+
+        self.user_limiter.reset(user_key)
+        if self.needs_rehash(user['password']):
+            password_hash = run_blocking(generate_password_hash, password, self.hash_method)
+            self.mongo.db.users.update_one({'_id': user['_id'], 'password': user['password']}, {'$set': {'password': password_hash}})
+            self.forget(username)
+        return user
+
+    # Returns False if the username is taken
+    def register(self, username, password, role='user'):
+        if User.find_by_username(self.mongo, username):
+            return False
+        try:
+            run_blocking(User, username, password, role, self.hash_method).save(self.mongo)
+        except DuplicateKeyError:
+            return False
+        self.forget(username)
+        return True
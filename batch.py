@@ -0,0 +1,171 @@
+from datetime import datetime
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from pymongo import DeleteOne, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from models import Entry, Task, Goal, Habit, Mood, ClassSchedule, Gratitude, TimeCapsule, Tombstone, notify_write
+
+# URL names of the resources, as used by the per-resource routes
+RESOURCES = {
+    'entries': Entry,
+    'tasks': Task,
+    'goals': Goal,
+    'habits': Habit,
+    'moods': Mood,
+    'classes': ClassSchedule,
+    'gratitude': Gratitude,
+    'timecapsule': TimeCapsule,
+}
+OPERATIONS = ('create', 'update', 'delete')
+
+
+class BatchError(ValueError):
+    pass
+
+
+def _parse(index, operation):
+    if not isinstance(operation, dict):
+        raise BatchError('Operation must be an object')
+    model = RESOURCES.get(operation.get('resource'))
+    if model is None:
+        raise BatchError('Unknown resource')
+    if operation.get('op') not in OPERATIONS:
+        raise BatchError('Unknown op')
+    data = operation.get('data') or {}
+    if not isinstance(data, dict):
+        raise BatchError('data must be an object')
+
+    object_id = None
+    if operation['op'] != 'create':
+        try:
+            object_id = ObjectId(operation.get('id'))
+        except (InvalidId, TypeError):
+            raise BatchError('Invalid id')
+    return {'index': index, 'model': model, 'op': operation['op'], 'id': object_id, 'data': data}
+
+
+def _write(parsed, user_id, prepare):
+    model, data = parsed['model'], parsed['data']
+    query = {'_id': parsed['id'], 'user_id': user_id}
+    if parsed['op'] == 'delete':
+        return DeleteOne(query)
+
+    # prepare lets the caller transform fields before they are written,
+    # e.g. encrypting entry content
+    fields = model.normalize_fields({f: data[f] for f in model.UPDATABLE if f in data})
+    if prepare and model in prepare:
+        fields = prepare[model](fields)
+
+    if parsed['op'] == 'create':
+        doc = model.from_data(user_id, data).to_bson()
+        doc.update(fields)
+        doc['_id'] = parsed['id'] = ObjectId()
+        parsed['doc'] = doc
+        return InsertOne(doc)
+    if not fields:
+        return None
+    return UpdateOne(query, {'$set': dict(fields, updated_at=datetime.utcnow()), '$inc': {'version': 1}})
+
+
+def _apply(mongo, model, group, user_id, ordered, prepare, results):
+    collection = mongo.db[model.COLLECTION]
+    ids = [parsed['id'] for parsed in group if parsed['id'] is not None]
+    owned = {}
+    if ids:
+        query = {'_id': {'$in': ids}, 'user_id': user_id}
+        owned = {doc['_id']: doc for doc in collection.find(query, {model.SORT_FIELD: 1})}
+        missing = [object_id for object_id in ids if object_id not in owned]
+        if missing and model.restore_archived(mongo, user_id, missing):
+            owned = {doc['_id']: doc for doc in collection.find(query, {model.SORT_FIELD: 1})}
+
+    ok = True
+    requests, pending = [], []
+    for parsed in group:
+        if parsed['op'] != 'create' and parsed['id'] not in owned:
+            results[parsed['index']] = {'status': 404, 'message': 'Not found'}
+            ok = False
+            if ordered:
+                break
+            continue
+        try:
+            request = _write(parsed, user_id, prepare)
+        except ValueError as e:
+            results[parsed['index']] = {'status': 400, 'message': str(e)}
+            ok = False
+            if ordered:
+                break
+            continue
+        if request is None:
+            results[parsed['index']] = {'status': 200, 'id': parsed['id']}
+        else:
+            requests.append(request)
+            pending.append(parsed)
+
+    errors = {}
+    if requests:
+        try:
+            collection.bulk_write(requests, ordered=ordered)
+        except BulkWriteError as e:
+            errors = {error['index']: error for error in e.details.get('writeErrors', [])}
+            ok = False
+
+    # In ordered mode nothing after the first write error was executed
+    last = min(errors) if ordered and errors else len(pending)
+    written, deleted = [], []
+    for position, parsed in enumerate(pending):
+        if position in errors:
+            results[parsed['index']] = {'status': 409, 'message': errors[position].get('errmsg')}
+        elif position < last:
+            status = 201 if parsed['op'] == 'create' else 200
+            results[parsed['index']] = {'status': status, 'id': parsed['id']}
+            written.append(parsed.get('doc') or owned[parsed['id']])
+            if parsed['op'] == 'delete':
+                deleted.append(parsed['id'])
+
+    if deleted:
+        Tombstone.record(mongo, model.COLLECTION, user_id, deleted)
+        after_bulk_delete = getattr(model, 'after_bulk_delete', None)
+        if after_bulk_delete:
+            after_bulk_delete(mongo, user_id, deleted)
+    if written:
+        after_bulk_write = getattr(model, 'after_bulk_write', None)
+        if after_bulk_write:
+            after_bulk_write(mongo, user_id, written)
+        notify_write(model.COLLECTION, user_id, [doc['_id'] for doc in written])
+    return ok
+
+
+# Apply a list of {resource, op, id, data} operations for one user.
+# Ownership of referenced documents is checked with one $in query per
+# collection and the writes go out as one bulk_write per collection. Ordered
+# batches run consecutive same-resource operations together and stop at the
+# first failure; anything not attempted is reported as 424.
+def run_batch(mongo, user_id, operations, ordered=True, prepare=None):
+    results = [None] * len(operations)
+    parsed_ops = []
+    for index, operation in enumerate(operations):
+        try:
+            parsed_ops.append(_parse(index, operation))
+        except BatchError as e:
+            results[index] = {'status': 400, 'message': str(e)}
+            if ordered:
+                break
+
+    groups = []
+    for parsed in parsed_ops:
+        if ordered and groups and groups[-1][0] is parsed['model']:
+            groups[-1][1].append(parsed)
+        elif ordered:
+            groups.append((parsed['model'], [parsed]))
+        else:
+            group = next((g for g in groups if g[0] is parsed['model']), None)
+            if group is None:
+                groups.append((parsed['model'], [parsed]))
+            else:
+                group[1].append(parsed)
+
+    for model, group in groups:
+        if not _apply(mongo, model, group, user_id, ordered, prepare, results) and ordered:
+            break
+
+    return [result or {'status': 424, 'message': 'Not attempted'} for result in results]
@@ -0,0 +1,66 @@
+# Microbenchmark for utils.decrypt_many: serial vs thread pool vs process pool
+# across batch sizes, reporting the smallest batch where each pool wins.
+#
+#   python benchmarks/bench_decrypt.py [--workers 4] [--content-size 2000]
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.fernet import Fernet, MultiFernet
+from utils import decrypt_many
+
+BATCH_SIZES = [16, 64, 128, 256, 512, 1024, 4096, 16384]
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--chunk-size', type=int, default=128)
+    parser.add_argument('--content-size', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    cipher = MultiFernet([Fernet(Fernet.generate_key())])
+    plaintext = 'x' * args.content_size
+    tokens = [cipher.encrypt(plaintext.encode('utf-8')) for _ in range(max(BATCH_SIZES))]
+
+    results = []
+    for size in BATCH_SIZES:
+        batch = tokens[:size]
+        row = {'batch': size}
+        row['serial'] = best_of(lambda: decrypt_many(batch, cipher, workers=1), args.repeat)
+        for executor in ('thread', 'process'):
+            row[executor] = best_of(lambda: decrypt_many(
+                batch, cipher, workers=args.workers, executor=executor,
+                chunk_size=args.chunk_size, min_parallel=0,
+            ), args.repeat)
+        results.append(row)
+
+    crossover = {
+        executor: next((row['batch'] for row in results if row[executor] < row['serial']), None)
+        for executor in ('thread', 'process')
+    }
+    print(json.dumps({
+        'workers': args.workers,
+        'chunk_size': args.chunk_size,
+        'content_size': args.content_size,
+        'results': results,
+        'crossover': crossover,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
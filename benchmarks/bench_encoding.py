@@ -0,0 +1,95 @@
+# Microbenchmark for list response encodings: JSON vs MessagePack, each
+# plain, gzip and zstd, reporting wire size and encode time per page size.
+#
+#   python benchmarks/bench_encoding.py [--content-size 2000] [--repeat 5]
+import argparse
+import gzip
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import zstandard
+from bson import ObjectId
+from encoding import dumps, packb
+
+PAGE_SIZES = [1, 20, 100, 500]
+TAGS = ['work', 'family', 'travel', 'health', 'reading', 'music']
+WORDS = ('today i went to the park with friends and we talked about work music books '
+         'dinner weather walk tired happy plans tomorrow morning coffee class notes').split()
+
+
+# Entry-shaped rows with varied prose, as the list endpoints return them
+def make_rows(count, content_size, seed=0):
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    rows = []
+    for i in range(count):
+        words = [rng.choice(WORDS) for _ in range(content_size // 6)]
+        rows.append({
+            '_id': ObjectId(),
+            'user_id': 'bench-user',
+            'title': f'Entry {i}',
+            'content': ' '.join(words),
+            'tags': TAGS[i % len(TAGS):i % len(TAGS) + 2],
+            'timestamp': now - timedelta(hours=i),
+            'version': 1,
+        })
+    return rows
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--content-size', type=int, default=2000)
+    parser.add_argument('--gzip-level', type=int, default=6)
+    parser.add_argument('--zstd-level', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    zstd = zstandard.ZstdCompressor(level=args.zstd_level)
+    compressors = {
+        'identity': lambda data: data,
+        'gzip': lambda data: gzip.compress(data, args.gzip_level, mtime=0),
+        'zstd': zstd.compress,
+    }
+    formats = {
+        'json': lambda rows: dumps(rows).encode('utf-8'),
+        'msgpack': packb,
+    }
+    results = []
+    for size in PAGE_SIZES:
+        rows = make_rows(size, args.content_size)
+        for fmt, encode in formats.items():
+            body = encode(rows)
+            for encoding, compress in compressors.items():
+                results.append({
+                    'page': size,
+                    'format': fmt,
+                    'encoding': encoding,
+                    'bytes': len(compress(body)),
+                    'seconds': best_of(lambda: compress(encode(rows)), args.repeat),
+                })
+
+    print(json.dumps({
+        'content_size': args.content_size,
+        'gzip_level': args.gzip_level,
+        'zstd_level': args.zstd_level,
+        'results': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+# Storage backend conformance and latency. Replays one scripted session
+# (register, login, creates, paged lists, updates with version checks,
+# check-ins, stats, search, timeline, sync, batch writes, deletes and the
+# usual error cases) against the Flask app on the reference backend and on
+# the SQLite backend, then compares every response. Ids, timestamps and
+# cursors differ between runs, so ids are numbered in order of appearance
+# and timestamps are blanked before comparing.
+#
+#   python benchmarks/bench_storage.py                                   # mongomock vs SQLite
+#   python benchmarks/bench_storage.py --mongo-uri mongodb://localhost:27017/diary_conformance
+#
+# Prints per-request latency (p50/p95 by route) for both backends as JSON.
+# The exit status is 1 if any response differs.
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from config import Config
+from indexes import ensure_indexes, ensure_validators
+
+OBJECT_ID = re.compile(r'^[0-9a-f]{24}$')
+TIMESTAMP = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}')
+# Steps whose routes read without a sort, so order is up to the backend
+UNORDERED = {'habit_stats'}
+
+BODIES = {
+    'entries': lambda i: {'title': f'Entry {i}', 'content': f'Walked to the lake, day {i}', 'tags': ['walk', f't{i % 3}']},
+    'tasks': lambda i: {'title': f'Task {i}', 'description': 'Something to do', 'due_date': f'2030-01-{i % 28 + 1:02d}'},
+    'goals': lambda i: {'title': f'Goal {i}', 'description': 'Get there', 'milestones': ['start', 'finish']},
+    'habits': lambda i: {'title': f'Habit {i}', 'frequency': ('daily', 'weekly')[i % 2], 'goal': 10},
+    'moods': lambda i: {'mood': ('happy', 'calm', 'sad', 'tired')[i % 4], 'note': f'note {i}', 'rating': i % 5 + 1},
+    'classes': lambda i: {'course_name': f'Course {i}', 'start_time': '09:00', 'end_time': '10:00', 'days_of_week': ['Mon', 'Wed']},
+    'gratitude': lambda i: {'content': f'Grateful for the lake, day {i}', 'tags': ['lake']},
+    'timecapsule': lambda i: {'content': f'Capsule {i}', 'open_date': f'20{30 + i % 5}-01-01T00:00:00Z'},
+}
+
+
+def make_app(backend, args):
+    class ConformanceConfig(Config):
+        MONGO_URI = args.mongo_uri if backend == 'mongo' else 'mongodb://localhost:27017/diary_conformance'
+        STORAGE_BACKEND = 'sqlite' if backend == 'sqlite' else 'mongo'
+        SQLITE_PATH = args.sqlite_path
+        ENSURE_INDEXES = False
+        CACHE_BACKEND = 'none'
+        METRICS_ENABLED = False
+        LOGIN_IP_LIMIT = 10 ** 9
+        CAPSULE_SCHEDULER = False
+        REMINDER_ENGINE = False
+        JOB_BROKER = 'eager'
+        COMPRESS_MIN_BYTES = 0
+        SYNC_OVERLAP_SECONDS = 0
+
+    mongo = None
+    if backend == 'memory':
+        import mongomock
+        client = mongomock.MongoClient()
+        mongo = SimpleNamespace(cx=client, db=client.diary_conformance)
+    elif backend == 'sqlite':
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.sqlite_path + suffix):
+                os.remove(args.sqlite_path + suffix)
+    app = create_app(ConformanceConfig, mongo)
+
+    mongo = app.extensions['mongo']
+    mongo.cx.drop_database(mongo.db.name)
+    if backend != 'memory':
+        ensure_indexes(mongo.db)
+        ensure_validators(mongo.db)
+    return app
+
+
+# Runs the session through call(step, method, path, ...), which sends and
+# records each request. Later requests use ids and cursors taken from
+# earlier responses, so each backend is driven by its own data.
+def session(call, args):
+    tokens = []
+    for n in range(args.users):
+        credentials = {'username': f'user{n}', 'password': 'conformance'}
+        call('register', 'POST', '/register', json=credentials)
+        response = call('login', 'POST', '/login', json=credentials)
+        tokens.append({'Authorization': f"Bearer {response.get_json()['access_token']}"})
+    call('register_duplicate', 'POST', '/register', json={'username': 'user0', 'password': 'x'})
+    call('login_wrong_password', 'POST', '/login', json={'username': 'user0', 'password': 'wrong'})
+
+    for headers in tokens:
+        for name, body in BODIES.items():
+            for i in range(args.docs):
+                call(f'create_{name}', 'POST', f'/{name}', json=body(i), headers=headers)
+
+        ids = {}
+        for name in BODIES:
+            query, items = f'?limit={args.page_size}', []
+            while True:
+                response = call(f'list_{name}', 'GET', f'/{name}{query}', headers=headers)
+                items += response.get_json()
+                cursor = response.headers.get('X-Next-Cursor')
+                if not cursor:
+                    break
+                query = f'?limit={args.page_size}&cursor={cursor}'
+            ids[name] = [item.get('id') or item['_id'] for item in items]
+            call(f'list_{name}_fields', 'GET', f'/{name}?limit=3&fields=user_id', headers=headers)
+
+        for name in BODIES:
+            for i, doc_id in enumerate(ids[name][:args.docs // 2]):
+                call(f'update_{name}', 'PUT', f'/{name}/{doc_id}', json=BODIES[name](i + 100), headers=headers)
+            # Time capsules only list once opened
+            for doc_id in ids[name][-1:]:
+                call(f'update_{name}_version', 'PUT', f'/{name}/{doc_id}', json=dict(BODIES[name](7), version=1), headers=headers)
+                call(f'update_{name}_stale', 'PUT', f'/{name}/{doc_id}', json=dict(BODIES[name](8), version=1), headers=headers)
+            call(f'update_{name}_missing', 'PUT', f'/{name}/{"0" * 24}', json=BODIES[name](9), headers=headers)
+        for doc_id in ids['habits'][:3]:
+            call('checkin_habit', 'POST', f'/habits/{doc_id}/checkin', json={'amount': 2}, headers=headers)
+
+        call('mood_stats', 'GET', '/moods/stats', headers=headers)
+        call('mood_stats_week', 'GET', '/moods/stats?granularity=week', headers=headers)
+        call('habit_stats', 'GET', '/habits/stats', headers=headers)
+        call('search', 'GET', '/search?q=lake', headers=headers)
+        call('timeline', 'GET', '/timeline?limit=20', headers=headers)
+        # Sync tokens are times; keep earlier writes clear of the token
+        # (SYNC_OVERLAP_SECONDS is 0) and later ones after it
+        time.sleep(0.01)
+        response = call('sync', 'GET', '/sync', headers=headers)
+        time.sleep(0.01)
+        since = response.get_json().get('next') if response.status_code == 200 else None
+
+        call('batch', 'POST', '/batch', json={'ordered': False, 'operations': [
+            {'resource': 'tasks', 'op': 'create', 'data': BODIES['tasks'](50)},
+            {'resource': 'entries', 'op': 'update', 'id': ids['entries'][0], 'data': {'title': 'Batched'}},
+            {'resource': 'goals', 'op': 'delete', 'id': ids['goals'][0]},
+            {'resource': 'goals', 'op': 'delete', 'id': ids['goals'][0]},
+        ]}, headers=headers)
+
+        for name in BODIES:
+            for doc_id in ids[name][-(args.docs // 3):]:
+                call(f'delete_{name}', 'DELETE', f'/{name}/{doc_id}', headers=headers)
+            call(f'delete_{name}_missing', 'DELETE', f'/{name}/{"0" * 24}', headers=headers)
+        if since:
+            call('sync_delta', 'GET', f'/sync?since={since}', headers=headers)
+        call('list_entries_after', 'GET', '/entries', headers=headers)
+
+
+# Ids become id1, id2, ... in order of first appearance; timestamps and
+# opaque tokens are dropped
+def normalize(value, ids):
+    if isinstance(value, dict):
+        return {key: normalize(item, ids) for key, item in value.items()
+                if key not in ('access_token', 'next', 'ping_ms')}
+    if isinstance(value, list):
+        return [normalize(item, ids) for item in value]
+    if isinstance(value, str):
+        if OBJECT_ID.match(value):
+            return ids.setdefault(value, f'id{len(ids) + 1}')
+        if TIMESTAMP.match(value):
+            return '<timestamp>'
+    if isinstance(value, float):
+        return round(value, 6)
+    return value
+
+
+def run(backend, args):
+    app = make_app(backend, args)
+    client = app.test_client()
+    ids, transcript, latencies = {}, [], {}
+
+    def call(name, method, path, **kwargs):
+        start = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+        body = response.get_json(silent=True)
+        if name in UNORDERED and isinstance(body, list):
+            body = sorted(body, key=lambda item: json.dumps(item, sort_keys=True))
+        transcript.append((name, response.status_code, normalize(body, ids), 'X-Next-Cursor' in response.headers))
+        return response
+
+    session(call, args)
+    if backend == 'sqlite':
+        app.extensions['mongo'].close()
+    return transcript, latencies
+
+
+def summarize(latencies):
+    summary = {}
+    for name, values in sorted(latencies.items()):
+        values = sorted(values)
+        summary[name] = {
+            'requests': len(values),
+            'p50_ms': round(values[len(values) // 2] * 1000, 3),
+            'p95_ms': round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 3),
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mongo-uri', default='memory', help="reference backend: a MongoDB URI or 'memory' for mongomock")
+    parser.add_argument('--sqlite-path', default=os.path.join(tempfile.gettempdir(), 'diary_conformance.sqlite3'))
+    parser.add_argument('--users', type=int, default=2)
+    parser.add_argument('--docs', type=int, default=30, help='documents created per resource and user')
+    parser.add_argument('--page-size', type=int, default=7)
+    args = parser.parse_args()
+
+    reference = 'memory' if args.mongo_uri == 'memory' else 'mongo'
+    expected, reference_latencies = run(reference, args)
+    actual, sqlite_latencies = run('sqlite', args)
+
+    mismatches, skipped = [], 0
+    for index, (want, got) in enumerate(zip(expected, actual)):
+        if reference == 'memory' and want[1] == 500:
+            # mongomock lacks some operators (e.g. $dateTrunc)
+            skipped += 1
+        elif want != got:
+            mismatches.append({'step': index, 'name': want[0], reference: want[1:], 'sqlite': got[1:]})
+    if len(expected) != len(actual):
+        mismatches.append({'steps': {reference: len(expected), 'sqlite': len(actual)}})
+
+    print(json.dumps({
+        'config': {'reference': reference, 'users': args.users, 'docs': args.docs, 'page_size': args.page_size},
+        'requests': len(expected),
+        'mismatches': len(mismatches),
+        'skipped': skipped,
+        'latency': {reference: summarize(reference_latencies), 'sqlite': summarize(sqlite_latencies)},
+    }, indent=2))
+    for mismatch in mismatches[:20]:
+        print(f'MISMATCH {json.dumps(mismatch, default=str)}', file=sys.stderr)
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+# Load test: the threaded Flask server (sync, PyMongo) vs the ASGI entry
+# point (async, Motor) over the same routes and data. Seeds a throwaway
+# database, starts each server as a subprocess, drives it with concurrent
+# keep-alive clients and prints requests/sec and latency percentiles as JSON.
+#
+# Against a local mongod; the database named in the URI is dropped first:
+#   mongod --dbpath /tmp/bench-db --port 27017
+#   python benchmarks/load_test.py --mongo-uri mongodb://localhost:27017/diary_bench
+#
+# Or against an in-memory fake (mongomock), with no mongod at all. Each
+# server process seeds its own copy and the async mode reaches it through
+# bridge.ThreadedClient in place of Motor, so this compares the serving
+# models rather than the drivers. One worker per mode.
+#   python benchmarks/load_test.py --mongo-uri memory
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PATHS = ['/tasks', '/moods', '/entries', '/gratitude?limit=20']
+
+
+def server_command(mode, args):
+    if args.mongo_uri == 'memory':
+        return [
+            sys.executable, os.path.abspath(__file__), '--serve', mode, '--mongo-uri', 'memory',
+            '--port', str(args.port), '--users', str(args.users), '--docs', str(args.docs),
+        ]
+    if mode == 'sync':
+        return [sys.executable, '-m', 'flask', '--app', 'app:create_app()', 'run', '--port', str(args.port), '--with-threads']
+    return [
+        sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(args.port),
+        '--workers', str(args.workers), '--log-level', 'warning',
+    ]
+
+
+# mongomock with the rest of the store interface (ping, pool_stats, close)
+class MemoryStore:
+    def __init__(self):
+        import mongomock
+        self.cx = mongomock.MongoClient()
+        self.db = self.cx.diary_bench
+
+    def ping(self, timeout=1.0):
+        return 0.0
+
+    def pool_stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Server on port {port} did not start')
+
+
+# Users with a spread of documents in each listed collection; returns tokens
+def seed(app, users, docs):
+    from flask_jwt_extended import create_access_token
+    from models import Entry, Gratitude, Mood, Task, User
+
+    mongo, keystore = app.extensions['mongo'], app.extensions['keystore']
+    mongo.cx.drop_database(mongo.db.name)
+    tokens = []
+    with app.app_context():
+        for n in range(users):
+            user_id = str(User(f'bench{n}', 'password').save(mongo).inserted_id)
+            mongo.db.tasks.insert_many([
+                Task.from_data(user_id, {'title': f'task {i}', 'description': 'x' * 200}).to_bson() for i in range(docs)
+            ])
+            mongo.db.moods.insert_many([
+                Mood.from_data(user_id, {'mood': 'calm', 'rating': i % 5}).to_bson() for i in range(docs)
+            ])
+            mongo.db.gratitude.insert_many([
+                Gratitude.from_data(user_id, {'content': f'thankful for {i}'}).to_bson() for i in range(docs)
+            ])
+            entries = []
+            for i in range(docs):
+                content, key_id = keystore.encrypt(user_id, 'dear diary ' * 50)
+                entries.append(Entry(user_id, f'entry {i}', content, ['bench'], key_id).to_bson())
+            mongo.db.entries.insert_many(entries)
+            tokens.append(create_access_token(identity=user_id))
+    return tokens
+
+
+# --serve: one server on its own seeded in-memory store. The tokens go to
+# stdout as the first line, for the driver.
+def serve(mode, args):
+    from app import create_app
+    from config import Config
+
+    store = MemoryStore()
+    if mode == 'sync':
+        app = create_app(Config, store)
+    else:
+        from bridge import BridgedMongo, ThreadedClient
+        app = create_app(Config, BridgedMongo(store, ThreadedClient(store)))
+    print(json.dumps(seed(app, args.users, args.docs)), flush=True)
+    if mode == 'sync':
+        app.run(port=args.port, threaded=True)
+    else:
+        import uvicorn
+        from asgi import AsgiApp
+        uvicorn.run(AsgiApp(app), port=args.port, log_level='warning')
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def drive(port, tokens, paths, concurrency, duration):
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(worker):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local, failed, n = [], 0, worker
+        while time.monotonic() < deadline:
+            path = paths[n % len(paths)]
+            headers = {'Authorization': f'Bearer {tokens[n % len(tokens)]}'}
+            n += concurrency
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                continue
+            local.append(time.perf_counter() - start)
+        connection.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000 if latencies else None,
+        'p95_ms': percentile(latencies, 0.95) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+
+
+def run_mode(mode, args, tokens, env):
+    process = subprocess.Popen(
+        server_command(mode, args), cwd=ROOT, env=env,
+        stdout=subprocess.PIPE if tokens is None else subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        if tokens is None:
+            tokens = json.loads(process.stdout.readline())
+        wait_for_port(args.port)
+        drive(args.port, tokens, args.paths, args.concurrency, args.warmup)
+        return drive(args.port, tokens, args.paths, args.concurrency, args.duration)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/diary_bench', help="or 'memory' for mongomock")
+    parser.add_argument('--modes', default='sync,async')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--docs', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--paths', default=','.join(PATHS))
+    parser.add_argument('--cache', default='none', help='CACHE_BACKEND for both servers')
+    parser.add_argument('--serve', choices=['sync', 'async'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.paths = args.paths.split(',')
+    sys.path.insert(0, ROOT)
+    if args.serve:
+        return serve(args.serve, args)
+
+    # Servers and the seeding step must share the database and JWT secret
+    env = dict(os.environ, MONGO_URI=args.mongo_uri, CACHE_BACKEND=args.cache)
+    env.setdefault('JWT_SECRET_KEY', 'load-test-secret')
+    tokens = None
+    if args.mongo_uri == 'memory':
+        # Nothing in the background to contend for the fake store
+        env.update(ENSURE_INDEXES='0', CAPSULE_SCHEDULER='0', REMINDER_ENGINE='0', JOB_BROKER='memory')
+    else:
+        os.environ.update(env)
+        from app import create_app
+        tokens = seed(create_app(), args.users, args.docs)
+
+    results = {mode: run_mode(mode, args, tokens, env) for mode in args.modes.split(',')}
+    print(json.dumps({
+        'backend': 'memory' if args.mongo_uri == 'memory' else 'mongo',
+        'users': args.users,
+        'docs_per_collection': args.docs,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'paths': args.paths,
+        'results': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
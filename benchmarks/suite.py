@@ -0,0 +1,336 @@
+# Benchmark suite for the API hot paths. Seeds a database with a realistic
+# spread of users (many light users, a few heavy ones with tens of
+# thousands of entries and moods), then drives the real Flask app in-process
+# through its test client and prints throughput, p50/p95/p99 latency per
+# scenario and the peak RSS as JSON.
+#
+#   python benchmarks/suite.py --mongo-uri mongodb://localhost:27017/diary_bench
+#   python benchmarks/suite.py --mongo-uri memory --scale 0.05   # needs mongomock
+#   python benchmarks/suite.py --mongo-uri sqlite:///tmp/diary_bench.sqlite3
+#
+# The database named in the URI (or the SQLite file) is dropped first.
+# With --baseline, results are compared against an earlier run and the exit
+# status is 1 if any scenario regressed by more than --tolerance.
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_jwt_extended import create_access_token
+from app import create_app
+from config import Config
+from indexes import ensure_indexes
+from models import User, Entry, Task, Goal, Habit, Mood, ClassSchedule, Gratitude, TimeCapsule
+
+PASSWORD = 'benchmark-password'
+INSERT_BATCH = 5000
+
+# URL name -> (model, request body for creates and updates)
+RESOURCES = {
+    'entries': (Entry, {'title': 'Bench entry', 'content': 'Dear diary, ' * 40, 'tags': ['bench']}),
+    'tasks': (Task, {'title': 'Bench task', 'description': 'Something to do'}),
+    'goals': (Goal, {'title': 'Bench goal', 'description': 'Get there', 'milestones': ['start', 'finish']}),
+    'habits': (Habit, {'title': 'Bench habit', 'frequency': 'daily', 'goal': 10}),
+    'moods': (Mood, {'mood': 'calm', 'note': 'fine', 'rating': 4}),
+    'classes': (ClassSchedule, {'course_name': 'Bench 101', 'start_time': '09:00', 'end_time': '10:00', 'days_of_week': ['Mon']}),
+    'gratitude': (Gratitude, {'content': 'Grateful for fast endpoints', 'tags': ['bench']}),
+    'timecapsule': (TimeCapsule, {'content': 'Open me later', 'open_date': '2030-01-01T00:00:00Z'}),
+}
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def make_app(args):
+    memory = args.mongo_uri == 'memory'
+    sqlite_path = args.mongo_uri[len('sqlite://'):] if args.mongo_uri.startswith('sqlite://') else None
+    if sqlite_path:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(sqlite_path + suffix):
+                os.remove(sqlite_path + suffix)
+
+    class BenchConfig(Config):
+        MONGO_URI = 'mongodb://localhost:27017/diary_bench' if memory or sqlite_path else args.mongo_uri
+        STORAGE_BACKEND = 'sqlite' if sqlite_path else 'mongo'
+        SQLITE_PATH = sqlite_path
+        ENSURE_INDEXES = False
+        CACHE_BACKEND = args.cache
+        METRICS_ENABLED = False
+        LOGIN_IP_LIMIT = 10 ** 9
+        CAPSULE_SCHEDULER = False
+        REMINDERS_ENABLED = False
+        # Secondary work inline, so runs stay comparable with older baselines
+        JOB_BROKER = 'eager'
+
+    mongo = None
+    if memory:
+        import mongomock
+        client = mongomock.MongoClient()
+        mongo = SimpleNamespace(cx=client, db=client.diary_bench)
+    app = create_app(BenchConfig, mongo)
+
+    mongo = app.extensions['mongo']
+    mongo.cx.drop_database(mongo.db.name)
+    if not memory:
+        ensure_indexes(mongo.db)
+    return app
+
+
+def insert(collection, docs):
+    ids = []
+    for start in range(0, len(docs), INSERT_BATCH):
+        ids.extend(collection.insert_many(docs[start:start + INSERT_BATCH], ordered=False).inserted_ids)
+    return ids
+
+
+def _backdate(doc, field, minutes):
+    doc[field] = doc['updated_at'] = doc[field] - timedelta(minutes=minutes)
+    return doc
+
+
+def seed_user_documents(mongo, keystore, user_id, count, capsules):
+    entries = []
+    for i in range(count):
+        content, key_id = keystore.encrypt(user_id, f'Entry {i}: ' + 'Today I wrote some benchmark text. ' * 12)
+        entries.append(_backdate(Entry(user_id, f'Entry {i}', content, ['daily', f'tag{i % 20}'], key_id).to_bson(), 'timestamp', i))
+    insert(mongo.db.entries, entries)
+    insert(mongo.db.moods, [
+        _backdate(Mood(user_id, ('happy', 'calm', 'sad', 'tired')[i % 4], '', i % 5 + 1).to_bson(), 'date', i * 30)
+        for i in range(count)
+    ])
+
+    now = datetime.utcnow()
+    insert(mongo.db.timecapsule, [
+        TimeCapsule(user_id, f'Capsule {i}', now + timedelta(days=(i % 2) * 365 - 180)).to_bson()
+        for i in range(capsules)
+    ])
+
+
+# Light users get a handful of documents in every collection; the first
+# heavy_users users get heavy_docs entries and moods each
+def seed(app, args):
+    mongo, keystore = app.extensions['mongo'], app.extensions['keystore']
+    # Hash the password once; every user shares it
+    template = User('template', PASSWORD).to_bson()
+    user_ids = [str(i) for i in insert(mongo.db.users, [dict(template, username=f'user{n}') for n in range(args.users)])]
+
+    for n, user_id in enumerate(user_ids):
+        heavy = n < args.heavy_users
+        seed_user_documents(mongo, keystore, user_id, args.heavy_docs if heavy else args.light_docs, 1000 if heavy else 2)
+
+    light = user_ids[args.heavy_users:]
+    for name in ('tasks', 'goals', 'habits', 'classes', 'gratitude'):
+        model, data = RESOURCES[name]
+        insert(mongo.db[model.COLLECTION], [
+            model.from_data(user_id, data).to_bson() for user_id in light for _ in range(args.light_docs)
+        ])
+    return user_ids
+
+
+# Documents owned by one user for the update and delete scenarios
+def seed_crud_pool(app, user_id, size):
+    mongo = app.extensions['mongo']
+    pools = {}
+    for name, (model, data) in RESOURCES.items():
+        if model is Entry:
+            content, key_id = app.extensions['keystore'].encrypt(user_id, data['content'])
+            docs = [Entry(user_id, data['title'], content, data['tags'], key_id).to_bson() for _ in range(size)]
+        else:
+            docs = [model.from_data(user_id, data).to_bson() for _ in range(size)]
+        pools[name] = [str(i) for i in insert(mongo.db[model.COLLECTION], docs)]
+    return pools
+
+
+def scenarios(app, args, user_ids):
+    heavy = user_ids[:max(args.heavy_users, 1)]
+    light = user_ids[len(heavy):] or heavy
+    crud_user = light[-1]
+    pools = seed_crud_pool(app, crud_user, args.iterations + args.warmup)
+    rng = random.Random(args.seed)
+    tokens = {}
+
+    def auth(user_id):
+        if user_id not in tokens:
+            with app.app_context():
+                tokens[user_id] = create_access_token(identity=user_id)
+        return {'Authorization': f'Bearer {tokens[user_id]}'}
+
+    def login(i):
+        return 'POST', '/login', {'username': f'user{rng.randrange(len(user_ids))}', 'password': PASSWORD}, {}
+
+    def list_first_page(path):
+        def request(i):
+            return 'GET', path, None, auth(heavy[i % len(heavy)])
+        return request
+
+    # Walk one heavy user's entries page by page, wrapping at the end
+    cursor = {'next': None}
+
+    def list_entries_deep(i):
+        query = f'?limit={args.page_size}' + (f'&cursor={cursor["next"]}' if cursor['next'] else '')
+        return 'GET', '/entries' + query, None, auth(heavy[0])
+
+    def after_deep(response):
+        cursor['next'] = response.headers.get('X-Next-Cursor')
+
+    def light_lists(i):
+        path = ('/tasks', '/goals', '/habits', '/gratitude', '/classes')[i % 5]
+        return 'GET', path, None, auth(light[rng.randrange(len(light))])
+
+    def create(name):
+        def request(i):
+            return 'POST', f'/{name}', RESOURCES[name][1], auth(crud_user)
+        return request
+
+    def update(name):
+        def request(i):
+            return 'PUT', f'/{name}/{pools[name][i % len(pools[name])]}', RESOURCES[name][1], auth(crud_user)
+        return request
+
+    def delete(name):
+        def request(i):
+            return 'DELETE', f'/{name}/{pools[name].pop()}', None, auth(crud_user)
+        return request
+
+    page = f'?limit={args.page_size}'
+    plan = [
+        ('login', login, None, args.login_iterations),
+        ('list_entries', list_first_page('/entries' + page), None, args.iterations),
+        ('list_entries_deep', list_entries_deep, after_deep, args.iterations),
+        ('list_moods', list_first_page('/moods' + page), None, args.iterations),
+        ('list_timecapsule', list_first_page('/timecapsule' + page), None, args.iterations),
+        ('list_light_users', light_lists, None, args.iterations),
+    ]
+    for name in RESOURCES:
+        plan.append((f'create_{name}', create(name), None, args.iterations))
+        plan.append((f'update_{name}', update(name), None, args.iterations))
+    for name in RESOURCES:
+        plan.append((f'delete_{name}', delete(name), None, args.iterations))
+    return plan
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure(client, request, after, iterations, warmup):
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    for i in range(warmup + iterations):
+        method, path, body, headers = request(i)
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body, headers=headers)
+        elapsed = time.perf_counter() - start
+        if after:
+            after(response)
+        if i < warmup:
+            started = time.perf_counter()
+            continue
+        latencies.append(elapsed)
+        if response.status_code >= 400:
+            errors += 1
+    total = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': iterations,
+        'errors': errors,
+        'throughput': round(iterations / total, 1) if total else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            found.append(f'{name}: p95 {previous["p95_ms"]}ms -> {current["p95_ms"]}ms')
+        if previous['throughput'] and current['throughput'] < previous['throughput'] * (1 - tolerance):
+            found.append(f'{name}: throughput {previous["throughput"]} -> {current["throughput"]} req/s')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/diary_bench', help="or 'memory' for mongomock, sqlite:///path for SQLite")
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--heavy-users', type=int, default=3)
+    parser.add_argument('--heavy-docs', type=int, default=50000, help='entries and moods per heavy user')
+    parser.add_argument('--light-docs', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies --users and --heavy-docs')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--login-iterations', type=int, default=20, help='logins verify a slow password hash')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--cache', default='none', help='CACHE_BACKEND: none, memory or mongo')
+    parser.add_argument('--only', default=None, help='comma-separated scenario names')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='also write the JSON report here')
+    parser.add_argument('--baseline', default=None, help='earlier report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+    args.users = max(int(args.users * args.scale), args.heavy_users + 1)
+    args.heavy_docs = max(int(args.heavy_docs * args.scale), args.page_size + 1)
+
+    app = make_app(args)
+    started = time.perf_counter()
+    user_ids = seed(app, args)
+    seed_seconds = time.perf_counter() - started
+    rss_after_seed = peak_rss_mb()
+
+    only = set(args.only.split(',')) if args.only else None
+    client = app.test_client()
+    results = {}
+    for name, request, after, iterations in scenarios(app, args, user_ids):
+        if only is None or name in only:
+            results[name] = measure(client, request, after, iterations, args.warmup)
+
+    report = {
+        'config': {
+            'mongo': 'memory' if args.mongo_uri == 'memory' else 'sqlite' if args.mongo_uri.startswith('sqlite://') else 'mongod',
+            'users': args.users,
+            'heavy_users': args.heavy_users,
+            'heavy_docs': args.heavy_docs,
+            'light_docs': args.light_docs,
+            'iterations': args.iterations,
+            'page_size': args.page_size,
+            'cache': args.cache,
+        },
+        'seed_seconds': round(seed_seconds, 1),
+        'peak_rss_mb_after_seed': rss_after_seed,
+        'peak_rss_mb': peak_rss_mb(),
+        'scenarios': results,
+    }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        for line in found:
+            print(f'REGRESSION {line}', file=sys.stderr)
+        if found:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+import asyncio
+import contextvars
+import inspect
+import sys
+from collections import deque
+from itertools import islice
+from greenlet import getcurrent, greenlet
+
+# Documents fetched per round trip when a bridged cursor is iterated
+CURSOR_BATCH = 100
+
+# Cursor methods that return the cursor itself
+CURSOR_CHAINING = {
+    'sort', 'limit', 'skip', 'batch_size', 'max_time_ms', 'hint', 'collation', 'comment', 'allow_disk_use', 'where',
+}
+
+
+# Runs the sync app on an event loop (asgi.py). Each request is handled in
+# a greenlet; where the sync code would block on the database, the greenlet
+# hands the async driver's awaitable to the loop and is resumed with its
+# result. The same routes, models and error handlers run either way, but a
+# slow query no longer pins a thread.
+class _Bridged(greenlet):
+    pass
+
+
+def in_bridge():
+    return isinstance(getcurrent(), _Bridged)
+
+
+# Only from inside a bridged greenlet
+def await_only(awaitable):
+    return getcurrent().parent.switch(awaitable)
+
+
+async def _await(awaitable):
+    return await awaitable
+
+
+# Calls fn(*args) in a bridged greenlet, awaiting whatever it waits on.
+# Awaits run in the greenlet's context, so the request context and metrics
+# stats follow the query onto the driver's threads.
+async def spawn(fn, *args):
+    bridged = _Bridged(fn, getcurrent())
+    bridged.gr_context = contextvars.copy_context()
+    result = bridged.switch(*args)
+    while not bridged.dead:
+        try:
+            value = await asyncio.create_task(_await(result), context=bridged.gr_context)
+        except BaseException:
+            result = bridged.throw(*sys.exc_info())
+        else:
+            result = bridged.switch(value)
+    return result
+
+
+# CPU-bound or blocking work (decryption, password hashing, Redis): on a
+# thread when bridged so the loop keeps serving, inline otherwise
+def run_blocking(fn, *args):
+    if in_bridge():
+        return await_only(asyncio.to_thread(fn, *args))
+    return fn(*args)
+
+
+def _result(value):
+    if hasattr(value, 'to_list'):
+        return BridgedCursor(value)
+    if hasattr(value, 'find'):
+        return BridgedCollection(value)
+    if inspect.isawaitable(value):
+        return await_only(value)
+    return value
+
+
+# Sync facade over an async cursor (Motor's, or ThreadedCursor's): chaining
+# methods return the facade, iteration fetches batch_size documents per
+# round trip
+class BridgedCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.length = CURSOR_BATCH
+        self.buffer = deque()
+        self.exhausted = False
+
+    def batch_size(self, length):
+        self.length = length or CURSOR_BATCH
+        self.cursor.batch_size(length)
+        return self
+
+    def __getattr__(self, name):
+        method = getattr(self.cursor, name)
+
+        def call(*args, **kwargs):
+            value = method(*args, **kwargs)
+            return self if value is self.cursor else _result(value)
+        return call
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.buffer and not self.exhausted:
+            batch = await_only(self.cursor.to_list(length=self.length))
+            self.buffer.extend(batch)
+            self.exhausted = len(batch) < self.length
+        if not self.buffer:
+            raise StopIteration
+        return self.buffer.popleft()
+
+
+class BridgedCollection:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+        if not callable(method):
+            return method
+
+        def call(*args, **kwargs):
+            return _result(method(*args, **kwargs))
+        return call
+
+
+class BridgedDatabase:
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, name):
+        return BridgedCollection(self.db[name])
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if hasattr(attr, 'find'):
+            return BridgedCollection(attr)
+
+        def call(*args, **kwargs):
+            return _result(attr(*args, **kwargs))
+        return call
+
+
+# The store the app is built with under asgi.py: the async client inside
+# bridged greenlets, the sync store everywhere else (background threads,
+# CLI commands, work handed to run_blocking). The async client needs db,
+# an async ping(timeout), pool_stats and close.
+class BridgedMongo:
+    def __init__(self, store, client):
+        self.store = store
+        self.client = client
+
+    @property
+    def db(self):
+        if in_bridge():
+            return BridgedDatabase(self.client.db)
+        return self.store.db
+
+    @property
+    def cx(self):
+        return self.store.cx
+
+    def pool_stats(self):
+        if in_bridge():
+            return self.client.pool_stats()
+        return self.store.pool_stats()
+
+    def ping(self, timeout=1.0):
+        if in_bridge():
+            return await_only(self.client.ping(timeout))
+        return self.store.ping(timeout)
+
+    def close(self):
+        self.client.close()
+        self.store.close()
+
+
+# Motor's interface over a sync store (the SQLite store, or mongomock in
+# benchmarks/load_test.py): every call runs on a thread, as Motor runs
+# PyMongo's
+class ThreadedClient:
+    def __init__(self, store):
+        self.store = store
+
+    @property
+    def db(self):
+        return ThreadedDatabase(self.store.db)
+
+    def pool_stats(self):
+        return self.store.pool_stats()
+
+    async def ping(self, timeout=1.0):
+        return await asyncio.to_thread(self.store.ping, timeout)
+
+    def close(self):
+        pass
+
+
+def _threaded(method):
+    async def call(*args, **kwargs):
+        return await asyncio.to_thread(method, *args, **kwargs)
+    return call
+
+
+class ThreadedDatabase:
+    def __init__(self, db):
+        self.db = db
+
+    def __getitem__(self, name):
+        return ThreadedCollection(self.db[name])
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if hasattr(attr, 'find'):
+            return ThreadedCollection(attr)
+        return _threaded(attr)
+
+
+class ThreadedCollection:
+    CURSORS = {'find', 'aggregate', 'list_indexes'}
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        method = getattr(self.collection, name)
+        if name in self.CURSORS:
+            return lambda *args, **kwargs: ThreadedCursor(method, args, kwargs)
+        if not callable(method):
+            return method
+        return _threaded(method)
+
+
+# Opened on its first fetch, on a thread, with the chained calls applied
+class ThreadedCursor:
+    def __init__(self, method, args, kwargs):
+        self.open = lambda: method(*args, **kwargs)
+        self.calls = []
+        self.cursor = self.rows = None
+
+    def _opened(self):
+        if self.cursor is None:
+            self.cursor = self.open()
+            for name, args, kwargs in self.calls:
+                self.cursor = getattr(self.cursor, name)(*args, **kwargs)
+            self.rows = iter(self.cursor)
+        return self.cursor
+
+    def __getattr__(self, name):
+        if name in CURSOR_CHAINING:
+            def chain(*args, **kwargs):
+                self.calls.append((name, args, kwargs))
+                return self
+            return chain
+        return _threaded(lambda *args, **kwargs: getattr(self._opened(), name)(*args, **kwargs))
+
+    def _fetch(self, length):
+        self._opened()
+        return list(islice(self.rows, length))
+
+    async def to_list(self, length=None):
+        return await asyncio.to_thread(self._fetch, length)
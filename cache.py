@@ -0,0 +1,174 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import partial
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from bridge import run_blocking
+
+
+# In-process LRU with per-key TTL. Each worker process has its own, so a
+# write handled by one worker leaves the others serving stale pages: only
+# for single-process installs. Generation counters live in their own
+# dict so they are never evicted ahead of the entries they guard.
+class MemoryBackend:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl if ttl else None, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def add(self, key, value):
+        with self._lock:
+            return self._counters.setdefault(key, value) == value
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+
+# Any client with Redis' get/set/incr semantics (redis-py, or a local fake).
+# Calls go to a thread when serving over ASGI.
+class RedisBackend:
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url):
+        import redis
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key):
+        return run_blocking(self.client.get, key)
+
+    def set(self, key, value, ttl=None):
+        run_blocking(partial(self.client.set, ex=ttl), key, value)
+
+    def delete(self, key):
+        run_blocking(self.client.delete, key)
+
+    def add(self, key, value):
+        return bool(run_blocking(partial(self.client.set, nx=True), key, value))
+
+    def incr(self, key):
+        return run_blocking(self.client.incr, key)
+
+
+# A collection every worker shares, on the app's own storage. Expired
+# entries are ignored on read and removed by the TTL index; generation
+# counters have no expiry.
+class MongoBackend:
+    COLLECTION = 'response_cache'
+    INDEXES = [IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0)]
+
+    def __init__(self, mongo):
+        self.mongo = mongo
+
+    @property
+    def collection(self):
+        return self.mongo.db[self.COLLECTION]
+
+    def get(self, key):
+        doc = self.collection.find_one({'_id': key})
+        if doc is None or (doc.get('expires_at') and doc['expires_at'] < datetime.utcnow()):
+            return None
+        return doc['value']
+
+    def set(self, key, value, ttl=None):
+        doc = {'value': value}
+        if ttl:
+            doc['expires_at'] = datetime.utcnow() + timedelta(seconds=ttl)
+        self.collection.replace_one({'_id': key}, doc, upsert=True)
+
+    def delete(self, key):
+        self.collection.delete_one({'_id': key})
+
+    def add(self, key, value):
+        try:
+            self.collection.insert_one({'_id': key, 'value': value})
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def incr(self, key):
+        doc = self.collection.find_one_and_update(
+            {'_id': key}, {'$inc': {'value': 1}}, upsert=True, return_document=ReturnDocument.AFTER,
+        )
+        return doc['value']
+
+
+# Read-through cache for list responses, keyed per (user, collection,
+# query string). Writes bump the (user, collection) generation, which
+# orphans every cached page for that pair at once.
+class ResponseCache:
+    def __init__(self, backend, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+
+    def _generation(self, user_id, collection):
+        key = f'gen:{user_id}:{collection}'
+        generation = self.backend.get(key)
+        if generation is None:
+            # Start from the clock so a lost counter never reuses an old value
+            self.backend.add(key, time.time_ns())
+            generation = self.backend.get(key)
+        return int(generation)
+
+    def key(self, user_id, collection, params):
+        digest = hashlib.sha1(params).hexdigest()
+        return f'resp:{user_id}:{collection}:{self._generation(user_id, collection)}:{digest}'
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            return None
+        etag, next_cursor, body = value.split(b'\n', 2)
+        return etag.decode('ascii'), next_cursor.decode('ascii') or None, body
+
+    def set(self, key, etag, next_cursor, body):
+        value = b'\n'.join([etag.encode('ascii'), (next_cursor or '').encode('ascii'), body])
+        self.backend.set(key, value, self.ttl)
+
+    def invalidate(self, collection, user_id, doc_ids=None):
+        self.backend.incr(f'gen:{user_id}:{collection}')
+
+
+def create_cache(config, mongo=None):
+    backend = config.get('CACHE_BACKEND', 'mongo')
+    if backend == 'none':
+        return None
+    if backend == 'redis':
+        return ResponseCache(RedisBackend.from_url(config['CACHE_URL']), config.get('CACHE_TTL', 60))
+    if backend == 'memory':
+        return ResponseCache(MemoryBackend(config.get('CACHE_MAX_ENTRIES', 10000)), config.get('CACHE_TTL', 60))
+    if backend == 'mongo':
+        return ResponseCache(MongoBackend(mongo), config.get('CACHE_TTL', 60))
+    raise ValueError(f'Unknown CACHE_BACKEND {backend!r}')
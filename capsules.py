@@ -0,0 +1,134 @@
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta
+from models import Notification, TimeCapsule, notify_write
+
+logger = logging.getLogger(__name__)
+
+
+# Opens time capsules when their open_date passes. Upcoming unlocks within
+# the horizon sit in a min-heap; the thread sleeps until the earliest one
+# (or the next reload) and flips it with a conditional update, so several
+# schedulers can run side by side and each capsule is opened, and its
+# notification enqueued, exactly once. Capsules written without going
+# through schedule() (e.g. /batch) are picked up by the periodic reload.
+class CapsuleScheduler:
+    def __init__(self, mongo, horizon=timedelta(minutes=10), reload_interval=60):
+        self.mongo = mongo
+        self.horizon = horizon
+        self.reload_interval = reload_interval
+        self._heap = []
+        self._queued = set()
+        self._horizon_end = None
+        self._next_reload = None
+        self._wakeup = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _push(self, open_date, capsule_id):
+        if (open_date, capsule_id) not in self._queued:
+            self._queued.add((open_date, capsule_id))
+            heapq.heappush(self._heap, (open_date, capsule_id))
+
+    def reload(self, now=None):
+        now = now or datetime.utcnow()
+        horizon_end = now + self.horizon
+        pending = self.mongo.db[TimeCapsule.COLLECTION].find(
+            {'opened': False, 'open_date': {'$lte': horizon_end}}, {'open_date': 1},
+        )
+        with self._wakeup:
+            for capsule in pending:
+                self._push(capsule['open_date'], capsule['_id'])
+            self._horizon_end = horizon_end
+            self._next_reload = now + timedelta(seconds=self.reload_interval)
+            self._wakeup.notify()
+
+    # Called after a capsule is created or its open_date changes
+    def schedule(self, capsule_id, open_date):
+        with self._wakeup:
+            if self._horizon_end is None or open_date <= self._horizon_end:
+                self._push(open_date, capsule_id)
+                self._wakeup.notify()
+
+    # Open everything due by now; returns the opened capsule documents
+    def run_due(self, now=None):
+        now = now or datetime.utcnow()
+        with self._wakeup:
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                self._queued.discard(entry)
+                due.append(entry[1])
+
+        opened = []
+        collection = self.mongo.db[TimeCapsule.COLLECTION]
+        for capsule_id in due:
+            # Skips capsules already opened elsewhere or postponed since queued
+            capsule = collection.find_one_and_update(
+                {'_id': capsule_id, 'opened': False, 'open_date': {'$lte': now}},
+                {'$set': {'opened': True, 'updated_at': now}, '$inc': {'version': 1}},
+                {'user_id': 1, 'open_date': 1},
+            )
+            if capsule is None:
+                continue
+            Notification.enqueue(self.mongo, capsule['user_id'], 'capsule_opened', {'capsule_id': capsule['_id']})
+            notify_write(TimeCapsule.COLLECTION, capsule['user_id'], [capsule['_id']])
+            opened.append(capsule)
+        return opened
+
+    def _seconds_until_next(self, now):
+        if self._next_reload is None:
+            return self.reload_interval
+        wake = self._next_reload
+        if self._heap and self._heap[0][0] < wake:
+            wake = self._heap[0][0]
+        return max((wake - now).total_seconds(), 0)
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                now = datetime.utcnow()
+                if self._next_reload is None or now >= self._next_reload:
+                    self.reload(now)
+                for capsule in self.run_due(now):
+                    logger.info('Opened time capsule %s', capsule['_id'])
+            except Exception:
+                logger.exception('Time capsule scheduler pass failed')
+            with self._wakeup:
+                # stop() may have notified while this pass ran
+                if not self._stop.is_set():
+                    self._wakeup.wait(min(self._seconds_until_next(datetime.utcnow()), self.reload_interval))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='capsule-scheduler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._wakeup:
+            self._wakeup.notify()
+
+
+# One-off migration for capsules stored before open_date was normalised:
+# parse string dates and set the opened flag. Returns (migrated, invalid).
+def backfill(mongo, batch_size=500):
+    collection = mongo.db[TimeCapsule.COLLECTION]
+    now = datetime.utcnow()
+    migrated = invalid = 0
+    query = {'$or': [{'opened': {'$exists': False}}, {'open_date': {'$type': 'string'}}]}
+    for capsule in collection.find(query, {'open_date': 1}).batch_size(batch_size):
+        try:
+            open_date = TimeCapsule.parse_open_date(capsule.get('open_date'))
+        except ValueError:
+            # Unparseable dates never open, as before
+            collection.update_one({'_id': capsule['_id']}, {'$set': {'opened': False}})
+            invalid += 1
+            continue
+        collection.update_one(
+            {'_id': capsule['_id']},
+            {'$set': {'open_date': open_date, 'opened': open_date <= now, 'updated_at': now}},
+        )
+        migrated += 1
+    return migrated, invalid
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+import pymongo
+from pymongo import MongoClient
+from pymongo.monitoring import ConnectionCheckOutFailedReason, ConnectionPoolListener
+
+
+# MongoClient keyword options from the MONGO_* settings. Unset options are
+# left out so anything given in the URI still applies.
+def mongo_options(config):
+    w = config.get('MONGO_W')
+    j = config.get('MONGO_J')
+    options = {
+        'maxPoolSize': config.get('MONGO_MAX_POOL_SIZE'),
+        'minPoolSize': config.get('MONGO_MIN_POOL_SIZE'),
+        'waitQueueTimeoutMS': config.get('MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+        'serverSelectionTimeoutMS': config.get('MONGO_SERVER_SELECTION_TIMEOUT_MS'),
+        'readPreference': config.get('MONGO_READ_PREFERENCE'),
+        'w': int(w) if w and w.isdigit() else w,
+        'journal': j == '1' if j else None,
+    }
+    return {name: value for name, value in options.items() if value not in (None, '')}
+
+
+# Counts connections across the client's pools, fed by pool monitoring events
+class PoolStats(ConnectionPoolListener):
+    def __init__(self, max_pool_size):
+        self.max_pool_size = max_pool_size
+        self.open = 0
+        self.checked_out = 0
+        self.wait_timeouts = 0
+        self._lock = threading.Lock()
+
+    def _add(self, counter, amount):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def connection_created(self, event):
+        self._add('open', 1)
+
+    def connection_closed(self, event):
+        self._add('open', -1)
+
+    def connection_checked_out(self, event):
+        self._add('checked_out', 1)
+
+    def connection_checked_in(self, event):
+        self._add('checked_out', -1)
+
+    def connection_check_out_failed(self, event):
+        if event.reason == ConnectionCheckOutFailedReason.TIMEOUT:
+            self._add('wait_timeouts', 1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'max_size': self.max_pool_size,
+                'open': self.open,
+                'checked_out': self.checked_out,
+                'utilization': self.checked_out / self.max_pool_size if self.max_pool_size else None,
+                'wait_timeouts': self.wait_timeouts,
+            }
+
+
+# Drop-in for flask_pymongo's PyMongo (mongo.db / mongo.cx). The client is
+# only created on first use and again after a fork, so a pre-forking server
+# can build the app in the master and every worker gets its own pool.
+class Mongo:
+    def __init__(self, config, listeners=()):
+        self.uri = config['MONGO_URI']
+        self.options = mongo_options(config)
+        self.listeners = list(listeners)
+        self._client = None
+        self._pid = None
+        self._stats = None
+        self._lock = threading.Lock()
+
+    @property
+    def cx(self):
+        if self._client is None or self._pid != os.getpid():
+            with self._lock:
+                if self._client is None or self._pid != os.getpid():
+                    stats = PoolStats(self.options.get('maxPoolSize', 100))
+                    self._client = MongoClient(self.uri, event_listeners=[stats] + self.listeners, **self.options)
+                    self._stats, self._pid = stats, os.getpid()
+        return self._client
+
+    @property
+    def db(self):
+        return self.cx.get_default_database()
+
+    def pool_stats(self):
+        if self._stats is None or self._pid != os.getpid():
+            return PoolStats(self.options.get('maxPoolSize', 100)).snapshot()
+        return self._stats.snapshot()
+
+    # Round-trip a ping; returns the latency in milliseconds
+    def ping(self, timeout=1.0):
+        start = time.perf_counter()
+        with pymongo.timeout(timeout):
+            self.cx.admin.command('ping')
+        return (time.perf_counter() - start) * 1000
+
+    def close(self):
+        if self._client is not None and self._pid == os.getpid():
+            self._client.close()
+        self._client = None
+
+
+# The storage the app runs on, from STORAGE_BACKEND. Both expose the same
+# db interface (the subset of PyMongo's Database the models use), ping,
+# pool_stats and close.
+def create_store(config, listeners=()):
+    backend = config.get('STORAGE_BACKEND', 'mongo')
+    if backend == 'mongo':
+        return Mongo(config, listeners)
+    if backend == 'sqlite':
+        from sqlite_store import SQLiteStore
+        return SQLiteStore(config)
+    raise ValueError(f'Unknown STORAGE_BACKEND: {backend}')
@@ -0,0 +1,111 @@
+import base64
+import json
+from itertools import islice
+from datetime import date, datetime
+from bson.objectid import ObjectId
+from flask import current_app, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+MSGPACK_MIMETYPE = 'application/msgpack'
+MSGPACK_MIMETYPES = (MSGPACK_MIMETYPE, 'application/x-msgpack', 'application/vnd.msgpack')
+
+
+def encode_datetime(value):
+    text = value.isoformat()
+    # Stored timestamps are naive UTC (datetime.utcnow)
+    return text + 'Z' if value.tzinfo is None else text
+
+
+def encode_bytes(value):
+    # Fernet tokens are already url-safe base64, so they pass through as text
+    try:
+        return value.decode('ascii')
+    except UnicodeDecodeError:
+        return base64.b64encode(value).decode('ascii')
+
+
+# Exact-type dispatch first; isinstance fallback covers subclasses (e.g. bson Binary)
+_ENCODERS = {
+    ObjectId: str,
+    datetime: encode_datetime,
+    date: date.isoformat,
+    bytes: encode_bytes,
+}
+
+
+def bson_default(value):
+    encoder = _ENCODERS.get(type(value))
+    if encoder is None:
+        for kind, candidate in _ENCODERS.items():
+            if isinstance(value, kind):
+                encoder = candidate
+                break
+        else:
+            raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+    return encoder(value)
+
+
+def dumps(obj):
+    return json.dumps(obj, default=bson_default, separators=(',', ':'), check_circular=False)
+
+
+# Same conversions as JSON (ids and dates become strings), so both formats
+# decode to the same shapes; bytes stay binary
+def packb(obj):
+    return msgpack.packb(obj, default=bson_default, use_bin_type=True, datetime=False)
+
+
+def unpackb(data):
+    return msgpack.unpackb(data, raw=False)
+
+
+# True if the client prefers MessagePack over JSON (e.g. Accept:
+# application/msgpack); */* and missing Accept headers get JSON
+def wants_msgpack():
+    if msgpack is None:
+        return False
+    best = request.accept_mimetypes.best_match(('application/json',) + MSGPACK_MIMETYPES)
+    return best in MSGPACK_MIMETYPES
+
+
+def response_mimetype():
+    return MSGPACK_MIMETYPE if wants_msgpack() else 'application/json'
+
+
+# Lets jsonify() encode documents straight from PyMongo, as MessagePack
+# when the request asks for it
+class BSONJSONProvider(DefaultJSONProvider):
+    default = staticmethod(bson_default)
+
+    def response(self, *args, **kwargs):
+        if has_request_context() and wants_msgpack():
+            obj = self._prepare_response_obj(args, kwargs)
+            return self._app.response_class(packb(obj), mimetype=MSGPACK_MIMETYPE)
+        return super().response(*args, **kwargs)
+
+
+def wants_stream():
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return request.accept_mimetypes.best == NDJSON_MIMETYPE
+
+
+# Yield one JSON document per line, pulling from the cursor in bounded
+# batches. serialize, if given, maps a list of documents to output rows.
+def ndjson_lines(cursor, serialize=None):
+    batch_size = current_app.config.get('STREAM_BATCH_SIZE', 500)
+    return _ndjson_lines(iter(cursor.batch_size(batch_size)), batch_size, serialize)
+
+
+def _ndjson_lines(docs, batch_size, serialize):
+    while True:
+        batch = list(islice(docs, batch_size))
+        if not batch:
+            return
+        yield ''.join(dumps(row) + '\n' for row in (serialize(batch) if serialize else batch))
@@ -0,0 +1,148 @@
+import logging
+from datetime import datetime
+from pymongo.errors import CollectionInvalid
+from analytics import HabitRollup, MoodRollup
+from archive import Archive
+from attachments import Attachment, AttachmentChunk
+from cache import MongoBackend
+from jobs import MongoBroker
+from keystore import KeyStore
+from models import User, Entry, Task, Goal, Habit, Mood, ClassSchedule, Gratitude, TimeCapsule, Tombstone, Notification
+from reminders import Reminder, ReminderSettings
+from search import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+MODELS = [
+    User, Entry, Task, Goal, Habit, Mood, ClassSchedule, Gratitude, TimeCapsule,
+    KeyStore, MoodRollup, HabitRollup, Tombstone, SearchIndex, Notification, MongoBroker, Archive,
+    Reminder, ReminderSettings, Attachment, AttachmentChunk, MongoBackend,
+]
+LIST_MODELS = [Entry, Task, Goal, Habit, Mood, ClassSchedule, Gratitude]
+
+
+def _sort(model):
+    if model.SORT_FIELD == '_id':
+        return [('_id', -1)]
+    return [(model.SORT_FIELD, -1), ('_id', -1)]
+
+
+# The filter/sort combinations the routes actually issue
+def query_shapes():
+    shapes = [(User, {'username': ''}, None)]
+    shapes += [(model, {'user_id': ''}, _sort(model)) for model in LIST_MODELS]
+    shapes.append((TimeCapsule, {'user_id': '', 'opened': True}, _sort(TimeCapsule)))
+    shapes.append((TimeCapsule, {'opened': False, 'open_date': {'$lte': datetime.utcnow()}}, None))
+    for model, field in ((Entry, 'timestamp'), (Mood, 'date'), (Task, 'due_at'), (Goal, 'due_at')):
+        shapes.append((model, {'user_id': '', field: {'$gte': datetime.utcnow()}}, [(field, 1), ('_id', 1)]))
+    shapes.append((Archive, {'collection': Entry.COLLECTION, 'user_id': '', 'restored_at': None,
+                             'month': {'$lte': datetime.utcnow()}}, [('month', -1)]))
+    shapes.append((Reminder, {'fire_at': {'$lte': datetime.utcnow()}}, None))
+    shapes.append((Reminder, {'updated_at': {'$gte': datetime.utcnow()}, 'fire_at': {'$lte': datetime.utcnow()}}, None))
+    shapes.append((Reminder, {'user_id': '', 'collection': ''}, None))
+    shapes.append((Reminder, {'user_id': '', 'fire_at': {'$ne': None}}, [('fire_at', 1)]))
+    shapes.append((Attachment, {'user_id': '', 'entry_id': ''}, None))
+    shapes.append((Attachment, {'status': 'uploading', 'created_at': {'$lt': datetime.utcnow()}}, None))
+    shapes.append((AttachmentChunk, {'attachment_id': '', 'n': {'$gte': 0, '$lte': 7}}, [('n', 1)]))
+    shapes.append((AttachmentChunk, {'user_id': '', 'key_id': {'$ne': 1}}, None))
+    shapes.append((MongoBroker, {'status': {'$in': ['queued', 'running']}, 'run_at': {'$lte': datetime.utcnow()}}, [('run_at', 1)]))
+    return shapes
+
+
+# Options that change what an index does; anything else the server reports
+# (v, ns, background) is ignored
+INDEX_OPTIONS = ('unique', 'sparse', 'expireAfterSeconds', 'partialFilterExpression', 'collation')
+
+
+def _index_options(spec, collation_fields=None):
+    options = {name: spec[name] for name in INDEX_OPTIONS if spec.get(name) not in (None, False)}
+    collation = options.get('collation')
+    if collation is not None:
+        # The server fills in every collation default; compare what was declared
+        if collation.get('locale') == 'simple':
+            del options['collation']
+        elif collation_fields is not None:
+            options['collation'] = {key: collation.get(key) for key in collation_fields}
+    return options
+
+
+# Which options of an existing index differ from its declaration; a
+# different key counts as the whole index
+def _index_drift(existing, declared):
+    if list(existing['key']) != list(declared['key'].items()):
+        return {'key'}
+    want = _index_options(declared)
+    have = _index_options(existing, want.get('collation', {}).keys())
+    return {name for name in INDEX_OPTIONS if have.get(name) != want.get(name)}
+
+
+# Create missing indexes and bring drifted ones in line with their
+# declaration: a changed TTL is applied in place with collMod, any other
+# change rebuilds the index. Indexes that are not declared on a model are
+# reported, never dropped.
+def ensure_indexes(db, models=MODELS):
+    report = {}
+    for model in models:
+        collection = db[model.COLLECTION]
+        existing = collection.index_information()
+        created, modified, rebuilt = [], [], []
+
+        for index in model.INDEXES:
+            declared = index.document
+            name = declared['name']
+            if name not in existing:
+                collection.create_indexes([index])
+                created.append(name)
+                continue
+            drift = _index_drift(existing[name], declared)
+            if drift == {'expireAfterSeconds'} and 'expireAfterSeconds' in existing[name] and 'expireAfterSeconds' in declared:
+                db.command('collMod', model.COLLECTION, index={'name': name, 'expireAfterSeconds': declared['expireAfterSeconds']})
+                modified.append(name)
+            elif drift:
+                collection.drop_index(name)
+                collection.create_indexes([index])
+                rebuilt.append(name)
+
+        declared_names = {index.document['name'] for index in model.INDEXES}
+        extra = [name for name in existing if name != '_id_' and name not in declared_names]
+        report[model.COLLECTION] = {'created': created, 'modified': modified, 'rebuilt': rebuilt, 'undeclared': extra}
+        if created or modified or rebuilt:
+            logger.info('Indexes on %s: created %s, modified %s, rebuilt %s', model.COLLECTION, created, modified, rebuilt)
+    return report
+
+
+# Install each model's $jsonSchema validator (creating the collection if
+# needed). 'moderate' leaves updates to documents that already fail the
+# schema alone, so legacy data does not block writes.
+def ensure_validators(db, models=MODELS, level='moderate'):
+    applied = []
+    for model in models:
+        if not hasattr(model, 'json_schema'):
+            continue
+        validator = model.json_schema()
+        try:
+            db.create_collection(model.COLLECTION, validator=validator, validationLevel=level)
+        except CollectionInvalid:
+            db.command('collMod', model.COLLECTION, validator=validator, validationLevel=level)
+        applied.append(model.COLLECTION)
+    return applied
+
+
+def _stages(plan):
+    yield plan.get('stage')
+    for child in plan.get('inputStages', []) + [plan[k] for k in ('inputStage', 'queryPlan') if k in plan]:
+        yield from _stages(child)
+
+
+# Explain every known query shape and return the ones that scan a whole collection
+def find_collscans(db):
+    collscans = []
+    for model, query, sort in query_shapes():
+        cursor = db[model.COLLECTION].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+        if 'COLLSCAN' in _stages(plan):
+            collscans.append({'collection': model.COLLECTION, 'filter': sorted(query), 'sort': sort})
+            logger.warning('COLLSCAN on %s for filter %s', model.COLLECTION, sorted(query))
+    return collscans
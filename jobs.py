@@ -0,0 +1,304 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+# A job is a plain dict: name, payload, attempts, max_attempts and an
+# optional key. A key makes enqueue idempotent while a job with that key is
+# still waiting to run; once it has been claimed the same key can be queued
+# again, so a job that reads current state never misses a later write.
+def make_job(name, payload, key=None, max_attempts=5, run_at=None):
+    job = {
+        'name': name,
+        'payload': payload,
+        'status': 'queued',
+        'attempts': 0,
+        'max_attempts': max_attempts,
+        'run_at': run_at or datetime.utcnow(),
+    }
+    if key is not None:
+        job['key'] = key
+    return job
+
+
+class Broker:
+    def __init__(self):
+        self._wakeup = threading.Condition()
+
+    def _notify(self):
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    # Block until something is enqueued in this process or timeout passes
+    def wait(self, timeout):
+        with self._wakeup:
+            self._wakeup.wait(timeout)
+
+
+# Jobs live in a collection so any process can claim them. Claiming sets
+# run_at to the end of the lease, so jobs whose worker died become
+# claimable again once it expires. Finished jobs are kept for a week.
+class MongoBroker(Broker):
+    COLLECTION = 'jobs'
+    INDEXES = [
+        IndexModel([('status', ASCENDING), ('run_at', ASCENDING)], name='status_run_at'),
+        IndexModel(
+            [('key', ASCENDING)], name='queued_key', unique=True,
+            partialFilterExpression={'status': 'queued', 'key': {'$exists': True}},
+        ),
+        IndexModel([('finished_at', ASCENDING)], name='finished_at_ttl', expireAfterSeconds=7 * 24 * 3600),
+    ]
+
+    def __init__(self, mongo):
+        super().__init__()
+        self.mongo = mongo
+
+    @property
+    def collection(self):
+        return self.mongo.db[self.COLLECTION]
+
+    def enqueue(self, job):
+        try:
+            job_id = self.collection.insert_one(job).inserted_id
+        except DuplicateKeyError:
+            return None
+        self._notify()
+        return job_id
+
+    def enqueue_many(self, jobs):
+        if not jobs:
+            return
+        try:
+            self.collection.insert_many(jobs, ordered=False)
+        except BulkWriteError as e:
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+        self._notify()
+
+    def claim(self, lease):
+        now = datetime.utcnow()
+        return self.collection.find_one_and_update(
+            {'status': {'$in': ['queued', 'running']}, 'run_at': {'$lte': now}},
+            {'$set': {'status': 'running', 'run_at': now + lease, 'started_at': now}, '$inc': {'attempts': 1}},
+            sort=[('run_at', ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def complete(self, job):
+        self.collection.update_one(
+            {'_id': job['_id'], 'attempts': job['attempts']},
+            {'$set': {'status': 'done', 'finished_at': datetime.utcnow()}},
+        )
+
+    def retry(self, job, run_at, error):
+        try:
+            self.collection.update_one(
+                {'_id': job['_id'], 'attempts': job['attempts']},
+                {'$set': {'status': 'queued', 'run_at': run_at, 'error': error}},
+            )
+        except DuplicateKeyError:
+            # A newer job with the same key is already waiting
+            self.fail(job, error, 'superseded')
+
+    def fail(self, job, error, status='failed'):
+        self.collection.update_one(
+            {'_id': job['_id'], 'attempts': job['attempts']},
+            {'$set': {'status': status, 'error': error, 'finished_at': datetime.utcnow()}},
+        )
+
+    def counts(self):
+        return {row['_id']: row['count'] for row in self.collection.aggregate([
+            {'$group': {'_id': '$status', 'count': {'$sum': 1}}},
+        ])}
+
+
+# In-process queue for tests and single-process setups; jobs are lost on exit
+class MemoryBroker(Broker):
+    def __init__(self):
+        super().__init__()
+        self._heap = []
+        self._keys = {}
+        self._counter = itertools.count()
+        self.finished = []
+
+    def enqueue(self, job):
+        with self._wakeup:
+            key = job.get('key')
+            if key is not None and key in self._keys:
+                return None
+            job['_id'] = next(self._counter)
+            heapq.heappush(self._heap, (job['run_at'], job['_id'], job))
+            if key is not None:
+                self._keys[key] = job['_id']
+            self._wakeup.notify_all()
+            return job['_id']
+
+    def enqueue_many(self, jobs):
+        for job in jobs:
+            self.enqueue(job)
+
+    def claim(self, lease):
+        with self._wakeup:
+            if not self._heap or self._heap[0][0] > datetime.utcnow():
+                return None
+            _, _, job = heapq.heappop(self._heap)
+            self._keys.pop(job.get('key'), None)
+            job['status'] = 'running'
+            job['attempts'] += 1
+            return job
+
+    def complete(self, job):
+        job['status'] = 'done'
+        self.finished.append(job)
+
+    def retry(self, job, run_at, error):
+        job.update(status='queued', run_at=run_at, error=error)
+        with self._wakeup:
+            if job.get('key') in self._keys:
+                job['status'] = 'superseded'
+                self.finished.append(job)
+                return
+            if job.get('key') is not None:
+                self._keys[job['key']] = job['_id']
+            heapq.heappush(self._heap, (run_at, job['_id'], job))
+
+    def fail(self, job, error, status='failed'):
+        job.update(status=status, error=error)
+        self.finished.append(job)
+
+    def counts(self):
+        with self._wakeup:
+            counts = {'queued': len(self._heap)}
+        for job in self.finished:
+            counts[job['status']] = counts.get(job['status'], 0) + 1
+        return counts
+
+
+# Named handlers plus the workers that run them. Handlers take the payload
+# as keyword arguments and must be safe to run more than once: a job is
+# retried with exponential backoff when it raises, and re-run if its
+# worker dies mid-way. With eager=True enqueue runs the handler inline
+# instead, which is what the routes fall back to without a queue.
+class JobQueue:
+    def __init__(self, broker, max_attempts=5, backoff=2.0, max_backoff=600, lease=300, poll_interval=1.0, eager=False):
+        self.broker = broker
+        self.handlers = {}
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = timedelta(seconds=lease)
+        self.poll_interval = poll_interval
+        self.eager = eager
+        self._stop = threading.Event()
+        self._threads = []
+
+    @classmethod
+    def from_config(cls, mongo, config):
+        broker = MemoryBroker() if config['JOB_BROKER'] == 'memory' else MongoBroker(mongo)
+        return cls(
+            broker,
+            config['JOB_MAX_ATTEMPTS'],
+            config['JOB_BACKOFF_SECONDS'],
+            config['JOB_MAX_BACKOFF_SECONDS'],
+            config['JOB_LEASE_SECONDS'],
+            config['JOB_POLL_SECONDS'],
+            config['JOB_BROKER'] == 'eager',
+        )
+
+    def handler(self, name):
+        def register(func):
+            self.handlers[name] = func
+            return func
+        return register
+
+    def enqueue(self, name, payload=None, key=None):
+        payload = payload or {}
+        if self.eager:
+            self.handlers[name](**payload)
+            return None
+        return self.broker.enqueue(make_job(name, payload, key, self.max_attempts))
+
+    # (name, payload, key) tuples, in one round trip for the Mongo broker
+    def enqueue_many(self, jobs):
+        if self.eager:
+            for name, payload, _ in jobs:
+                self.handlers[name](**payload)
+            return
+        self.broker.enqueue_many([make_job(name, payload, key, self.max_attempts) for name, payload, key in jobs])
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        return delay * random.uniform(0.5, 1.0)
+
+    # Claim and run one job; returns False if none was due
+    def run_once(self):
+        job = self.broker.claim(self.lease)
+        if job is None:
+            return False
+        name = job['name']
+        handler = self.handlers.get(name)
+        if handler is None:
+            self.broker.fail(job, f'No handler for {name}')
+            metrics.JOBS.inc(name, 'failed')
+            return True
+
+        start = time.perf_counter()
+        try:
+            handler(**job['payload'])
+        except Exception:
+            error = traceback.format_exc(limit=5)
+            if job['attempts'] >= job['max_attempts']:
+                logger.exception('Job %s %s failed for good after %d attempts', name, job['_id'], job['attempts'])
+                self.broker.fail(job, error)
+                metrics.JOBS.inc(name, 'failed')
+            else:
+                logger.warning('Job %s %s failed (attempt %d), retrying', name, job['_id'], job['attempts'], exc_info=True)
+                self.broker.retry(job, datetime.utcnow() + timedelta(seconds=self._backoff(job['attempts'])), error)
+                metrics.JOBS.inc(name, 'retried')
+            return True
+        metrics.JOB_LATENCY.observe(time.perf_counter() - start, name)
+        self.broker.complete(job)
+        metrics.JOBS.inc(name, 'done')
+        return True
+
+    def work(self):
+        while not self._stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception:
+                logger.exception('Job worker pass failed')
+            self.broker.wait(self.poll_interval)
+
+    def start(self, concurrency=1):
+        if self.eager:
+            return
+        for i in range(concurrency - len(self._threads)):
+            thread = threading.Thread(target=self.work, name=f'job-worker-{len(self._threads)}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # Foreground worker pool, e.g. 'flask run-jobs' in its own process
+    def run(self, concurrency=1):
+        self.start(concurrency)
+        try:
+            self._stop.wait()
+        except KeyboardInterrupt:
+            self.stop()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self.broker._notify()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
@@ -0,0 +1,188 @@
+import base64
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import partial
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from pymongo import ASCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from bridge import run_blocking
+from utils import decrypt_content, decrypt_many, encrypt_content, generate_key
+
+
+# Master keys come from config (newest first). Without any configured we
+# derive one from SECRET_KEY so development setups keep working.
+def load_master_keys(config):
+    keys = [k.strip() for k in config.get('MASTER_KEYS', '').split(',') if k.strip()]
+    if not keys:
+        digest = hashlib.sha256(config['SECRET_KEY'].encode('utf-8')).digest()
+        keys = [base64.urlsafe_b64encode(digest).decode('ascii')]
+    return MultiFernet([Fernet(k) for k in keys])
+
+
+# Envelope encryption: every user has data keys wrapped by the master key.
+# Unwrapped ciphers are kept in an LRU so a request reading N entries pays
+# for one unwrap instead of N cipher constructions.
+class KeyStore:
+    COLLECTION = 'data_keys'
+    INDEXES = [IndexModel([('user_id', ASCENDING)], name='user_id_unique', unique=True)]
+
+    def __init__(self, mongo, master, cache_size=1024, cache_ttl=300, decrypt_options=None):
+        self.mongo = mongo
+        self.master = master
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.decrypt_options = decrypt_options or {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def collection(self):
+        return self.mongo.db[self.COLLECTION]
+
+    def _new_key(self, key_id):
+        return {'id': key_id, 'wrapped': self.master.encrypt(generate_key()), 'created_at': datetime.utcnow()}
+
+    def _load(self, user_id):
+        try:
+            doc = self.collection.find_one_and_update(
+                {'user_id': user_id},
+                {'$setOnInsert': {'keys': [self._new_key(1)]}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Another worker created the user's key concurrently
+            doc = self.collection.find_one({'user_id': user_id})
+        # Active key first, older keys kept for decrypting not-yet-migrated entries
+        ciphers = [Fernet(self.master.decrypt(key['wrapped'])) for key in doc['keys']]
+        return (doc['keys'][0]['id'], MultiFernet(ciphers)), {key['id'] for key in doc['keys']}
+
+    # Returns (active key id, MultiFernet) for the user. key_ids are the ids
+    # of the tokens about to be decrypted: one this process has not loaded
+    # (the key was rotated by another process since) reloads the user's keys.
+    def cipher(self, user_id, key_ids=()):
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(user_id)
+            if cached and cached[0] > now and all(key_id in cached[2] for key_id in key_ids if key_id is not None):
+                self._cache.move_to_end(user_id)
+                return cached[1]
+
+        value, loaded = self._load(user_id)
+        with self._lock:
+            self._cache[user_id] = (now + self.cache_ttl, value, loaded)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def forget(self, user_id):
+        with self._lock:
+            self._cache.pop(user_id, None)
+
+    def encrypt(self, user_id, content):
+        key_id, cipher = self.cipher(user_id)
+        return encrypt_content(content, cipher), key_id
+
+    # Legacy entries carry their own Fernet key in the document; entries whose
+    # key was never stored come back as None
+    def decrypt_entry(self, cipher, entry):
+        try:
+            return decrypt_content(entry['content'], entry.get('key') or cipher)
+        except InvalidToken:
+            return None
+
+    # Batch form of decrypt_entry; returns plaintexts in input order. Off
+    # the event loop when serving over ASGI.
+    def decrypt_entries(self, cipher, entries):
+        output = run_blocking(partial(decrypt_many, **self.decrypt_options), [entry['content'] for entry in entries], cipher)
+        for i, entry in enumerate(entries):
+            if entry.get('key'):
+                output[i] = self.decrypt_entry(cipher, entry)
+        return output
+
+    # Prepend a fresh data key; older keys stay until purge_old_keys. The new
+    # id is taken from the stored keys rather than this process's cache, and
+    # the push only applies while no concurrent rotation has used that id.
+    def rotate_user_key(self, user_id):
+        self.cipher(user_id)
+        while True:
+            doc = self.collection.find_one({'user_id': user_id}, {'keys': 1})
+            key_id = max(key['id'] for key in doc['keys']) + 1
+            result = self.collection.update_one(
+                {'user_id': user_id, 'keys.id': {'$ne': key_id}},
+                {'$push': {'keys': {'$each': [self._new_key(key_id)], '$position': 0}}},
+            )
+            if result.modified_count:
+                break
+        self.forget(user_id)
+        return key_id
+
+    # Drop data keys no entry or attachment is encrypted with any more.
+    # Other processes can go on encrypting with the previous key until their
+    # cached copy expires, so nothing is dropped (False) until cache_ttl has
+    # passed since the active key was created; anything written in that
+    # window has to be re-encrypted before this succeeds.
+    def purge_old_keys(self, user_id):
+        doc = self.collection.find_one({'user_id': user_id})
+        if doc is None:
+            return False
+        active = doc['keys'][0]
+        if datetime.utcnow() - active.get('created_at', datetime.min) < timedelta(seconds=self.cache_ttl):
+            return False
+        stale = {'user_id': user_id, 'key_id': {'$ne': active['id']}}
+        if self.mongo.db.entries.find_one(stale, {'_id': 1}) or self.mongo.db.attachment_chunks.find_one(stale, {'_id': 1}):
+            return False
+        # Only older keys, in case another rotation has just added a newer one
+        self.collection.update_one({'user_id': user_id}, {'$pull': {'keys': {'id': {'$lt': active['id']}}}})
+        self.forget(user_id)
+        return True
+
+    # Re-wrap every data key with the newest master key
+    def rotate_master_key(self, batch_size=500):
+        ops, count = [], 0
+        for doc in self.collection.find({}, {'keys': 1}).batch_size(batch_size):
+            keys = [dict(key, wrapped=self.master.rotate(key['wrapped'])) for key in doc['keys']]
+            ops.append(UpdateOne({'_id': doc['_id']}, {'$set': {'keys': keys}}))
+            if len(ops) >= batch_size:
+                count += self.collection.bulk_write(ops, ordered=False).modified_count
+                ops = []
+        if ops:
+            count += self.collection.bulk_write(ops, ordered=False).modified_count
+        with self._lock:
+            self._cache.clear()
+        return count
+
+    # Batched migration: moves legacy per-entry keys and entries written
+    # under an older data key onto the user's active data key.
+    def reencrypt_entries(self, user_id=None, batch_size=500):
+        query = {} if user_id is None else {'user_id': user_id}
+        projection = {'user_id': 1, 'content': 1, 'key': 1, 'key_id': 1}
+        ops, migrated, skipped = [], 0, 0
+
+        for entry in self.mongo.db.entries.find(query, projection).batch_size(batch_size):
+            key_id, cipher = self.cipher(entry['user_id'])
+            if entry.get('key_id') == key_id and 'key' not in entry:
+                continue
+            # Entries whose key was never stored cannot be recovered
+            try:
+                if entry.get('key'):
+                    token = cipher.encrypt(Fernet(entry['key']).decrypt(entry['content']))
+                else:
+                    token = cipher.rotate(entry['content'])
+            except (InvalidToken, TypeError):
+                skipped += 1
+                continue
+            ops.append(UpdateOne(
+                {'_id': entry['_id']},
+                {'$set': {'content': token, 'key_id': key_id}, '$unset': {'key': ''}},
+            ))
+            if len(ops) >= batch_size:
+                migrated += self.mongo.db.entries.bulk_write(ops, ordered=False).modified_count
+                ops = []
+        if ops:
+            migrated += self.mongo.db.entries.bulk_write(ops, ordered=False).modified_count
+        return {'migrated': migrated, 'skipped': skipped}
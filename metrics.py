@@ -0,0 +1,256 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as Tally
+from contextvars import ContextVar
+from functools import wraps
+from flask import Response, g, request
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+METRICS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [f'{self.name}{_labels(self.labels, key)} {value}' for key, value in sorted(self._values.items())]
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            position = bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{_labels(self.labels + ("le",), key + (bound,))} {cumulative}')
+                lines.append(f'{self.name}_bucket{_labels(self.labels + ("le",), key + ("+Inf",))} {count}')
+                lines.append(f'{self.name}_sum{_labels(self.labels, key)} {total}')
+                lines.append(f'{self.name}_count{_labels(self.labels, key)} {count}')
+        return lines
+
+
+# Process-wide metrics rendered in the Prometheus text format. Each worker
+# process keeps its own, so scrape every worker (or run one per pod).
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+HTTP_REQUESTS = REGISTRY.add(Counter('http_requests_total', 'Requests by route and status', ('method', 'route', 'status')))
+HTTP_LATENCY = REGISTRY.add(Histogram('http_request_duration_seconds', 'Request latency', ('method', 'route')))
+HTTP_REQUEST_SIZE = REGISTRY.add(Histogram('http_request_size_bytes', 'Request body size', ('route',), SIZE_BUCKETS))
+HTTP_RESPONSE_SIZE = REGISTRY.add(Histogram('http_response_size_bytes', 'Response body size', ('route',), SIZE_BUCKETS))
+REQUEST_QUERIES = REGISTRY.add(Histogram('http_request_mongo_commands', 'Mongo commands issued per request', ('route',), COUNT_BUCKETS))
+REQUEST_MONGO_TIME = REGISTRY.add(Histogram('http_request_mongo_seconds', 'Mongo time spent per request', ('route',)))
+MONGO_COMMANDS = REGISTRY.add(Counter('mongo_commands_total', 'Mongo commands by outcome', ('command', 'collection', 'outcome')))
+MONGO_LATENCY = REGISTRY.add(Histogram('mongo_command_duration_seconds', 'Mongo command latency', ('command', 'collection')))
+MONGO_DOCUMENTS = REGISTRY.add(Counter('mongo_documents_returned_total', 'Documents returned by Mongo', ('collection',)))
+CRYPTO_LATENCY = REGISTRY.add(Histogram('crypto_duration_seconds', 'Encrypt/decrypt call latency', ('op',)))
+JOBS = REGISTRY.add(Counter('jobs_total', 'Background jobs by outcome', ('name', 'outcome')))
+JOB_LATENCY = REGISTRY.add(Histogram('job_duration_seconds', 'Background job run time', ('name',)))
+
+
+# What one request did, attributed through a context variable so Mongo
+# command events and crypto timings land on the request that caused them
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.documents = 0
+        self.crypto_seconds = 0.0
+        self.shapes = Tally()
+
+
+_current = ContextVar('request_stats', default=None)
+
+
+def timed(op):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                CRYPTO_LATENCY.observe(elapsed, op)
+                stats = _current.get()
+                if stats is not None:
+                    stats.crypto_seconds += elapsed
+        return wrapper
+    return decorator
+
+
+def _shape(value):
+    if isinstance(value, dict):
+        return {key: _shape(item) if key.startswith('$') or isinstance(item, dict) else '?' for key, item in value.items()}
+    if isinstance(value, list):
+        return [_shape(item) for item in value[:1]]
+    return '?'
+
+
+# Filter and sort of a command with the values blanked out, e.g.
+# find tasks {"user_id":"?"} sort {"created_at":-1,"_id":-1}
+def query_shape(command_name, command):
+    collection = command.get(command_name)
+    spec = command.get('filter', command.get('query'))
+    if command_name == 'aggregate':
+        spec = next((stage['$match'] for stage in command.get('pipeline', []) if '$match' in stage), None)
+    elif command_name in ('update', 'delete'):
+        statements = command.get('updates' if command_name == 'update' else 'deletes') or [{}]
+        spec = statements[0].get('q')
+    shape = f'{command_name} {collection}'
+    if spec is not None:
+        shape += ' ' + json.dumps(_shape(spec), separators=(',', ':'))
+    if command.get('sort'):
+        shape += ' sort ' + json.dumps(dict(command['sort']), separators=(',', ':'))
+    return shape
+
+
+def _returned(reply):
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+    if 'value' in reply:
+        return 1 if reply['value'] is not None else 0
+    return 0
+
+
+class CommandMetrics(monitoring.CommandListener):
+    def __init__(self):
+        self._started = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get('collection', '')
+        stats = _current.get()
+        shape = query_shape(event.command_name, event.command) if stats is not None else None
+        self._started[(event.connection_id, event.request_id)] = (collection, stats, shape)
+
+    def _finish(self, event, outcome, documents=0):
+        collection, stats, shape = self._started.pop((event.connection_id, event.request_id), ('', None, None))
+        seconds = event.duration_micros / 1e6
+        MONGO_COMMANDS.inc(event.command_name, collection, outcome)
+        MONGO_LATENCY.observe(seconds, event.command_name, collection)
+        if documents:
+            MONGO_DOCUMENTS.inc(collection, amount=documents)
+        if stats is not None:
+            stats.queries += 1
+            stats.query_seconds += seconds
+            stats.documents += documents
+            stats.shapes[shape] += 1
+
+    def succeeded(self, event):
+        self._finish(event, 'ok', _returned(event.reply))
+
+    def failed(self, event):
+        self._finish(event, 'error')
+
+
+# Request hooks and the /metrics endpoint. Requests slower than
+# SLOW_REQUEST_MS are logged with the query shapes they issued.
+def init_app(app):
+    slow_seconds = app.config.get('SLOW_REQUEST_MS', 0) / 1000
+
+    @app.before_request
+    def start_request():
+        g.request_started = time.perf_counter()
+        _current.set(RequestStats())
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUESTS.inc(request.method, route, response.status_code)
+        HTTP_LATENCY.observe(elapsed, request.method, route)
+        if request.content_length:
+            HTTP_REQUEST_SIZE.observe(request.content_length, route)
+        if not response.is_streamed:
+            HTTP_RESPONSE_SIZE.observe(response.calculate_content_length() or 0, route)
+
+        stats = _current.get()
+        if stats is not None:
+            REQUEST_QUERIES.observe(stats.queries, route)
+            REQUEST_MONGO_TIME.observe(stats.query_seconds, route)
+            if slow_seconds and elapsed >= slow_seconds:
+                logger.warning(
+                    'Slow request %s %s -> %s in %.1fms: %d mongo commands (%.1fms, %d docs), crypto %.1fms; shapes: %s',
+                    request.method, route, response.status_code, elapsed * 1000, stats.queries,
+                    stats.query_seconds * 1000, stats.documents, stats.crypto_seconds * 1000,
+                    '; '.join(f'{count}x {shape}' for shape, count in stats.shapes.most_common()),
+                )
+        return response
+
+    @app.teardown_request
+    def end_request(exc):
+        _current.set(None)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(REGISTRY.render(), mimetype=METRICS_MIMETYPE)
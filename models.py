@@ -1,17 +1,381 @@
+from operator import attrgetter
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta
+from analytics import HabitRollup, MoodRollup, parse_date
+from archive import Archive
+from encoding import encode_bytes, encode_datetime
+from pagination import paginate
+
+# Delta sync (see sync.py) reads changes through this index on every collection
+UPDATED_AT_INDEX = IndexModel([('user_id', ASCENDING), ('updated_at', ASCENDING), ('_id', ASCENDING)], name='user_updated_at')
+# Timeline range queries over tasks' and goals' due dates
+DUE_AT_INDEX = IndexModel([('user_id', ASCENDING), ('due_at', ASCENDING), ('_id', ASCENDING)], name='user_due_at')
+TOMBSTONE_RETENTION = timedelta(days=90)
+
+
+# Called with (collection, user_id, doc_ids) after every write, e.g. to
+# invalidate the response cache; doc_ids is None when the written documents
+# are not known
+write_listeners = []
+
+
+def notify_write(collection, user_id, doc_ids=None):
+    for listener in write_listeners:
+        listener(collection, user_id, doc_ids)
+
+
+class VersionConflict(Exception):
+    pass
+
+
+# Bad input for a model field; routes answer it with 400
+class ValidationError(ValueError):
+    pass
+
+
+# Partial update of a document owned by user_id in one round-trip. Only the
+# given fields are $set; inc holds atomic counters. Every write bumps the
+# document's version, and passing version makes the update conditional on it
+# (documents written before versioning count as version 0). Returns the
+# updated document, None if not found, or raises VersionConflict.
+def update_owned(mongo, model, object_id, user_id, fields, version=None, inc=None, unset=None):
+    try:
+        object_id = ObjectId(object_id)
+    except (InvalidId, TypeError):
+        return None
+
+    collection = mongo.db[model.COLLECTION]
+    query = {'_id': object_id, 'user_id': user_id}
+    if version is not None:
+        query['version'] = version if version else {'$in': [None, 0]}
+
+    update = {'$inc': dict(inc or {}, version=1), '$set': dict(fields or {}, updated_at=datetime.utcnow())}
+    if unset:
+        update['$unset'] = {field: '' for field in unset}
+
+    doc = collection.find_one_and_update(query, update, return_document=ReturnDocument.AFTER)
+    if doc is None and model.restore_archived(mongo, user_id, [object_id]):
+        doc = collection.find_one_and_update(query, update, return_document=ReturnDocument.AFTER)
+    if doc is None and version is not None:
+        if collection.count_documents({'_id': object_id, 'user_id': user_id}, limit=1):
+            raise VersionConflict()
+    if doc is not None:
+        notify_write(model.COLLECTION, user_id, [doc['_id']])
+    return doc
+
+
+# Deletes are hard deletes; a tombstone per deleted document lets sync
+# clients learn about them. Tombstones expire after TOMBSTONE_RETENTION.
+class Tombstone:
+    COLLECTION = 'tombstones'
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING), ('updated_at', ASCENDING), ('_id', ASCENDING)], name='user_updated_at'),
+        IndexModel([('updated_at', ASCENDING)], name='expire', expireAfterSeconds=int(TOMBSTONE_RETENTION.total_seconds())),
+    ]
+
+    @classmethod
+    def record(cls, mongo, collection, user_id, doc_ids):
+        now = datetime.utcnow()
+        mongo.db[cls.COLLECTION].insert_many([
+            {'collection': collection, 'doc_id': doc_id, 'user_id': user_id, 'updated_at': now}
+            for doc_id in doc_ids
+        ])
+
+
+# Events for the user (e.g. a time capsule opened), written for delivery
+# by whatever notifier consumes the collection
+class Notification:
+    COLLECTION = 'notifications'
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING)], name='user_created_at'),
+        IndexModel([('delivered', ASCENDING), ('created_at', ASCENDING)], name='delivered_created_at'),
+    ]
+
+    @classmethod
+    def enqueue(cls, mongo, user_id, kind, payload):
+        return mongo.db[cls.COLLECTION].insert_one({
+            'user_id': user_id,
+            'kind': kind,
+            'payload': payload,
+            'delivered': False,
+            'created_at': datetime.utcnow(),
+        })
+
+
+# Declared fields. Input is checked against type (numbers accept int or
+# float, never bool), lists against items; parse replaces the type check
+# with a converter that raises ValidationError. Fields with input=False are
+# set by the model, not the client. default may be a factory, e.g. list.
+NUMBER = (int, float)
+_BSON_TYPES = {
+    str: ['string'], int: ['int', 'long'], NUMBER: ['number'], bool: ['bool'], datetime: ['date'],
+    list: ['array'], bytes: ['binData'], dict: ['object'],
+}
+_JSON_ENCODERS = {datetime: encode_datetime, bytes: encode_bytes}
+_MISSING = object()
+
+
+class Field:
+    __slots__ = ('type', 'required', 'default', 'parse', 'items', 'input')
+
+    def __init__(self, type, required=False, default=None, parse=None, items=None, input=True):
+        self.type = type
+        self.required = required
+        self.default = default
+        self.parse = parse
+        self.items = items
+        self.input = input
+
+    def _is(self, value, kind):
+        return isinstance(value, kind) and (kind is bool or not isinstance(value, bool))
+
+    def check(self, name, value):
+        if value is None:
+            if self.required:
+                raise ValidationError(f'{name} is required')
+            return None
+        if self.parse:
+            return self.parse(value)
+        if not self._is(value, self.type) or (self.items and not all(self._is(item, self.items) for item in value)):
+            raise ValidationError(f'Invalid {name}')
+        return value
+
+    def bson_schema(self):
+        schema = {'bsonType': _BSON_TYPES[self.type] + ([] if self.required else ['null'])}
+        if self.items:
+            schema['items'] = {'bsonType': _BSON_TYPES[self.items]}
+        return schema
+
+
+# Builds each model from its FIELDS: __slots__ instead of a per-instance
+# dict, plus serializers compiled once per class so saving and encoding a
+# document never has to inspect the instance or the values' types.
+class ModelMeta(type):
+    def __new__(mcs, name, bases, namespace):
+        fields = namespace.get('FIELDS')
+        if fields is not None:
+            namespace['__slots__'] = tuple(fields)
+        cls = super().__new__(mcs, name, bases, namespace)
+        if fields is not None:
+            cls._compile(fields)
+        return cls
+
+    def _compile(cls, fields):
+        names = tuple(fields)
+        values = attrgetter(*names)
+        inputs = [(name, field) for name, field in fields.items() if field.input]
+        encoders = [(name, _JSON_ENCODERS[field.type]) for name, field in fields.items() if field.type in _JSON_ENCODERS]
+
+        def to_bson(self):
+            return dict(zip(names, values(self)))
+
+        def from_bson(model, doc):
+            obj = object.__new__(model)
+            for name in names:
+                setattr(obj, name, doc.get(name))
+            return obj
+
+        # Converts the declared datetime/bytes fields up front; anything
+        # else (e.g. legacy fields) is left to the JSON provider
+        def to_json(doc):
+            out = dict(doc)
+            if '_id' in out:
+                out['_id'] = str(out['_id'])
+            for name, encode in encoders:
+                value = out.get(name)
+                if value is not None:
+                    out[name] = encode(value)
+            return out
+
+        def validate(model, data, partial=False):
+            clean = {}
+            for name, field in inputs:
+                value = data.get(name, _MISSING)
+                if value is _MISSING:
+                    if partial:
+                        continue
+                    value = field.default() if callable(field.default) else field.default
+                    if value is None and field.required:
+                        raise ValidationError(f'{name} is required')
+                    clean[name] = value
+                else:
+                    clean[name] = field.check(name, value)
+            return clean
+
+        cls.to_bson = to_bson
+        cls.from_bson = classmethod(from_bson)
+        cls.to_json = staticmethod(to_json)
+        cls.validate = classmethod(validate)
+
+
+class Document(metaclass=ModelMeta):
+    __slots__ = ()
+
+    # Clean input fields from a request body; raises ValidationError
+    @classmethod
+    def from_data(cls, user_id, data):
+        return cls(user_id, **cls.validate(data))
+
+    # Validated $set fields for an update of the given UPDATABLE fields
+    @classmethod
+    def normalize_fields(cls, fields):
+        return cls.validate(fields, partial=True)
+
+    @classmethod
+    def serialize(cls, docs):
+        return [cls.to_json(doc) for doc in docs]
+
+    # $jsonSchema validator for the collection (see indexes.ensure_validators).
+    # Only declared fields are checked, so legacy extra fields are allowed.
+    @classmethod
+    def json_schema(cls):
+        return {'$jsonSchema': {
+            'bsonType': 'object',
+            'required': [name for name, field in cls.FIELDS.items() if field.required],
+            'properties': {name: field.bson_schema() for name, field in cls.FIELDS.items()},
+        }}
+
+    def save(self, mongo):
+        return mongo.db[self.COLLECTION].insert_one(self.to_bson())
+
+    @classmethod
+    def find_by_id(cls, mongo, object_id):
+        return mongo.db[cls.COLLECTION].find_one({"_id": ObjectId(object_id)})
+
+
+# A user's document: saves notify write listeners, and deletes leave a tombstone
+class OwnedDocument(Document):
+    __slots__ = ()
+
+    def save(self, mongo):
+        result = super().save(mongo)
+        notify_write(self.COLLECTION, self.user_id, [result.inserted_id])
+        return result
+
+    @classmethod
+    def find_by_user(cls, mongo, user_id, limit=None, after=None, fields=None):
+        return paginate(mongo.db[cls.COLLECTION], {"user_id": user_id}, cls.SORT_FIELD, limit, after, fields)
+
+    # Delete one of user_id's documents in one round-trip; returns the deleted
+    # document (user_id and projection only), or None if the id is malformed
+    # or not the user's
+    @classmethod
+    def delete_by_id(cls, mongo, object_id, user_id, projection=None):
+        try:
+            query = {'_id': ObjectId(object_id), 'user_id': user_id}
+        except (InvalidId, TypeError):
+            return None
+        doc = mongo.db[cls.COLLECTION].find_one_and_delete(query, dict.fromkeys(['user_id', *(projection or [])], 1))
+        if doc:
+            Tombstone.record(mongo, cls.COLLECTION, doc['user_id'], [doc['_id']])
+            notify_write(cls.COLLECTION, doc['user_id'], [doc['_id']])
+        return doc
+
+    # Bring any of the user's ids back from the archive; True if any were
+    @classmethod
+    def restore_archived(cls, mongo, user_id, ids):
+        return False
+
+
+# Documents older than ARCHIVE_AFTER_DAYS are moved into compressed monthly
+# archives (see archive.py). Reads that reach past what is still in the
+# collection restore the months they need first, so the API is unchanged.
+class ArchivedDocument(OwnedDocument):
+    __slots__ = ()
+
+    @classmethod
+    def find_by_user(cls, mongo, user_id, limit=None, after=None, fields=None):
+        Archive.rehydrate(mongo, cls, user_id, limit, after[0] if after else None)
+        return cls.find_hot_by_user(mongo, user_id, limit, after, fields)
+
+    # Collection only, for callers that rehydrate separately (asgi.py)
+    @classmethod
+    def find_hot_by_user(cls, mongo, user_id, limit=None, after=None, fields=None):
+        return super().find_by_user(mongo, user_id, limit, after, fields)
+
+    @classmethod
+    def find_by_id(cls, mongo, object_id, user_id=None):
+        doc = super().find_by_id(mongo, object_id)
+        if doc is None and cls.restore_archived(mongo, user_id, [object_id]):
+            doc = super().find_by_id(mongo, object_id)
+        return doc
+
+    @classmethod
+    def delete_by_id(cls, mongo, object_id, user_id, projection=None):
+        doc = super().delete_by_id(mongo, object_id, user_id, projection)
+        if doc is None and ObjectId.is_valid(object_id) and cls.restore_archived(mongo, user_id, [object_id]):
+            doc = super().delete_by_id(mongo, object_id, user_id, projection)
+        return doc
+
+    @classmethod
+    def restore_archived(cls, mongo, user_id, ids):
+        return user_id is not None and bool(Archive.restore_ids(mongo, cls, user_id, ids))
+
+
+def _owner():
+    return Field(str, required=True, input=False)
+
+
+def _timestamp():
+    return Field(datetime, required=True, input=False)
+
+
+def _version():
+    return Field(int, input=False)
+
+
+# open_date is stored as a naive UTC datetime; clients send ISO strings
+def parse_open_date(value):
+    if isinstance(value, datetime):
+        return parse_date(value.isoformat())
+    if not isinstance(value, str):
+        raise ValidationError('Invalid open_date')
+    try:
+        return parse_date(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValidationError('Invalid open_date')
+
+
+# due_date is free text from the client; due_at is its parsed form (None if
+# it is not an ISO date), which the timeline range-queries
+def parse_due_date(value):
+    try:
+        return parse_date(value.replace('Z', '+00:00')) if isinstance(value, str) else None
+    except ValueError:
+        return None
+
+
+def with_due_at(fields):
+    if 'due_date' in fields:
+        fields['due_at'] = parse_due_date(fields['due_date'])
+    return fields
+
+
+# Entry content arrives as text and is stored as a Fernet token
+def entry_text(value):
+    if not isinstance(value, str):
+        raise ValidationError('Invalid content')
+    return value
+
 
 # User Model
-class User:
-    def __init__(self, username, password, role='user'):
+class User(Document):
+    COLLECTION = 'users'
+    INDEXES = [IndexModel([('username', ASCENDING)], name='username_unique', unique=True)]
+    FIELDS = {
+        'username': Field(str, required=True),
+        'password': Field(str, required=True),
+        'role': Field(str, required=True, default='user'),
+    }
+
+    def __init__(self, username, password, role='user', hash_method='scrypt'):
         self.username = username
-        self.password = generate_password_hash(password)
+        self.password = generate_password_hash(password, hash_method)
         self.role = role
 
-    def save(self, mongo):
-        return mongo.db.users.insert_one(self.__dict__)
-
     @staticmethod
     def find_by_username(mongo, username):
         return mongo.db.users.find_one({"username": username})
@@ -21,203 +385,293 @@ class User:
 
 
 # Diary Entry Model
-class Entry:
-    def __init__(self, user_id, title, content, tags=[]):
+class Entry(ArchivedDocument):
+    COLLECTION = 'entries'
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)], name='user_timestamp'),
+        UPDATED_AT_INDEX,
+    ]
+    SORT_FIELD = 'timestamp'
+    UPDATABLE = ('title', 'content', 'tags')
+    FIELDS = {
+        'user_id': _owner(),
+        'title': Field(str),
+        'content': Field(bytes, required=True, parse=entry_text),
+        'tags': Field(list, default=list, items=str),
+        'key_id': Field(int, input=False),
+        # Completed uploads by attachment id (see attachments.AttachmentStore)
+        'attachments': Field(dict, input=False),
+        'timestamp': _timestamp(),
+        'updated_at': _timestamp(),
+        'version': _version(),
+    }
+
+    def __init__(self, user_id, title, content, tags=None, key_id=None):
         self.user_id = user_id
         self.title = title
         self.content = content
-        self.tags = tags
-        self.timestamp = datetime.utcnow()
+        self.tags = tags if tags is not None else []
+        self.key_id = key_id
+        self.attachments = {}
+        self.timestamp = self.updated_at = datetime.utcnow()
+        self.version = 0
 
-    def save(self, mongo):
-        return mongo.db.entries.insert_one(self.__dict__)
-
-    @staticmethod
-    def find_by_user(mongo, user_id):
-        return mongo.db.entries.find({"user_id": user_id})
-
-    @staticmethod
-    def find_by_id(mongo, entry_id):
-        return mongo.db.entries.find_one({"_id": ObjectId(entry_id)})
-
-    @staticmethod
-    def delete_by_id(mongo, entry_id):
-        return mongo.db.entries.delete_one({"_id": ObjectId(entry_id)})
+    # Projected content still needs key_id to pick its data key
+    @classmethod
+    def find_hot_by_user(cls, mongo, user_id, limit=None, after=None, fields=None):
+        if fields and 'content' in fields:
+            fields = [*fields, 'key_id']
+        return super().find_hot_by_user(mongo, user_id, limit, after, fields)
 
 
 # Task Model
-class Task:
+class Task(OwnedDocument):
+    COLLECTION = 'tasks'
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)], name='user_created_at'),
+        DUE_AT_INDEX,
+        UPDATED_AT_INDEX,
+    ]
+    SORT_FIELD = 'created_at'
+    UPDATABLE = ('title', 'description', 'due_date', 'is_completed')
+    FIELDS = {
+        'user_id': _owner(),
+        'title': Field(str, required=True),
+        'description': Field(str),
+        'due_date': Field(str),
+        'due_at': Field(datetime, input=False),
+        'is_completed': Field(bool, default=False),
+        'created_at': _timestamp(),
+        'updated_at': _timestamp(),
+        'version': _version(),
+    }
+
     def __init__(self, user_id, title, description, due_date, is_completed=False):
         self.user_id = user_id
         self.title = title
         self.description = description
         self.due_date = due_date
+        self.due_at = parse_due_date(due_date)
         self.is_completed = is_completed
-        self.created_at = datetime.utcnow()
+        self.created_at = self.updated_at = datetime.utcnow()
+        self.version = 0
 
-    def save(self, mongo):
-        return mongo.db.tasks.insert_one(self.__dict__)
-
-    @staticmethod
-    def find_by_user(mongo, user_id):
-        return mongo.db.tasks.find({"user_id": user_id})
-
-    @staticmethod
-    def find_by_id(mongo, task_id):
-        return mongo.db.tasks.find_one({"_id": ObjectId(task_id)})
-
-    @staticmethod
-    def delete_by_id(mongo, task_id):
-        return mongo.db.tasks.delete_one({"_id": ObjectId(task_id)})
+    @classmethod
+    def normalize_fields(cls, fields):
+        return with_due_at(super().normalize_fields(fields))
 
 
 # Goal Model with Milestones
-class Goal:
-    def __init__(self, user_id, title, description, milestones=[], due_date=None, is_completed=False):
+class Goal(OwnedDocument):
+    COLLECTION = 'goals'
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)], name='user_created_at'),
+        DUE_AT_INDEX,
+        UPDATED_AT_INDEX,
+    ]
+    SORT_FIELD = 'created_at'
+    UPDATABLE = ('title', 'description', 'milestones', 'due_date', 'is_completed')
+    FIELDS = {
+        'user_id': _owner(),
+        'title': Field(str, required=True),
+        'description': Field(str),
+        'milestones': Field(list, default=list),
+        'due_date': Field(str),
+        'due_at': Field(datetime, input=False),
+        'is_completed': Field(bool, default=False),
+        'created_at': _timestamp(),
+        'updated_at': _timestamp(),
+        'version': _version(),
+    }
+
+    def __init__(self, user_id, title, description, milestones=None, due_date=None, is_completed=False):
         self.user_id = user_id
         self.title = title
         self.description = description
-        self.milestones = milestones
+        self.milestones = milestones if milestones is not None else []
         self.due_date = due_date
+        self.due_at = parse_due_date(due_date)
         self.is_completed = is_completed
-        self.created_at = datetime.utcnow()
+        self.created_at = self.updated_at = datetime.utcnow()
+        self.version = 0
 
-    def save(self, mongo):
-        return mongo.db.goals.insert_one(self.__dict__)
-
-    @staticmethod
-    def find_by_user(mongo, user_id):
-        return mongo.db.goals.find({"user_id": user_id})
-
-    @staticmethod
-    def find_by_id(mongo, goal_id):
-        return mongo.db.goals.find_one({"_id": ObjectId(goal_id)})
-
-    @staticmethod
-    def delete_by_id(mongo, goal_id):
-        return mongo.db.goals.delete_one({"_id": ObjectId(goal_id)})
+    @classmethod
+    def normalize_fields(cls, fields):
+        return with_due_at(super().normalize_fields(fields))
 
 
 # Habit Model
-class Habit:
+class Habit(OwnedDocument):
+    COLLECTION = 'habits'
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)], name='user_created_at'),
+        UPDATED_AT_INDEX,
+    ]
+    SORT_FIELD = 'created_at'
+    UPDATABLE = ('title', 'frequency', 'progress', 'goal')
+    FIELDS = {
+        'user_id': _owner(),
+        'title': Field(str, required=True),
+        'frequency': Field(str, default='daily'),
+        'progress': Field(NUMBER, default=0),
+        'goal': Field(NUMBER, default=0),
+        'created_at': _timestamp(),
+        'updated_at': _timestamp(),
+        'version': _version(),
+    }
+
     def __init__(self, user_id, title, frequency='daily', progress=0, goal=0):
         self.user_id = user_id
         self.title = title
         self.frequency = frequency
         self.progress = progress
         self.goal = goal
-        self.created_at = datetime.utcnow()
-
-    def save(self, mongo):
-        return mongo.db.habits.insert_one(self.__dict__)
+        self.created_at = self.updated_at = datetime.utcnow()
+        self.version = 0
 
+    # Check-in rollups go with habits deleted through /batch
     @staticmethod
-    def find_by_user(mongo, user_id):
-        return mongo.db.habits.find({"user_id": user_id})
-
-    @staticmethod
-    def find_by_id(mongo, habit_id):
-        return mongo.db.habits.find_one({"_id": ObjectId(habit_id)})
-
-    @staticmethod
-    def delete_by_id(mongo, habit_id):
-        return mongo.db.habits.delete_one({"_id": ObjectId(habit_id)})
+    def after_bulk_delete(mongo, user_id, habit_ids):
+        for habit_id in habit_ids:
+            HabitRollup.forget(mongo, user_id, habit_id)
 
 
 # Mood Tracking Model
-class Mood:
+class Mood(ArchivedDocument):
+    COLLECTION = 'moods'
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING), ('date', DESCENDING), ('_id', DESCENDING)], name='user_date'),
+        UPDATED_AT_INDEX,
+    ]
+    SORT_FIELD = 'date'
+    UPDATABLE = ('mood', 'note', 'rating')
+    FIELDS = {
+        'user_id': _owner(),
+        'mood': Field(str, required=True),
+        'note': Field(str, default=''),
+        'rating': Field(NUMBER, default=0),
+        'date': _timestamp(),
+        'updated_at': _timestamp(),
+        'version': _version(),
+    }
+
     def __init__(self, user_id, mood, note='', rating=0):
         self.user_id = user_id
         self.mood = mood
         self.note = note
         self.rating = rating
-        self.date = datetime.utcnow()
+        self.date = self.updated_at = datetime.utcnow()
+        self.version = 0
 
     def save(self, mongo):
-        return mongo.db.moods.insert_one(self.__dict__)
-
-    @staticmethod
-    def find_by_user(mongo, user_id):
-        return mongo.db.moods.find({"user_id": user_id})
-
-    @staticmethod
-    def find_by_id(mongo, mood_id):
-        return mongo.db.moods.find_one({"_id": ObjectId(mood_id)})
+        result = mongo.db.moods.insert_one(self.to_bson())
+        MoodRollup.record(mongo, {'user_id': self.user_id, 'date': self.date, 'mood': self.mood, 'rating': self.rating})
+        notify_write(self.COLLECTION, self.user_id, [result.inserted_id])
+        return result
 
+    # Keep daily rollups in step with /batch writes
     @staticmethod
-    def delete_by_id(mongo, mood_id):
-        return mongo.db.moods.delete_one({"_id": ObjectId(mood_id)})
+    def after_bulk_write(mongo, user_id, docs):
+        for day in {doc['date'].date() for doc in docs if doc.get('date')}:
+            MoodRollup.refresh(mongo, user_id, day)
 
 
 # Class Schedule Model
-class ClassSchedule:
-    def __init__(self, user_id, course_name, start_time, end_time, location='', days_of_week=[]):
+class ClassSchedule(OwnedDocument):
+    COLLECTION = 'class_schedules'
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING), ('_id', DESCENDING)], name='user_id'),
+        UPDATED_AT_INDEX,
+    ]
+    SORT_FIELD = '_id'
+    UPDATABLE = ('course_name', 'start_time', 'end_time', 'location', 'days_of_week')
+    FIELDS = {
+        'user_id': _owner(),
+        'course_name': Field(str, required=True),
+        'start_time': Field(str),
+        'end_time': Field(str),
+        'location': Field(str, default=''),
+        'days_of_week': Field(list, default=list, items=str),
+        'updated_at': _timestamp(),
+        'version': _version(),
+    }
+
+    def __init__(self, user_id, course_name, start_time, end_time, location='', days_of_week=None):
         self.user_id = user_id
         self.course_name = course_name
         self.start_time = start_time
         self.end_time = end_time
         self.location = location
-        self.days_of_week = days_of_week
-
-    def save(self, mongo):
-        return mongo.db.class_schedules.insert_one(self.__dict__)
-
-    @staticmethod
-    def find_by_user(mongo, user_id):
-        return mongo.db.class_schedules.find({"user_id": user_id})
-
-    @staticmethod
-    def find_by_id(mongo, schedule_id):
-        return mongo.db.class_schedules.find_one({"_id": ObjectId(schedule_id)})
-
-    @staticmethod
-    def delete_by_id(mongo, schedule_id):
-        return mongo.db.class_schedules.delete_one({"_id": ObjectId(schedule_id)})
+        self.days_of_week = days_of_week if days_of_week is not None else []
+        self.updated_at = datetime.utcnow()
+        self.version = 0
 
 
 # Gratitude Model
-class Gratitude:
-    def __init__(self, user_id, content, tags=[]):
+class Gratitude(ArchivedDocument):
+    COLLECTION = 'gratitude'
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)], name='user_timestamp'),
+        UPDATED_AT_INDEX,
+    ]
+    SORT_FIELD = 'timestamp'
+    UPDATABLE = ('content', 'tags')
+    FIELDS = {
+        'user_id': _owner(),
+        'content': Field(str, required=True),
+        'tags': Field(list, default=list, items=str),
+        'timestamp': _timestamp(),
+        'updated_at': _timestamp(),
+        'version': _version(),
+    }
+
+    def __init__(self, user_id, content, tags=None):
         self.user_id = user_id
         self.content = content
-        self.tags = tags
-        self.timestamp = datetime.utcnow()
-
-    def save(self, mongo):
-        return mongo.db.gratitude.insert_one(self.__dict__)
-
-    @staticmethod
-    def find_by_user(mongo, user_id):
-        return mongo.db.gratitude.find({"user_id": user_id})
-
-    @staticmethod
-    def find_by_id(mongo, gratitude_id):
-        return mongo.db.gratitude.find_one({"_id": ObjectId(gratitude_id)})
-
-    @staticmethod
-    def delete_by_id(mongo, gratitude_id):
-        return mongo.db.gratitude.delete_one({"_id": ObjectId(gratitude_id)})
+        self.tags = tags if tags is not None else []
+        self.timestamp = self.updated_at = datetime.utcnow()
+        self.version = 0
 
 
 # Time Capsule Model
-class TimeCapsule:
+class TimeCapsule(OwnedDocument):
+    COLLECTION = 'timecapsule'
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING), ('opened', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)], name='user_opened_timestamp'),
+        IndexModel([('opened', ASCENDING), ('open_date', ASCENDING)], name='opened_open_date'),
+        UPDATED_AT_INDEX,
+    ]
+    SORT_FIELD = 'timestamp'
+    UPDATABLE = ('content', 'open_date')
+    FIELDS = {
+        'user_id': _owner(),
+        'content': Field(str, required=True),
+        'open_date': Field(datetime, required=True, parse=parse_open_date),
+        # Flipped by capsules.CapsuleScheduler once open_date has passed
+        'opened': Field(bool, required=True, input=False),
+        'timestamp': _timestamp(),
+        'updated_at': _timestamp(),
+        'version': _version(),
+    }
+    parse_open_date = staticmethod(parse_open_date)
+
     def __init__(self, user_id, content, open_date):
         self.user_id = user_id
         self.content = content
-        self.open_date = open_date
-        self.timestamp = datetime.utcnow()
-
-    def save(self, mongo):
-        return mongo.db.timecapsule.insert_one(self.__dict__)
-
-    @staticmethod
-    def find_by_user_and_date(mongo, user_id, current_date):
-        return mongo.db.timecapsule.find({"user_id": user_id, "open_date": {"$lte": current_date}})
-
-    @staticmethod
-    def find_by_id(mongo, capsule_id):
-        return mongo.db.timecapsule.find_one({"_id": ObjectId(capsule_id)})
-
-    @staticmethod
-    def delete_by_id(mongo, capsule_id):
-        return mongo.db.timecapsule.delete_one({"_id": ObjectId(capsule_id)})
+        self.open_date = parse_open_date(open_date)
+        self.opened = self.open_date <= datetime.utcnow()
+        self.timestamp = self.updated_at = datetime.utcnow()
+        self.version = 0
+
+    # Also keep the opened flag consistent with a new open_date
+    @classmethod
+    def normalize_fields(cls, fields):
+        fields = super().normalize_fields(fields)
+        if fields.get('open_date') is not None:
+            fields['opened'] = fields['open_date'] <= datetime.utcnow()
+        return fields
+
+    @classmethod
+    def find_opened_by_user(cls, mongo, user_id, limit=None, after=None, fields=None):
+        query = {"user_id": user_id, "opened": True}
+        return paginate(mongo.db.timecapsule, query, cls.SORT_FIELD, limit, after, fields)
@@ -0,0 +1,134 @@
+import gzip
+import io
+import json
+import zlib
+from flask import Request, current_app, request
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge, UnsupportedMediaType
+from cache import MemoryBackend
+from encoding import MSGPACK_MIMETYPES, unpackb
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE = ('application/json', 'text/plain', 'text/html') + MSGPACK_MIMETYPES
+_MISSING = object()
+
+
+def _gunzip(data, limit):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    body = decompressor.decompress(data, limit + 1)
+    if len(body) > limit:
+        raise RequestEntityTooLarge()
+    if not decompressor.eof:
+        raise BadRequest('Truncated gzip body')
+    return body
+
+
+def _unzstd(data, limit):
+    body = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)).read(limit + 1)
+    if len(body) > limit:
+        raise RequestEntityTooLarge()
+    return body
+
+
+DECODERS = {'gzip': _gunzip, 'x-gzip': _gunzip}
+DECODE_ERRORS = (ValueError, zlib.error)
+if zstandard is not None:
+    DECODERS['zstd'] = _unzstd
+    DECODE_ERRORS += (zstandard.ZstdError,)
+
+
+# Request bodies may be MessagePack (Content-Type: application/msgpack) and
+# gzip- or zstd-compressed (Content-Encoding). Decompressed size is capped
+# by MAX_DECODED_BODY_BYTES, since MAX_CONTENT_LENGTH only sees the wire size.
+class APIRequest(Request):
+    _decoded_body = _MISSING
+
+    def get_json(self, force=False, silent=False, cache=True):
+        encoding = self.headers.get('Content-Encoding', 'identity').strip().lower()
+        msgpack_body = self.mimetype in MSGPACK_MIMETYPES
+        if encoding == 'identity' and not msgpack_body:
+            return super().get_json(force, silent, cache)
+        if cache and self._decoded_body is not _MISSING:
+            return self._decoded_body
+        if not (force or msgpack_body or self.is_json):
+            return super().get_json(force, silent, cache)
+
+        decode = DECODERS.get(encoding)
+        if decode is None and encoding != 'identity':
+            raise UnsupportedMediaType(f'Unsupported Content-Encoding: {encoding}')
+        data = self.get_data(cache=cache)
+        try:
+            body = decode(data, current_app.config['MAX_DECODED_BODY_BYTES']) if decode else data
+            value = unpackb(body) if msgpack_body else json.loads(body)
+        except DECODE_ERRORS as e:
+            if silent:
+                return None
+            raise BadRequest('Failed to decode request body') from e
+        if cache:
+            self._decoded_body = value
+        return value
+
+
+# Compresses responses of at least min_size bytes with the best encoding the
+# client accepts (zstd, then gzip). Bodies with a strong ETag are compressed
+# once per encoding and kept in a small LRU, so cached list pages and
+# unchanged resources are served pre-compressed; their ETag becomes weak.
+class Compressor:
+    def __init__(self, min_size=1024, gzip_level=6, zstd_level=3, cache_size=1000):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.zstd_level = zstd_level
+        self.encodings = ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+        self.compressed = MemoryBackend(cache_size)
+
+    def compress(self, encoding, data):
+        if encoding == 'zstd':
+            return zstandard.ZstdCompressor(level=self.zstd_level).compress(data)
+        return gzip.compress(data, self.gzip_level, mtime=0)
+
+    def __call__(self, response):
+        if response.mimetype not in COMPRESSIBLE:
+            return response
+        response.vary.add('Accept-Encoding')
+        if (response.direct_passthrough or response.is_streamed or response.status_code in (204, 304)
+                or 'Content-Encoding' in response.headers or (response.content_length or 0) < self.min_size):
+            return response
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+
+        etag, weak = response.get_etag()
+        key = f'{etag}:{encoding}' if etag and not weak else None
+        body = self.compressed.get(key) if key else None
+        if body is None:
+            body = self.compress(encoding, response.get_data())
+            if key:
+                self.compressed.set(key, body)
+        response.set_data(body)
+        response.headers['Content-Encoding'] = encoding
+        if etag:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+# MessagePack responses come from the JSON provider (see encoding.py); this
+# adds the request side and response compression
+def init_app(app):
+    app.request_class = APIRequest
+    compressor = None
+    if app.config['COMPRESS_MIN_BYTES']:
+        compressor = Compressor(
+            app.config['COMPRESS_MIN_BYTES'],
+            app.config['COMPRESS_GZIP_LEVEL'],
+            app.config['COMPRESS_ZSTD_LEVEL'],
+            app.config['COMPRESS_CACHE_SIZE'],
+        )
+
+    @app.after_request
+    def negotiate(response):
+        if response.mimetype == 'application/json' or response.mimetype in MSGPACK_MIMETYPES:
+            response.vary.add('Accept')
+        return compressor(response) if compressor else response
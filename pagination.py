@@ -0,0 +1,86 @@
+import base64
+import re
+from bson import json_util
+from flask import current_app, request
+
+FIELD_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class PageError(ValueError):
+    pass
+
+
+# Opaque cursor: base64 of the last document's sort key and _id
+def encode_cursor(doc, sort_field):
+    payload = json_util.dumps({'v': doc.get(sort_field), 'id': doc['_id']})
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token):
+    try:
+        payload = json_util.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        return payload['v'], payload['id']
+    except Exception:
+        raise PageError('Invalid cursor')
+
+
+# Read limit / cursor / fields from the query string
+def page_args():
+    default_size = current_app.config.get('DEFAULT_PAGE_SIZE', 100)
+    max_size = current_app.config.get('MAX_PAGE_SIZE', 500)
+
+    try:
+        limit = int(request.args.get('limit', default_size))
+    except ValueError:
+        raise PageError('Invalid limit')
+    if limit < 1:
+        raise PageError('Invalid limit')
+    limit = min(limit, max_size)
+
+    after = request.args.get('cursor')
+    if after:
+        after = decode_cursor(after)
+
+    fields = request.args.get('fields')
+    if fields:
+        fields = [f.strip() for f in fields.split(',') if f.strip()]
+        if not all(FIELD_NAME.match(f) for f in fields):
+            raise PageError('Invalid fields')
+
+    return limit, after, fields or None
+
+
+# Keyset query over (sort_field, _id), newest first. Fetches one extra
+# document so the caller can tell whether another page exists.
+def paginate(collection, query, sort_field='_id', limit=None, after=None, fields=None):
+    query = dict(query)
+    if after:
+        value, last_id = after
+        if sort_field == '_id':
+            query['_id'] = {'$lt': last_id}
+        else:
+            query['$or'] = [
+                {sort_field: {'$lt': value}},
+                {sort_field: value, '_id': {'$lt': last_id}},
+            ]
+
+    projection = None
+    if fields:
+        projection = {f: 1 for f in fields}
+        projection[sort_field] = 1
+
+    sort = [('_id', -1)] if sort_field == '_id' else [(sort_field, -1), ('_id', -1)]
+    cursor = collection.find(query, projection).sort(sort)
+    if limit:
+        cursor = cursor.limit(limit + 1)
+    return cursor
+
+
+# Split a paginate() result into the page and the next cursor token
+def split_page(docs, sort_field, limit):
+    docs = list(docs)
+    next_cursor = None
+    if limit and len(docs) > limit:
+        docs = docs[:limit]
+        next_cursor = encode_cursor(docs[-1], sort_field)
+    return docs, next_cursor
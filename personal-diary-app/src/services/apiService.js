@@ -1,4 +1,5 @@
 import axios from 'axios';
+import { decode } from '@msgpack/msgpack';
 import { getData, saveData, removeData } from './storageService';
 
 // Define the base URL for your API
@@ -15,17 +16,49 @@ const getAuthToken = async () => {
   }
 };
 
+// Ask the API for MessagePack instead of JSON (smaller list responses)
+let binaryTransport = false;
+export const setBinaryTransport = (enabled) => {
+  binaryTransport = enabled;
+};
+
+// Decode MessagePack bodies; anything else (e.g. error messages) is JSON
+const decodeResponse = (data, headers) => {
+  const contentType = headers['content-type'] || '';
+  if (contentType.includes('msgpack')) {
+    return decode(new Uint8Array(data));
+  }
+  const text = typeof data === 'string' ? data : new TextDecoder().decode(data);
+  return text ? JSON.parse(text) : text;
+};
+
 // Create an axios instance with the Authorization header
 const apiClient = async () => {
   const token = await getAuthToken();
+  const headers = { Authorization: `Bearer ${token}` };
+  if (!binaryTransport) {
+    return axios.create({ baseURL: API_BASE_URL, headers });
+  }
   return axios.create({
     baseURL: API_BASE_URL,
-    headers: {
-      Authorization: `Bearer ${token}`,
-    },
+    headers: { ...headers, Accept: 'application/msgpack' },
+    responseType: 'arraybuffer',
+    transformResponse: [decodeResponse],
   });
 };
 
+// Follow X-Next-Cursor headers until the list endpoint is exhausted
+const fetchAllPages = async (client, path) => {
+  const items = [];
+  let cursor = null;
+  do {
+    const response = await client.get(path, { params: cursor ? { cursor } : {} });
+    items.push(...response.data);
+    cursor = response.headers['x-next-cursor'];
+  } while (cursor);
+  return items;
+};
+
 // User Authentication
 export const loginUser = async (username, password) => {
   try {
@@ -62,8 +95,7 @@ export const logoutUser = async () => {
 export const getEntries = async () => {
   try {
     const client = await apiClient();
-    const response = await client.get('/entries');
-    return response.data;
+    return await fetchAllPages(client, '/entries');
   } catch (error) {
     console.error('Error fetching entries:', error);
     throw error;
@@ -107,8 +139,7 @@ export const deleteEntry = async (entryId) => {
 export const getTasks = async () => {
   try {
     const client = await apiClient();
-    const response = await client.get('/tasks');
-    return response.data;
+    return await fetchAllPages(client, '/tasks');
   } catch (error) {
     console.error('Error fetching tasks:', error);
     throw error;
@@ -152,8 +183,7 @@ export const deleteTask = async (taskId) => {
 export const getGoals = async () => {
   try {
     const client = await apiClient();
-    const response = await client.get('/goals');
-    return response.data;
+    return await fetchAllPages(client, '/goals');
   } catch (error) {
     console.error('Error fetching goals:', error);
     throw error;
@@ -197,8 +227,7 @@ export const deleteGoal = async (goalId) => {
 export const getHabits = async () => {
   try {
     const client = await apiClient();
-    const response = await client.get('/habits');
-    return response.data;
+    return await fetchAllPages(client, '/habits');
   } catch (error) {
     console.error('Error fetching habits:', error);
     throw error;
@@ -227,6 +256,17 @@ export const updateHabit = async (habitId, updatedData) => {
   }
 };
 
+export const checkInHabit = async (habitId, amount = 1) => {
+  try {
+    const client = await apiClient();
+    const response = await client.post(`/habits/${habitId}/checkin`, { amount });
+    return response.data;
+  } catch (error) {
+    console.error('Error checking in habit:', error);
+    throw error;
+  }
+};
+
 export const deleteHabit = async (habitId) => {
   try {
     const client = await apiClient();
@@ -242,8 +282,7 @@ export const deleteHabit = async (habitId) => {
 export const getMoods = async () => {
   try {
     const client = await apiClient();
-    const response = await client.get('/moods');
-    return response.data;
+    return await fetchAllPages(client, '/moods');
   } catch (error) {
     console.error('Error fetching moods:', error);
     throw error;
@@ -283,12 +322,35 @@ export const deleteMood = async (moodId) => {
   }
 };
 
+// Analytics
+// params: { from, to } as ISO dates, plus granularity ('day' | 'week' | 'month') for moods
+export const getMoodStats = async (params = {}) => {
+  try {
+    const client = await apiClient();
+    const response = await client.get('/moods/stats', { params });
+    return response.data;
+  } catch (error) {
+    console.error('Error fetching mood stats:', error);
+    throw error;
+  }
+};
+
+export const getHabitStats = async (params = {}) => {
+  try {
+    const client = await apiClient();
+    const response = await client.get('/habits/stats', { params });
+    return response.data;
+  } catch (error) {
+    console.error('Error fetching habit stats:', error);
+    throw error;
+  }
+};
+
 // Class Schedules
 export const getClassSchedules = async () => {
   try {
     const client = await apiClient();
-    const response = await client.get('/classes');
-    return response.data;
+    return await fetchAllPages(client, '/classes');
   } catch (error) {
     console.error('Error fetching class schedules:', error);
     throw error;
@@ -332,8 +394,7 @@ export const deleteClassSchedule = async (scheduleId) => {
 export const getGratitudeEntries = async () => {
   try {
     const client = await apiClient();
-    const response = await client.get('/gratitude');
-    return response.data;
+    return await fetchAllPages(client, '/gratitude');
   } catch (error) {
     console.error('Error fetching gratitude entries:', error);
     throw error;
@@ -377,8 +438,7 @@ export const deleteGratitudeEntry = async (entryId) => {
 export const getTimeCapsules = async () => {
   try {
     const client = await apiClient();
-    const response = await client.get('/timecapsule');
-    return response.data;
+    return await fetchAllPages(client, '/timecapsule');
   } catch (error) {
     console.error('Error fetching time capsules:', error);
     throw error;
@@ -417,3 +477,63 @@ export const deleteTimeCapsule = async (capsuleId) => {
     throw error;
   }
 };
+
+// Batch writes
+// operations: [{ resource: 'tasks', op: 'create' | 'update' | 'delete', id, data }]
+export const runBatch = async (operations, ordered = true) => {
+  try {
+    const client = await apiClient();
+    const response = await client.post('/batch', { operations, ordered });
+    return response.data.results;
+  } catch (error) {
+    console.error('Error running batch:', error);
+    throw error;
+  }
+};
+
+// Timeline: entries, moods, task/goal due dates and class occurrences in
+// time order. from/to are ISO dates; defaults to the week starting today.
+export const getTimelineEvents = async (from = null, to = null) => {
+  try {
+    const client = await apiClient();
+    const params = {};
+    if (from) params.from = from;
+    if (to) params.to = to;
+    const items = [];
+    let cursor = null;
+    do {
+      const response = await client.get('/timeline', { params: cursor ? { ...params, cursor } : params });
+      items.push(...response.data);
+      cursor = response.headers['x-next-cursor'];
+    } while (cursor);
+    return items;
+  } catch (error) {
+    console.error('Error fetching timeline:', error);
+    throw error;
+  }
+};
+
+// Delta sync: pass the `next` token from the previous call (or null for a
+// fresh start, which asks for a full fetch through the list endpoints)
+export const syncChanges = async (since = null) => {
+  try {
+    const client = await apiClient();
+    const response = await client.get('/sync', { params: since ? { since } : {} });
+    return response.data;
+  } catch (error) {
+    console.error('Error syncing changes:', error);
+    throw error;
+  }
+};
+
+// Search diary and gratitude entries
+export const searchEntries = async (q, limit = 20) => {
+  try {
+    const client = await apiClient();
+    const response = await client.get('/search', { params: { q, limit } });
+    return response.data;
+  } catch (error) {
+    console.error('Error searching entries:', error);
+    throw error;
+  }
+};
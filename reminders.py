@@ -0,0 +1,589 @@
+import logging
+import math
+import threading
+import urllib.request
+from datetime import datetime, time, timedelta
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
+from encoding import dumps
+from models import Document, Field, Notification, ValidationError
+from tasks import reminder_document_job, reminder_job
+from timeline import parse_time_of_day, parse_weekdays
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+# Reminder sources by collection: (resource, lead time setting, title field,
+# projection). Times are naive UTC like everything else the API stores.
+SOURCES = {
+    'tasks': ('tasks', 'due_lead_minutes', 'title', {'title': 1, 'due_at': 1, 'is_completed': 1}),
+    'goals': ('goals', 'due_lead_minutes', 'title', {'title': 1, 'due_at': 1, 'is_completed': 1}),
+    'habits': ('habits', None, 'title', {'title': 1, 'frequency': 1, 'created_at': 1}),
+    'class_schedules': ('classes', 'class_lead_minutes', 'course_name',
+                        {'course_name': 1, 'start_time': 1, 'days_of_week': 1}),
+    # Capsule content stays out of reminders; opening itself is notified by
+    # capsules.CapsuleScheduler
+    'timecapsule': ('timecapsule', 'capsule_lead_minutes', None, {'open_date': 1, 'opened': 1}),
+}
+# Stored fields that decide whether a recomputed reminder changed
+COMPARED = ('fire_at', 'event_at', 'last_event_at', 'title')
+RELOAD_OVERLAP = timedelta(seconds=30)
+
+
+def _seconds(value):
+    return (value - EPOCH).total_seconds()
+
+
+# Hierarchical timing wheel: levels rings of slots, where a slot on level n
+# spans slots ** n ticks. Adding and cancelling a timer are dict operations;
+# when a ring wraps, the next slot of the ring above is cascaded down, so a
+# timer moves at most levels - 1 times before it fires. Timers past the top
+# ring wait in an overflow bucket that is re-checked once per top slot.
+# Timers fire on the first tick at or after their time, never before it,
+# and advancing skips straight over stretches where nothing can fire.
+class TimingWheel:
+    def __init__(self, tick=1.0, slots=64, levels=4, now=0.0):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self._spans = [slots ** level for level in range(levels)]
+        self._rings = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._overflow = {}
+        self._ready = {}
+        # key -> (level, bucket); level is None when ready, levels in overflow
+        self._timers = {}
+        self._counts = [0] * (levels + 1)
+        self._current = math.floor(now / tick)
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def _place(self, key, at, value):
+        delta = at - self._current
+        if delta <= 0:
+            level, bucket = None, self._ready
+        else:
+            level, bucket = self.levels, self._overflow
+            for n, span in enumerate(self._spans):
+                if delta < span * self.slots:
+                    level, bucket = n, self._rings[n][(at // span) % self.slots]
+                    break
+            self._counts[level] += 1
+        bucket[key] = (at, value)
+        self._timers[key] = (level, bucket)
+
+    # Schedule key at when (in the wheel's time unit), replacing any timer
+    # already set for it
+    def add(self, key, when, value=None):
+        if key in self._timers:
+            self.remove(key)
+        self._place(key, math.ceil(when / self.tick), value)
+
+    def remove(self, key):
+        entry = self._timers.pop(key, None)
+        if entry is None:
+            return False
+        level, bucket = entry
+        del bucket[key]
+        if level is not None:
+            self._counts[level] -= 1
+        return True
+
+    # Every timer in a bucket is on the same level
+    def _fire(self, bucket, level, due):
+        for key, (_, value) in bucket.items():
+            del self._timers[key]
+            due.append((key, value))
+        if level is not None:
+            self._counts[level] -= len(bucket)
+        bucket.clear()
+
+    def _replace(self, bucket, level):
+        timers = list(bucket.items())
+        self._counts[level] -= len(timers)
+        bucket.clear()
+        for key, (at, value) in timers:
+            self._place(key, at, value)
+
+    # Upper rings first, so timers cascaded into a lower ring's current
+    # slot are cascaded again (or fired) on this same tick
+    def _cascade(self):
+        if self._current % self._spans[-1] == 0 and self._overflow:
+            self._replace(self._overflow, self.levels)
+        for level in range(self.levels - 1, 0, -1):
+            span = self._spans[level]
+            if self._current % span == 0:
+                self._replace(self._rings[level][(self._current // span) % self.slots], level)
+
+    # The next tick at which a timer can fire or cascade: the next slot
+    # boundary of the lowest ring holding any timers
+    def _next_tick(self):
+        for level, count in enumerate(self._counts):
+            if count:
+                span = self._spans[min(level, self.levels - 1)]
+                return (self._current // span + 1) * span
+        return None
+
+    # The earliest time (in the wheel's unit) any timer is due, or None. A
+    # ring only holds timers past its current slot, so the first occupied
+    # slot after it has that ring's earliest timers.
+    def next_expiry(self):
+        if self._ready:
+            return self._current * self.tick
+        earliest = None
+        for level, span in enumerate(self._spans):
+            if not self._counts[level]:
+                continue
+            ring, position = self._rings[level], self._current // span
+            for offset in range(1, self.slots + 1):
+                bucket = ring[(position + offset) % self.slots]
+                if bucket:
+                    at = min(at for at, _ in bucket.values())
+                    earliest = at if earliest is None else min(earliest, at)
+                    break
+        if self._overflow:
+            at = min(at for at, _ in self._overflow.values())
+            earliest = at if earliest is None else min(earliest, at)
+        return None if earliest is None else earliest * self.tick
+
+    # Move the wheel to now; returns (key, value) for every timer due by then
+    def advance(self, now):
+        target = math.floor(now / self.tick)
+        due = []
+        self._fire(self._ready, None, due)
+        while self._current < target:
+            next_tick = self._next_tick()
+            if next_tick is None or next_tick > target:
+                self._current = target
+                break
+            self._current = next_tick
+            self._cascade()
+            self._fire(self._ready, None, due)
+            self._fire(self._rings[0][self._current % self.slots], 0, due)
+        return due
+
+
+def _time_setting(value):
+    at = parse_time_of_day(value) if isinstance(value, str) else None
+    if at is None:
+        raise ValidationError('Invalid habit_time')
+    return at.strftime('%H:%M')
+
+
+def _minutes_setting(value):
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= 7 * 24 * 60:
+        raise ValidationError('Invalid lead time')
+    return value
+
+
+# A user's reminder preferences, _id being the user id. Only what the user
+# changed is stored; everything else comes from the REMINDER_* defaults.
+class ReminderSettings(Document):
+    COLLECTION = 'reminder_settings'
+    INDEXES = []
+    FIELDS = {
+        'tasks': Field(bool),
+        'goals': Field(bool),
+        'habits': Field(bool),
+        'classes': Field(bool),
+        'timecapsule': Field(bool),
+        'due_lead_minutes': Field(int, parse=_minutes_setting),
+        'class_lead_minutes': Field(int, parse=_minutes_setting),
+        'capsule_lead_minutes': Field(int, parse=_minutes_setting),
+        'habit_time': Field(str, parse=_time_setting),
+        'updated_at': Field(datetime, required=True, input=False),
+    }
+
+
+# The pending reminder of each source document, sharing its _id.
+# last_event_at is the event last reminded of, so recomputing never repeats it.
+class Reminder:
+    COLLECTION = 'reminders'
+    INDEXES = [
+        IndexModel([('fire_at', ASCENDING)], name='fire_at'),
+        IndexModel([('user_id', ASCENDING), ('fire_at', ASCENDING)], name='user_fire_at'),
+        IndexModel([('updated_at', ASCENDING)], name='updated_at'),
+    ]
+
+    @staticmethod
+    def to_json(reminder):
+        return {
+            'id': str(reminder['_id']),
+            'resource': reminder['resource'],
+            'title': reminder.get('title'),
+            'event_at': reminder['event_at'],
+            'fire_at': reminder['fire_at'],
+        }
+
+
+def _next_weekly(days, at, after):
+    day = after.date()
+    for _ in range(8):
+        if day.weekday() in days and datetime.combine(day, at) > after:
+            return datetime.combine(day, at)
+        day += timedelta(days=1)
+    return None
+
+
+# The source's first event after after, or None
+def next_event(collection, doc, settings, after):
+    if collection in ('tasks', 'goals'):
+        due = doc.get('due_at')
+        return due if due and not doc.get('is_completed') and due > after else None
+    if collection == 'timecapsule':
+        open_date = doc.get('open_date')
+        return open_date if isinstance(open_date, datetime) and not doc.get('opened') and open_date > after else None
+    if collection == 'habits':
+        if doc.get('frequency') == 'weekly':
+            days = {(doc.get('created_at') or after).weekday()}
+        elif doc.get('frequency') == 'daily':
+            days = set(range(7))
+        else:
+            return None
+        return _next_weekly(days, parse_time_of_day(settings['habit_time']), after)
+    # Classes without a readable start time are all-day; remind before midnight
+    days = parse_weekdays(doc.get('days_of_week'))
+    return _next_weekly(days, parse_time_of_day(doc.get('start_time')) or time(), after) if days else None
+
+
+# The reminder to store for a source document, or None: its first event
+# after both now and the last one reminded of, lead minutes early. A fire
+# time that has already passed fires on the engine's next tick.
+def next_reminder(collection, doc, settings, now, last_event=None):
+    resource, lead, title, _ = SOURCES[collection]
+    if not settings[resource]:
+        return None
+    event = next_event(collection, doc, settings, max(now, last_event) if last_event else now)
+    if event is None:
+        return None
+    return {
+        '_id': doc['_id'],
+        'user_id': doc['user_id'],
+        'collection': collection,
+        'resource': resource,
+        'title': doc.get(title) if title else None,
+        'event_at': event,
+        'fire_at': event - timedelta(minutes=settings[lead] if lead else 0),
+        'last_event_at': last_event,
+        'updated_at': now,
+    }
+
+
+# Once nothing is left to remind of, a reminder that fired is kept without
+# a fire_at, so the event it fired for is not reminded of again
+def _spent(reminder, last_event, now):
+    if not last_event:
+        return None
+    return dict(reminder, event_at=None, fire_at=None, last_event_at=last_event, updated_at=now)
+
+
+def _unchanged(reminder):
+    return {'_id': reminder['_id'], 'fire_at': reminder['fire_at'], 'last_event_at': reminder.get('last_event_at')}
+
+
+class LogSink:
+    def deliver(self, reminder):
+        logger.info('Reminder for %s: %s %s at %s', reminder['user_id'], reminder['resource'], reminder['id'],
+                    reminder['event_at'])
+
+
+# Keeps delivered reminders in memory, for tests
+class MemorySink:
+    def __init__(self):
+        self.delivered = []
+
+    def deliver(self, reminder):
+        self.delivered.append(reminder)
+
+
+# A 'reminder' notification, the same way capsule openings are delivered
+class NotificationSink:
+    def __init__(self, mongo):
+        self.mongo = mongo
+
+    def deliver(self, reminder):
+        Notification.enqueue(self.mongo, reminder['user_id'], 'reminder', reminder)
+
+
+# POSTs each reminder as JSON. A failed POST is logged and not retried; the
+# reminder has already been claimed.
+class WebhookSink:
+    def __init__(self, url, timeout=5):
+        self.url = url
+        self.timeout = timeout
+
+    def deliver(self, reminder):
+        request = urllib.request.Request(
+            self.url, dumps(reminder).encode('utf-8'), {'Content-Type': 'application/json'}, method='POST',
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except OSError:
+            logger.exception('Reminder webhook failed for %s', reminder['id'])
+
+
+def create_sink(mongo, config):
+    sink = config['REMINDER_SINK']
+    if sink == 'notification':
+        return NotificationSink(mongo)
+    if sink == 'log':
+        return LogSink()
+    if sink == 'memory':
+        return MemorySink()
+    if sink == 'webhook':
+        return WebhookSink(config['REMINDER_WEBHOOK_URL'], config['REMINDER_WEBHOOK_TIMEOUT'])
+    raise ValueError(f'Unknown REMINDER_SINK: {sink}')
+
+
+# Keeps each source document's next reminder in the reminders collection and
+# fires them. A write to a source document queues a refresh of that one
+# document's reminder (see listener), which only rewrites it if it changed.
+# Reminders due within the horizon sit in a timing wheel; the thread ticks
+# it and claims each due reminder with a conditional write that also stores
+# the source's next one, so several engines can run side by side and each
+# reminder reaches the sink exactly once. Reloads after the first only read
+# reminders changed since the last one, plus those the horizon moved over.
+class ReminderEngine:
+    def __init__(self, mongo, sink, defaults, tick=1.0, horizon=timedelta(hours=24), reload_interval=60):
+        self.mongo = mongo
+        self.sink = sink
+        self.defaults = defaults
+        self.tick = tick
+        self.horizon = horizon
+        self.reload_interval = reload_interval
+        self._wheel = TimingWheel(tick, now=_seconds(datetime.utcnow()))
+        self._horizon_end = None
+        self._last_reload = None
+        self._next_reload = None
+        self._wakeup = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, mongo, config):
+        defaults = {
+            'tasks': True, 'goals': True, 'habits': True, 'classes': True, 'timecapsule': True,
+            'due_lead_minutes': config['REMINDER_DUE_LEAD_MINUTES'],
+            'class_lead_minutes': config['REMINDER_CLASS_LEAD_MINUTES'],
+            'capsule_lead_minutes': config['REMINDER_CAPSULE_LEAD_MINUTES'],
+            'habit_time': config['REMINDER_HABIT_TIME'],
+        }
+        return cls(
+            mongo, create_sink(mongo, config), defaults, config['REMINDER_TICK_SECONDS'],
+            timedelta(seconds=config['REMINDER_HORIZON_SECONDS']), config['REMINDER_RELOAD_SECONDS'],
+        )
+
+    @property
+    def collection(self):
+        return self.mongo.db[Reminder.COLLECTION]
+
+    def settings(self, user_id):
+        stored = self.mongo.db[ReminderSettings.COLLECTION].find_one({'_id': user_id}) or {}
+        return dict(self.defaults, **{name: value for name, value in stored.items()
+                                      if name in self.defaults and value is not None})
+
+    # Validates and stores the given fields; returns the merged settings
+    def update_settings(self, user_id, data):
+        fields = ReminderSettings.validate(data, partial=True)
+        fields['updated_at'] = datetime.utcnow()
+        self.mongo.db[ReminderSettings.COLLECTION].update_one({'_id': user_id}, {'$set': fields}, upsert=True)
+        return self.settings(user_id)
+
+    # Write listener: a burst of writes to one document costs one refresh;
+    # writes that do not say which documents changed refresh the collection
+    def listener(self, jobs):
+        def on_write(collection, user_id, doc_ids=None):
+            if collection not in SOURCES:
+                return
+            if doc_ids is None:
+                jobs.enqueue(*reminder_job(collection, user_id))
+            else:
+                jobs.enqueue_many([reminder_document_job(collection, user_id, doc_id) for doc_id in doc_ids])
+        return on_write
+
+    def upcoming(self, user_id, limit=100):
+        query = {'user_id': user_id, 'fire_at': {'$ne': None}}
+        reminders = self.collection.find(query).sort('fire_at', ASCENDING).limit(limit)
+        return [Reminder.to_json(reminder) for reminder in reminders]
+
+    # Store new (None to delete) in place of old, unless another writer got
+    # there first; returns True if written
+    def _write(self, old, new):
+        try:
+            if old is None:
+                return new is None or bool(self.collection.insert_one(new).inserted_id)
+            if new is None:
+                return bool(self.collection.delete_one(_unchanged(old)).deleted_count)
+            return bool(self.collection.replace_one(_unchanged(old), new).matched_count)
+        except DuplicateKeyError:
+            return False
+
+    def _store(self, collection, doc, settings, now, old):
+        for _ in range(3):
+            last_event = old and old.get('last_event_at')
+            new = next_reminder(collection, doc, settings, now, last_event) or (old and _spent(old, last_event, now))
+            if old is None and new is None:
+                return False
+            if old and new and all(old.get(name) == new[name] for name in COMPARED):
+                return False
+            if self._write(old, new):
+                self._track(doc['_id'], new)
+                return True
+            old = self.collection.find_one({'_id': doc['_id']})
+        return False
+
+    # Recompute the user's reminders for one source collection; returns how
+    # many were written or removed
+    def refresh(self, collection, user_id, now=None):
+        now = now or datetime.utcnow()
+        settings = self.settings(user_id)
+        existing = {r['_id']: r for r in self.collection.find({'user_id': user_id, 'collection': collection})}
+        changed = 0
+        for doc in self.mongo.db[collection].find({'user_id': user_id}, SOURCES[collection][3]):
+            doc['user_id'] = user_id
+            changed += self._store(collection, doc, settings, now, existing.pop(doc['_id'], None))
+        for old in existing.values():
+            if self._write(old, None):
+                self._track(old['_id'], None)
+                changed += 1
+        return changed
+
+    # Recompute one source document's reminder, removing it if the document
+    # is gone; returns True if it was written or removed
+    def refresh_document(self, collection, user_id, doc_id, now=None):
+        now = now or datetime.utcnow()
+        old = self.collection.find_one({'_id': doc_id, 'user_id': user_id})
+        doc = self.mongo.db[collection].find_one({'_id': doc_id, 'user_id': user_id}, SOURCES[collection][3])
+        if doc is None:
+            if old is None or not self._write(old, None):
+                return False
+            self._track(doc_id, None)
+            return True
+        doc['user_id'] = user_id
+        return self._store(collection, doc, self.settings(user_id), now, old)
+
+    # Every user's reminders, e.g. after changing the REMINDER_* defaults
+    def rebuild(self):
+        refreshed = {}
+        for collection in SOURCES:
+            users = self.mongo.db[collection].distinct('user_id')
+            refreshed[collection] = sum(self.refresh(collection, user_id) for user_id in users)
+        return refreshed
+
+    # Mirror a stored change in the wheel, if this engine is running
+    def _track(self, reminder_id, reminder):
+        with self._wakeup:
+            if self._horizon_end is None:
+                return
+            if reminder is None or reminder['fire_at'] is None or reminder['fire_at'] > self._horizon_end:
+                self._wheel.remove(reminder_id)
+            else:
+                self._wheel.add(reminder_id, _seconds(reminder['fire_at']), reminder['fire_at'])
+                self._wakeup.notify()
+
+    def reload(self, now=None):
+        now = now or datetime.utcnow()
+        horizon_end = now + self.horizon
+        if self._horizon_end is None:
+            query = {'fire_at': {'$lte': horizon_end}}
+        else:
+            query = {'$or': [
+                {'fire_at': {'$gt': self._horizon_end, '$lte': horizon_end}},
+                {'updated_at': {'$gte': self._last_reload - RELOAD_OVERLAP}, 'fire_at': {'$lte': horizon_end}},
+            ]}
+        pending = list(self.collection.find(query, {'fire_at': 1}))
+        with self._wakeup:
+            for reminder in pending:
+                self._wheel.add(reminder['_id'], _seconds(reminder['fire_at']), reminder['fire_at'])
+            self._horizon_end = horizon_end
+            self._last_reload = now
+            self._next_reload = now + timedelta(seconds=self.reload_interval)
+            self._wakeup.notify()
+        return len(pending)
+
+    # Claim one due reminder, storing the source's next one. The sink is only
+    # called if the claim wins and the source still has this event.
+    def _fire(self, reminder_id, fire_at, now, settings):
+        reminder = self.collection.find_one({'_id': reminder_id, 'fire_at': fire_at})
+        if reminder is None:
+            return None
+        collection, user_id = reminder['collection'], reminder['user_id']
+        doc = self.mongo.db[collection].find_one({'_id': reminder_id}, SOURCES[collection][3])
+        if user_id not in settings:
+            settings[user_id] = self.settings(user_id)
+        current = None
+        if doc is not None:
+            doc['user_id'] = user_id
+            # Events due at fire_at itself (no lead time) must still count
+            since = fire_at - timedelta(milliseconds=1)
+            current = next_reminder(collection, doc, settings[user_id], since, reminder.get('last_event_at'))
+        if current is None or current['event_at'] != reminder['event_at']:
+            # Changed since it was stored and the refresh has not caught up
+            if doc is None:
+                self._write(reminder, None)
+            else:
+                self._store(collection, doc, settings[user_id], now, reminder)
+            return None
+
+        new = (next_reminder(collection, doc, settings[user_id], now, reminder['event_at'])
+               or _spent(reminder, reminder['event_at'], now))
+        if not self._write(reminder, new):
+            return None
+        self._track(reminder_id, new)
+        return dict(Reminder.to_json(reminder), user_id=user_id)
+
+    # Fire everything due by now; returns the delivered reminders
+    def run_due(self, now=None):
+        now = now or datetime.utcnow()
+        with self._wakeup:
+            due = self._wheel.advance(_seconds(now))
+        delivered, settings = [], {}
+        for reminder_id, fire_at in due:
+            reminder = self._fire(reminder_id, fire_at, now, settings)
+            if reminder is None:
+                continue
+            try:
+                self.sink.deliver(reminder)
+            except Exception:
+                logger.exception('Reminder sink failed for %s', reminder['id'])
+            delivered.append(reminder)
+        return delivered
+
+    # Until the next reload or the earliest timer, whichever comes first;
+    # _track notifies when an earlier timer is added
+    def _seconds_until_next(self, now):
+        if self._next_reload is None:
+            return self.reload_interval
+        wait = (self._next_reload - now).total_seconds()
+        expiry = self._wheel.next_expiry()
+        if expiry is not None:
+            wait = min(wait, expiry - _seconds(now))
+        return max(wait, 0)
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                now = datetime.utcnow()
+                if self._next_reload is None or now >= self._next_reload:
+                    self.reload(now)
+                self.run_due(now)
+            except Exception:
+                logger.exception('Reminder engine pass failed')
+            with self._wakeup:
+                # stop() may have notified while this pass ran
+                if not self._stop.is_set():
+                    self._wakeup.wait(min(self._seconds_until_next(datetime.utcnow()), self.reload_interval))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name='reminder-engine', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._wakeup:
+            self._wakeup.notify()
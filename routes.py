@@ -1,10 +1,282 @@
-from flask import Blueprint, request, jsonify
+import math
+from datetime import timedelta
+from functools import partial
+from urllib.parse import quote
+from flask import Blueprint, Response, current_app, request, jsonify, stream_with_context
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
-from models import User, Entry, Task, Goal, Habit, Mood, ClassSchedule, Gratitude, TimeCapsule
-from utils import encrypt_content, decrypt_content, generate_key
+from pymongo.errors import PyMongoError
+from analytics import GRANULARITIES, HabitRollup, MoodRollup, parse_range
+from attachments import AttachmentError
+from auth import Authenticator, RateLimited
+from batch import run_batch
+from encoding import NDJSON_MIMETYPE, ndjson_lines, response_mimetype, wants_stream
+from jobs import JobQueue, MemoryBroker
+from models import (
+    Entry, Task, Goal, Habit, Mood, ClassSchedule, Gratitude, TimeCapsule, ValidationError, VersionConflict, update_owned,
+)
+from pagination import PageError, page_args, split_page
+from search import FIELD_WEIGHTS
+from sync import SyncError, SyncTokenExpired, changes_since, decode_token
+from reminders import SOURCES as REMINDER_SOURCES
+from tasks import mood_day_job, purge_attachments_job, register_tasks, reindex_job, reminder_job, thumbnail_job
+from timeline import TimelineError, decode_cursor, parse_window, timeline
+
+# Decrypting serializer for a batch of the user's entries
+def make_entry_serializer(keystore, user_id):
+    def serialize(entries):
+        output = []
+        for entry in entries:
+            entry_data = {'id': entry['_id']}
+            for field in ('title', 'tags', 'timestamp'):
+                if field in entry:
+                    entry_data[field] = entry[field]
+            # Only the metadata; files are fetched from /attachments/<id>
+            if entry.get('attachments'):
+                entry_data['attachments'] = [dict(meta, id=attachment_id) for attachment_id, meta in entry['attachments'].items()]
+            output.append(entry_data)
 
-def create_routes(mongo):
+        with_content = [i for i, entry in enumerate(entries) if 'content' in entry]
+        # Key ids let the keystore notice a rotation made by another process
+        _, cipher = keystore.cipher(user_id, {entries[i].get('key_id') for i in with_content})
+        contents = keystore.decrypt_entries(cipher, [entries[i] for i in with_content])
+        for i, content in zip(with_content, contents):
+            output[i]['content'] = content
+        return output
+
+    return serialize
+
+def create_routes(mongo, keystore, cache=None, search_index=None, auth=None, scheduler=None, jobs=None, reminders=None,
+                  attachments=None):
     api_bp = Blueprint('api', __name__)
+    if auth is None:
+        auth = Authenticator(mongo)
+    # Without a queue, secondary work runs inline as part of the request
+    if jobs is None:
+        jobs = JobQueue(MemoryBroker(), eager=True)
+        register_tasks(jobs, mongo, keystore, search_index, reminders, attachments)
+
+    # Model field validation failures, from creates, updates and /batch
+    @api_bp.errorhandler(ValidationError)
+    def validation_error(e):
+        return jsonify({'message': str(e)}), 400
+
+    # Shared list handler: keyset pagination with an optional field projection.
+    # The next page token is returned in the X-Next-Cursor header. With
+    # ?stream=1 or Accept: application/x-ndjson the whole remaining result is
+    # streamed one document per line instead. Pages carry an ETag, and when
+    # cache_as names the collection they are also served from the response
+    # cache until the next write to it.
+    def list_response(find, sort_field, serialize=None, cache_as=None):
+        try:
+            limit, after, fields = page_args()
+        except PageError as e:
+            return jsonify({'message': str(e)}), 400
+
+        if wants_stream():
+            lines = ndjson_lines(find(after=after, fields=fields), serialize)
+            return Response(stream_with_context(lines), mimetype=NDJSON_MIMETYPE)
+
+        cache_key = cached = None
+        mimetype = response_mimetype()
+        if cache is not None and cache_as:
+            # JSON and MessagePack pages are cached separately
+            cache_key = cache.key(get_jwt_identity(), cache_as, request.query_string + b'|' + mimetype.encode())
+            cached = cache.get(cache_key)
+        if cached:
+            etag, next_cursor, body = cached
+            response = current_app.response_class(body, mimetype=mimetype)
+            response.set_etag(etag)
+        else:
+            docs, next_cursor = split_page(find(limit=limit, after=after, fields=fields), sort_field, limit)
+            output = serialize(docs) if serialize else docs
+            response = jsonify(output)
+            response.add_etag()
+            if cache_key:
+                cache.set(cache_key, response.get_etag()[0], next_cursor, response.get_data())
+
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response.make_conditional(request)
+
+    entry_serializer = partial(make_entry_serializer, keystore)
+
+    # Shared update handler: a single find_one_and_update of the supplied
+    # fields. A version in the body (or If-Match) makes it conditional.
+    def update_response(model, object_id, data, not_found, updated, fields=None, inc=None, unset=None, on_update=None):
+        if fields is None:
+            fields = model.normalize_fields({f: data[f] for f in model.UPDATABLE if f in data})
+
+        version = data.get('version', request.headers.get('If-Match'))
+        if version is not None:
+            try:
+                version = int(str(version).strip('"'))
+            except ValueError:
+                return jsonify({'message': 'Invalid version'}), 400
+
+        try:
+            doc = update_owned(mongo, model, object_id, get_jwt_identity(), fields, version, inc, unset)
+        except VersionConflict:
+            return jsonify({'message': 'Version conflict'}), 409
+        if doc is None:
+            return jsonify({'message': not_found}), 404
+        if on_update:
+            on_update(doc)
+        return jsonify({'message': updated, 'version': doc['version']}), 200
+
+    # Batch writes: {"ordered": true, "operations": [{"resource", "op", "id", "data"}]}
+    @api_bp.route('/batch', methods=['POST'])
+    @jwt_required()
+    def batch():
+        current_user_id = get_jwt_identity()
+        data = request.get_json() or {}
+        operations = data.get('operations')
+
+        if not isinstance(operations, list) or not operations:
+            return jsonify({'message': 'operations must be a non-empty list'}), 400
+        if len(operations) > current_app.config['MAX_BATCH_SIZE']:
+            return jsonify({'message': 'Too many operations'}), 413
+
+        def encrypt_entry_fields(fields):
+            if 'content' in fields:
+                fields['content'], fields['key_id'] = keystore.encrypt(current_user_id, fields['content'])
+            return fields
+
+        results = run_batch(mongo, current_user_id, operations, data.get('ordered', True), {Entry: encrypt_entry_fields})
+
+        if search_index:
+            jobs.enqueue_many([
+                reindex_job(operation['resource'], result['id'])
+                for operation, result in zip(operations, results)
+                if isinstance(operation, dict) and operation.get('resource') in ('entries', 'gratitude')
+                and result['status'] in (200, 201)
+            ])
+        if attachments is not None:
+            jobs.enqueue_many([
+                purge_attachments_job(current_user_id, result['id'])
+                for operation, result in zip(operations, results)
+                if isinstance(operation, dict) and operation.get('resource') == 'entries' and operation.get('op') == 'delete'
+                and result['status'] == 200
+            ])
+        return jsonify({'results': results}), 200
+
+    # Ranked search over the user's diary and gratitude entries
+    @api_bp.route('/search', methods=['GET'])
+    @jwt_required()
+    def search():
+        current_user_id = get_jwt_identity()
+        query = request.args.get('q', '').strip()
+        if not query:
+            return jsonify({'message': 'q is required'}), 400
+        try:
+            limit = min(max(int(request.args.get('limit', 20)), 1), 100)
+        except ValueError:
+            return jsonify({'message': 'Invalid limit'}), 400
+        if not search_index:
+            return jsonify([]), 200
+
+        hits = search_index.search(current_user_id, query, limit)
+        found = {}
+        for model, serialize in ((Entry, entry_serializer(current_user_id)), (Gratitude, None)):
+            ids = [doc_id for collection, doc_id, _ in hits if collection == model.COLLECTION]
+            if not ids:
+                continue
+            docs = list(mongo.db[model.COLLECTION].find({'_id': {'$in': ids}, 'user_id': current_user_id}))
+            if len(docs) < len(ids) and model.restore_archived(mongo, current_user_id, ids):
+                docs = list(mongo.db[model.COLLECTION].find({'_id': {'$in': ids}, 'user_id': current_user_id}))
+            for doc, item in zip(docs, serialize(docs) if serialize else docs):
+                found[doc['_id']] = item
+
+        output = [
+            {'resource': collection, 'score': score, 'item': found[doc_id]}
+            for collection, doc_id, score in hits if doc_id in found
+        ]
+        return jsonify(output), 200
+
+    # Entries, moods, task and goal due dates and class occurrences merged
+    # in time order: /timeline?from=&to=, paged through X-Next-Cursor
+    @api_bp.route('/timeline', methods=['GET'])
+    @jwt_required()
+    def get_timeline():
+        current_user_id = get_jwt_identity()
+        try:
+            start, end = parse_window(request.args, current_app.config['TIMELINE_MAX_DAYS'])
+            after = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+            limit = min(max(int(request.args.get('limit', current_app.config['TIMELINE_LIMIT'])), 1),
+                        current_app.config['TIMELINE_LIMIT'])
+        except TimelineError as e:
+            return jsonify({'message': str(e)}), 400
+        except ValueError:
+            return jsonify({'message': 'Invalid limit'}), 400
+
+        items, next_cursor = timeline(mongo, current_user_id, start, end, limit, after)
+        response = jsonify(items)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+
+    # The user's next reminders, soonest first
+    @api_bp.route('/reminders', methods=['GET'])
+    @jwt_required()
+    def get_reminders():
+        if reminders is None:
+            return jsonify([]), 200
+        try:
+            limit = min(max(int(request.args.get('limit', 100)), 1), 500)
+        except ValueError:
+            return jsonify({'message': 'Invalid limit'}), 400
+        return jsonify(reminders.upcoming(get_jwt_identity(), limit)), 200
+
+    # Which resources remind, lead times in minutes and the habit time (UTC)
+    @api_bp.route('/reminders/settings', methods=['GET', 'PUT'])
+    @jwt_required()
+    def reminder_settings():
+        current_user_id = get_jwt_identity()
+        if reminders is None:
+            return jsonify({'message': 'Reminders are not enabled'}), 404
+        if request.method == 'GET':
+            return jsonify(reminders.settings(current_user_id)), 200
+
+        data = request.get_json()
+        if not isinstance(data, dict):
+            return jsonify({'message': 'Settings must be an object'}), 400
+        settings = reminders.update_settings(current_user_id, data)
+        jobs.enqueue_many([reminder_job(collection, current_user_id) for collection in REMINDER_SOURCES])
+        return jsonify(settings), 200
+
+    # Delta sync across all resources: /sync?since=<token>
+    @api_bp.route('/sync', methods=['GET'])
+    @jwt_required()
+    def sync():
+        current_user_id = get_jwt_identity()
+        try:
+            since = request.args.get('since')
+            result = changes_since(
+                mongo,
+                current_user_id,
+                decode_token(since) if since else None,
+                current_app.config['SYNC_LIMIT'],
+                timedelta(seconds=current_app.config['SYNC_OVERLAP_SECONDS']),
+                {Entry: entry_serializer(current_user_id)},
+            )
+        except SyncTokenExpired as e:
+            return jsonify({'message': str(e)}), 410
+        except SyncError as e:
+            return jsonify({'message': str(e)}), 400
+        return jsonify(result), 200
+
+    # Liveness: no database round-trip, just this worker's pool usage
+    @api_bp.route('/healthz', methods=['GET'])
+    def healthz():
+        return jsonify({'status': 'ok', 'pool': mongo.pool_stats()}), 200
+
+    # Readiness: the database answers a ping within READYZ_TIMEOUT_MS
+    @api_bp.route('/readyz', methods=['GET'])
+    def readyz():
+        try:
+            latency = mongo.ping(current_app.config['READYZ_TIMEOUT_MS'] / 1000)
+        except PyMongoError as e:
+            return jsonify({'status': 'unavailable', 'error': str(e), 'pool': mongo.pool_stats()}), 503
+        return jsonify({'status': 'ok', 'ping_ms': round(latency, 2), 'pool': mongo.pool_stats()}), 200
 
     # User Registration
     @api_bp.route('/register', methods=['POST'])
@@ -14,11 +286,8 @@ def create_routes(mongo):
         password = data.get('password')
         role = data.get('role', 'user')
 
-        if User.find_by_username(mongo, username):
+        if not auth.register(username, password, role):
             return jsonify({'message': 'User already exists'}), 400
-
-        user = User(username, password, role)
-        user.save(mongo)
         return jsonify({'message': 'User registered successfully'}), 201
 
     # User Login
@@ -28,8 +297,13 @@ def create_routes(mongo):
         username = data.get('username')
         password = data.get('password')
 
-        user_data = User.find_by_username(mongo, username)
-        if not user_data or not User(user_data['username'], user_data['password']).check_password(password):
+        try:
+            user_data = auth.authenticate(username, password, request.remote_addr)
+        except RateLimited as e:
+            response = jsonify({'message': str(e)})
+            response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+            return response, 429
+        if not user_data:
             return jsonify({'message': 'Invalid credentials'}), 401
 
         access_token = create_access_token(identity=str(user_data['_id']))
@@ -41,70 +315,190 @@ def create_routes(mongo):
     def create_entry():
         current_user_id = get_jwt_identity()
         data = request.get_json()
-        title = data.get('title')
-        content = data.get('content')
-        tags = data.get('tags', [])
-
-        key = generate_key()
-        encrypted_content = encrypt_content(content, key)
-
-        entry = Entry(current_user_id, title, encrypted_content, tags)
-        entry.save(mongo)
+        entry = Entry.from_data(current_user_id, data)
+        entry.content, entry.key_id = keystore.encrypt(current_user_id, entry.content)
+        result = entry.save(mongo)
+        if search_index:
+            jobs.enqueue(*reindex_job(Entry.COLLECTION, result.inserted_id))
         return jsonify({'message': 'Entry created successfully'}), 201
 
     @api_bp.route('/entries', methods=['GET'])
     @jwt_required()
     def get_entries():
         current_user_id = get_jwt_identity()
-        entries = Entry.find_by_user(mongo, current_user_id)
-        output = []
-        for entry in entries:
-            entry_data = {
-                'id': str(entry['_id']),
-                'title': entry['title'],
-                'content': decrypt_content(entry['content'], entry['key']),
-                'tags': entry['tags'],
-                'timestamp': entry['timestamp']
-            }
-            output.append(entry_data)
-        return jsonify(output), 200
+        find = partial(Entry.find_by_user, mongo, current_user_id)
+        return list_response(find, Entry.SORT_FIELD, entry_serializer(current_user_id))
 
     @api_bp.route('/entries/<entry_id>', methods=['PUT'])
     @jwt_required()
     def update_entry(entry_id):
         current_user_id = get_jwt_identity()
         data = request.get_json()
-        entry = Entry.find_by_id(mongo, entry_id)
+        fields = Entry.normalize_fields({f: data[f] for f in Entry.UPDATABLE if f in data})
 
-        if not entry or entry['user_id'] != current_user_id:
-            return jsonify({'message': 'Entry not found'}), 404
+        unset = None
+        if 'content' in fields:
+            fields['content'], fields['key_id'] = keystore.encrypt(current_user_id, fields['content'])
+            unset = ['key']
 
-        entry['title'] = data.get('title', entry['title'])
-        entry['content'] = encrypt_content(data.get('content', decrypt_content(entry['content'], entry['key'])), entry['key'])
-        entry['tags'] = data.get('tags', entry['tags'])
-        mongo.db.entries.save(entry)
+        def reindex(entry):
+            if search_index and any(f in data for f in FIELD_WEIGHTS):
+                jobs.enqueue(*reindex_job(Entry.COLLECTION, entry['_id']))
 
-        return jsonify({'message': 'Entry updated successfully'}), 200
+        return update_response(
+            Entry, entry_id, data, 'Entry not found', 'Entry updated successfully', fields,
+            unset=unset, on_update=reindex,
+        )
 
     @api_bp.route('/entries/<entry_id>', methods=['DELETE'])
     @jwt_required()
     def delete_entry(entry_id):
         current_user_id = get_jwt_identity()
-        entry = Entry.find_by_id(mongo, entry_id)
-
-        if not entry or entry['user_id'] != current_user_id:
+        entry = Entry.delete_by_id(mongo, entry_id, current_user_id, ['attachments'])
+        if not entry:
             return jsonify({'message': 'Entry not found'}), 404
-
-        Entry.delete_by_id(mongo, entry_id)
+        if search_index:
+            jobs.enqueue(*reindex_job(Entry.COLLECTION, entry['_id']))
+        if attachments is not None and entry.get('attachments'):
+            jobs.enqueue(*purge_attachments_job(current_user_id, entry['_id']))
         return jsonify({'message': 'Entry deleted successfully'}), 200
 
+    # Attachment uploads: create with {filename, content_type, size}, then
+    # PUT each chunk's raw bytes, in any order and as often as needed; the
+    # status lists the chunks received so an interrupted upload resumes.
+    # complete adds the attachment to the entry.
+    def find_attachment(attachment_id):
+        if attachments is None:
+            return None
+        return attachments.get(get_jwt_identity(), attachment_id)
+
+    @api_bp.route('/entries/<entry_id>/attachments', methods=['POST'])
+    @jwt_required()
+    def create_attachment(entry_id):
+        if attachments is None:
+            return jsonify({'message': 'Entry not found'}), 404
+        data = request.get_json()
+        if not isinstance(data, dict):
+            return jsonify({'message': 'Attachment must be an object'}), 400
+        try:
+            attachment = attachments.create(get_jwt_identity(), entry_id, data)
+        except AttachmentError as e:
+            return jsonify({'message': str(e)}), 400
+        if attachment is None:
+            return jsonify({'message': 'Entry not found'}), 404
+        return jsonify(attachments.status(attachment)), 201
+
+    @api_bp.route('/attachments/<attachment_id>/chunks/<int:n>', methods=['PUT'])
+    @jwt_required()
+    def put_attachment_chunk(attachment_id, n):
+        attachment = find_attachment(attachment_id)
+        if attachment is None:
+            return jsonify({'message': 'Attachment not found'}), 404
+        # Read no more than one chunk, whatever the client claims to send
+        limit = attachment['chunk_size']
+        if request.content_length is not None and request.content_length > limit:
+            return jsonify({'message': 'Chunk too large'}), 413
+        data = request.stream.read(limit + 1)
+        if len(data) > limit:
+            return jsonify({'message': 'Chunk too large'}), 413
+        try:
+            attachments.put_chunk(attachment, n, data)
+        except AttachmentError as e:
+            return jsonify({'message': str(e)}), 409 if attachment['status'] != 'uploading' else 400
+        return '', 204
+
+    @api_bp.route('/attachments/<attachment_id>/status', methods=['GET'])
+    @jwt_required()
+    def attachment_status(attachment_id):
+        attachment = find_attachment(attachment_id)
+        if attachment is None:
+            return jsonify({'message': 'Attachment not found'}), 404
+        return jsonify(attachments.status(attachment)), 200
+
+    @api_bp.route('/attachments/<attachment_id>/complete', methods=['POST'])
+    @jwt_required()
+    def complete_attachment(attachment_id):
+        attachment = find_attachment(attachment_id)
+        if attachment is None:
+            return jsonify({'message': 'Attachment not found'}), 404
+        try:
+            missing = attachments.complete(attachment)
+        except AttachmentError as e:
+            return jsonify({'message': str(e)}), 404
+        if missing:
+            return jsonify({'message': 'Upload incomplete', 'missing': missing}), 409
+        jobs.enqueue(*thumbnail_job(attachment['_id']))
+        return jsonify(dict(attachments.metadata(attachment), id=str(attachment['_id']))), 200
+
+    # Downloads stream the decrypted file, decrypting only the chunks a
+    # single-range Range request covers. Completed attachments never change,
+    # so the ETag is strong and If-Range/If-None-Match are honoured.
+    @api_bp.route('/attachments/<attachment_id>', methods=['GET'])
+    @jwt_required()
+    def download_attachment(attachment_id):
+        attachment = find_attachment(attachment_id)
+        if attachment is None or attachment['status'] != 'complete':
+            return jsonify({'message': 'Attachment not found'}), 404
+
+        size, etag = attachment['size'], str(attachment['_id'])
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Cache-Control': 'private, max-age=86400',
+            'Content-Disposition': f"inline; filename*=UTF-8''{quote(attachment['filename'])}",
+        }
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304, headers=headers)
+            response.set_etag(etag)
+            return response
+
+        # Multiple ranges, other units and a stale If-Range get the whole file
+        start, stop, status = 0, size, 200
+        ranges = request.range
+        fresh = 'If-Range' not in request.headers or request.if_range.etag == etag
+        if ranges is not None and ranges.units == 'bytes' and len(ranges.ranges) == 1 and fresh:
+            span = ranges.range_for_length(size)
+            if span is None:
+                headers['Content-Range'] = f'bytes */{size}'
+                return jsonify({'message': 'Range not satisfiable'}), 416, headers
+            (start, stop), status = span, 206
+            headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+
+        response = current_app.response_class(
+            attachments.read(attachment, start, stop), status=status,
+            mimetype=attachment['content_type'], headers=headers, direct_passthrough=True,
+        )
+        response.content_length = stop - start
+        response.set_etag(etag)
+        return response
+
+    @api_bp.route('/attachments/<attachment_id>/thumbnail', methods=['GET'])
+    @jwt_required()
+    def attachment_thumbnail(attachment_id):
+        attachment = find_attachment(attachment_id)
+        thumbnail = attachments.thumbnail(attachment) if attachment and attachment['thumbnail_type'] else None
+        if thumbnail is None:
+            return jsonify({'message': 'Thumbnail not found'}), 404
+        response = current_app.response_class(thumbnail, mimetype=attachment['thumbnail_type'])
+        response.headers['Cache-Control'] = 'private, max-age=86400'
+        response.set_etag(f'{attachment["_id"]}-thumbnail')
+        return response.make_conditional(request)
+
+    @api_bp.route('/attachments/<attachment_id>', methods=['DELETE'])
+    @jwt_required()
+    def delete_attachment(attachment_id):
+        attachment = find_attachment(attachment_id)
+        if attachment is None:
+            return jsonify({'message': 'Attachment not found'}), 404
+        attachments.delete(attachment)
+        return jsonify({'message': 'Attachment deleted successfully'}), 200
+
     # Tasks
     @api_bp.route('/tasks', methods=['POST'])
     @jwt_required()
     def create_task():
         current_user_id = get_jwt_identity()
         data = request.get_json()
-        task = Task(current_user_id, data.get('title'), data.get('description'), data.get('due_date'))
+        task = Task.from_data(current_user_id, data)
         task.save(mongo)
         return jsonify({'message': 'Task created successfully'}), 201
 
@@ -112,37 +506,20 @@ def create_routes(mongo):
     @jwt_required()
     def get_tasks():
         current_user_id = get_jwt_identity()
-        tasks = Task.find_by_user(mongo, current_user_id)
-        return jsonify(list(tasks)), 200
+        find = partial(Task.find_by_user, mongo, current_user_id)
+        return list_response(find, Task.SORT_FIELD, Task.serialize, Task.COLLECTION)
 
     @api_bp.route('/tasks/<task_id>', methods=['PUT'])
     @jwt_required()
     def update_task(task_id):
-        current_user_id = get_jwt_identity()
         data = request.get_json()
-        task = Task.find_by_id(mongo, task_id)
-
-        if not task or task['user_id'] != current_user_id:
-            return jsonify({'message': 'Task not found'}), 404
-
-        task['title'] = data.get('title', task['title'])
-        task['description'] = data.get('description', task['description'])
-        task['due_date'] = data.get('due_date', task['due_date'])
-        task['is_completed'] = data.get('is_completed', task['is_completed'])
-        mongo.db.tasks.save(task)
-
-        return jsonify({'message': 'Task updated successfully'}), 200
+        return update_response(Task, task_id, data, 'Task not found', 'Task updated successfully')
 
     @api_bp.route('/tasks/<task_id>', methods=['DELETE'])
     @jwt_required()
     def delete_task(task_id):
-        current_user_id = get_jwt_identity()
-        task = Task.find_by_id(mongo, task_id)
-
-        if not task or task['user_id'] != current_user_id:
+        if not Task.delete_by_id(mongo, task_id, get_jwt_identity()):
             return jsonify({'message': 'Task not found'}), 404
-
-        Task.delete_by_id(mongo, task_id)
         return jsonify({'message': 'Task deleted successfully'}), 200
 
     # Goals
@@ -151,7 +528,7 @@ def create_routes(mongo):
     def create_goal():
         current_user_id = get_jwt_identity()
         data = request.get_json()
-        goal = Goal(current_user_id, data.get('title'), data.get('description'), data.get('milestones', []), data.get('due_date'))
+        goal = Goal.from_data(current_user_id, data)
         goal.save(mongo)
         return jsonify({'message': 'Goal created successfully'}), 201
 
@@ -159,38 +536,20 @@ def create_routes(mongo):
     @jwt_required()
     def get_goals():
         current_user_id = get_jwt_identity()
-        goals = Goal.find_by_user(mongo, current_user_id)
-        return jsonify(list(goals)), 200
+        find = partial(Goal.find_by_user, mongo, current_user_id)
+        return list_response(find, Goal.SORT_FIELD, Goal.serialize, Goal.COLLECTION)
 
     @api_bp.route('/goals/<goal_id>', methods=['PUT'])
     @jwt_required()
     def update_goal(goal_id):
-        current_user_id = get_jwt_identity()
         data = request.get_json()
-        goal = Goal.find_by_id(mongo, goal_id)
-
-        if not goal or goal['user_id'] != current_user_id:
-            return jsonify({'message': 'Goal not found'}), 404
-
-        goal['title'] = data.get('title', goal['title'])
-        goal['description'] = data.get('description', goal['description'])
-        goal['milestones'] = data.get('milestones', goal['milestones'])
-        goal['due_date'] = data.get('due_date', goal['due_date'])
-        goal['is_completed'] = data.get('is_completed', goal['is_completed'])
-        mongo.db.goals.save(goal)
-
-        return jsonify({'message': 'Goal updated successfully'}), 200
+        return update_response(Goal, goal_id, data, 'Goal not found', 'Goal updated successfully')
 
     @api_bp.route('/goals/<goal_id>', methods=['DELETE'])
     @jwt_required()
     def delete_goal(goal_id):
-        current_user_id = get_jwt_identity()
-        goal = Goal.find_by_id(mongo, goal_id)
-
-        if not goal or goal['user_id'] != current_user_id:
+        if not Goal.delete_by_id(mongo, goal_id, get_jwt_identity()):
             return jsonify({'message': 'Goal not found'}), 404
-
-        Goal.delete_by_id(mongo, goal_id)
         return jsonify({'message': 'Goal deleted successfully'}), 200
 
     # Habits
@@ -199,7 +558,7 @@ def create_routes(mongo):
     def create_habit():
         current_user_id = get_jwt_identity()
         data = request.get_json()
-        habit = Habit(current_user_id, data.get('title'), data.get('frequency', 'daily'), data.get('progress', 0), data.get('goal', 0))
+        habit = Habit.from_data(current_user_id, data)
         habit.save(mongo)
         return jsonify({'message': 'Habit created successfully'}), 201
 
@@ -207,37 +566,50 @@ def create_routes(mongo):
     @jwt_required()
     def get_habits():
         current_user_id = get_jwt_identity()
-        habits = Habit.find_by_user(mongo, current_user_id)
-        return jsonify(list(habits)), 200
+        find = partial(Habit.find_by_user, mongo, current_user_id)
+        return list_response(find, Habit.SORT_FIELD, Habit.serialize, Habit.COLLECTION)
 
     @api_bp.route('/habits/<habit_id>', methods=['PUT'])
     @jwt_required()
     def update_habit(habit_id):
-        current_user_id = get_jwt_identity()
         data = request.get_json()
-        habit = Habit.find_by_id(mongo, habit_id)
+        return update_response(Habit, habit_id, data, 'Habit not found', 'Habit updated successfully')
 
-        if not habit or habit['user_id'] != current_user_id:
-            return jsonify({'message': 'Habit not found'}), 404
+    # Atomic check-in: concurrent check-ins never lose increments
+    @api_bp.route('/habits/<habit_id>/checkin', methods=['POST'])
+    @jwt_required()
+    def check_in_habit(habit_id):
+        data = request.get_json(silent=True) or {}
+        amount = data.get('amount', 1)
+        if not isinstance(amount, int) or isinstance(amount, bool):
+            return jsonify({'message': 'Invalid amount'}), 400
 
-        habit['title'] = data.get('title', habit['title'])
-        habit['frequency'] = data.get('frequency', habit['frequency'])
-        habit['progress'] = data.get('progress', habit['progress'])
-        habit['goal'] = data.get('goal', habit['goal'])
-        mongo.db.habits.save(habit)
+        def record(habit):
+            HabitRollup.record(mongo, habit['user_id'], habit['_id'], amount)
 
-        return jsonify({'message': 'Habit updated successfully'}), 200
+        return update_response(
+            Habit, habit_id, data, 'Habit not found', 'Habit checked in successfully', {},
+            inc={'progress': amount}, on_update=record,
+        )
+
+    @api_bp.route('/habits/stats', methods=['GET'])
+    @jwt_required()
+    def get_habit_stats():
+        current_user_id = get_jwt_identity()
+        try:
+            start, end = parse_range(request.args)
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+        return jsonify(HabitRollup.stats(mongo, current_user_id, start, end)), 200
 
     @api_bp.route('/habits/<habit_id>', methods=['DELETE'])
     @jwt_required()
     def delete_habit(habit_id):
         current_user_id = get_jwt_identity()
-        habit = Habit.find_by_id(mongo, habit_id)
-
-        if not habit or habit['user_id'] != current_user_id:
+        habit = Habit.delete_by_id(mongo, habit_id, current_user_id)
+        if not habit:
             return jsonify({'message': 'Habit not found'}), 404
-
-        Habit.delete_by_id(mongo, habit_id)
+        HabitRollup.forget(mongo, current_user_id, habit['_id'])
         return jsonify({'message': 'Habit deleted successfully'}), 200
 
     # Mood Tracking
@@ -246,43 +618,48 @@ def create_routes(mongo):
     def create_mood():
         current_user_id = get_jwt_identity()
         data = request.get_json()
-        mood = Mood(current_user_id, data.get('mood'), data.get('note', ''), data.get('rating', 0))
+        mood = Mood.from_data(current_user_id, data)
         mood.save(mongo)
         return jsonify({'message': 'Mood logged successfully'}), 201
+
     @api_bp.route('/moods', methods=['GET'])
     @jwt_required()
     def get_moods():
         current_user_id = get_jwt_identity()
-        moods = Mood.find_by_user(mongo, current_user_id)
-        return jsonify(list(moods)), 200
+        find = partial(Mood.find_by_user, mongo, current_user_id)
+        return list_response(find, Mood.SORT_FIELD, Mood.serialize, Mood.COLLECTION)
 
     @api_bp.route('/moods/<mood_id>', methods=['PUT'])
     @jwt_required()
     def update_mood(mood_id):
-        current_user_id = get_jwt_identity()
         data = request.get_json()
-        mood = Mood.find_by_id(mongo, mood_id)
 
-        if not mood or mood['user_id'] != current_user_id:
-            return jsonify({'message': 'Mood entry not found'}), 404
+        def refresh(mood):
+            jobs.enqueue(*mood_day_job(mood['user_id'], mood['date']))
 
-        mood['mood'] = data.get('mood', mood['mood'])
-        mood['note'] = data.get('note', mood['note'])
-        mood['rating'] = data.get('rating', mood['rating'])
-        mongo.db.moods.save(mood)
+        return update_response(Mood, mood_id, data, 'Mood entry not found', 'Mood entry updated successfully', on_update=refresh)
 
-        return jsonify({'message': 'Mood entry updated successfully'}), 200
+    @api_bp.route('/moods/stats', methods=['GET'])
+    @jwt_required()
+    def get_mood_stats():
+        current_user_id = get_jwt_identity()
+        granularity = request.args.get('granularity', 'day')
+        if granularity not in GRANULARITIES:
+            return jsonify({'message': 'Invalid granularity'}), 400
+        try:
+            start, end = parse_range(request.args)
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+        return jsonify(MoodRollup.stats(mongo, current_user_id, start, end, granularity)), 200
 
     @api_bp.route('/moods/<mood_id>', methods=['DELETE'])
     @jwt_required()
     def delete_mood(mood_id):
         current_user_id = get_jwt_identity()
-        mood = Mood.find_by_id(mongo, mood_id)
-
-        if not mood or mood['user_id'] != current_user_id:
+        mood = Mood.delete_by_id(mongo, mood_id, current_user_id, ['date'])
+        if not mood:
             return jsonify({'message': 'Mood entry not found'}), 404
-
-        Mood.delete_by_id(mongo, mood_id)
+        jobs.enqueue(*mood_day_job(current_user_id, mood['date']))
         return jsonify({'message': 'Mood entry deleted successfully'}), 200
 
     # Class Schedules
@@ -291,14 +668,7 @@ def create_routes(mongo):
     def create_class_schedule():
         current_user_id = get_jwt_identity()
         data = request.get_json()
-        class_schedule = ClassSchedule(
-            current_user_id,
-            data.get('course_name'),
-            data.get('start_time'),
-            data.get('end_time'),
-            data.get('location', ''),
-            data.get('days_of_week', [])
-        )
+        class_schedule = ClassSchedule.from_data(current_user_id, data)
         class_schedule.save(mongo)
         return jsonify({'message': 'Class schedule created successfully'}), 201
 
@@ -306,38 +676,20 @@ def create_routes(mongo):
     @jwt_required()
     def get_class_schedules():
         current_user_id = get_jwt_identity()
-        class_schedules = ClassSchedule.find_by_user(mongo, current_user_id)
-        return jsonify(list(class_schedules)), 200
+        find = partial(ClassSchedule.find_by_user, mongo, current_user_id)
+        return list_response(find, ClassSchedule.SORT_FIELD, ClassSchedule.serialize, ClassSchedule.COLLECTION)
 
     @api_bp.route('/classes/<schedule_id>', methods=['PUT'])
     @jwt_required()
     def update_class_schedule(schedule_id):
-        current_user_id = get_jwt_identity()
         data = request.get_json()
-        class_schedule = ClassSchedule.find_by_id(mongo, schedule_id)
-
-        if not class_schedule or class_schedule['user_id'] != current_user_id:
-            return jsonify({'message': 'Class schedule not found'}), 404
-
-        class_schedule['course_name'] = data.get('course_name', class_schedule['course_name'])
-        class_schedule['start_time'] = data.get('start_time', class_schedule['start_time'])
-        class_schedule['end_time'] = data.get('end_time', class_schedule['end_time'])
-        class_schedule['location'] = data.get('location', class_schedule['location'])
-        class_schedule['days_of_week'] = data.get('days_of_week', class_schedule['days_of_week'])
-        mongo.db.class_schedules.save(class_schedule)
-
-        return jsonify({'message': 'Class schedule updated successfully'}), 200
+        return update_response(ClassSchedule, schedule_id, data, 'Class schedule not found', 'Class schedule updated successfully')
 
     @api_bp.route('/classes/<schedule_id>', methods=['DELETE'])
     @jwt_required()
     def delete_class_schedule(schedule_id):
-        current_user_id = get_jwt_identity()
-        class_schedule = ClassSchedule.find_by_id(mongo, schedule_id)
-
-        if not class_schedule or class_schedule['user_id'] != current_user_id:
+        if not ClassSchedule.delete_by_id(mongo, schedule_id, get_jwt_identity()):
             return jsonify({'message': 'Class schedule not found'}), 404
-
-        ClassSchedule.delete_by_id(mongo, schedule_id)
         return jsonify({'message': 'Class schedule deleted successfully'}), 200
 
     # Gratitude Entries
@@ -346,43 +698,41 @@ def create_routes(mongo):
     def create_gratitude_entry():
         current_user_id = get_jwt_identity()
         data = request.get_json()
-        gratitude_entry = Gratitude(current_user_id, data.get('content'), data.get('tags', []))
-        gratitude_entry.save(mongo)
+        gratitude_entry = Gratitude.from_data(current_user_id, data)
+        result = gratitude_entry.save(mongo)
+        if search_index:
+            jobs.enqueue(*reindex_job(Gratitude.COLLECTION, result.inserted_id))
         return jsonify({'message': 'Gratitude entry created successfully'}), 201
 
     @api_bp.route('/gratitude', methods=['GET'])
     @jwt_required()
     def get_gratitude_entries():
         current_user_id = get_jwt_identity()
-        entries = Gratitude.find_by_user(mongo, current_user_id)
-        return jsonify(list(entries)), 200
+        find = partial(Gratitude.find_by_user, mongo, current_user_id)
+        return list_response(find, Gratitude.SORT_FIELD, Gratitude.serialize, Gratitude.COLLECTION)
 
     @api_bp.route('/gratitude/<entry_id>', methods=['PUT'])
     @jwt_required()
     def update_gratitude_entry(entry_id):
-        current_user_id = get_jwt_identity()
         data = request.get_json()
-        entry = Gratitude.find_by_id(mongo, entry_id)
 
-        if not entry or entry['user_id'] != current_user_id:
-            return jsonify({'message': 'Gratitude entry not found'}), 404
+        def reindex(entry):
+            if search_index and any(f in data for f in FIELD_WEIGHTS):
+                jobs.enqueue(*reindex_job(Gratitude.COLLECTION, entry['_id']))
 
-        entry['content'] = data.get('content', entry['content'])
-        entry['tags'] = data.get('tags', entry['tags'])
-        mongo.db.gratitude.save(entry)
-
-        return jsonify({'message': 'Gratitude entry updated successfully'}), 200
+        return update_response(
+            Gratitude, entry_id, data, 'Gratitude entry not found', 'Gratitude entry updated successfully',
+            on_update=reindex,
+        )
 
     @api_bp.route('/gratitude/<entry_id>', methods=['DELETE'])
     @jwt_required()
     def delete_gratitude_entry(entry_id):
-        current_user_id = get_jwt_identity()
-        entry = Gratitude.find_by_id(mongo, entry_id)
-
-        if not entry or entry['user_id'] != current_user_id:
+        entry = Gratitude.delete_by_id(mongo, entry_id, get_jwt_identity())
+        if not entry:
             return jsonify({'message': 'Gratitude entry not found'}), 404
-
-        Gratitude.delete_by_id(mongo, entry_id)
+        if search_index:
+            jobs.enqueue(*reindex_job(Gratitude.COLLECTION, entry['_id']))
         return jsonify({'message': 'Gratitude entry deleted successfully'}), 200
 
     # Time Capsule Entries
@@ -391,43 +741,40 @@ def create_routes(mongo):
     def create_time_capsule():
         current_user_id = get_jwt_identity()
         data = request.get_json()
-        time_capsule_entry = TimeCapsule(current_user_id, data.get('content'), data.get('open_date'))
-        time_capsule_entry.save(mongo)
+        time_capsule_entry = TimeCapsule.from_data(current_user_id, data)
+        result = time_capsule_entry.save(mongo)
+        if scheduler and not time_capsule_entry.opened:
+            scheduler.schedule(result.inserted_id, time_capsule_entry.open_date)
         return jsonify({'message': 'Time capsule created successfully'}), 201
 
+    # Opened capsules only; the scheduler flips them when open_date passes
     @api_bp.route('/timecapsule', methods=['GET'])
     @jwt_required()
     def get_time_capsules():
         current_user_id = get_jwt_identity()
-        time_capsules = TimeCapsule.find_by_user_and_date(mongo, current_user_id, datetime.utcnow())
-        return jsonify(list(time_capsules)), 200
+        find = partial(TimeCapsule.find_opened_by_user, mongo, current_user_id)
+        return list_response(find, TimeCapsule.SORT_FIELD, TimeCapsule.serialize, TimeCapsule.COLLECTION)
 
     @api_bp.route('/timecapsule/<entry_id>', methods=['PUT'])
     @jwt_required()
     def update_time_capsule(entry_id):
-        current_user_id = get_jwt_identity()
         data = request.get_json()
-        entry = TimeCapsule.find_by_id(mongo, entry_id)
-
-        if not entry or entry['user_id'] != current_user_id:
-            return jsonify({'message': 'Time capsule not found'}), 404
+        fields = TimeCapsule.normalize_fields({f: data[f] for f in TimeCapsule.UPDATABLE if f in data})
 
-        entry['content'] = data.get('content', entry['content'])
-        entry['open_date'] = data.get('open_date', entry['open_date'])
-        mongo.db.timecapsule.save(entry)
+        def reschedule(capsule):
+            if scheduler and not capsule.get('opened', True):
+                scheduler.schedule(capsule['_id'], capsule['open_date'])
 
-        return jsonify({'message': 'Time capsule updated successfully'}), 200
+        return update_response(
+            TimeCapsule, entry_id, data, 'Time capsule not found', 'Time capsule updated successfully', fields,
+            on_update=reschedule,
+        )
 
     @api_bp.route('/timecapsule/<entry_id>', methods=['DELETE'])
     @jwt_required()
     def delete_time_capsule(entry_id):
-        current_user_id = get_jwt_identity()
-        entry = TimeCapsule.find_by_id(mongo, entry_id)
-
-        if not entry or entry['user_id'] != current_user_id:
+        if not TimeCapsule.delete_by_id(mongo, entry_id, get_jwt_identity()):
             return jsonify({'message': 'Time capsule not found'}), 404
-
-        TimeCapsule.delete_by_id(mongo, entry_id)
         return jsonify({'message': 'Time capsule deleted successfully'}), 200
 
     return api_bp
\ No newline at end of file
@@ -0,0 +1,140 @@
+import hashlib
+import hmac
+import math
+import re
+from collections import Counter, defaultdict
+from itertools import chain
+from pymongo import ASCENDING, DeleteMany, IndexModel, InsertOne
+from pymongo.errors import DuplicateKeyError
+from archive import Archive
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+STOPWORDS = frozenset('a an and are as at be but by for from has have i in is it my of on or so that the to was we with'.split())
+INDEXED_COLLECTIONS = ('entries', 'gratitude')
+FIELD_WEIGHTS = {'title': 2.0, 'tags': 2.0, 'content': 1.0}
+
+
+def tokenize(text):
+    if isinstance(text, (list, tuple)):
+        text = ' '.join(str(part) for part in text)
+    return [t for t in TOKEN.findall((text or '').lower()) if len(t) > 1 and t not in STOPWORDS]
+
+
+# Inverted index over titles, tags and content of entries and gratitude.
+# Terms are stored as HMAC digests under a per-user key, so the index
+# reveals no plaintext at rest. One posting per (term, document, field).
+# search_stats counts each user's indexed documents for idf.
+class SearchIndex:
+    COLLECTION = 'search_index'
+    STATS_COLLECTION = 'search_stats'
+    INDEXES = [
+        IndexModel([('user_id', ASCENDING), ('term', ASCENDING)], name='user_term'),
+        IndexModel([('doc_id', ASCENDING), ('field', ASCENDING)], name='doc_field'),
+    ]
+
+    def __init__(self, mongo, secret):
+        self.mongo = mongo
+        self.secret = secret.encode('utf-8') if isinstance(secret, str) else secret
+
+    @property
+    def collection(self):
+        return self.mongo.db[self.COLLECTION]
+
+    @property
+    def stats(self):
+        return self.mongo.db[self.STATS_COLLECTION]
+
+    def _user_key(self, user_id):
+        return hmac.new(self.secret, str(user_id).encode('utf-8'), hashlib.sha256).digest()
+
+    def _terms(self, user_key, tokens):
+        return Counter(hmac.new(user_key, t.encode('utf-8'), hashlib.sha256).hexdigest()[:32] for t in tokens)
+
+    def _requests(self, user_id, collection, doc_id, fields):
+        user_key = self._user_key(user_id)
+        requests = [DeleteMany({'doc_id': doc_id, 'field': {'$in': list(fields)}})]
+        for field, text in fields.items():
+            for term, tf in self._terms(user_key, tokenize(text)).items():
+                requests.append(InsertOne({
+                    'user_id': user_id, 'term': term, 'collection': collection,
+                    'doc_id': doc_id, 'field': field, 'tf': tf,
+                }))
+        return requests
+
+    def _has_postings(self, doc_id):
+        return self.collection.find_one({'doc_id': doc_id}, {'_id': 1}) is not None
+
+    # No-op until documents() has counted the user
+    def _count(self, user_id, delta):
+        if delta:
+            self.stats.update_one({'_id': user_id}, {'$inc': {'documents': delta}})
+
+    # fields maps field name -> plaintext for the fields that changed
+    def index(self, user_id, collection, doc_id, fields):
+        fields = {f: v for f, v in fields.items() if f in FIELD_WEIGHTS}
+        if fields:
+            had = self._has_postings(doc_id)
+            requests = self._requests(user_id, collection, doc_id, fields)
+            self.collection.bulk_write(requests, ordered=True)
+            has = len(requests) > 1 or self._has_postings(doc_id)
+            self._count(user_id, has - had)
+
+    # Backfill: reindex every entry (decrypted through the keystore) and
+    # gratitude entry, archived ones included
+    def rebuild(self, keystore, batch_size=500):
+        self.collection.delete_many({})
+        count = 0
+        for name in INDEXED_COLLECTIONS:
+            docs = chain(self.mongo.db[name].find({}).batch_size(batch_size), Archive.documents(self.mongo, name))
+            for doc in docs:
+                fields = {f: doc.get(f) for f in FIELD_WEIGHTS if f in doc}
+                if name == 'entries' and 'content' in doc:
+                    _, cipher = keystore.cipher(doc['user_id'], [doc.get('key_id')])
+                    fields['content'] = keystore.decrypt_entry(cipher, doc)
+                self.index(doc['user_id'], name, doc['_id'], fields)
+                count += 1
+        # Recounted from the finished postings
+        self.stats.delete_many({})
+        return count
+
+    def remove(self, doc_id):
+        posting = self.collection.find_one({'doc_id': doc_id}, {'user_id': 1})
+        if posting is not None and self.collection.delete_many({'doc_id': doc_id}).deleted_count:
+            self._count(posting['user_id'], -1)
+
+    # Documents of the user's with postings, archived ones included. Kept
+    # up to date by index and remove once counted here from the postings.
+    def documents(self, user_id):
+        stats = self.stats.find_one({'_id': user_id})
+        if stats is None:
+            stats = {'_id': user_id, 'documents': len(self.collection.distinct('doc_id', {'user_id': user_id}))}
+            try:
+                self.stats.insert_one(stats)
+            except DuplicateKeyError:
+                pass
+        return stats['documents']
+
+    # Rank documents by summed tf-idf over the query terms; returns
+    # [(collection, doc_id, score)] best first
+    def search(self, user_id, query, limit=20):
+        terms = list(self._terms(self._user_key(user_id), tokenize(query)))
+        if not terms:
+            return []
+
+        postings = list(self.collection.find(
+            {'user_id': user_id, 'term': {'$in': terms}},
+            {'_id': 0, 'term': 1, 'collection': 1, 'doc_id': 1, 'field': 1, 'tf': 1},
+        ))
+        docs_per_term = defaultdict(set)
+        for posting in postings:
+            docs_per_term[posting['term']].add(posting['doc_id'])
+        total = self.documents(user_id)
+
+        scores = defaultdict(float)
+        for posting in postings:
+            idf = math.log(1 + max(total, 1) / len(docs_per_term[posting['term']]))
+            key = (posting['collection'], posting['doc_id'])
+            scores[key] += (1 + math.log(posting['tf'])) * idf * FIELD_WEIGHTS[posting['field']]
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(collection, doc_id, score) for (collection, doc_id), score in ranked]
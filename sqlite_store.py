@@ -0,0 +1,1157 @@
+import base64
+import copy
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from bson.objectid import ObjectId
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import (
+    BulkWriteError, CollectionInvalid, ConnectionFailure, DuplicateKeyError, OperationFailure, WriteError,
+)
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+# Embedded storage for single-node installs: the part of PyMongo's
+# Database / Collection API the app uses, on one SQLite file in WAL mode.
+#
+# Each collection is a table of (id, doc) rows, doc being the document as
+# JSON. Declared IndexModels become expression indexes over json_extract,
+# and the parts of a filter on indexed fields are translated to SQL so
+# lookups, ranges, sorts and limits run on those indexes; anything else is
+# matched in Python against the decoded documents, as is every aggregation
+# pipeline. Indexed fields are expected to hold scalars (Mongo would make
+# them multikey). Documents are read a query at a time, which suits the
+# small installs this is for.
+
+TAG = '\x01'
+DUPLICATE_KEY = 11000
+VALIDATION_FAILED = 121
+TTL_INTERVAL = 60
+NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_.]*$')
+_MISSING = object()
+RANGE = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+
+
+# Values are stored as JSON with ObjectIds, datetimes and bytes as tagged
+# strings, so json_extract gives SQLite values that sort and compare
+# within each type. Datetimes keep milliseconds, as BSON does.
+def _datetime_text(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.strftime('%Y-%m-%dT%H:%M:%S.') + f'{value.microsecond // 1000:03d}'
+
+
+def encode(value):
+    if isinstance(value, str):
+        return TAG + 's' + value if value.startswith(TAG) else value
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, datetime):
+        return TAG + 'd' + _datetime_text(value)
+    if isinstance(value, ObjectId):
+        return TAG + 'o' + str(value)
+    if isinstance(value, bytes):
+        return TAG + 'b' + base64.b64encode(value).decode('ascii')
+    if isinstance(value, dict):
+        return {key: encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    raise TypeError(f'Cannot store {type(value).__name__}')
+
+
+_DECODERS = {
+    's': lambda text: TAG + text,
+    'd': datetime.fromisoformat,
+    'o': ObjectId,
+    'b': base64.b64decode,
+}
+
+
+def decode(value):
+    if isinstance(value, str):
+        return _DECODERS[value[1]](value[2:]) if value.startswith(TAG) else value
+    if isinstance(value, dict):
+        return {key: decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    return value
+
+
+def _sql_value(value):
+    value = encode(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(',', ':'))
+    return value
+
+
+def _dumps(doc):
+    return json.dumps(encode(doc), separators=(',', ':'), ensure_ascii=False)
+
+
+# Query matching with Mongo semantics: a path reaches into arrays, and a
+# condition on an array field holds if it holds for the array or any element
+_TYPE_ORDER = [
+    (type(None), 1), (bool, 8), ((int, float), 2), (str, 3), (dict, 4), (list, 5), (bytes, 6), (ObjectId, 7), (datetime, 9),
+]
+_TYPE_NAMES = {
+    'null': type(None), 'bool': bool, 'string': str, 'object': dict, 'array': list, 'binData': bytes,
+    'objectId': ObjectId, 'date': datetime, 'int': int, 'long': int, 'double': float, 'number': (int, float),
+}
+
+
+def _rank(value):
+    for kind, rank in _TYPE_ORDER:
+        if isinstance(value, kind):
+            return rank
+    return 10
+
+
+def _is_type(value, name):
+    kind = _TYPE_NAMES.get(name)
+    if kind is None:
+        raise OperationFailure(f'Unsupported $type: {name}')
+    return isinstance(value, kind) and (kind is bool or not isinstance(value, bool))
+
+
+def _sort_key(value):
+    rank = _rank(value)
+    if rank in (4, 5):
+        return rank, json.dumps(encode(value), sort_keys=True)
+    if rank == 1:
+        return rank, 0
+    if rank == 7:
+        return rank, value.binary
+    return rank, value
+
+
+def _equal(a, b):
+    return _rank(a) == _rank(b) and a == b
+
+
+def _compare(a, b):
+    if _rank(a) != _rank(b):
+        return None
+    a, b = _sort_key(a)[1], _sort_key(b)[1]
+    return (a > b) - (a < b)
+
+
+def _lookup(doc, path):
+    values = [doc]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                else:
+                    found.extend(item[part] for item in value if isinstance(item, dict) and part in item)
+        values = found
+    return values
+
+
+def _operator(op, values, arg):
+    candidates = values + [item for value in values if isinstance(value, list) for item in value]
+    if op == '$eq':
+        return any(_equal(value, arg) for value in candidates) or (arg is None and not values)
+    if op == '$ne':
+        return not _operator('$eq', values, arg)
+    if op == '$in':
+        return any(_operator('$eq', values, item) for item in arg)
+    if op == '$nin':
+        return not _operator('$in', values, arg)
+    if op in ('$gt', '$gte', '$lt', '$lte'):
+        accept = {'$gt': (1,), '$gte': (0, 1), '$lt': (-1,), '$lte': (-1, 0)}[op]
+        return any(_compare(value, arg) in accept for value in candidates)
+    if op == '$exists':
+        return bool(values) == bool(arg)
+    if op == '$type':
+        names = arg if isinstance(arg, list) else [arg]
+        return any(_is_type(value, name) for value in candidates for name in names)
+    if op == '$not':
+        return not _condition(values, arg)
+    if op == '$size':
+        return any(isinstance(value, list) and len(value) == arg for value in values)
+    if op == '$all':
+        return all(_operator('$eq', values, item) for item in arg)
+    if op == '$elemMatch':
+        return any(isinstance(item, dict) and matches(item, arg) for value in values if isinstance(value, list) for item in value)
+    raise OperationFailure(f'Unsupported query operator: {op}')
+
+
+def _is_operators(cond):
+    return isinstance(cond, dict) and cond and all(key.startswith('$') for key in cond)
+
+
+def _condition(values, cond):
+    if _is_operators(cond):
+        return all(_operator(op, values, arg) for op, arg in cond.items())
+    return _operator('$eq', values, cond)
+
+
+def matches(doc, query):
+    for key, cond in (query or {}).items():
+        if key == '$or':
+            if not any(matches(doc, branch) for branch in cond):
+                return False
+        elif key == '$and':
+            if not all(matches(doc, branch) for branch in cond):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, branch) for branch in cond):
+                return False
+        elif key.startswith('$'):
+            raise OperationFailure(f'Unsupported query operator: {key}')
+        elif not _condition(_lookup(doc, key), cond):
+            return False
+    return True
+
+
+def sort_documents(docs, sort):
+    docs = list(docs)
+    for key, direction in reversed(sort):
+        docs.sort(key=lambda doc: _sort_key(_get(doc, key)), reverse=direction < 0)
+    return docs
+
+
+# Single-value path helpers for updates and projections
+def _get(doc, path, default=None):
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return default
+    return value
+
+
+def _set(doc, path, value):
+    parts = path.split('.')
+    target = doc
+    for part in parts[:-1]:
+        if isinstance(target, list) and part.isdigit():
+            target = target[int(part)]
+        else:
+            target = target.setdefault(part, {})
+    if isinstance(target, list) and parts[-1].isdigit():
+        target[int(parts[-1])] = value
+    else:
+        target[parts[-1]] = value
+
+
+def _unset(doc, path):
+    parts = path.split('.')
+    target = _get(doc, '.'.join(parts[:-1])) if len(parts) > 1 else doc
+    if isinstance(target, dict):
+        target.pop(parts[-1], None)
+
+
+def _pull_matches(item, cond):
+    if _is_operators(cond):
+        return _condition([item], cond)
+    if isinstance(cond, dict) and isinstance(item, dict):
+        return matches(item, cond)
+    return _equal(item, cond)
+
+
+# Applies update operators (or a replacement) to doc in place
+def apply_update(doc, update, inserting=False):
+    if not any(key.startswith('$') for key in update):
+        doc_id = doc.get('_id')
+        doc.clear()
+        doc.update(update)
+        if doc_id is not None:
+            doc['_id'] = doc_id
+        return doc
+    for op, fields in update.items():
+        for path, arg in fields.items():
+            current = _get(doc, path, _MISSING)
+            if op == '$set' or (op == '$setOnInsert' and inserting):
+                _set(doc, path, arg)
+            elif op == '$setOnInsert':
+                continue
+            elif op == '$unset':
+                _unset(doc, path)
+            elif op == '$inc':
+                _set(doc, path, arg if current is _MISSING or current is None else current + arg)
+            elif op in ('$min', '$max'):
+                order = _compare(arg, current) if current is not _MISSING else None
+                if current is _MISSING or (order is not None and order == (-1 if op == '$min' else 1)):
+                    _set(doc, path, arg)
+            elif op in ('$push', '$addToSet'):
+                items = list(current) if isinstance(current, list) else []
+                each = arg['$each'] if isinstance(arg, dict) and '$each' in arg else [arg]
+                if op == '$addToSet':
+                    each = [item for item in each if not any(_equal(item, existing) for existing in items)]
+                position = arg.get('$position') if isinstance(arg, dict) else None
+                if position is None:
+                    items.extend(each)
+                else:
+                    items[position:position] = each
+                _set(doc, path, items)
+            elif op == '$pull':
+                if isinstance(current, list):
+                    _set(doc, path, [item for item in current if not _pull_matches(item, arg)])
+            else:
+                raise WriteError(f'Unsupported update operator: {op}')
+    return doc
+
+
+# The document an upsert starts from: the filter's equality conditions
+def _upsert_seed(query):
+    doc = {}
+    for key, cond in query.items():
+        if key == '$and':
+            for branch in cond:
+                doc.update(_upsert_seed(branch))
+        elif not key.startswith('$'):
+            if not _is_operators(cond):
+                _set(doc, key, cond)
+            elif '$eq' in cond:
+                _set(doc, key, cond['$eq'])
+    return doc
+
+
+def project(doc, projection):
+    if not projection:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = {field: 1 for field in projection}
+    include = [field for field, flag in projection.items() if flag and field != '_id']
+    if include:
+        out = {'_id': doc['_id']} if projection.get('_id', 1) and '_id' in doc else {}
+        for field in include:
+            value = _get(doc, field, _MISSING)
+            if value is not _MISSING:
+                _set(out, field, value)
+        return out
+    out = dict(doc)
+    for field, flag in projection.items():
+        if not flag:
+            _unset(out, field)
+    return out
+
+
+# $jsonSchema subset used by Document.json_schema()
+def _schema_errors(schema, value):
+    types = schema.get('bsonType')
+    if types is not None:
+        types = types if isinstance(types, list) else [types]
+        if not any(_is_type(value, name) for name in types):
+            return True
+    if isinstance(value, dict):
+        if any(field not in value for field in schema.get('required', ())):
+            return True
+        for field, sub in schema.get('properties', {}).items():
+            if field in value and _schema_errors(sub, value[field]):
+                return True
+    if isinstance(value, list) and 'items' in schema:
+        return any(_schema_errors(schema['items'], item) for item in value)
+    return False
+
+
+# Aggregation expressions and stages
+def _date_trunc(value, unit):
+    if value is None:
+        return None
+    if unit == 'year':
+        return datetime(value.year, 1, 1)
+    if unit == 'month':
+        return datetime(value.year, value.month, 1)
+    day = datetime(value.year, value.month, value.day)
+    if unit == 'week':
+        # Weeks start on Sunday, as $dateTrunc's default
+        return day - timedelta(days=(day.weekday() + 1) % 7)
+    if unit == 'day':
+        return day
+    if unit == 'hour':
+        return day.replace(hour=value.hour)
+    raise OperationFailure(f'Unsupported $dateTrunc unit: {unit}')
+
+
+def _arithmetic(op, values):
+    if any(value is None for value in values):
+        return None
+    if op == '$divide':
+        return values[0] / values[1]
+    if op == '$subtract':
+        return values[0] - values[1]
+    total = 0 if op == '$add' else 1
+    for value in values:
+        total = total + value if op == '$add' else total * value
+    return total
+
+
+def evaluate(expr, doc):
+    if isinstance(expr, str) and expr.startswith('$'):
+        return _get(doc, expr[1:])
+    if isinstance(expr, list):
+        return [evaluate(item, doc) for item in expr]
+    if isinstance(expr, dict):
+        if len(expr) == 1 and next(iter(expr)).startswith('$'):
+            op, arg = next(iter(expr.items()))
+            if op == '$dateTrunc':
+                return _date_trunc(evaluate(arg['date'], doc), arg['unit'])
+            if op == '$ifNull':
+                for item in arg:
+                    value = evaluate(item, doc)
+                    if value is not None:
+                        return value
+                return None
+            if op in ('$add', '$subtract', '$multiply', '$divide'):
+                return _arithmetic(op, [evaluate(item, doc) for item in arg])
+            if op == '$literal':
+                return arg
+            raise OperationFailure(f'Unsupported expression: {op}')
+        return {key: evaluate(item, doc) for key, item in expr.items()}
+    return expr
+
+
+def _group_key(value):
+    return json.dumps(encode(value), sort_keys=True)
+
+
+def _group(docs, spec):
+    groups = {}
+    for doc in docs:
+        key = evaluate(spec['_id'], doc)
+        group = groups.setdefault(_group_key(key), {'_id': key})
+        for field, accumulator in spec.items():
+            if field == '_id':
+                continue
+            (op, arg), = accumulator.items()
+            value = evaluate(arg, doc)
+            if op == '$sum':
+                group[field] = group.get(field, 0) + (value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0)
+            elif op == '$push':
+                group.setdefault(field, []).append(value)
+            elif op == '$addToSet':
+                items = group.setdefault(field, [])
+                if not any(_equal(value, item) for item in items):
+                    items.append(value)
+            elif op == '$first':
+                group.setdefault(field, value)
+            elif op == '$last':
+                group[field] = value
+            elif op in ('$min', '$max'):
+                if value is not None:
+                    current = group.get(field)
+                    if current is None or _compare(value, current) == (-1 if op == '$min' else 1):
+                        group[field] = value
+            elif op == '$avg':
+                count, total = group.get(f'\0{field}', (0, 0))
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    count, total = count + 1, total + value
+                group[f'\0{field}'] = (count, total)
+                group[field] = total / count if count else None
+            else:
+                raise OperationFailure(f'Unsupported accumulator: {op}')
+    return [{key: value for key, value in group.items() if not key.startswith('\0')} for group in groups.values()]
+
+
+def _project_stage(doc, spec):
+    include_id = spec.get('_id', 1)
+    if not any(value not in (0, False) for key, value in spec.items() if key != '_id'):
+        return project(doc, spec)
+    out = {'_id': doc['_id']} if include_id and include_id in (1, True) and '_id' in doc else {}
+    for field, value in spec.items():
+        if field == '_id' and value in (0, 1, True, False):
+            continue
+        if value in (1, True):
+            found = _get(doc, field, _MISSING)
+            if found is not _MISSING:
+                _set(out, field, found)
+        elif value not in (0, False):
+            result = evaluate(value, doc)
+            if result is not None or not (isinstance(value, str) and value.startswith('$')):
+                _set(out, field, result)
+    return out
+
+
+def run_pipeline(database, docs, pipeline):
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == '$match':
+            docs = [doc for doc in docs if matches(doc, spec)]
+        elif name == '$sort':
+            docs = sort_documents(docs, list(spec.items()))
+        elif name == '$group':
+            docs = _group(docs, spec)
+        elif name == '$project':
+            docs = [_project_stage(doc, spec) for doc in docs]
+        elif name == '$limit':
+            docs = list(docs)[:spec]
+        elif name == '$skip':
+            docs = list(docs)[spec:]
+        elif name == '$count':
+            docs = list(docs)
+            docs = [{spec: len(docs)}] if docs else []
+        elif name == '$unwind':
+            path = spec if isinstance(spec, str) else spec['path']
+            docs = [dict(doc, **{path[1:]: item}) for doc in docs for item in (_get(doc, path[1:]) or [])]
+        elif name == '$facet':
+            docs = list(docs)
+            docs = [{field: list(run_pipeline(database, docs, sub)) for field, sub in spec.items()}]
+        elif name == '$merge':
+            into = spec['into'] if isinstance(spec, dict) else spec
+            database[into].merge_documents(docs)
+            docs = []
+        else:
+            raise OperationFailure(f'Unsupported pipeline stage: {name}')
+    return iter(list(docs))
+
+
+def _path(field):
+    return '$' + ''.join(f'."{part}"' for part in field.split('.'))
+
+
+def _quote(name):
+    if not NAME.match(name):
+        raise OperationFailure(f'Invalid collection name: {name}')
+    return f'"{name}"'
+
+
+class SQLiteCursor:
+    def __init__(self, collection, query, projection=None, sort=None, limit=0, skip=0):
+        self.collection = collection
+        self.query = query or {}
+        self.projection = projection
+        self._sort = list(sort or [])
+        self._limit = limit or 0
+        self._skip = skip or 0
+        self._docs = None
+
+    def sort(self, key_or_list, direction=1):
+        self._sort = [(key_or_list, direction)] if isinstance(key_or_list, str) else list(key_or_list)
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    # Rows are read in one go; kept for PyMongo compatibility
+    def batch_size(self, size):
+        return self
+
+    def max_time_ms(self, ms):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._docs is None:
+            rows = self.collection._select(self.collection._connection(), self.query, self._sort, self._limit, self._skip)
+            self._docs = iter([project(doc, self.projection) for _, doc in rows])
+        return next(self._docs)
+
+    def rewind(self):
+        self._docs = None
+        return self
+
+    def close(self):
+        self._docs = iter(())
+
+    def distinct(self, key):
+        return self.collection.distinct(key, self.query)
+
+    # Mongo-shaped plan from EXPLAIN QUERY PLAN, enough for find_collscans
+    def explain(self):
+        conn = self.collection._connection()
+        sql, params, _ = self.collection._select_sql(self.query, self._sort, self._limit, self._skip)
+        details = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        scan = 'COLLSCAN' if any(d.startswith('SCAN') and 'INDEX' not in d for d in details) else 'IXSCAN'
+        plan = {'stage': 'FETCH', 'inputStage': {'stage': scan}}
+        if any('TEMP B-TREE' in d for d in details):
+            plan = {'stage': 'SORT', 'inputStage': plan}
+        return {'queryPlanner': {'winningPlan': plan}, 'sqlite': details}
+
+
+class SQLiteCollection:
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.store = database.store
+        self.table = _quote(name)
+
+    def _connection(self):
+        conn = self.store.connection()
+        self.store.ensure_table(conn, self.name)
+        return conn
+
+    @contextmanager
+    def _write(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            self._expire(conn)
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    # TTL indexes: expired documents are purged by writes, at most once a minute
+    def _expire(self, conn):
+        for field, seconds in self.store.ttl_fields(self.name):
+            key = (self.name, field)
+            now = time.monotonic()
+            if now - self.store.ttl_checked.get(key, 0) < TTL_INTERVAL:
+                continue
+            self.store.ttl_checked[key] = now
+            cutoff = _sql_value(datetime.utcnow() - timedelta(seconds=seconds))
+            expr = self._expr(field)
+            conn.execute(f'DELETE FROM {self.table} WHERE {expr} < ? AND {expr} > ?', [cutoff, TAG + 'd'])
+
+    def _expr(self, field):
+        return 'id' if field == '_id' else f"json_extract(doc, '{_path(field)}')"
+
+    def _load(self, doc_id, text):
+        doc = {'_id': decode(doc_id)}
+        doc.update(decode(json.loads(text)))
+        return doc
+
+    # SQL for the translatable part of a filter: conditions on indexed
+    # (scalar) fields. exact is False if some of the filter is left for
+    # matches() to check.
+    def _where(self, query, indexed=None):
+        if indexed is None:
+            indexed = self.store.indexed_fields(self.name)
+        clauses, params, exact = [], [], True
+        for key, cond in (query or {}).items():
+            if key in ('$or', '$and'):
+                parts = [self._where(branch, indexed) for branch in cond]
+                if key == '$and':
+                    for sub_clauses, sub_params, sub_exact in parts:
+                        clauses += sub_clauses
+                        params += sub_params
+                        exact = exact and sub_exact
+                elif parts and all(sub_clauses for sub_clauses, _, _ in parts):
+                    clauses.append('(' + ' OR '.join('(' + ' AND '.join(c) + ')' for c, _, _ in parts) + ')')
+                    params += [param for _, sub_params, _ in parts for param in sub_params]
+                    exact = exact and all(sub_exact for _, _, sub_exact in parts)
+                else:
+                    exact = False
+            elif key.startswith('$') or (key != '_id' and key not in indexed):
+                exact = False
+            else:
+                sub_clauses, sub_params, sub_exact = self._field_where(key, cond)
+                clauses += sub_clauses
+                params += sub_params
+                exact = exact and sub_exact
+        return clauses, params, exact
+
+    def _field_where(self, field, cond):
+        expr = self._expr(field)
+        numeric = f"json_type(doc, '{_path(field)}') IN ('integer', 'real')"
+        conditions = cond.items() if _is_operators(cond) else [('$eq', cond)]
+        clauses, params, exact = [], [], True
+        for op, arg in conditions:
+            if op == '$eq' and arg is None:
+                clauses.append(f'{expr} IS NULL')
+            elif op == '$eq' and isinstance(arg, bool):
+                # json_extract gives 1 / 0 for true / false
+                clauses.append(f"{expr} = ? AND json_type(doc, '{_path(field)}') = ?")
+                params += [int(arg), 'true' if arg else 'false']
+            elif op == '$eq' and isinstance(arg, (int, float)):
+                clauses.append(f'{expr} = ?' if field == '_id' else f'{expr} = ? AND {numeric}')
+                params.append(arg)
+            elif op == '$eq' and not isinstance(arg, (dict, list)):
+                clauses.append(f'{expr} = ?')
+                params.append(_sql_value(arg))
+            elif op == '$in' and all(isinstance(item, (str, datetime, ObjectId, bytes)) or item is None for item in arg):
+                values = [_sql_value(item) for item in arg if item is not None]
+                sql = f"{expr} IN ({', '.join('?' * len(values))})" if values else '0'
+                clauses.append(f'({sql} OR {expr} IS NULL)' if len(values) < len(arg) else sql)
+                params += values
+            elif op in RANGE and isinstance(arg, (datetime, ObjectId)):
+                # Tagged strings sort within their type; bound the other
+                # side by the tag so no other type matches
+                tag = TAG + ('d' if isinstance(arg, datetime) else 'o')
+                if op in ('$gt', '$gte'):
+                    clauses.append(f'{expr} {RANGE[op]} ? AND {expr} < ?')
+                    params += [_sql_value(arg), TAG + chr(ord(tag[1]) + 1)]
+                else:
+                    clauses.append(f'{expr} {RANGE[op]} ? AND {expr} > ?')
+                    params += [_sql_value(arg), tag]
+            elif op in RANGE and isinstance(arg, (int, float)) and not isinstance(arg, bool):
+                clauses.append(f'{expr} {RANGE[op]} ? AND {numeric}')
+                params.append(arg)
+            elif op == '$exists' and field != '_id':
+                clauses.append(f"json_type(doc, '{_path(field)}') IS {'NOT ' if arg else ''}NULL")
+            else:
+                exact = False
+        return clauses, params, exact
+
+    def _order_by(self, sort):
+        return ', '.join(f"{self._expr(field)} {'DESC' if direction < 0 else 'ASC'}" for field, direction in sort)
+
+    def _select_sql(self, query, sort=None, limit=0, skip=0):
+        clauses, params, exact = self._where(query)
+        sql = f'SELECT rowid, id, doc FROM {self.table}'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        if sort:
+            sql += ' ORDER BY ' + self._order_by(sort)
+        if exact and (limit or skip):
+            sql += ' LIMIT ? OFFSET ?'
+            params = params + [limit or -1, skip]
+        return sql, params, exact
+
+    # [(rowid, doc)] matching query, in sort order
+    def _select(self, conn, query, sort=None, limit=0, skip=0):
+        sql, params, exact = self._select_sql(query, sort, limit, skip)
+        rows = [(rowid, self._load(doc_id, text)) for rowid, doc_id, text in conn.execute(sql, params)]
+        if exact:
+            return rows
+        rows = [row for row in rows if matches(row[1], query)]
+        return rows[skip:skip + limit] if limit else rows[skip:]
+
+    def _validate(self, doc, old=None):
+        validator = self.store.validators.get(self.name)
+        if validator is None:
+            return
+        schema, level = validator
+        if level == 'off':
+            return
+        if level == 'moderate' and old is not None and _schema_errors(schema, old):
+            return
+        if _schema_errors(schema, doc):
+            raise WriteError('Document failed validation', VALIDATION_FAILED)
+
+    def _duplicate(self, error):
+        return DuplicateKeyError(f'E11000 duplicate key error collection: {self.name} ({error})', DUPLICATE_KEY)
+
+    def _insert(self, conn, doc, validate=True):
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        if validate:
+            self._validate(doc)
+        body = {key: value for key, value in doc.items() if key != '_id'}
+        try:
+            conn.execute(f'INSERT INTO {self.table} (id, doc) VALUES (?, ?)', [_sql_value(doc['_id']), _dumps(body)])
+        except sqlite3.IntegrityError as e:
+            raise self._duplicate(e)
+        return doc['_id']
+
+    def _replace_row(self, conn, rowid, doc, old, validate=True):
+        if validate:
+            self._validate(doc, old)
+        body = {key: value for key, value in doc.items() if key != '_id'}
+        try:
+            conn.execute(f'UPDATE {self.table} SET id = ?, doc = ? WHERE rowid = ?', [_sql_value(doc['_id']), _dumps(body), rowid])
+        except sqlite3.IntegrityError as e:
+            raise self._duplicate(e)
+
+    # Update one or all matches; returns (matched, modified, upserted_id, before, after)
+    def _update(self, conn, query, update, multi=False, upsert=False, sort=None, validate=True):
+        rows = self._select(conn, query, sort, 0 if multi else 1)
+        if not rows and upsert:
+            doc = apply_update(_upsert_seed(query), update, inserting=True)
+            return 0, 0, self._insert(conn, doc, validate), None, doc
+        modified, before, after = 0, None, None
+        for rowid, doc in rows:
+            before = copy.deepcopy(doc)
+            after = apply_update(doc, update)
+            if after != before:
+                self._replace_row(conn, rowid, after, before, validate)
+                modified += 1
+        return len(rows), modified, None, before, after
+
+    def _delete(self, conn, query, multi=False, sort=None):
+        rows = self._select(conn, query, sort, 0 if multi else 1)
+        conn.executemany(f'DELETE FROM {self.table} WHERE rowid = ?', [(rowid,) for rowid, _ in rows])
+        return rows
+
+    def find(self, filter=None, projection=None, skip=0, limit=0, sort=None, **kwargs):
+        return SQLiteCursor(self, filter, projection, sort, limit, skip)
+
+    def find_one(self, filter=None, projection=None, sort=None, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {'_id': filter}
+        return next(self.find(filter, projection, sort=sort, limit=1), None)
+
+    def insert_one(self, document, bypass_document_validation=False, **kwargs):
+        with self._write() as conn:
+            return InsertOneResult(self._insert(conn, document, not bypass_document_validation), True)
+
+    def insert_many(self, documents, ordered=True, bypass_document_validation=False, **kwargs):
+        documents = list(documents)
+        result = self.bulk_write([InsertOne(doc) for doc in documents], ordered, bypass_document_validation)
+        return InsertManyResult([doc['_id'] for doc in documents if '_id' in doc][:result.inserted_count], True)
+
+    def _update_result(self, matched, modified, upserted_id):
+        raw = {'n': matched + (1 if upserted_id is not None else 0), 'nModified': modified, 'ok': 1.0,
+               'updatedExisting': bool(matched)}
+        if upserted_id is not None:
+            raw['upserted'] = upserted_id
+        return UpdateResult(raw, True)
+
+    def update_one(self, filter, update, upsert=False, bypass_document_validation=False, **kwargs):
+        with self._write() as conn:
+            matched, modified, upserted_id, _, _ = self._update(conn, filter, update, False, upsert,
+                                                                validate=not bypass_document_validation)
+        return self._update_result(matched, modified, upserted_id)
+
+    def update_many(self, filter, update, upsert=False, bypass_document_validation=False, **kwargs):
+        with self._write() as conn:
+            matched, modified, upserted_id, _, _ = self._update(conn, filter, update, True, upsert,
+                                                                validate=not bypass_document_validation)
+        return self._update_result(matched, modified, upserted_id)
+
+    def replace_one(self, filter, replacement, upsert=False, bypass_document_validation=False, **kwargs):
+        return self.update_one(filter, replacement, upsert, bypass_document_validation)
+
+    def delete_one(self, filter, **kwargs):
+        with self._write() as conn:
+            return DeleteResult({'n': len(self._delete(conn, filter)), 'ok': 1.0}, True)
+
+    def delete_many(self, filter, **kwargs):
+        with self._write() as conn:
+            return DeleteResult({'n': len(self._delete(conn, filter, multi=True)), 'ok': 1.0}, True)
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False, return_document=False, **kwargs):
+        with self._write() as conn:
+            _, _, _, before, after = self._update(conn, filter, update, False, upsert, sort)
+        doc = after if return_document else before
+        return project(doc, projection) if doc is not None else None
+
+    def find_one_and_replace(self, filter, replacement, projection=None, sort=None, upsert=False, return_document=False,
+                             **kwargs):
+        return self.find_one_and_update(filter, replacement, projection, sort, upsert, return_document)
+
+    def find_one_and_delete(self, filter, projection=None, sort=None, **kwargs):
+        with self._write() as conn:
+            rows = self._delete(conn, filter, sort=sort)
+        return project(rows[0][1], projection) if rows else None
+
+    def count_documents(self, filter, limit=0, skip=0, **kwargs):
+        conn = self._connection()
+        sql, params, exact = self._select_sql(filter, None, limit, skip)
+        if exact:
+            return conn.execute(f'SELECT COUNT(*) FROM ({sql})', params).fetchone()[0]
+        return len(self._select(conn, filter, None, limit, skip))
+
+    def estimated_document_count(self, **kwargs):
+        return self._connection().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def distinct(self, key, filter=None, **kwargs):
+        values, seen = [], set()
+        for doc in self.find(filter):
+            for value in _lookup(doc, key):
+                for item in value if isinstance(value, list) else [value]:
+                    marker = _group_key(item)
+                    if marker not in seen:
+                        seen.add(marker)
+                        values.append(item)
+        return values
+
+    def aggregate(self, pipeline, **kwargs):
+        pipeline = list(pipeline)
+        query = pipeline.pop(0)['$match'] if pipeline and '$match' in pipeline[0] else {}
+        return run_pipeline(self.database, self.find(query), pipeline)
+
+    # $merge with the defaults: merge into a document with the same _id,
+    # insert otherwise
+    def merge_documents(self, docs):
+        with self._write() as conn:
+            for doc in docs:
+                if '_id' in doc:
+                    self._update(conn, {'_id': doc['_id']}, {'$set': {k: v for k, v in doc.items() if k != '_id'}}, upsert=True)
+                else:
+                    self._insert(conn, dict(doc))
+
+    def bulk_write(self, requests, ordered=True, bypass_document_validation=False, **kwargs):
+        counts = {'nInserted': 0, 'nUpserted': 0, 'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        errors = []
+        validate = not bypass_document_validation
+        with self._write() as conn:
+            for index, request in enumerate(requests):
+                try:
+                    if isinstance(request, InsertOne):
+                        self._insert(conn, request._doc, validate)
+                        counts['nInserted'] += 1
+                    elif isinstance(request, (UpdateOne, UpdateMany, ReplaceOne)):
+                        matched, modified, upserted_id, _, _ = self._update(
+                            conn, request._filter, request._doc, isinstance(request, UpdateMany), request._upsert,
+                            validate=validate,
+                        )
+                        counts['nMatched'] += matched
+                        counts['nModified'] += modified
+                        if upserted_id is not None:
+                            counts['nUpserted'] += 1
+                            counts['upserted'].append({'index': index, '_id': upserted_id})
+                    elif isinstance(request, (DeleteOne, DeleteMany)):
+                        counts['nRemoved'] += len(self._delete(conn, request._filter, isinstance(request, DeleteMany)))
+                    else:
+                        raise OperationFailure(f'Unsupported bulk request: {type(request).__name__}')
+                except (DuplicateKeyError, WriteError) as e:
+                    errors.append({'index': index, 'code': e.code, 'errmsg': str(e), 'op': getattr(request, '_doc', None)})
+                    if ordered:
+                        break
+        if errors:
+            raise BulkWriteError(dict(counts, writeErrors=errors, writeConcernErrors=[]))
+        return BulkWriteResult(counts, True)
+
+    def create_index(self, keys, **kwargs):
+        from pymongo import IndexModel
+        return self.create_indexes([IndexModel(keys, **kwargs)])[0]
+
+    def create_indexes(self, indexes, **kwargs):
+        names = []
+        conn = self._connection()
+        for index in indexes:
+            spec = index.document
+            name = spec['name']
+            keys = list(spec['key'].items())
+            columns = ', '.join(f"{self._expr(field)} {'DESC' if direction == -1 else 'ASC'}" for field, direction in keys)
+            sql = f'CREATE {"UNIQUE " if spec.get("unique") else ""}INDEX IF NOT EXISTS "{self.name}.{name}" ON {self.table} ({columns})'
+            partial = spec.get('partialFilterExpression')
+            if partial:
+                sql += ' WHERE ' + self._partial_where(partial)
+            conn.execute(sql)
+            self.store.save_index(conn, self.name, name, {
+                'key': keys,
+                'unique': bool(spec.get('unique')),
+                'expireAfterSeconds': spec.get('expireAfterSeconds'),
+                'partialFilterExpression': partial,
+                # Kept for index_information only; SQLite indexes every row
+                # and compares with the column's own collation
+                'sparse': bool(spec.get('sparse')),
+                'collation': spec.get('collation'),
+            })
+            names.append(name)
+        return names
+
+    # Index WHERE clauses take no parameters, so values are inlined
+    def _partial_where(self, partial):
+        clauses, params, exact = self._where(partial, {key for key in partial if not key.startswith('$')})
+        if not exact:
+            raise OperationFailure(f'Unsupported partialFilterExpression: {partial}')
+        pieces = ' AND '.join(clauses).split('?')
+        literals = [str(p) if isinstance(p, (int, float)) else "'" + str(p).replace("'", "''") + "'" for p in params]
+        return ''.join(piece + literal for piece, literal in zip(pieces, literals + ['']))
+
+    def index_information(self):
+        self._connection()
+        info = {'_id_': {'key': [('_id', 1)], 'v': 2}}
+        for name, spec in self.store.indexes.get(self.name, {}).items():
+            info[name] = {'key': [tuple(key) for key in spec['key']], 'v': 2}
+            if spec.get('unique'):
+                info[name]['unique'] = True
+            if spec.get('expireAfterSeconds') is not None:
+                info[name]['expireAfterSeconds'] = spec['expireAfterSeconds']
+            for option in ('partialFilterExpression', 'sparse', 'collation'):
+                if spec.get(option):
+                    info[name][option] = spec[option]
+        return info
+
+    def drop_index(self, name, **kwargs):
+        conn = self._connection()
+        conn.execute(f'DROP INDEX IF EXISTS "{self.name}.{name}"')
+        self.store.delete_index(conn, self.name, name)
+
+    def drop_indexes(self, **kwargs):
+        self._connection()
+        for name in list(self.store.indexes.get(self.name, {})):
+            self.drop_index(name)
+
+    def drop(self, **kwargs):
+        self.database.drop_collection(self.name)
+
+
+class SQLiteDatabase:
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self._collections = {}
+
+    def __getitem__(self, name):
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = SQLiteCollection(self, name)
+        return collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name, **kwargs):
+        return self[name]
+
+    def list_collection_names(self, **kwargs):
+        return sorted(self.store.tables(self.store.connection()))
+
+    def create_collection(self, name, validator=None, validationLevel='strict', **kwargs):
+        conn = self.store.connection()
+        if name in self.store.tables(conn):
+            raise CollectionInvalid(f'collection {name} already exists')
+        self.store.ensure_table(conn, name)
+        if validator:
+            self.store.save_validator(conn, name, validator, validationLevel)
+        return self[name]
+
+    def drop_collection(self, name, **kwargs):
+        conn = self.store.connection()
+        conn.execute(f'DROP TABLE IF EXISTS {_quote(name)}')
+        conn.execute('DELETE FROM _meta WHERE collection = ?', [name])
+        self.store.forget(name)
+
+    def command(self, command, value=None, **kwargs):
+        if command == 'ping':
+            self.store.connection().execute('SELECT 1')
+            return {'ok': 1.0}
+        if command == 'collMod':
+            conn = self.store.connection()
+            validator = kwargs.get('validator')
+            if validator:
+                self.store.save_validator(conn, value, validator, kwargs.get('validationLevel', 'strict'))
+            index = kwargs.get('index')
+            if index:
+                spec = self.store.indexes.get(value, {}).get(index['name'])
+                if spec is None:
+                    raise OperationFailure(f"cannot find index {index['name']} for ns {value}")
+                self.store.save_index(conn, value, index['name'], dict(spec, expireAfterSeconds=index['expireAfterSeconds']))
+            return {'ok': 1.0}
+        raise OperationFailure(f'Unsupported command: {command}')
+
+
+# Stand-in for MongoClient where callers reach for mongo.cx
+class SQLiteClient:
+    def __init__(self, store):
+        self.store = store
+
+    def get_default_database(self):
+        return self.store.db
+
+    def __getitem__(self, name):
+        return self.store.db
+
+    def drop_database(self, name):
+        db = self.store.db
+        for collection in db.list_collection_names():
+            db.drop_collection(collection)
+
+    def close(self):
+        self.store.close()
+
+
+# Same interface as database.Mongo (db, cx, ping, pool_stats, close). Each
+# thread gets its own connection; SQLite serializes the writers, and WAL
+# lets readers run alongside them.
+class SQLiteStore:
+    def __init__(self, config):
+        self.path = config['SQLITE_PATH']
+        self.busy_timeout = config.get('SQLITE_BUSY_TIMEOUT_MS', 5000) / 1000
+        name = os.path.splitext(os.path.basename(self.path))[0] or 'main'
+        self._db = SQLiteDatabase(self, name)
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._tables = None
+        self.indexes = {}
+        self.validators = {}
+        self.ttl_checked = {}
+
+    @property
+    def db(self):
+        return self._db
+
+    @property
+    def cx(self):
+        return SQLiteClient(self)
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS _meta (collection TEXT, kind TEXT, name TEXT, spec TEXT, '
+                         'PRIMARY KEY (collection, kind, name))')
+            self._local.conn, self._local.pid = conn, os.getpid()
+            with self._lock:
+                if self._tables is None:
+                    self._load_meta(conn)
+                self._connections.append(conn)
+        return conn
+
+    def _load_meta(self, conn):
+        self._tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for collection, kind, name, spec in conn.execute('SELECT collection, kind, name, spec FROM _meta'):
+            spec = decode(json.loads(spec))
+            if kind == 'index':
+                self.indexes.setdefault(collection, {})[name] = spec
+            elif kind == 'validator':
+                self.validators[collection] = (spec['validator'].get('$jsonSchema', {}), spec['level'])
+
+    def tables(self, conn):
+        return {name for name in self._tables if name != '_meta'}
+
+    def ensure_table(self, conn, name):
+        if name not in self._tables:
+            conn.execute(f'CREATE TABLE IF NOT EXISTS {_quote(name)} '
+                         '(rowid INTEGER PRIMARY KEY, id UNIQUE NOT NULL, doc TEXT NOT NULL)')
+            self._tables.add(name)
+
+    def forget(self, name):
+        self._tables.discard(name)
+        self.indexes.pop(name, None)
+        self.validators.pop(name, None)
+
+    def indexed_fields(self, name):
+        return {field for spec in self.indexes.get(name, {}).values() for field, _ in spec['key']}
+
+    def ttl_fields(self, name):
+        return [
+            (spec['key'][0][0], spec['expireAfterSeconds'])
+            for spec in self.indexes.get(name, {}).values() if spec.get('expireAfterSeconds') is not None
+        ]
+
+    def _save_meta(self, conn, collection, kind, name, spec):
+        conn.execute('INSERT OR REPLACE INTO _meta (collection, kind, name, spec) VALUES (?, ?, ?, ?)',
+                     [collection, kind, name, _dumps(spec)])
+
+    def save_index(self, conn, collection, name, spec):
+        self._save_meta(conn, collection, 'index', name, spec)
+        self.indexes.setdefault(collection, {})[name] = spec
+
+    def delete_index(self, conn, collection, name):
+        conn.execute("DELETE FROM _meta WHERE collection = ? AND kind = 'index' AND name = ?", [collection, name])
+        self.indexes.get(collection, {}).pop(name, None)
+
+    def save_validator(self, conn, collection, validator, level):
+        self._save_meta(conn, collection, 'validator', '', {'validator': validator, 'level': level})
+        self.validators[collection] = (validator.get('$jsonSchema', {}), level)
+
+    def pool_stats(self):
+        with self._lock:
+            return {'backend': 'sqlite', 'open': len(self._connections)}
+
+    def ping(self, timeout=1.0):
+        start = time.perf_counter()
+        try:
+            self.db.command('ping')
+        except sqlite3.Error as e:
+            raise ConnectionFailure(str(e))
+        return (time.perf_counter() - start) * 1000
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
@@ -0,0 +1,96 @@
+import base64
+from datetime import datetime, timedelta
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from batch import RESOURCES
+from models import TOMBSTONE_RETENTION, TimeCapsule, Tombstone
+
+COLLECTION_RESOURCES = {model.COLLECTION: name for name, model in RESOURCES.items()}
+# Only what the resource's list endpoint would show: a capsule is sent once
+# it has been opened (opening it bumps updated_at)
+VISIBLE = {TimeCapsule: {'opened': True}}
+
+
+class SyncError(ValueError):
+    pass
+
+
+class SyncTokenExpired(SyncError):
+    pass
+
+
+# A token is a point in time, plus the last _id sent at that time when a
+# response was truncated
+def encode_token(when, last_id=None):
+    text = when.isoformat() if last_id is None else f'{when.isoformat()}|{last_id}'
+    return base64.urlsafe_b64encode(text.encode('ascii')).decode('ascii')
+
+
+def decode_token(token):
+    try:
+        when, _, last_id = base64.urlsafe_b64decode(token.encode('ascii')).decode('ascii').partition('|')
+        return datetime.fromisoformat(when), ObjectId(last_id) if last_id else None
+    except (ValueError, InvalidId):
+        raise SyncError('Invalid sync token')
+
+
+def _changed_after(when, last_id):
+    if last_id is None:
+        return {'updated_at': {'$gte': when}}
+    return {'$or': [{'updated_at': {'$gt': when}}, {'updated_at': when, '_id': {'$gt': last_id}}]}
+
+
+# Changes to a user's documents since a sync token, driven by updated_at on
+# every collection plus tombstones for deletes. Without a token the client
+# is expected to do a full fetch through the list endpoints first.
+#
+# The next token trails the server clock by `overlap` so writes that were in
+# flight during this read are picked up next time; clients apply changes by
+# id, so the few repeated documents are harmless. If any collection has more
+# than `limit` changes the response is truncated and `more` is set; the next
+# token then resumes after the oldest truncated (updated_at, _id), since
+# timestamps only have millisecond precision and many documents can share one.
+def changes_since(mongo, user_id, since, limit=500, overlap=timedelta(seconds=5), serializers=None):
+    now = datetime.utcnow()
+    if since is None:
+        return {'full': True, 'changes': {}, 'deleted': [], 'more': False, 'next': encode_token(now - overlap)}
+    since, last_id = since
+    if since < now - TOMBSTONE_RETENTION:
+        raise SyncTokenExpired('Sync token expired, do a full sync')
+    changed = _changed_after(since, last_id)
+
+    changes, resume_points = {}, []
+    for name, model in RESOURCES.items():
+        docs = list(mongo.db[model.COLLECTION]
+                    .find(dict(VISIBLE.get(model, {}), user_id=user_id, **changed))
+                    .sort([('updated_at', 1), ('_id', 1)])
+                    .limit(limit + 1))
+        if len(docs) > limit:
+            docs = docs[:limit]
+            resume_points.append((docs[-1]['updated_at'], docs[-1]['_id']))
+        serialize = (serializers or {}).get(model)
+        changes[name] = serialize(docs) if serialize else docs
+
+    tombstones = list(mongo.db[Tombstone.COLLECTION]
+                      .find(dict(changed, user_id=user_id))
+                      .sort([('updated_at', 1), ('_id', 1)])
+                      .limit(limit + 1))
+    if len(tombstones) > limit:
+        tombstones = tombstones[:limit]
+        resume_points.append((tombstones[-1]['updated_at'], tombstones[-1]['_id']))
+    deleted = [
+        {'resource': COLLECTION_RESOURCES[t['collection']], 'id': t['doc_id'], 'deleted_at': t['updated_at']}
+        for t in tombstones
+    ]
+
+    if resume_points:
+        next_point = min(resume_points)
+    else:
+        next_point = (now - overlap, None) if now - overlap > since else (since, last_id)
+    return {
+        'full': False,
+        'changes': changes,
+        'deleted': deleted,
+        'more': bool(resume_points),
+        'next': encode_token(*next_point),
+    }
@@ -0,0 +1,77 @@
+from bson import ObjectId
+from analytics import MoodRollup, day_of
+from search import FIELD_WEIGHTS
+
+
+# Secondary work the routes hand off to the job queue. Handlers re-read the
+# current documents rather than trusting the payload, so a job can be
+# retried, coalesced with a newer one or run late and still converge.
+# Payloads never carry plaintext; entry content is decrypted when indexed.
+def register_tasks(jobs, mongo, keystore, search_index, reminders=None, attachments=None):
+    @jobs.handler('search.reindex')
+    def reindex(collection, doc_id):
+        if search_index is None:
+            return
+        doc = mongo.db[collection].find_one({'_id': ObjectId(doc_id)})
+        if doc is None:
+            search_index.remove(ObjectId(doc_id))
+            return
+        fields = {f: doc.get(f) for f in FIELD_WEIGHTS if f in doc}
+        if collection == 'entries' and 'content' in doc:
+            _, cipher = keystore.cipher(doc['user_id'], [doc.get('key_id')])
+            fields['content'] = keystore.decrypt_entry(cipher, doc)
+        search_index.index(doc['user_id'], collection, doc['_id'], fields)
+
+    @jobs.handler('rollups.mood_day')
+    def refresh_mood_day(user_id, day):
+        MoodRollup.refresh(mongo, user_id, day)
+
+    @jobs.handler('reminders.refresh')
+    def refresh_reminders(collection, user_id):
+        if reminders is not None:
+            reminders.refresh(collection, user_id)
+
+    @jobs.handler('reminders.refresh_document')
+    def refresh_document_reminder(collection, user_id, doc_id):
+        if reminders is not None:
+            reminders.refresh_document(collection, user_id, ObjectId(doc_id))
+
+    @jobs.handler('attachments.thumbnail')
+    def attachment_thumbnail(attachment_id):
+        if attachments is not None:
+            attachments.generate_thumbnail(attachment_id)
+
+    @jobs.handler('attachments.purge_entry')
+    def purge_entry_attachments(user_id, entry_id):
+        if attachments is not None:
+            attachments.purge_entry(user_id, entry_id)
+
+
+# (name, payload, key) for JobQueue.enqueue; jobs for the same document or
+# day collapse into one while it is waiting
+def reindex_job(collection, doc_id):
+    return 'search.reindex', {'collection': collection, 'doc_id': str(doc_id)}, f'search.reindex:{doc_id}'
+
+
+def mood_day_job(user_id, date):
+    day = day_of(date)
+    return 'rollups.mood_day', {'user_id': user_id, 'day': day}, f'rollups.mood_day:{user_id}:{day.date()}'
+
+
+def reminder_job(collection, user_id):
+    key = f'reminders.refresh:{collection}:{user_id}'
+    return 'reminders.refresh', {'collection': collection, 'user_id': user_id}, key
+
+
+def reminder_document_job(collection, user_id, doc_id):
+    payload = {'collection': collection, 'user_id': user_id, 'doc_id': str(doc_id)}
+    return 'reminders.refresh_document', payload, f'reminders.refresh_document:{doc_id}'
+
+
+def thumbnail_job(attachment_id):
+    return 'attachments.thumbnail', {'attachment_id': str(attachment_id)}, f'attachments.thumbnail:{attachment_id}'
+
+
+def purge_attachments_job(user_id, entry_id):
+    key = f'attachments.purge_entry:{entry_id}'
+    return 'attachments.purge_entry', {'user_id': user_id, 'entry_id': str(entry_id)}, key
@@ -0,0 +1,80 @@
+import pytest
+from app import create_app
+from config import Config
+from models import write_listeners
+
+
+# Each test gets the app on its own SQLite file, with jobs run inline and no
+# background threads, so everything a request sets off has happened by the
+# time it returns
+class TestConfig(Config):
+    TESTING = True
+    STORAGE_BACKEND = 'sqlite'
+    JOB_BROKER = 'eager'
+    CAPSULE_SCHEDULER = False
+    REMINDER_ENGINE = False
+    CACHE_BACKEND = 'none'
+    METRICS_ENABLED = False
+    COMPRESS_MIN_BYTES = 0
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    SYNC_OVERLAP_SECONDS = 0
+
+
+# make_app(**settings) builds an app with settings overriding TestConfig;
+# pass mongo to use another store (e.g. mongomock)
+@pytest.fixture
+def make_app(tmp_path):
+    apps = []
+    listeners = list(write_listeners)
+
+    def make(mongo=None, **settings):
+        settings.setdefault('SQLITE_PATH', str(tmp_path / f'diary{len(apps)}.sqlite3'))
+        app = create_app(type('Config', (TestConfig,), settings), mongo)
+        apps.append(app)
+        return app
+
+    yield make
+    for app in apps:
+        if hasattr(app.extensions['mongo'], 'close'):
+            app.extensions['mongo'].close()
+    # Apps register their cache and reminder listeners globally
+    write_listeners[:] = listeners
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+# login(username) registers the user if needed and returns auth headers;
+# pass client to log in to an app from make_app
+@pytest.fixture
+def login(client):
+    default = client
+
+    def login(username='alice', password='secret', client=None):
+        client = client or default
+        client.post('/register', json={'username': username, 'password': password})
+        response = client.post('/login', json={'username': username, 'password': password})
+        return {'Authorization': f"Bearer {response.get_json()['access_token']}"}
+
+    return login
+
+
+@pytest.fixture
+def headers(login):
+    return login()
+
+
+# user_id(username) is the id tokens carry, for calling into the app directly
+@pytest.fixture
+def user_id(app):
+    def user_id(username='alice'):
+        return str(app.extensions['mongo'].db.users.find_one({'username': username})['_id'])
+
+    return user_id
@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import pytest
+from analytics import HabitRollup, MoodRollup, day_of
+from models import Mood
+
+
+def log(mongo, owner, mood, rating, date):
+    doc = dict(Mood(owner, mood, rating=rating).to_bson(), date=date)
+    mongo.db.moods.insert_one(doc)
+    MoodRollup.record(mongo, doc)
+    return doc
+
+
+def rollups(app):
+    rows = app.extensions['mongo'].db.mood_daily.find({}, {'_id': 0, 'user_id': 0})
+    return sorted((row['day'], row['mood'], row['count'], row['rating_sum']) for row in rows)
+
+
+def test_mood_stats_from_rollups(app, client, headers, user_id):
+    mongo = app.extensions['mongo']
+    log(mongo, user_id(), 'happy', 5, datetime(2030, 3, 1, 9))
+    log(mongo, user_id(), 'happy', 3, datetime(2030, 3, 1, 10))
+    log(mongo, user_id(), 'sad', 1, datetime(2030, 3, 2, 9))
+    stats = client.get('/moods/stats?from=2030-03-01&to=2030-03-03', headers=headers).get_json()
+    assert [(p['count'], p['average_rating']) for p in stats['series']] == [(2, 4), (1, 1)]
+    assert stats['distribution'] == [{'mood': 'happy', 'count': 2}, {'mood': 'sad', 'count': 1}]
+
+
+def test_batch_writes_refresh_the_affected_day(app, client, headers):
+    client.post('/moods', json={'mood': 'happy', 'rating': 5}, headers=headers)
+    mood_id = client.get('/moods', headers=headers).get_json()[0]['_id']
+    response = client.post('/batch', json={'operations': [
+        {'resource': 'moods', 'op': 'update', 'id': mood_id, 'data': {'mood': 'calm', 'rating': 2}},
+        {'resource': 'moods', 'op': 'create', 'data': {'mood': 'calm', 'rating': 4}},
+    ]}, headers=headers)
+    assert response.status_code == 200
+    assert rollups(app) == [(day_of(datetime.utcnow()), 'calm', 2, 6)]
+
+
+def test_refresh_overwrites_existing_rows_in_place(app, headers, user_id):
+    mongo = app.extensions['mongo']
+    day = datetime(2030, 3, 1)
+    log(mongo, user_id(), 'happy', 5, day)
+    mongo.db.mood_daily.update_many({}, {'$set': {'count': 99}})
+    mongo.db.mood_daily.insert_one({'user_id': user_id(), 'day': day, 'mood': 'gone', 'count': 1, 'rating_sum': 1})
+    MoodRollup.refresh(mongo, user_id(), day)
+    MoodRollup.refresh(mongo, user_id(), day)
+    assert rollups(app) == [(day, 'happy', 1, 5)]
+
+
+# A delete-then-insert refresh lets record() upsert into the gap and then
+# fails on the unique index
+def test_refresh_races_with_record(app, headers, user_id):
+    mongo = app.extensions['mongo']
+    owner = user_id()
+    day = datetime(2030, 3, 1, 12)
+
+    def work(i):
+        if i % 2:
+            log(mongo, owner, f'mood{i % 5}', 1, day)
+        else:
+            MoodRollup.refresh(mongo, owner, day)
+
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(work, range(200)))
+    MoodRollup.refresh(mongo, owner, day)
+    assert sum(row[2] for row in rollups(app)) == 100
+
+
+def test_habit_streaks(app, client, headers, user_id):
+    client.post('/habits', json={'title': 'Run', 'frequency': 'daily'}, headers=headers)
+    habit = app.extensions['mongo'].db.habits.find_one()
+    today = day_of(datetime.utcnow())
+    for days_ago in (0, 1, 3, 4, 5):
+        HabitRollup.record(app.extensions['mongo'], user_id(), habit['_id'], 1, today - timedelta(days=days_ago))
+    start = (today - timedelta(days=5)).date().isoformat()
+    stats = client.get(f'/habits/stats?from={start}', headers=headers).get_json()
+    assert stats[0]['checkins'] == 5
+    assert (stats[0]['current_streak'], stats[0]['longest_streak']) == (2, 3)
+    assert stats[0]['completion_ratio'] == pytest.approx(5 / 6)
+
+
+def test_invalid_range(client, headers):
+    assert client.get('/moods/stats?from=2030-03-02&to=2030-03-01', headers=headers).status_code == 400
+    assert client.get('/moods/stats?from=soon', headers=headers).status_code == 400
+    assert client.get('/moods/stats?granularity=year', headers=headers).status_code == 400
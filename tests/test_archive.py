@@ -0,0 +1,124 @@
+from datetime import datetime, timedelta
+from archive import Archive, Archiver, month_of, next_month
+from models import Entry, Mood
+
+NOW = datetime(2021, 1, 15)
+
+
+# Posts entries and moves them back in time, one per month from January
+def old_entries(app, client, headers, count):
+    mongo = app.extensions['mongo']
+    ids = []
+    for i in range(count):
+        client.post('/entries', json={'title': f'Old {i}', 'content': f'month {i + 1}'}, headers=headers)
+        doc = mongo.db.entries.find_one_and_update({'title': f'Old {i}'}, {'$set': {'timestamp': datetime(2020, i + 1, 10)}})
+        ids.append(str(doc['_id']))
+    return ids
+
+
+def archived_months(mongo, collection='entries'):
+    return sorted(Archive.documents(mongo, collection), key=lambda doc: doc['timestamp'])
+
+
+def test_months():
+    assert month_of(datetime(2030, 5, 17, 9)) == datetime(2030, 5, 1)
+    assert next_month(datetime(2030, 12, 1)) == datetime(2031, 1, 1)
+
+
+def test_run_moves_whole_old_months(app, client, headers):
+    mongo = app.extensions['mongo']
+    old_entries(app, client, headers, 8)
+    client.post('/entries', json={'title': 'New', 'content': 'today'}, headers=headers)
+
+    moved = Archiver(mongo, after_days=180).run([Entry, Mood], now=NOW)
+    assert moved == {'entries': 6, 'moods': 0}
+    assert sorted(doc['title'] for doc in mongo.db.entries.find()) == ['New', 'Old 6', 'Old 7']
+    assert [doc['title'] for doc in archived_months(mongo)] == [f'Old {i}' for i in range(6)]
+    assert mongo.db.archives.count_documents({}) == 6
+    # Nothing left to move
+    assert Archiver(mongo, after_days=180).run([Entry], now=NOW) == {'entries': 0}
+
+
+def test_parts_are_split_and_round_trip(app, client, headers):
+    mongo = app.extensions['mongo']
+    for i in range(5):
+        client.post('/entries', json={'title': f'Same month {i}', 'content': 'x' * 200}, headers=headers)
+    mongo.db.entries.update_many({}, {'$set': {'timestamp': datetime(2020, 1, 10)}})
+    originals = sorted(mongo.db.entries.find(), key=lambda doc: doc['_id'])
+
+    Archiver(mongo, after_days=180, part_bytes=600, codec='zlib').run([Entry], now=NOW)
+    parts = list(mongo.db.archives.find())
+    assert len(parts) > 1 and {part['codec'] for part in parts} == {'zlib'}
+    assert sorted(Archive.documents(mongo, 'entries'), key=lambda doc: doc['_id']) == originals
+
+
+def test_listing_rehydrates_newest_months_first(app, client, headers):
+    mongo = app.extensions['mongo']
+    old_entries(app, client, headers, 6)
+    Archiver(mongo, after_days=180).run([Entry], now=NOW)
+    assert mongo.db.entries.count_documents({}) == 0
+
+    page = client.get('/entries?limit=2', headers=headers).get_json()
+    assert [entry['title'] for entry in page] == ['Old 5', 'Old 4']
+    assert page[0]['content'] == 'month 6'
+    assert mongo.db.entries.count_documents({}) == 3
+    assert len(archived_months(mongo)) == 3
+
+    everything = client.get('/entries', headers=headers).get_json()
+    assert [entry['title'] for entry in everything] == [f'Old {i}' for i in reversed(range(6))]
+    assert list(Archive.documents(mongo, 'entries')) == []
+
+
+def test_restore_by_id_and_range(app, client, headers, user_id):
+    mongo = app.extensions['mongo']
+    ids = old_entries(app, client, headers, 4)
+    Archiver(mongo, after_days=180).run([Entry], now=NOW)
+
+    response = client.put(f'/entries/{ids[1]}', json={'title': 'Edited'}, headers=headers)
+    assert response.status_code == 200
+    assert [doc['title'] for doc in mongo.db.entries.find()] == ['Edited']
+
+    assert Archive.restore_range(mongo, Entry, user_id(), datetime(2020, 3, 20), datetime(2020, 4, 2)) == 2
+    assert sorted(doc['title'] for doc in mongo.db.entries.find()) == ['Edited', 'Old 2', 'Old 3']
+    assert Archive.restore_ids(mongo, Entry, user_id(), ids[2:]) == 0
+
+
+def test_restored_months_are_held_then_rearchived(app, client, headers):
+    mongo = app.extensions['mongo']
+    old_entries(app, client, headers, 1)
+    archiver = Archiver(mongo, after_days=180, hold_days=30)
+    archiver.run([Entry], now=NOW)
+    client.get('/entries', headers=headers)
+
+    assert archiver.run([Entry], now=NOW) == {'entries': 0}
+    assert mongo.db.entries.count_documents({}) == 1
+
+    mongo.db.archives.update_many({}, {'$set': {'restored_at': datetime.utcnow() - timedelta(days=31)}})
+    assert archiver.run([Entry], now=NOW) == {'entries': 1}
+    assert mongo.db.entries.count_documents({}) == 0
+    parts = list(mongo.db.archives.find())
+    assert len(parts) == 1 and parts[0]['restored_at'] is None
+
+
+def test_concurrent_edit_stays_in_the_collection(app, client, headers):
+    mongo = app.extensions['mongo']
+    old_entries(app, client, headers, 1)
+    client.post('/entries', json={'title': 'Sibling', 'content': 'x'}, headers=headers)
+    mongo.db.entries.update_one({'title': 'Sibling'}, {'$set': {'timestamp': datetime(2020, 1, 20)}})
+    docs = list(mongo.db.entries.find().sort('timestamp', 1))
+    # Edited after the archiver read it
+    mongo.db.entries.update_one({'_id': docs[0]['_id']}, {'$inc': {'version': 1}})
+
+    archiver = Archiver(mongo, after_days=180)
+    assert archiver.archive_month(Entry, docs[0]['user_id'], datetime(2020, 1, 1), docs) == 1
+    assert [doc['title'] for doc in mongo.db.entries.find()] == ['Old 0']
+    assert [doc['title'] for doc in Archive.documents(mongo, 'entries')] == ['Sibling']
+
+
+def test_deleting_an_archived_entry(app, client, headers):
+    mongo = app.extensions['mongo']
+    ids = old_entries(app, client, headers, 2)
+    Archiver(mongo, after_days=180).run([Entry], now=NOW)
+    assert client.delete(f'/entries/{ids[0]}', headers=headers).status_code == 200
+    assert [doc['title'] for doc in mongo.db.entries.find()] == []
+    assert [doc['title'] for doc in Archive.documents(mongo, 'entries')] == ['Old 1']
@@ -0,0 +1,155 @@
+import asyncio
+import json
+import pytest
+from flask import request
+from pymongo.errors import PyMongoError
+import metrics
+from asgi import AsgiApp
+from bridge import BridgedMongo, ThreadedClient
+from database import create_store
+
+
+# ThreadedClient over the test app's own store, counting the requests
+# that reach it
+class CountingClient(ThreadedClient):
+    def __init__(self, store):
+        super().__init__(store)
+        self.uses = self.pings = 0
+
+    @property
+    def db(self):
+        self.uses += 1
+        return super().db
+
+    async def ping(self, timeout=1.0):
+        self.pings += 1
+        return await super().ping(timeout)
+
+
+def bridged_store(config, listeners=()):
+    store = create_store(config, listeners)
+    return BridgedMongo(store, CountingClient(store))
+
+
+def call(asgi_app, method, path, headers=None, query_string='', body=b''):
+    scope = {
+        'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'https', 'path': path, 'root_path': '',
+        'query_string': query_string.encode(), 'client': ('203.0.113.9', 51000), 'server': ('diary.example', 443),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in (headers or {}).items()],
+    }
+    # The body arrives in two messages, as a client may send it
+    requests = [
+        {'type': 'http.request', 'body': body[:5], 'more_body': True},
+        {'type': 'http.request', 'body': body[5:], 'more_body': False},
+    ]
+    messages = []
+
+    async def receive():
+        return requests.pop(0)
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi_app(scope, receive, send))
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in messages[0]['headers']}
+    return messages[0]['status'], headers, b''.join(message.get('body', b'') for message in messages[1:])
+
+
+def call_json(asgi_app, method, path, headers=None, data=None):
+    headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+    status, _, body = call(asgi_app, method, path, headers, body=json.dumps(data).encode())
+    return status, json.loads(body)
+
+
+@pytest.fixture
+def seen():
+    return []
+
+
+@pytest.fixture
+def bridged(make_app, seen):
+    app = make_app(bridged_store, METRICS_ENABLED=True)
+
+    @app.after_request
+    def capture(response):
+        seen.append((request.remote_addr, request.host, request.scheme, metrics._current.get()))
+        return response
+
+    return app, AsgiApp(app)
+
+
+def test_routes_match_the_flask_app(bridged):
+    app, asgi_app = bridged
+    client = app.test_client()
+    credentials = {'username': 'alice', 'password': 'secret'}
+    assert call_json(asgi_app, 'POST', '/register', data=credentials)[0] == 201
+    status, token = call_json(asgi_app, 'POST', '/login', data=credentials)
+    assert status == 200
+    headers = {'Authorization': f"Bearer {token['access_token']}"}
+
+    for title in ('one', 'two', 'three'):
+        assert call_json(asgi_app, 'POST', '/tasks', headers, {'title': title})[0] == 201
+    assert call_json(asgi_app, 'POST', '/entries', headers, {'title': 'Day', 'content': 'secret lake'})[0] == 201
+    task_id = client.get('/tasks', headers=headers).get_json()[0]['_id']
+    assert call_json(asgi_app, 'PUT', f'/tasks/{task_id}', headers, {'title': 'renamed'})[0] == 200
+    assert call(asgi_app, 'DELETE', f'/tasks/{task_id}', headers)[0] == 200
+
+    for path, query in (('/tasks', 'limit=1'), ('/entries', ''), ('/search', 'q=lake'), ('/tasks', 'stream=1')):
+        status, response_headers, body = call(asgi_app, 'GET', path, headers, query)
+        expected = client.get(f'{path}?{query}', headers=headers)
+        assert status == expected.status_code == 200
+        assert body == expected.get_data()
+        assert response_headers.get('x-next-cursor') == expected.headers.get('X-Next-Cursor')
+    assert [task['title'] for task in client.get('/tasks', headers=headers).get_json()] == ['two', 'one']
+    assert asgi_app.mongo.client.uses > 0
+
+    etag = client.get('/moods', headers=headers).headers['ETag']
+    status, _, body = call(asgi_app, 'GET', '/moods', dict(headers, **{'If-None-Match': etag}))
+    assert (status, body) == (304, b'')
+
+
+# Failures inside awaited queries reach the app's error handlers, as they
+# would under the Flask server
+def test_errors_go_through_the_flask_handlers(bridged, login, monkeypatch):
+    app, asgi_app = bridged
+
+    @app.errorhandler(PyMongoError)
+    def unavailable(error):
+        return {'message': str(error)}, 503
+
+    headers = login(client=app.test_client())
+    assert call(asgi_app, 'GET', '/tasks')[0] == 401
+    assert call(asgi_app, 'GET', '/tasks', headers, 'limit=nonsense')[0] == 400
+    assert call(asgi_app, 'DELETE', '/tasks/not-an-id', headers)[0] == 404
+    assert call_json(asgi_app, 'POST', '/tasks', headers, {})[0] == 400
+
+    async def fail(*args, **kwargs):
+        raise PyMongoError('connection reset')
+
+    collection = asgi_app.mongo.client.db.tasks
+    monkeypatch.setattr(type(collection), '__getattr__', lambda self, name: fail)
+    status, _, body = call(asgi_app, 'GET', '/tasks', headers)
+    assert (status, json.loads(body)) == (503, {'message': 'connection reset'})
+
+
+def test_bridged_requests_keep_their_context(bridged, login, seen):
+    app, asgi_app = bridged
+    client = app.test_client()
+    headers = login(client=client)
+    client.post('/entries', json={'title': 'Day', 'content': 'secret'}, headers=headers)
+    before = metrics.HTTP_REQUESTS._values.get(('GET', '/entries', 200), 0)
+    seen.clear()
+
+    assert call(asgi_app, 'GET', '/entries', headers)[0] == 200
+    remote_addr, host, scheme, stats = seen[0]
+    assert (remote_addr, host, scheme) == ('203.0.113.9', 'diary.example', 'https')
+    # Decryption ran on a worker thread but was timed against this request
+    assert stats.crypto_seconds > 0
+    assert metrics.HTTP_REQUESTS._values[('GET', '/entries', 200)] == before + 1
+
+
+def test_readiness_pings_through_the_async_client(bridged):
+    app, asgi_app = bridged
+    status, _, body = call(asgi_app, 'GET', '/readyz')
+    assert (status, json.loads(body)['status']) == (200, 'ok')
+    assert asgi_app.mongo.client.pings == 1
@@ -0,0 +1,166 @@
+from datetime import datetime, timedelta
+import pytest
+
+DATA = bytes(range(256)) * 2 + b'tail'
+CHUNK = 100
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app(ATTACHMENT_CHUNK_BYTES=CHUNK)
+
+
+@pytest.fixture
+def entry_id(client, headers):
+    client.post('/entries', json={'title': 'Photos', 'content': 'x'}, headers=headers)
+    return client.get('/entries', headers=headers).get_json()[0]['id']
+
+
+def start(client, headers, entry_id, size=len(DATA), content_type='image/png'):
+    return client.post(f'/entries/{entry_id}/attachments', headers=headers,
+                       json={'filename': 'cat photo.png', 'content_type': content_type, 'size': size})
+
+
+def put(client, headers, attachment_id, n, data=None):
+    data = DATA[n * CHUNK:(n + 1) * CHUNK] if data is None else data
+    return client.put(f'/attachments/{attachment_id}/chunks/{n}', data=data, headers=headers)
+
+
+# Upload the whole of DATA and complete it; returns the attachment id
+@pytest.fixture
+def uploaded(client, headers, entry_id):
+    attachment_id = start(client, headers, entry_id).get_json()['id']
+    for n in range(6):
+        assert put(client, headers, attachment_id, n).status_code == 204
+    assert client.post(f'/attachments/{attachment_id}/complete', headers=headers).status_code == 200
+    return attachment_id
+
+
+def test_create_validates(client, headers, entry_id):
+    created = start(client, headers, entry_id)
+    assert created.status_code == 201
+    assert created.get_json()['chunks'] == 6 and created.get_json()['received'] == []
+
+    assert start(client, headers, entry_id, content_type='application/pdf').status_code == 400
+    assert start(client, headers, entry_id, size=0).status_code == 400
+    assert start(client, headers, entry_id, size=10 ** 12).status_code == 400
+    assert start(client, headers, 'not-an-id').status_code == 404
+    assert start(client, headers, '0' * 24).status_code == 404
+
+
+def test_interrupted_upload_resumes(client, headers, entry_id):
+    attachment_id = start(client, headers, entry_id).get_json()['id']
+    for n in (0, 3, 5):
+        put(client, headers, attachment_id, n)
+    status = client.get(f'/attachments/{attachment_id}/status', headers=headers).get_json()
+    assert status['received'] == [0, 3, 5]
+
+    incomplete = client.post(f'/attachments/{attachment_id}/complete', headers=headers)
+    assert incomplete.status_code == 409 and incomplete.get_json()['missing'] == [1, 2, 4]
+    assert client.get(f'/attachments/{attachment_id}', headers=headers).status_code == 404
+
+    for n in (1, 2, 4):
+        put(client, headers, attachment_id, n)
+    # Chunks can be sent again
+    put(client, headers, attachment_id, 2)
+    done = client.post(f'/attachments/{attachment_id}/complete', headers=headers)
+    assert done.status_code == 200 and done.get_json()['size'] == len(DATA)
+    [entry] = client.get('/entries', headers=headers).get_json()
+    assert entry['attachments'] == [{'id': attachment_id, 'filename': 'cat photo.png', 'content_type': 'image/png',
+                                     'size': len(DATA), 'thumbnail': False}]
+    assert put(client, headers, attachment_id, 0).status_code == 409
+
+
+def test_bad_chunks(client, headers, entry_id):
+    attachment_id = start(client, headers, entry_id).get_json()['id']
+    assert put(client, headers, attachment_id, 0, b'short').status_code == 400
+    assert put(client, headers, attachment_id, 6, b'x').status_code == 400
+    assert put(client, headers, attachment_id, 0, b'x' * (CHUNK + 1)).status_code == 413
+    assert put(client, headers, attachment_id, 5, DATA[500:]).status_code == 204
+    assert put(client, headers, '0' * 24, 0).status_code == 404
+
+
+def test_download(client, headers, uploaded):
+    response = client.get(f'/attachments/{uploaded}', headers=headers)
+    assert response.status_code == 200 and response.data == DATA
+    assert response.mimetype == 'image/png' and response.headers['Accept-Ranges'] == 'bytes'
+    assert "filename*=UTF-8''cat%20photo.png" in response.headers['Content-Disposition']
+    assert response.headers['ETag'] == f'"{uploaded}"'
+
+
+def test_ranges(client, headers, uploaded):
+    def get(**extra):
+        return client.get(f'/attachments/{uploaded}', headers=dict(headers, **extra))
+
+    partial = get(Range='bytes=95-305')
+    assert partial.status_code == 206 and partial.data == DATA[95:306]
+    assert partial.headers['Content-Range'] == f'bytes 95-305/{len(DATA)}'
+    assert get(Range='bytes=-4').data == b'tail'
+    assert get(Range='bytes=510-').data == DATA[510:]
+
+    unsatisfiable = get(Range='bytes=9999-')
+    assert unsatisfiable.status_code == 416 and unsatisfiable.headers['Content-Range'] == f'bytes */{len(DATA)}'
+    # Several ranges, or a stale If-Range, get the whole file
+    assert get(Range='bytes=0-1,5-6').status_code == 200
+    assert get(Range='bytes=0-1', **{'If-Range': '"stale"'}).data == DATA
+    assert get(Range='bytes=0-1', **{'If-Range': f'"{uploaded}"'}).data == DATA[:2]
+
+    not_modified = get(**{'If-None-Match': f'"{uploaded}"'})
+    assert not_modified.status_code == 304 and not_modified.data == b''
+
+
+def test_only_the_owner_sees_attachments(client, login, uploaded):
+    other = login('bob')
+    assert client.get(f'/attachments/{uploaded}', headers=other).status_code == 404
+    assert client.delete(f'/attachments/{uploaded}', headers=other).status_code == 404
+
+
+def test_delete(app, client, headers, uploaded):
+    assert client.delete(f'/attachments/{uploaded}', headers=headers).status_code == 200
+    assert client.get(f'/attachments/{uploaded}', headers=headers).status_code == 404
+    assert app.extensions['mongo'].db.attachment_chunks.count_documents({}) == 0
+    [entry] = client.get('/entries', headers=headers).get_json()
+    assert not entry.get('attachments')
+
+
+def test_deleting_the_entry_purges_attachments(app, client, headers, entry_id, uploaded):
+    unfinished = start(client, headers, entry_id).get_json()['id']
+    put(client, headers, unfinished, 0)
+    assert client.delete(f'/entries/{entry_id}', headers=headers).status_code == 200
+    db = app.extensions['mongo'].db
+    assert db.attachments.count_documents({}) == 0 and db.attachment_chunks.count_documents({}) == 0
+
+
+def test_purge_stale_uploads(app, client, headers, entry_id, uploaded):
+    stale = start(client, headers, entry_id).get_json()['id']
+    put(client, headers, stale, 0)
+    store = app.extensions['attachments']
+    assert store.purge_stale_uploads() == 0
+    app.extensions['mongo'].db.attachments.update_many({}, {'$set': {'created_at': datetime.utcnow() - timedelta(days=2)}})
+    assert store.purge_stale_uploads() == 1
+    assert client.get(f'/attachments/{stale}/status', headers=headers).status_code == 404
+    assert client.get(f'/attachments/{uploaded}', headers=headers).data == DATA
+
+
+# An upload completed between the purge's scan and its delete keeps its data
+def test_purge_spares_uploads_completed_meanwhile(app, client, headers, entry_id, monkeypatch):
+    racing = start(client, headers, entry_id).get_json()['id']
+    for n in range(6):
+        put(client, headers, racing, n)
+    app.extensions['mongo'].db.attachments.update_many({}, {'$set': {'created_at': datetime.utcnow() - timedelta(days=2)}})
+    store = app.extensions['attachments']
+    collection, pending = store.collection, [racing]
+
+    class Racing:
+        def __getattr__(self, name):
+            return getattr(collection, name)
+
+        def find(self, *args, **kwargs):
+            found = list(collection.find(*args, **kwargs))
+            while pending:
+                assert client.post(f'/attachments/{pending.pop()}/complete', headers=headers).status_code == 200
+            return found
+
+    monkeypatch.setattr(type(store), 'collection', property(lambda self: Racing()))
+    assert store.purge_stale_uploads() == 0
+    assert client.get(f'/attachments/{racing}', headers=headers).data == DATA
@@ -0,0 +1,89 @@
+import pytest
+from werkzeug.security import generate_password_hash
+
+
+def login(client, password='secret', username='alice', forwarded_for=None):
+    headers = {'X-Forwarded-For': forwarded_for} if forwarded_for else {}
+    return client.post('/login', json={'username': username, 'password': password}, headers=headers,
+                       environ_base={'REMOTE_ADDR': '10.0.0.1'})
+
+
+@pytest.fixture
+def limited(make_app):
+    def make(**settings):
+        app = make_app(LOGIN_IP_LIMIT=3, LOGIN_USER_LIMIT=3, **settings)
+        client = app.test_client()
+        for username in ('alice', 'bob', 'carol'):
+            client.post('/register', json={'username': username, 'password': 'secret'})
+        return client
+
+    return make
+
+
+def test_successful_logins_are_not_limited(limited):
+    client = limited()
+    assert [login(client).status_code for _ in range(6)] == [200] * 6
+
+
+def test_failed_logins_are_limited_per_address(limited):
+    client = limited()
+    assert [login(client, 'wrong', username).status_code for username in ('alice', 'bob', 'carol')] == [401] * 3
+    response = login(client, username='carol')
+    assert response.status_code == 429 and int(response.headers['Retry-After']) > 0
+
+
+def test_failed_logins_are_limited_per_username(limited):
+    client = limited(PROXY_FIX_X_FOR=1)
+    for n in range(3):
+        assert login(client, 'wrong', forwarded_for=f'198.51.100.{n}').status_code == 401
+    assert login(client, forwarded_for='198.51.100.9').status_code == 429
+    assert login(client, username='bob', forwarded_for='198.51.100.9').status_code == 200
+
+
+def test_clients_behind_a_trusted_proxy_are_limited_separately(limited):
+    client = limited(PROXY_FIX_X_FOR=1)
+    for username in ('alice', 'bob', 'carol'):
+        assert login(client, 'wrong', username, forwarded_for='198.51.100.1').status_code == 401
+    assert login(client, username='bob', forwarded_for='198.51.100.1').status_code == 429
+    assert login(client, username='bob', forwarded_for='198.51.100.2').status_code == 200
+    # Only the hop the proxy appended is trusted
+    assert login(client, username='bob', forwarded_for='198.51.100.2, 198.51.100.1').status_code == 429
+
+
+def test_forwarded_for_is_ignored_without_trusted_proxies(limited):
+    client = limited()
+    for n, username in enumerate(('alice', 'bob', 'carol')):
+        assert login(client, 'wrong', username, forwarded_for=f'198.51.100.{n}').status_code == 401
+    assert login(client, username='bob', forwarded_for='198.51.100.7').status_code == 429
+
+
+def test_old_hashes_are_upgraded_on_login(app, client, headers):
+    users = app.extensions['mongo'].db.users
+    users.update_one({'username': 'alice'}, {'$set': {'password': generate_password_hash('secret', 'pbkdf2:sha256:500')}})
+    app.extensions['auth'].forget('alice')
+    assert client.post('/login', json={'username': 'alice', 'password': 'secret'}).status_code == 200
+    assert users.find_one({'username': 'alice'})['password'].startswith('pbkdf2:sha256:1000$')
+
+
+def test_register_twice(client, headers):
+    assert client.post('/register', json={'username': 'alice', 'password': 'other'}).status_code == 400
+
+
+def test_user_lookups_are_cached(app, client, headers, monkeypatch):
+    auth, users = app.extensions['auth'], app.extensions['mongo'].db.users
+    lookups, find_one = [], type(users).find_one
+
+    def counted(self, *args, **kwargs):
+        lookups.append(args)
+        return find_one(self, *args, **kwargs)
+
+    monkeypatch.setattr(type(users), 'find_one', counted)
+    auth.forget('alice')
+    for _ in range(3):
+        assert auth.find_user('alice')['username'] == 'alice'
+        assert auth.find_user('nobody') is None
+    assert len(lookups) == 2
+
+    # Registering drops the cached miss
+    assert client.post('/register', json={'username': 'nobody', 'password': 'secret'}).status_code == 201
+    assert auth.find_user('nobody')['username'] == 'nobody'
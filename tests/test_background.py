@@ -0,0 +1,81 @@
+import asyncio
+import threading
+import pytest
+
+
+def running(name):
+    return any(thread.name.startswith(name) and thread.is_alive() for thread in threading.enumerate())
+
+
+@pytest.fixture
+def services(make_app):
+    apps = []
+
+    def make(**settings):
+        app = make_app(**settings)
+        apps.append(app)
+        return app
+
+    yield make
+    for app in apps:
+        scheduler = app.extensions['scheduler']
+        scheduler.stop()
+        if scheduler._thread is not None:
+            scheduler._thread.join(5)
+        app.extensions['jobs'].stop(5)
+        engine = app.extensions['reminders']
+        engine.stop()
+        if engine._thread is not None:
+            engine._thread.join(5)
+
+
+def test_scheduler_starts_with_the_first_request(services):
+    app = services(CAPSULE_SCHEDULER=True)
+    assert not running('capsule-scheduler')
+    app.test_client().get('/healthz')
+    assert running('capsule-scheduler')
+
+
+def test_job_workers_start_with_the_first_request(services):
+    app = services(JOB_BROKER='memory', JOB_WORKERS=2)
+    assert not running('job-worker')
+    client = app.test_client()
+    client.get('/healthz')
+    client.get('/healthz')
+    assert len([thread for thread in threading.enumerate() if thread.name.startswith('job-worker')]) == 2
+
+
+def test_reminder_engine_starts_with_the_first_request(services):
+    app = services(REMINDER_ENGINE=True, REMINDER_SINK='memory')
+    assert not running('reminder-engine')
+    app.test_client().get('/healthz')
+    assert running('reminder-engine')
+
+
+def test_commands_start_no_threads(services):
+    app = services(CAPSULE_SCHEDULER=True, JOB_BROKER='memory', JOB_WORKERS=2, REMINDER_ENGINE=True)
+    result = app.test_cli_runner().invoke(args=['backfill-time-capsules'])
+    assert result.exit_code == 0, result.output
+    assert not running('capsule-scheduler') and not running('job-worker') and not running('reminder-engine')
+
+
+def test_disabled_services_stay_off(services):
+    services(CAPSULE_SCHEDULER=False).test_client().get('/healthz')
+    assert not running('capsule-scheduler')
+
+
+def test_asgi_workers_start_services_at_startup(services):
+    from asgi import AsgiApp
+    app = services(CAPSULE_SCHEDULER=True)
+    messages = iter([{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+    sent = []
+
+    async def receive():
+        return next(messages)
+
+    async def send(message):
+        sent.append(message['type'])
+
+    asyncio.run(AsgiApp(app)({'type': 'lifespan'}, receive, send))
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert running('capsule-scheduler')
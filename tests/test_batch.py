@@ -0,0 +1,95 @@
+import pytest
+
+MISSING = '0' * 24
+
+
+def batch(client, headers, operations, ordered=True):
+    response = client.post('/batch', json={'ordered': ordered, 'operations': operations}, headers=headers)
+    assert response.status_code == 200
+    return [result['status'] for result in response.get_json()['results']], response.get_json()['results']
+
+
+def task(title):
+    return {'resource': 'tasks', 'op': 'create', 'data': {'title': title}}
+
+
+def test_mixed_operations_are_applied(client, headers):
+    statuses, results = batch(client, headers, [task('a'), task('b')])
+    assert statuses == [201, 201]
+    first, second = results[0]['id'], results[1]['id']
+
+    statuses, _ = batch(client, headers, [
+        {'resource': 'tasks', 'op': 'update', 'id': first, 'data': {'title': 'a2'}},
+        {'resource': 'tasks', 'op': 'delete', 'id': second},
+        {'resource': 'moods', 'op': 'create', 'data': {'mood': 'calm', 'rating': 3}},
+    ])
+    assert statuses == [200, 200, 201]
+    tasks = client.get('/tasks', headers=headers).get_json()
+    assert [(t['_id'], t['title'], t['version']) for t in tasks] == [(first, 'a2', 1)]
+    assert len(client.get('/moods', headers=headers).get_json()) == 1
+
+
+def test_ordered_batch_stops_at_the_first_failure(client, headers):
+    statuses, _ = batch(client, headers, [
+        task('a'),
+        {'resource': 'tasks', 'op': 'delete', 'id': MISSING},
+        task('b'),
+    ])
+    assert statuses == [201, 404, 424]
+    assert [t['title'] for t in client.get('/tasks', headers=headers).get_json()] == ['a']
+
+
+def test_unordered_batch_runs_everything_it_can(client, headers):
+    statuses, _ = batch(client, headers, [
+        task('a'),
+        {'resource': 'tasks', 'op': 'delete', 'id': MISSING},
+        {'resource': 'nope', 'op': 'create'},
+        {'resource': 'tasks', 'op': 'create', 'data': {'title': 5}},
+        task('b'),
+    ], ordered=False)
+    assert statuses == [201, 404, 400, 400, 201]
+    assert len(client.get('/tasks', headers=headers).get_json()) == 2
+
+
+def test_other_users_documents_are_not_found(client, headers, login):
+    _, results = batch(client, headers, [task('mine')])
+    statuses, _ = batch(client, login('bob'), [{'resource': 'tasks', 'op': 'delete', 'id': results[0]['id']}])
+    assert statuses == [404]
+    assert len(client.get('/tasks', headers=headers).get_json()) == 1
+
+
+def test_entry_content_is_encrypted(app, client, headers):
+    batch(client, headers, [{'resource': 'entries', 'op': 'create', 'data': {'title': 'T', 'content': 'via batch'}}])
+    assert b'via batch' not in app.extensions['mongo'].db.entries.find_one()['content']
+    assert client.get('/entries', headers=headers).get_json()[0]['content'] == 'via batch'
+
+
+def test_deletes_leave_tombstones(app, client, headers):
+    _, results = batch(client, headers, [task('a')])
+    batch(client, headers, [{'resource': 'tasks', 'op': 'delete', 'id': results[0]['id']}])
+    tombstone = app.extensions['mongo'].db.tombstones.find_one()
+    assert (tombstone['collection'], str(tombstone['doc_id'])) == ('tasks', results[0]['id'])
+
+
+def test_deleted_habits_lose_their_rollups(app, client, headers):
+    _, results = batch(client, headers, [
+        {'resource': 'habits', 'op': 'create', 'data': {'title': title}} for title in ('Run', 'Read')
+    ])
+    run, read = (result['id'] for result in results)
+    for habit_id in (run, read):
+        assert client.post(f'/habits/{habit_id}/checkin', json={}, headers=headers).status_code == 200
+
+    batch(client, headers, [{'resource': 'habits', 'op': 'delete', 'id': run}])
+    rollups = app.extensions['mongo'].db.habit_daily.find()
+    assert [str(rollup['habit_id']) for rollup in rollups] == [read]
+
+
+@pytest.mark.parametrize('body, status', [
+    ({'operations': []}, 400),
+    ({'operations': 'x'}, 400),
+    ({'operations': [task(str(i)) for i in range(3)]}, 413),
+])
+def test_malformed_batches_are_rejected(make_app, login, body, status):
+    app = make_app(MAX_BATCH_SIZE=2)
+    client = app.test_client()
+    assert client.post('/batch', json=body, headers=login(client=client)).status_code == status
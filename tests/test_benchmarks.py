@@ -0,0 +1,60 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import pytest
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks')
+SUITE = os.path.join(BENCHMARKS, 'suite.py')
+TINY = ['--users', '6', '--heavy-users', '1', '--heavy-docs', '60', '--page-size', '20',
+        '--iterations', '5', '--login-iterations', '2', '--warmup', '1']
+
+
+def run_suite(*args):
+    return subprocess.run([sys.executable, SUITE, *TINY, *args], capture_output=True, text=True, timeout=300)
+
+
+# The whole plan at a tiny scale: every scenario runs without a failed request
+@pytest.mark.parametrize('backend', ['sqlite', 'memory'])
+def test_suite_runs_every_scenario(tmp_path, backend):
+    if backend == 'memory':
+        pytest.importorskip('mongomock')
+    uri = f'sqlite://{tmp_path}/bench.sqlite3' if backend == 'sqlite' else 'memory'
+    result = run_suite('--mongo-uri', uri, '--output', str(tmp_path / 'report.json'))
+    assert result.returncode == 0, result.stderr
+    report = json.loads(result.stdout)
+    assert report == json.loads((tmp_path / 'report.json').read_text())
+    assert {'login', 'list_entries_deep', 'create_entries', 'delete_timecapsule'} <= set(report['scenarios'])
+    for name, scenario in report['scenarios'].items():
+        assert scenario['errors'] == 0, name
+        assert scenario['p50_ms'] <= scenario['p95_ms'] <= scenario['p99_ms']
+    assert report['peak_rss_mb'] > 0
+
+
+def test_regressions_against_a_baseline_fail_the_run(tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps({'scenarios': {'list_moods': {'p95_ms': 0.0001, 'throughput': 10 ** 9}}}))
+    result = run_suite('--mongo-uri', f'sqlite://{tmp_path}/bench.sqlite3', '--only', 'list_moods', '--baseline', str(baseline))
+    assert result.returncode == 1
+    assert 'REGRESSION list_moods: p95' in result.stderr
+    assert 'REGRESSION list_moods: throughput' in result.stderr
+
+
+# Both serving modes against the in-memory fake, briefly
+def test_load_test_runs_on_the_in_memory_fake():
+    pytest.importorskip('mongomock')
+    pytest.importorskip('uvicorn')
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    result = subprocess.run([
+        sys.executable, os.path.join(BENCHMARKS, 'load_test.py'), '--mongo-uri', 'memory', '--port', str(port),
+        '--users', '2', '--docs', '10', '--concurrency', '4', '--duration', '0.5', '--warmup', '0.2',
+    ], capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    report = json.loads(result.stdout)
+    assert report['backend'] == 'memory'
+    for mode in ('sync', 'async'):
+        assert report['results'][mode]['requests'] > 0
+        assert report['results'][mode]['errors'] == 0
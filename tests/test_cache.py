@@ -0,0 +1,45 @@
+from datetime import datetime
+import pytest
+from cache import MongoBackend, create_cache
+from config import Config
+from models import write_listeners
+
+
+def test_mongo_backend(app):
+    backend = MongoBackend(app.extensions['mongo'])
+    assert backend.get('page') is None
+    backend.set('page', b'body', ttl=60)
+    assert backend.get('page') == b'body'
+    backend.delete('page')
+    assert backend.get('page') is None
+    assert backend.add('gen', 5) and not backend.add('gen', 6)
+    assert backend.incr('gen') == 6 and backend.incr('new') == 1
+
+
+def test_mongo_backend_ignores_expired_entries(app):
+    backend = MongoBackend(app.extensions['mongo'])
+    backend.set('page', b'body', ttl=60)
+    backend.collection.update_one({'_id': 'page'}, {'$set': {'expires_at': datetime(2000, 1, 1)}})
+    assert backend.get('page') is None
+
+
+def test_shared_cache_is_the_default():
+    assert Config.CACHE_BACKEND == 'mongo'
+    assert isinstance(create_cache({'CACHE_BACKEND': 'mongo'}, object()).backend, MongoBackend)
+
+
+# Two apps on one database stand in for two workers: a write through one
+# must not leave the other serving its cached page. Each worker only hears
+# about its own writes, so the second app's write listener is dropped.
+@pytest.mark.parametrize('backend,fresh', [('mongo', True), ('memory', False)])
+def test_workers_share_invalidation(make_app, login, backend, fresh):
+    first = make_app(CACHE_BACKEND=backend)
+    listeners = list(write_listeners)
+    second = make_app(SQLITE_PATH=first.config['SQLITE_PATH'], CACHE_BACKEND=backend)
+    write_listeners[:] = listeners
+    headers = login(client=first.test_client())
+    reader = second.test_client()
+    assert reader.get('/tasks', headers=headers).get_json() == []
+    first.test_client().post('/tasks', json={'title': 'Write'}, headers=headers)
+    titles = [task['title'] for task in reader.get('/tasks', headers=headers).get_json()]
+    assert titles == (['Write'] if fresh else [])
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+from capsules import CapsuleScheduler, backfill
+
+
+def create(client, headers, open_date, content='Open me'):
+    response = client.post('/timecapsule', json={'content': content, 'open_date': open_date}, headers=headers)
+    assert response.status_code == 201
+    return response
+
+
+def contents(client, headers):
+    return [capsule['content'] for capsule in client.get('/timecapsule', headers=headers).get_json()]
+
+
+def test_open_date_is_normalised(app, client, headers):
+    create(client, headers, '2030-01-01T10:00:00+02:00')
+    capsule = app.extensions['mongo'].db.timecapsule.find_one()
+    assert capsule['open_date'] == datetime(2030, 1, 1, 8) and capsule['opened'] is False
+    assert client.post('/timecapsule', json={'content': 'x', 'open_date': 'next spring'}, headers=headers).status_code == 400
+
+
+def test_only_opened_capsules_are_listed(client, headers):
+    create(client, headers, '2020-01-01T00:00:00Z', 'past')
+    create(client, headers, '2999-01-01T00:00:00Z', 'future')
+    assert contents(client, headers) == ['past']
+
+
+def test_scheduler_opens_due_capsules_once(app, client, headers, user_id):
+    open_date = datetime.utcnow().replace(microsecond=0) + timedelta(minutes=1)
+    create(client, headers, open_date.isoformat(), 'soon')
+    scheduler = app.extensions['scheduler']
+    assert scheduler.run_due(open_date - timedelta(seconds=1)) == []
+    assert [c['open_date'] for c in scheduler.run_due(open_date)] == [open_date]
+    assert contents(client, headers) == ['soon']
+
+    # A second scheduler (another process) finds nothing left to open
+    other = CapsuleScheduler(app.extensions['mongo'])
+    other.reload(open_date)
+    assert other.run_due(open_date + timedelta(seconds=1)) == []
+    notifications = list(app.extensions['mongo'].db.notifications.find({'kind': 'capsule_opened'}))
+    assert [n['user_id'] for n in notifications] == [user_id()]
+
+
+def test_postponed_capsules_stay_closed(app, client, headers):
+    open_date = datetime.utcnow() + timedelta(minutes=1)
+    create(client, headers, open_date.isoformat())
+    capsule_id = app.extensions['mongo'].db.timecapsule.find_one()['_id']
+    later = (open_date + timedelta(days=1)).isoformat()
+    assert client.put(f'/timecapsule/{capsule_id}', json={'open_date': later}, headers=headers).status_code == 200
+    assert app.extensions['scheduler'].run_due(open_date + timedelta(seconds=1)) == []
+    assert contents(client, headers) == []
+
+
+def test_reload_picks_up_capsules_written_elsewhere(app, headers, user_id):
+    now = datetime.utcnow()
+    app.extensions['mongo'].db.timecapsule.insert_one({
+        'user_id': user_id(), 'content': 'batch', 'open_date': now + timedelta(minutes=5), 'opened': False,
+        'timestamp': now, 'updated_at': now, 'version': 0,
+    })
+    scheduler = CapsuleScheduler(app.extensions['mongo'], horizon=timedelta(minutes=10))
+    scheduler.reload(now)
+    assert len(scheduler.run_due(now + timedelta(minutes=6))) == 1
+
+
+def test_backfill_parses_legacy_dates(app, headers, user_id):
+    collection = app.extensions['mongo'].db.timecapsule
+    collection.insert_many([
+        {'user_id': user_id(), 'content': 'old', 'open_date': '2020-05-01T00:00:00Z'},
+        {'user_id': user_id(), 'content': 'later', 'open_date': '2999-05-01'},
+        {'user_id': user_id(), 'content': 'bad', 'open_date': 'someday'},
+    ], bypass_document_validation=True)
+    assert backfill(app.extensions['mongo']) == (2, 1)
+    assert {c['content']: c['opened'] for c in collection.find()} == {'old': True, 'later': False, 'bad': False}
+    assert collection.find_one({'content': 'old'})['open_date'] == datetime(2020, 5, 1)
@@ -0,0 +1,59 @@
+import os
+from types import SimpleNamespace
+import pytest
+from pymongo.monitoring import ConnectionCheckOutFailedReason
+from database import Mongo, PoolStats, create_store, mongo_options
+
+UNREACHABLE = {'MONGO_URI': 'mongodb://127.0.0.1:1/diary_test', 'MONGO_SERVER_SELECTION_TIMEOUT_MS': 200}
+
+
+def test_mongo_options_leave_unset_settings_to_the_uri():
+    assert mongo_options({'MONGO_MAX_POOL_SIZE': 10, 'MONGO_READ_PREFERENCE': ''}) == {'maxPoolSize': 10}
+    assert mongo_options({'MONGO_W': '2', 'MONGO_J': '1'}) == {'w': 2, 'journal': True}
+    assert mongo_options({'MONGO_W': 'majority', 'MONGO_J': '0'}) == {'w': 'majority', 'journal': False}
+
+
+def test_pool_stats_track_checkouts():
+    stats = PoolStats(4)
+    event = SimpleNamespace(reason=ConnectionCheckOutFailedReason.TIMEOUT)
+    for method in ('connection_created', 'connection_created', 'connection_checked_out', 'connection_check_out_failed'):
+        getattr(stats, method)(event)
+    assert stats.snapshot() == {'max_size': 4, 'open': 2, 'checked_out': 1, 'utilization': 0.25, 'wait_timeouts': 1}
+
+
+# Building the store connects nothing; a forked worker gets its own client
+def test_client_is_created_lazily_and_per_process(monkeypatch):
+    mongo = Mongo(UNREACHABLE)
+    assert mongo._client is None and mongo.pool_stats()['open'] == 0
+    try:
+        client = mongo.cx
+        assert mongo.cx is client
+        monkeypatch.setattr(os, 'getpid', lambda: -1)
+        assert mongo.cx is not client
+    finally:
+        client.close()
+        mongo.close()
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        create_store({'STORAGE_BACKEND': 'postgres'})
+
+
+def test_health_and_readiness(client):
+    health = client.get('/healthz').get_json()
+    assert health['status'] == 'ok' and health['pool']['backend'] == 'sqlite'
+    response = client.get('/readyz')
+    assert response.status_code == 200 and response.get_json()['ping_ms'] >= 0
+
+
+def test_not_ready_without_a_database(make_app):
+    mongo = Mongo(UNREACHABLE)
+    app = make_app(mongo, ENSURE_INDEXES=False, READYZ_TIMEOUT_MS=300)
+    try:
+        response = app.test_client().get('/readyz')
+        assert response.status_code == 503
+        assert response.get_json()['status'] == 'unavailable'
+        assert app.test_client().get('/healthz').status_code == 200
+    finally:
+        mongo.close()
@@ -0,0 +1,51 @@
+from cryptography.fernet import Fernet, MultiFernet
+import pytest
+from config import Config
+from utils import decrypt_many, encrypt_content
+
+
+@pytest.fixture
+def key():
+    return Fernet.generate_key()
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_parallel_decryption_keeps_input_order(key, executor):
+    tokens = [encrypt_content(f'entry {i}', key) for i in range(50)]
+    output = decrypt_many(tokens, key, workers=3, executor=executor, chunk_size=7, min_parallel=10)
+    assert output == [f'entry {i}' for i in range(50)]
+
+
+def test_small_batches_match_parallel_ones(key):
+    tokens = [encrypt_content(f'entry {i}', key) for i in range(20)]
+    inline = decrypt_many(tokens, key, workers=4, min_parallel=1000)
+    parallel = decrypt_many(tokens, key, workers=4, chunk_size=3, min_parallel=1)
+    assert inline == parallel
+
+
+def test_bad_tokens_come_back_as_none(key):
+    tokens = [encrypt_content('good', key), encrypt_content('other', Fernet.generate_key()), None]
+    assert decrypt_many(tokens, key, workers=2, chunk_size=1, min_parallel=1) == ['good', None, None]
+
+
+def test_multifernet_decrypts_tokens_of_any_of_its_keys(key):
+    old = Fernet.generate_key()
+    tokens = [encrypt_content('new', key), encrypt_content('old', old)]
+    assert decrypt_many(tokens, MultiFernet([Fernet(key), Fernet(old)])) == ['new', 'old']
+
+
+def test_large_listing_is_decrypted_in_parallel(make_app, login):
+    app = make_app(DECRYPT_WORKERS=2, DECRYPT_CHUNK_SIZE=4, DECRYPT_MIN_PARALLEL=5)
+    client = app.test_client()
+    headers = login(client=client)
+    client.post('/batch', json={'operations': [
+        {'resource': 'entries', 'op': 'create', 'data': {'title': f'E{i}', 'content': f'secret {i}'}} for i in range(12)
+    ]}, headers=headers)
+    entries = client.get('/entries', headers=headers).get_json()
+    assert sorted(entry['content'] for entry in entries) == sorted(f'secret {i}' for i in range(12))
+
+
+# Full pages and export batches have to reach the pool for it to matter
+def test_default_threshold_fits_pages_and_stream_batches():
+    assert Config.DECRYPT_MIN_PARALLEL <= min(Config.MAX_PAGE_SIZE, Config.STREAM_BATCH_SIZE)
+    assert Config.DECRYPT_MIN_PARALLEL >= 2 * Config.DECRYPT_CHUNK_SIZE
@@ -0,0 +1,83 @@
+import pytest
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import WriteError
+from indexes import MODELS, ensure_indexes, ensure_validators, find_collscans
+from models import Entry
+
+
+def model(*indexes):
+    return type('Model', (), {'COLLECTION': 'things', 'INDEXES': list(indexes)})
+
+
+@pytest.fixture
+def db(app):
+    return app.extensions['mongo'].db
+
+
+def test_startup_creates_every_declared_index(db):
+    report = ensure_indexes(db)
+    assert set(report) == {m.COLLECTION for m in MODELS}
+    for collection in report.values():
+        assert collection['created'] == collection['modified'] == collection['rebuilt'] == []
+    for m in MODELS:
+        existing = db[m.COLLECTION].index_information()
+        assert {index.document['name'] for index in m.INDEXES} <= set(existing)
+
+
+def test_missing_index_is_created(db):
+    index = IndexModel([('user_id', ASCENDING), ('day', DESCENDING)], name='user_day')
+    assert ensure_indexes(db, [model(index)])['things']['created'] == ['user_day']
+    assert db.things.index_information()['user_day']['key'] == [('user_id', 1), ('day', -1)]
+    assert ensure_indexes(db, [model(index)])['things']['created'] == []
+
+
+def test_changed_ttl_is_applied_in_place(db):
+    ensure_indexes(db, [model(IndexModel([('at', ASCENDING)], name='expire', expireAfterSeconds=60))])
+    report = ensure_indexes(db, [model(IndexModel([('at', ASCENDING)], name='expire', expireAfterSeconds=3600))])
+    assert report['things']['modified'] == ['expire']
+    assert report['things']['rebuilt'] == []
+    assert db.things.index_information()['expire']['expireAfterSeconds'] == 3600
+
+
+@pytest.mark.parametrize('before, after', [
+    ({}, {'unique': True}),
+    ({'unique': True}, {}),
+    ({}, {'expireAfterSeconds': 60}),
+    ({}, {'sparse': True}),
+    ({}, {'partialFilterExpression': {'status': 'queued'}}),
+    ({'partialFilterExpression': {'status': 'queued'}}, {'partialFilterExpression': {'status': 'running'}}),
+    ({}, {'collation': {'locale': 'en', 'strength': 2}}),
+])
+def test_changed_options_rebuild_the_index(db, before, after):
+    ensure_indexes(db, [model(IndexModel([('status', ASCENDING)], name='status', **before))])
+    report = ensure_indexes(db, [model(IndexModel([('status', ASCENDING)], name='status', **after))])
+    assert report['things']['rebuilt'] == ['status']
+    info = db.things.index_information()['status']
+    for option, value in after.items():
+        assert info[option] == value
+    assert ensure_indexes(db, [model(IndexModel([('status', ASCENDING)], name='status', **after))])['things']['rebuilt'] == []
+
+
+def test_changed_key_rebuilds_the_index(db):
+    ensure_indexes(db, [model(IndexModel([('a', ASCENDING)], name='lookup'))])
+    report = ensure_indexes(db, [model(IndexModel([('a', ASCENDING), ('b', ASCENDING)], name='lookup'))])
+    assert report['things']['rebuilt'] == ['lookup']
+    assert db.things.index_information()['lookup']['key'] == [('a', 1), ('b', 1)]
+
+
+def test_undeclared_indexes_are_reported_not_dropped(db):
+    db.things.create_index([('legacy', ASCENDING)], name='legacy')
+    report = ensure_indexes(db, [model(IndexModel([('a', ASCENDING)], name='lookup'))])
+    assert report['things']['undeclared'] == ['legacy']
+    assert 'legacy' in db.things.index_information()
+
+
+def test_validators_reject_documents_that_break_the_schema(db):
+    ensure_validators(db, [Entry], level='strict')
+    with pytest.raises(WriteError):
+        db.entries.insert_one({'user_id': 'u', 'title': 3, 'content': b'x'})
+
+
+def test_list_queries_use_indexes(db):
+    ensure_indexes(db)
+    assert find_collscans(db) == []
@@ -0,0 +1,97 @@
+import time
+from datetime import timedelta
+import pytest
+from jobs import JobQueue, MemoryBroker, MongoBroker
+
+
+@pytest.fixture(params=['memory', 'mongo'])
+def queue(request, app):
+    broker = MemoryBroker() if request.param == 'memory' else MongoBroker(app.extensions['mongo'])
+    queue = JobQueue(broker, max_attempts=3, backoff=0, poll_interval=0.01)
+    queue.calls = []
+
+    @queue.handler('record')
+    def record(value, fail=0):
+        queue.calls.append(value)
+        if queue.calls.count(value) <= fail:
+            raise RuntimeError('not yet')
+
+    yield queue
+    queue.stop(5)
+
+
+def drain(queue):
+    while queue.run_once():
+        pass
+
+
+def test_keys_coalesce_waiting_jobs(queue):
+    assert queue.enqueue('record', {'value': 1}, key='k') is not None
+    assert queue.enqueue('record', {'value': 2}, key='k') is None
+    drain(queue)
+    assert queue.calls == [1]
+    # Once claimed, the key can be queued again
+    assert queue.enqueue('record', {'value': 3}, key='k') is not None
+
+
+def test_failed_jobs_are_retried_then_given_up(queue):
+    queue.enqueue('record', {'value': 'flaky', 'fail': 1})
+    queue.enqueue('record', {'value': 'broken', 'fail': 10})
+    queue.enqueue('missing')
+    drain(queue)
+    assert queue.calls.count('flaky') == 2 and queue.calls.count('broken') == 3
+    counts = queue.broker.counts()
+    assert counts.get('done') == 1 and counts.get('failed') == 2
+
+
+def test_retries_back_off(queue):
+    queue.backoff = 60
+    queue.enqueue('record', {'value': 1, 'fail': 1})
+    assert queue.run_once() and not queue.run_once()
+    assert queue.calls == [1]
+
+
+def test_backoff_is_capped_with_jitter():
+    queue = JobQueue(MemoryBroker(), backoff=2, max_backoff=10)
+    assert 1 <= queue._backoff(1) <= 2
+    assert 5 <= queue._backoff(10) <= 10
+
+
+def test_workers_run_jobs_in_the_background(queue):
+    queue.start(2)
+    for value in range(5):
+        queue.enqueue('record', {'value': value})
+    deadline = time.monotonic() + 5
+    while len(queue.calls) < 5 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(queue.calls) == list(range(5))
+
+
+# A claimed job whose worker died is claimed again once its lease expires
+def test_expired_leases_are_reclaimed(app):
+    broker = MongoBroker(app.extensions['mongo'])
+    queue = JobQueue(broker, lease=0)
+    queue.enqueue('record', {'value': 1})
+    assert broker.claim(timedelta(0))['attempts'] == 1
+    assert broker.claim(timedelta(seconds=60))['attempts'] == 2
+    assert broker.claim(timedelta(seconds=60)) is None
+
+
+def test_eager_queue_runs_inline():
+    queue = JobQueue(MemoryBroker(), eager=True)
+    calls = []
+    queue.handler('record')(lambda value: calls.append(value))
+    queue.enqueue('record', {'value': 1})
+    queue.enqueue_many([('record', {'value': 2}, None)])
+    assert calls == [1, 2] and queue.broker.counts() == {'queued': 0}
+
+
+# Requests return after the primary write; secondary work waits for a worker
+def test_routes_hand_work_to_the_queue(make_app, login):
+    app = make_app(JOB_BROKER='memory', JOB_WORKERS=0)
+    client = app.test_client()
+    headers = login(client=client)
+    client.post('/entries', json={'title': 'Lake', 'content': 'swim'}, headers=headers)
+    assert client.get('/search?q=lake', headers=headers).get_json() == []
+    drain(app.extensions['jobs'])
+    assert len(client.get('/search?q=lake', headers=headers).get_json()) == 1
@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta
+from cryptography.fernet import Fernet
+import pytest
+from utils import encrypt_content
+
+
+@pytest.fixture
+def workers(make_app, tmp_path):
+    path = str(tmp_path / 'shared.sqlite3')
+    return make_app(SQLITE_PATH=path), make_app(SQLITE_PATH=path)
+
+
+def contents(client, headers):
+    return [entry['content'] for entry in client.get('/entries', headers=headers).get_json()]
+
+
+def backdate_keys(app, user_id, age):
+    keys = app.extensions['mongo'].db.data_keys
+    doc = keys.find_one({'user_id': user_id})
+    stamped = [dict(key, created_at=key['created_at'] - age) for key in doc['keys']]
+    keys.update_one({'user_id': user_id}, {'$set': {'keys': stamped}})
+
+
+def test_entries_are_encrypted_under_the_users_data_key(app, client, headers, user_id):
+    client.post('/entries', json={'title': 'T', 'content': 'dear diary'}, headers=headers)
+    stored = app.extensions['mongo'].db.entries.find_one()
+    assert b'dear diary' not in stored['content']
+    assert stored['key_id'] == 1
+    assert 'key' not in stored
+    assert contents(client, headers) == ['dear diary']
+
+
+def test_legacy_per_entry_keys_are_migrated(app, client, headers, user_id):
+    key = Fernet.generate_key()
+    app.extensions['mongo'].db.entries.insert_one({
+        'user_id': user_id(), 'title': 'old', 'content': encrypt_content('legacy', key), 'key': key,
+        'tags': [], 'timestamp': datetime.utcnow(),
+    }, bypass_document_validation=True)
+    assert contents(client, headers) == ['legacy']
+    assert app.extensions['keystore'].reencrypt_entries(user_id()) == {'migrated': 1, 'skipped': 0}
+    stored = app.extensions['mongo'].db.entries.find_one()
+    assert 'key' not in stored and stored['key_id'] == 1
+    assert contents(client, headers) == ['legacy']
+
+
+def test_worker_with_a_cached_key_reads_entries_rotated_elsewhere(workers, login):
+    web, cli = workers
+    client = web.test_client()
+    headers = login(client=client)
+    client.post('/entries', json={'title': 'T', 'content': 'before'}, headers=headers)
+    assert contents(client, headers) == ['before']
+
+    owner = web.extensions['mongo'].db.users.find_one()['_id']
+    assert cli.extensions['keystore'].rotate_user_key(str(owner)) == 2
+    cli.extensions['keystore'].reencrypt_entries(str(owner))
+    # The web worker still has key 1 cached as the only key
+    assert contents(client, headers) == ['before']
+
+
+def test_rotation_takes_the_next_id_from_the_database(workers, login):
+    web, cli = workers
+    headers = login(client=web.test_client())
+    owner = str(web.extensions['mongo'].db.users.find_one()['_id'])
+    web.extensions['keystore'].cipher(owner)
+    assert cli.extensions['keystore'].rotate_user_key(owner) == 2
+    # This process still has key 1 cached as active
+    assert web.extensions['keystore'].rotate_user_key(owner) == 3
+    keys = web.extensions['mongo'].db.data_keys.find_one({'user_id': owner})['keys']
+    assert [key['id'] for key in keys] == [3, 2, 1]
+
+
+def test_old_keys_are_kept_until_the_cache_ttl_has_passed(app, client, headers, user_id):
+    keystore = app.extensions['keystore']
+    client.post('/entries', json={'title': 'T', 'content': 'kept'}, headers=headers)
+    keystore.rotate_user_key(user_id())
+    keystore.reencrypt_entries(user_id())
+    assert not keystore.purge_old_keys(user_id())
+
+    backdate_keys(app, user_id(), timedelta(seconds=app.config['KEY_CACHE_TTL'] + 1))
+    assert keystore.purge_old_keys(user_id())
+    keys = app.extensions['mongo'].db.data_keys.find_one({'user_id': user_id()})['keys']
+    assert [key['id'] for key in keys] == [2]
+    assert contents(client, headers) == ['kept']
+
+
+def test_old_keys_are_kept_while_anything_uses_them(workers, login):
+    web, cli = workers
+    client = web.test_client()
+    headers = login(client=client)
+    client.post('/entries', json={'title': 'T', 'content': 'first'}, headers=headers)
+    owner = str(web.extensions['mongo'].db.users.find_one()['_id'])
+    keystore = cli.extensions['keystore']
+    keystore.rotate_user_key(owner)
+    keystore.reencrypt_entries(owner)
+    # Written by a worker whose cache still has key 1 as active
+    client.post('/entries', json={'title': 'T', 'content': 'late'}, headers=headers)
+    backdate_keys(cli, owner, timedelta(days=1))
+
+    assert not keystore.purge_old_keys(owner)
+    keystore.reencrypt_entries(owner)
+    assert keystore.purge_old_keys(owner)
+    web.extensions['keystore'].forget(owner)
+    assert sorted(contents(client, headers)) == ['first', 'late']
+
+
+def test_rotate_and_purge_commands(app, client, headers, user_id):
+    client.post('/entries', json={'title': 'T', 'content': 'cli'}, headers=headers)
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=['rotate-user-key', user_id()])
+    assert 'Active key' in result.output
+    assert runner.invoke(args=['purge-old-keys', user_id()]).exit_code == 1
+
+    backdate_keys(app, user_id(), timedelta(days=1))
+    result = runner.invoke(args=['purge-old-keys', user_id()])
+    assert result.exit_code == 0, result.output
+    assert app.extensions['mongo'].db.entries.find_one()['key_id'] == 2
+    assert contents(client, headers) == ['cli']
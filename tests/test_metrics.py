@@ -0,0 +1,87 @@
+import itertools
+import logging
+from types import SimpleNamespace
+import pytest
+import metrics
+from metrics import Counter, Histogram, RequestStats, query_shape, timed
+
+
+def command_events(listener, name, command, reply, request_id=1):
+    listener.started(SimpleNamespace(command_name=name, command=command, connection_id=('db', 1), request_id=request_id))
+    listener.succeeded(SimpleNamespace(command_name=name, connection_id=('db', 1), request_id=request_id,
+                                       duration_micros=2000, reply=reply))
+
+
+@pytest.fixture
+def metrics_app(make_app):
+    app = make_app(METRICS_ENABLED=True, SLOW_REQUEST_MS=500)
+
+    # Stands in for a route whose store reports command events
+    @app.route('/probe')
+    def probe():
+        command_events(app.extensions['mongo_listeners'][0], 'find',
+                       {'find': 'tasks', 'filter': {'user_id': 'u1', 'due_at': {'$gte': 5}}, 'sort': {'due_at': 1}},
+                       {'cursor': {'firstBatch': [{}, {}, {}]}})
+        return 'ok'
+
+    return app
+
+
+def test_render_prometheus_text():
+    requests = Counter('requests_total', 'Requests', ('route',))
+    requests.inc('/a"b')
+    latency = Histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    latency.observe(0.05)
+    latency.observe(5)
+    assert requests.samples() == ['requests_total{route="/a\\"b"} 1']
+    assert latency.samples() == [
+        'latency_seconds_bucket{le="0.1"} 1', 'latency_seconds_bucket{le="1.0"} 1',
+        'latency_seconds_bucket{le="+Inf"} 2', 'latency_seconds_sum 5.05', 'latency_seconds_count 2',
+    ]
+
+
+def test_query_shapes_blank_the_values():
+    assert query_shape('find', {'find': 'tasks', 'filter': {'user_id': 'u1', 'n': {'$in': [1, 2]}}, 'sort': {'_id': -1}}) \
+        == 'find tasks {"user_id":"?","n":{"$in":["?"]}} sort {"_id":-1}'
+    assert query_shape('aggregate', {'aggregate': 'moods', 'pipeline': [{'$match': {'user_id': 'u1'}}, {'$group': {}}]}) \
+        == 'aggregate moods {"user_id":"?"}'
+    assert query_shape('update', {'update': 'jobs', 'updates': [{'q': {'_id': 1}, 'u': {}}]}) == 'update jobs {"_id":"?"}'
+
+
+def test_commands_and_crypto_are_attributed_to_the_request():
+    stats = RequestStats()
+    token = metrics._current.set(stats)
+    try:
+        command_events(metrics.CommandMetrics(), 'find', {'find': 'entries', 'filter': {}}, {'cursor': {'firstBatch': [{}]}})
+        timed('test')(lambda: None)()
+    finally:
+        metrics._current.reset(token)
+    assert (stats.queries, stats.documents) == (1, 1)
+    assert stats.query_seconds == pytest.approx(0.002)
+    assert stats.crypto_seconds > 0
+    assert stats.shapes == {'find entries {}': 1}
+
+
+def test_metrics_endpoint(metrics_app, login):
+    client = metrics_app.test_client()
+    headers = login(client=client)
+    client.post('/entries', json={'title': 'Day', 'content': 'secret'}, headers=headers)
+    client.get('/tasks', headers=headers)
+    client.get('/probe')
+    response = client.get('/metrics')
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert 'http_request_duration_seconds_count{method="GET",route="/tasks"}' in text
+    assert 'crypto_duration_seconds_count{op="encrypt"}' in text
+    assert 'http_request_mongo_commands_bucket{route="/probe",le="3"}' in text
+    assert 'mongo_documents_returned_total{collection="tasks"}' in text
+
+
+def test_slow_requests_are_logged_with_their_query_shapes(metrics_app, monkeypatch, caplog):
+    # Every clock read is a second later
+    clock = itertools.count()
+    monkeypatch.setattr(metrics, 'time', SimpleNamespace(perf_counter=lambda: next(clock)))
+    with caplog.at_level(logging.WARNING, logger='metrics'):
+        metrics_app.test_client().get('/probe')
+    assert 'Slow request GET /probe -> 200' in caplog.text
+    assert '1x find tasks {"user_id":"?","due_at":{"$gte":"?"}} sort {"due_at":1}' in caplog.text
@@ -0,0 +1,62 @@
+from datetime import datetime
+import pytest
+from bson import ObjectId
+from pymongo.errors import WriteError
+from models import Entry, Gratitude, Habit, Mood, Task, ValidationError
+
+
+def test_validate_applies_defaults_and_types():
+    assert Habit.validate({'title': 'Run'}) == {'title': 'Run', 'frequency': 'daily', 'progress': 0, 'goal': 0}
+    task = Task.validate({'title': 'Write'})
+    assert task == {'title': 'Write', 'description': None, 'due_date': None, 'is_completed': False}
+    assert Mood.validate({'mood': 'calm', 'rating': 4.5})['rating'] == 4.5
+    with pytest.raises(ValidationError, match='title is required'):
+        Task.validate({})
+    with pytest.raises(ValidationError, match='Invalid is_completed'):
+        Task.validate({'title': 'x', 'is_completed': 'yes'})
+    with pytest.raises(ValidationError, match='Invalid rating'):
+        Mood.validate({'mood': 'calm', 'rating': True})
+    with pytest.raises(ValidationError, match='Invalid tags'):
+        Gratitude.validate({'content': 'x', 'tags': ['ok', 3]})
+
+
+def test_partial_validation_and_model_set_fields():
+    assert Task.normalize_fields({'due_date': '2030-01-02'}) == {'due_date': '2030-01-02', 'due_at': datetime(2030, 1, 2)}
+    assert Task.normalize_fields({'due_date': 'soon'})['due_at'] is None
+    # Fields the model sets are never taken from the client
+    assert 'due_at' not in Task.validate({'title': 'x', 'due_at': '2030-01-01'})
+
+
+def test_models_use_slots_and_round_trip_through_bson():
+    task = Task.from_data('u1', {'title': 'Write', 'due_date': '2030-01-02'})
+    assert not hasattr(task, '__dict__')
+    doc = task.to_bson()
+    assert doc['due_at'] == datetime(2030, 1, 2) and doc['version'] == 0
+    assert Task.from_bson(doc).to_bson() == doc
+
+
+def test_to_json_encodes_declared_fields():
+    doc = dict(Task.from_data('u1', {'title': 'Write'}).to_bson(), _id=ObjectId('0123456789abcdef01234567'))
+    doc['created_at'] = datetime(2030, 1, 2, 3, 4, 5)
+    encoded = Task.to_json(doc)
+    assert encoded['_id'] == '0123456789abcdef01234567'
+    assert encoded['created_at'].startswith('2030-01-02T03:04:05')
+    assert doc['created_at'] == datetime(2030, 1, 2, 3, 4, 5)
+
+
+def test_json_schema_marks_required_fields():
+    schema = Entry.json_schema()['$jsonSchema']
+    assert {'user_id', 'content'} <= set(schema['required'])
+    assert schema['properties']['content']['bsonType'] == ['binData']
+    assert schema['properties']['title']['bsonType'] == ['string', 'null']
+
+
+def test_bad_input_is_a_400(client, headers):
+    response = client.post('/tasks', json={'title': 7}, headers=headers)
+    assert response.status_code == 400 and response.get_json() == {'message': 'Invalid title'}
+    assert client.post('/moods', json={}, headers=headers).status_code == 400
+
+
+def test_the_database_rejects_invalid_documents(app):
+    with pytest.raises(WriteError):
+        app.extensions['mongo'].db.tasks.insert_one({'user_id': 'u1', 'title': 5})
@@ -0,0 +1,72 @@
+import gzip
+import json
+import msgpack
+import zstandard
+
+MSGPACK = 'application/msgpack'
+
+
+def test_msgpack_request_and_response(client, headers):
+    body = msgpack.packb({'title': 'Packed', 'content': 'binary wire'})
+    response = client.post('/entries', data=body, content_type=MSGPACK, headers=dict(headers, Accept=MSGPACK))
+    assert response.status_code == 201
+    assert response.mimetype == MSGPACK
+    assert 'Accept' in response.vary
+
+    listed = client.get('/entries', headers=dict(headers, Accept=MSGPACK))
+    entries = msgpack.unpackb(listed.data, raw=False)
+    assert [entry['content'] for entry in entries] == ['binary wire']
+    assert isinstance(entries[0]['id'], str)
+
+
+def test_json_stays_the_default(client, headers):
+    for accept in (None, '*/*', f'application/json, {MSGPACK};q=0.5'):
+        response = client.get('/entries', headers=dict(headers, **({'Accept': accept} if accept else {})))
+        assert response.mimetype == 'application/json'
+
+
+def test_compressed_request_bodies(client, headers):
+    payload = json.dumps({'title': 'Zipped', 'content': 'x' * 5000}).encode()
+    for encoding, data in (('gzip', gzip.compress(payload)), ('zstd', zstandard.ZstdCompressor().compress(payload))):
+        response = client.post('/entries', data=data, content_type='application/json',
+                               headers=dict(headers, **{'Content-Encoding': encoding}))
+        assert response.status_code == 201
+    assert [entry['title'] for entry in client.get('/entries', headers=headers).get_json()] == ['Zipped', 'Zipped']
+
+
+def test_bad_request_bodies(app, client, headers):
+    def post(data, **extra):
+        return client.post('/entries', data=data, content_type='application/json', headers=dict(headers, **extra))
+
+    assert post(b'{}', **{'Content-Encoding': 'br'}).status_code == 415
+    assert post(gzip.compress(b'{"title": "x"}')[:-6], **{'Content-Encoding': 'gzip'}).status_code == 400
+    assert post(b'not gzip', **{'Content-Encoding': 'gzip'}).status_code == 400
+
+    app.config['MAX_DECODED_BODY_BYTES'] = 1000
+    bomb = gzip.compress(json.dumps({'title': 'x', 'content': 'y' * 100000}).encode())
+    assert len(bomb) < 1000
+    assert post(bomb, **{'Content-Encoding': 'gzip'}).status_code == 413
+
+
+def test_response_compression(make_app, login):
+    app = make_app(COMPRESS_MIN_BYTES=512)
+    client = app.test_client()
+    headers = login(client=client)
+    for i in range(20):
+        client.post('/entries', json={'title': f'Entry {i}', 'content': 'compress me ' * 10}, headers=headers)
+
+    plain = client.get('/entries', headers=headers)
+    assert 'Content-Encoding' not in plain.headers and 'Accept-Encoding' in plain.vary
+    etag = plain.headers['ETag']
+
+    zipped = client.get('/entries', headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert zipped.headers['ETag'] == 'W/' + etag
+    assert gzip.decompress(zipped.data) == plain.data
+
+    zstd = client.get('/entries', headers=dict(headers, **{'Accept-Encoding': 'gzip, zstd'}))
+    assert zstd.headers['Content-Encoding'] == 'zstd'
+    assert zstandard.ZstdDecompressor().decompress(zstd.data) == plain.data
+
+    small = client.get('/entries?limit=1', headers=dict(headers, **{'Accept-Encoding': 'gzip'}))
+    assert 'Content-Encoding' not in small.headers
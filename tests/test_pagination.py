@@ -0,0 +1,65 @@
+import pytest
+
+
+@pytest.fixture
+def moods(client, headers):
+    for i in range(7):
+        client.post('/moods', json={'mood': 'calm', 'note': f'note {i}', 'rating': 3}, headers=headers)
+
+
+def pages(client, headers, path, limit):
+    query, items, cursors = f'?limit={limit}', [], 0
+    while True:
+        response = client.get(f'{path}{query}', headers=headers)
+        assert response.status_code == 200
+        items += response.get_json()
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            return items, cursors
+        cursors += 1
+        query = f'?limit={limit}&cursor={cursor}'
+
+
+def test_cursor_pages_cover_the_list_once(client, headers, moods):
+    items, cursors = pages(client, headers, '/moods', 3)
+    assert cursors == 2
+    assert len(items) == 7
+    assert len({item['_id'] for item in items}) == 7
+    # Newest first
+    assert [item['note'] for item in items] == [f'note {i}' for i in reversed(range(7))]
+
+
+def test_last_full_page_has_no_cursor(client, headers, moods):
+    response = client.get('/moods?limit=7', headers=headers)
+    assert len(response.get_json()) == 7
+    assert 'X-Next-Cursor' not in response.headers
+
+
+def test_fields_projects_documents(client, headers, moods):
+    items = client.get('/moods?limit=2&fields=note', headers=headers).get_json()
+    assert len(items) == 2
+    for item in items:
+        assert set(item) <= {'_id', 'note', 'date'}
+        assert 'rating' not in item
+
+
+def test_limit_is_capped(make_app, login):
+    app = make_app(MAX_PAGE_SIZE=2)
+    client = app.test_client()
+    headers = login(client=client)
+    for i in range(3):
+        client.post('/moods', json={'mood': 'calm', 'rating': 3}, headers=headers)
+    response = client.get('/moods?limit=50', headers=headers)
+    assert len(response.get_json()) == 2
+    assert response.headers['X-Next-Cursor']
+
+
+@pytest.mark.parametrize('query', ['limit=0', 'limit=abc', 'cursor=not-a-cursor', 'fields=a.b', 'fields=$where'])
+def test_bad_page_arguments(client, headers, query):
+    response = client.get(f'/moods?{query}', headers=headers)
+    assert response.status_code == 400
+
+
+def test_lists_are_per_user(client, headers, login, moods):
+    other = login('bob')
+    assert client.get('/moods', headers=other).get_json() == []
@@ -0,0 +1,174 @@
+from datetime import datetime, timedelta
+import pytest
+from reminders import TimingWheel
+
+SOON = (datetime.utcnow() + timedelta(days=2)).replace(microsecond=0)
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app(REMINDER_SINK='memory')
+
+
+@pytest.fixture
+def engine(app):
+    return app.extensions['reminders']
+
+
+def upcoming(client, headers):
+    response = client.get('/reminders', headers=headers)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def stored(value):
+    return datetime.fromisoformat(value.rstrip('Z'))
+
+
+def test_wheel_fires_on_the_first_tick_at_or_after_the_timer():
+    wheel = TimingWheel(tick=1.0, slots=4, levels=2, now=0)
+    wheel.add('a', 2.5)
+    wheel.add('b', 5)
+    wheel.add('far', 100)
+    wheel.add('gone', 3)
+    assert wheel.remove('gone') and not wheel.remove('gone')
+    assert len(wheel) == 3 and 'far' in wheel
+
+    assert wheel.advance(2.9) == []
+    assert wheel.advance(3) == [('a', None)]
+    assert wheel.advance(99.5) == [('b', None)]
+    assert wheel.advance(100) == [('far', None)]
+    assert len(wheel) == 0
+
+
+def test_wheel_replaces_timers_and_fires_overdue_ones_at_once():
+    wheel = TimingWheel(tick=0.5, now=10)
+    wheel.add('a', 20, 'first')
+    wheel.add('a', 30, 'second')
+    wheel.add('late', 5, 'overdue')
+    assert wheel.advance(10) == [('late', 'overdue')]
+    assert wheel.advance(29.9) == []
+    assert wheel.advance(10 ** 6) == [('a', 'second')]
+
+
+def test_wheel_reports_its_earliest_timer():
+    wheel = TimingWheel(tick=1.0, slots=4, levels=2, now=0)
+    assert wheel.next_expiry() is None
+    wheel.add('far', 100)
+    assert wheel.next_expiry() == 100
+    wheel.add('level1', 6)
+    wheel.advance(3)
+    # Placed on the lower ring later, yet after the timer cascading down
+    wheel.add('level0', 6.5)
+    assert wheel.next_expiry() == 6
+    wheel.remove('level1')
+    assert wheel.next_expiry() == 7
+    wheel.add('now', 1)
+    assert wheel.next_expiry() == 3
+
+
+def test_engine_sleeps_until_the_earliest_reminder(client, headers, engine):
+    now = datetime.utcnow()
+    engine.reload_interval = 10 ** 6
+    engine.reload(now)
+    assert engine._seconds_until_next(now) == pytest.approx(10 ** 6)
+    client.post('/tasks', json={'title': 'Essay', 'due_date': (now + timedelta(hours=3)).isoformat()}, headers=headers)
+    assert engine._seconds_until_next(now) == pytest.approx(2 * 3600, abs=engine.tick)
+
+
+def test_writes_refresh_reminders(client, headers):
+    response = client.post('/tasks', json={'title': 'Essay', 'due_date': SOON.isoformat()}, headers=headers)
+    assert response.status_code == 201
+    [reminder] = upcoming(client, headers)
+    assert (reminder['resource'], reminder['title']) == ('tasks', 'Essay')
+    assert stored(reminder['event_at']) == SOON
+    assert stored(reminder['fire_at']) == SOON - timedelta(minutes=60)
+
+    client.put(f"/tasks/{reminder['id']}", json={'is_completed': True}, headers=headers)
+    assert upcoming(client, headers) == []
+    client.post('/tasks', json={'title': 'Someday', 'due_date': 'whenever'}, headers=headers)
+    assert upcoming(client, headers) == []
+
+
+def test_a_write_refreshes_only_its_document(client, headers, engine, monkeypatch):
+    client.post('/tasks', json={'title': 'First', 'due_date': SOON.isoformat()}, headers=headers)
+    refreshed = []
+    monkeypatch.setattr(engine, 'refresh', lambda *args, **kwargs: pytest.fail('refreshed the whole collection'))
+    refresh_document = engine.refresh_document
+    monkeypatch.setattr(engine, 'refresh_document', lambda *args: refreshed.append(args[2]) or refresh_document(*args))
+
+    client.post('/tasks', json={'title': 'Second', 'due_date': (SOON + timedelta(days=1)).isoformat()}, headers=headers)
+    assert len(refreshed) == 1
+    monkeypatch.undo()
+    assert [reminder['title'] for reminder in upcoming(client, headers)] == ['First', 'Second']
+
+
+def test_settings(client, headers):
+    defaults = client.get('/reminders/settings', headers=headers).get_json()
+    assert defaults['due_lead_minutes'] == 60 and defaults['tasks'] is True
+
+    client.post('/tasks', json={'title': 'Essay', 'due_date': SOON.isoformat()}, headers=headers)
+    response = client.put('/reminders/settings', json={'due_lead_minutes': 15, 'habit_time': '7:30 am'},
+                          headers=headers)
+    assert response.status_code == 200
+    assert response.get_json()['habit_time'] == '07:30'
+    assert stored(upcoming(client, headers)[0]['fire_at']) == SOON - timedelta(minutes=15)
+
+    client.put('/reminders/settings', json={'tasks': False}, headers=headers)
+    assert upcoming(client, headers) == []
+    for bad in ({'due_lead_minutes': -1}, {'habit_time': 'noonish'}, {'tasks': 'yes'}):
+        assert client.put('/reminders/settings', json=bad, headers=headers).status_code == 400
+    assert client.put('/reminders/settings', json=[], headers=headers).status_code == 400
+
+
+def test_due_reminders_fire_once(make_app, app, client, headers, engine, user_id):
+    client.post('/tasks', json={'title': 'Essay', 'due_date': SOON.isoformat()}, headers=headers)
+    fire_at = SOON - timedelta(minutes=60)
+    # A second engine over the same store, as another worker would run
+    other = make_app(REMINDER_SINK='memory', SQLITE_PATH=app.config['SQLITE_PATH']).extensions['reminders']
+    for each in (engine, other):
+        each.reload(fire_at - timedelta(hours=1))
+
+    assert engine.run_due(fire_at - timedelta(seconds=1)) == []
+    [delivered] = engine.run_due(fire_at)
+    assert (delivered['title'], delivered['user_id']) == ('Essay', user_id())
+    assert other.run_due(fire_at) == []
+    assert engine.sink.delivered == [delivered] and other.sink.delivered == []
+    # Spent: kept without a fire time, so a refresh does not bring it back
+    assert upcoming(client, headers) == []
+    assert engine.refresh('tasks', user_id()) == 0
+
+
+def test_weekly_classes_fire_every_week(client, headers, engine, user_id):
+    client.post('/classes', json={'course_name': 'Maths', 'start_time': '09:00', 'end_time': '10:00',
+                                  'days_of_week': ['Mon']}, headers=headers)
+    [first] = upcoming(client, headers)
+    event = stored(first['event_at'])
+    assert event.weekday() == 0 and stored(first['fire_at']) == event - timedelta(minutes=15)
+
+    engine.reload(event - timedelta(hours=1))
+    assert [reminder['title'] for reminder in engine.run_due(event)] == ['Maths']
+    [second] = upcoming(client, headers)
+    assert stored(second['event_at']) == event + timedelta(days=7)
+
+
+def test_deleted_sources_never_fire(client, headers, engine):
+    client.post('/tasks', json={'title': 'Essay', 'due_date': SOON.isoformat()}, headers=headers)
+    [reminder] = upcoming(client, headers)
+    engine.reload(SOON - timedelta(hours=2))
+    client.delete(f"/tasks/{reminder['id']}", headers=headers)
+    assert engine.run_due(SOON) == []
+    assert engine.collection.count_documents({}) == 0
+
+
+def test_notification_sink(make_app, login):
+    app = make_app(REMINDER_SINK='notification')
+    client = app.test_client()
+    headers = login(client=client)
+    client.post('/tasks', json={'title': 'Essay', 'due_date': SOON.isoformat()}, headers=headers)
+    engine = app.extensions['reminders']
+    engine.reload(SOON - timedelta(hours=2))
+    engine.run_due(SOON)
+    [notification] = app.extensions['mongo'].db.notifications.find()
+    assert notification['kind'] == 'reminder' and notification['payload']['title'] == 'Essay'
+
@@ -0,0 +1,101 @@
+from datetime import datetime
+from archive import Archiver
+from models import Entry
+from search import tokenize
+
+
+def search(client, headers, q):
+    response = client.get('/search', query_string={'q': q}, headers=headers)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def entry_ids(client, headers):
+    return {entry['title']: entry['id'] for entry in client.get('/entries', headers=headers).get_json()}
+
+
+def test_tokenize():
+    assert tokenize('The Quiet lake, and a walk!') == ['quiet', 'lake', 'walk']
+    assert tokenize(['Travel', 'lake']) == ['travel', 'lake']
+
+
+def test_ranks_titles_above_content_and_decrypts_hits(client, headers):
+    client.post('/entries', json={'title': 'Monday', 'content': 'Walked around the lake'}, headers=headers)
+    client.post('/entries', json={'title': 'Lake day', 'content': 'Swimming'}, headers=headers)
+    client.post('/gratitude', json={'content': 'The lake was calm'}, headers=headers)
+    hits = search(client, headers, 'lake')
+    assert hits[0]['item']['title'] == 'Lake day'
+    assert sorted(hit['resource'] for hit in hits) == ['entries', 'entries', 'gratitude']
+    assert 'Walked around the lake' in [hit['item']['content'] for hit in hits]
+
+
+def test_index_holds_no_plaintext(app, client, headers):
+    client.post('/entries', json={'title': 'Secret', 'content': 'hidden words', 'tags': ['private']}, headers=headers)
+    postings = list(app.extensions['mongo'].db.search_index.find())
+    assert len(postings) == 4
+    assert not {'secret', 'hidden', 'words', 'private'} & {posting['term'] for posting in postings}
+
+
+def test_updates_and_deletes_keep_the_index_current(client, headers):
+    client.post('/entries', json={'title': 'Trip', 'content': 'mountains'}, headers=headers)
+    entry_id = entry_ids(client, headers)['Trip']
+    client.put(f'/entries/{entry_id}', json={'content': 'seaside'}, headers=headers)
+    assert search(client, headers, 'mountains') == []
+    assert [hit['item']['id'] for hit in search(client, headers, 'seaside trip')] == [entry_id]
+    client.delete(f'/entries/{entry_id}', headers=headers)
+    assert search(client, headers, 'seaside') == []
+
+
+def test_batch_writes_are_indexed(client, headers):
+    client.post('/batch', json={'operations': [
+        {'resource': 'entries', 'op': 'create', 'data': {'title': 'Batch', 'content': 'orchard'}},
+        {'resource': 'gratitude', 'op': 'create', 'data': {'content': 'orchard apples'}},
+    ]}, headers=headers)
+    assert len(search(client, headers, 'orchard')) == 2
+
+
+def test_users_only_find_their_own_documents(client, headers, login):
+    client.post('/entries', json={'title': 'Mine', 'content': 'garden'}, headers=headers)
+    assert search(client, login('bob'), 'garden') == []
+
+
+def test_rebuild(app, client, headers):
+    client.post('/entries', json={'title': 'Old', 'content': 'lighthouse'}, headers=headers)
+    index = app.extensions['search_index']
+    index.collection.delete_many({})
+    assert search(client, headers, 'lighthouse') == []
+    assert index.rebuild(app.extensions['keystore']) == 1
+    assert [hit['item']['title'] for hit in search(client, headers, 'lighthouse')] == ['Old']
+
+
+# The idf total is kept by index writes, archived documents included, rather
+# than counted over the collections on every query
+def test_document_counter_includes_archived_documents(app, client, headers, user_id, monkeypatch):
+    mongo, index = app.extensions['mongo'], app.extensions['search_index']
+    assert search(client, headers, 'harbour') == []
+    assert index.documents(user_id()) == 0
+    for i in range(3):
+        client.post('/entries', json={'title': f'Old {i}', 'content': 'harbour'}, headers=headers)
+        mongo.db.entries.update_one({'title': f'Old {i}'}, {'$set': {'timestamp': datetime(2020, 1, 10)}})
+    client.post('/gratitude', json={'content': 'harbour lights'}, headers=headers)
+    client.post('/gratitude', json={'content': 'the'}, headers=headers)
+    assert index.documents(user_id()) == 4
+
+    Archiver(mongo, after_days=180).run([Entry], now=datetime(2021, 1, 15))
+    assert mongo.db.entries.count_documents({}) == 0
+    monkeypatch.setattr(type(mongo.db.entries), 'count_documents', None)
+    assert len(search(client, headers, 'harbour')) == 4
+    assert index.documents(user_id()) == 4
+
+    gratitude_id = mongo.db.gratitude.find_one({'content': 'harbour lights'})['_id']
+    client.delete(f'/gratitude/{gratitude_id}', headers=headers)
+    assert index.documents(user_id()) == 3
+    # Recounted after a rebuild
+    assert index.rebuild(app.extensions['keystore']) == 4
+    assert index.documents(user_id()) == 3
+
+
+def test_bad_queries(client, headers):
+    assert client.get('/search', headers=headers).status_code == 400
+    assert client.get('/search?q=lake&limit=many', headers=headers).status_code == 400
+    assert search(client, headers, 'the and') == []
@@ -0,0 +1,171 @@
+from datetime import datetime
+import pytest
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, DeleteOne, IndexModel, InsertOne, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from sqlite_store import SQLiteStore
+
+DAY = datetime(2030, 1, 1)
+
+
+# The PyMongo subset the app relies on, run against the SQLite backend and
+# against mongomock as a stand-in for MongoDB, so both answer alike
+@pytest.fixture(params=['sqlite', 'mongomock'])
+def db(request, tmp_path):
+    if request.param == 'mongomock':
+        mongomock = pytest.importorskip('mongomock')
+        yield mongomock.MongoClient().diary_test
+        return
+    store = SQLiteStore({'SQLITE_PATH': str(tmp_path / 'store.sqlite3')})
+    yield store.db
+    store.close()
+
+
+@pytest.fixture
+def items(db):
+    collection = db.items
+    collection.create_indexes([
+        IndexModel([('user_id', ASCENDING), ('n', DESCENDING)], name='user_n'),
+        IndexModel([('slug', ASCENDING)], name='slug_unique', unique=True),
+    ])
+    collection.insert_many([
+        {'_id': ObjectId(f'{i:024x}'), 'user_id': 'u1' if i % 2 else 'u2', 'n': i, 'slug': f's{i}',
+         'tags': ['even' if i % 2 == 0 else 'odd'], 'at': DAY.replace(day=i + 1)}
+        for i in range(10)
+    ])
+    return collection
+
+
+def ns(docs):
+    return [doc['n'] for doc in docs]
+
+
+def test_find_sort_skip_limit(items):
+    assert ns(items.find({'user_id': 'u1'}).sort('n', -1)) == [9, 7, 5, 3, 1]
+    assert ns(items.find({'user_id': 'u1'}).sort('n', -1).skip(1).limit(2)) == [7, 5]
+    assert ns(items.find({}, sort=[('user_id', 1), ('n', -1)], limit=3)) == [9, 7, 5]
+    assert ns(items.find().sort([('user_id', -1), ('_id', 1)]).limit(2)) == [0, 2]
+    assert items.find_one({'n': {'$gt': 3}}, sort=[('n', 1)])['n'] == 4
+    assert items.find_one({'n': 99}) is None
+    assert set(items.find_one({'n': 1}, {'slug': 1})) == {'_id', 'slug'}
+    assert 'tags' not in items.find_one({'n': 1}, {'tags': 0})
+
+
+def test_query_operators(items):
+    assert ns(items.find({'n': {'$in': [1, 4, 99]}}).sort('n')) == [1, 4]
+    assert ns(items.find({'n': {'$nin': list(range(8))}}).sort('n')) == [8, 9]
+    assert ns(items.find({'n': {'$gte': 3, '$lt': 6}}).sort('n')) == [3, 4, 5]
+    assert ns(items.find({'at': {'$lte': DAY.replace(day=2)}}).sort('n')) == [0, 1]
+    assert ns(items.find({'user_id': 'u1', 'n': {'$ne': 3}}).sort('n')) == [1, 5, 7, 9]
+    assert ns(items.find({'$or': [{'n': 0}, {'slug': 's9'}]}).sort('n')) == [0, 9]
+    assert ns(items.find({'tags': 'odd', 'n': {'$lt': 4}}).sort('n')) == [1, 3]
+    items.update_one({'n': 0}, {'$set': {'extra': None}})
+    assert ns(items.find({'extra': {'$exists': True}})) == [0]
+    assert items.count_documents({'user_id': 'u2'}) == 5
+    assert items.count_documents({'user_id': 'u2'}, limit=2) == 2
+    assert sorted(items.distinct('user_id')) == ['u1', 'u2']
+
+
+def test_find_one_and_update(items):
+    before = items.find_one_and_update({'slug': 's1'}, {'$inc': {'n': 100}})
+    assert before['n'] == 1
+    after = items.find_one_and_update({'slug': 's1'}, {'$inc': {'n': 1}}, return_document=ReturnDocument.AFTER)
+    assert after['n'] == 102
+    assert items.find_one_and_update({'slug': 'missing'}, {'$set': {'n': 1}}) is None
+    assert items.count_documents({'slug': 'missing'}) == 0
+
+    created = items.find_one_and_update(
+        {'slug': 'new'}, {'$setOnInsert': {'n': 50}, '$set': {'user_id': 'u3'}},
+        upsert=True, return_document=ReturnDocument.AFTER,
+    )
+    assert (created['slug'], created['n'], created['user_id']) == ('new', 50, 'u3')
+    assert isinstance(created['_id'], ObjectId)
+    again = items.find_one_and_update(
+        {'slug': 'new'}, {'$setOnInsert': {'n': 0}}, upsert=True, return_document=ReturnDocument.AFTER,
+    )
+    assert again['_id'] == created['_id'] and again['n'] == 50
+
+    # Upserting a document the unique index already holds under another filter
+    with pytest.raises(DuplicateKeyError):
+        items.find_one_and_update({'n': -1}, {'$set': {'slug': 's2'}}, upsert=True)
+
+
+def test_update_operators(items):
+    items.update_one({'n': 0}, {'$push': {'tags': 'first'}})
+    items.update_one({'n': 0}, {'$push': {'tags': {'$each': ['zero'], '$position': 0}}})
+    assert items.find_one({'n': 0})['tags'] == ['zero', 'even', 'first']
+    items.update_one({'n': 0}, {'$pull': {'tags': 'even'}})
+    assert items.find_one({'n': 0})['tags'] == ['zero', 'first']
+
+    items.update_one({'n': 1}, {'$set': {'keys': [{'id': 1}, {'id': 2}, {'id': 3}]}})
+    items.update_one({'n': 1}, {'$pull': {'keys': {'id': {'$lt': 3}}}})
+    assert items.find_one({'n': 1})['keys'] == [{'id': 3}]
+    assert items.update_one({'n': 1, 'keys.id': {'$ne': 3}}, {'$set': {'x': 1}}).modified_count == 0
+
+    items.update_one({'n': 2}, {'$unset': {'tags': '', 'missing': ''}, '$set': {'meta.seen': True}})
+    doc = items.find_one({'n': 2})
+    assert 'tags' not in doc and doc['meta'] == {'seen': True}
+    assert items.find_one({'meta.seen': True})['n'] == 2
+
+    result = items.update_many({'user_id': 'u1'}, {'$inc': {'n': 10}})
+    assert (result.matched_count, result.modified_count) == (5, 5)
+    assert ns(items.find({'user_id': 'u1'}).sort('n')) == [11, 13, 15, 17, 19]
+    assert items.update_one({'n': 99}, {'$set': {'x': 1}}).matched_count == 0
+    assert items.update_one({'n': 99}, {'$set': {'slug': 'up'}}, upsert=True).upserted_id is not None
+
+
+def test_unique_index(items):
+    with pytest.raises(DuplicateKeyError):
+        items.insert_one({'slug': 's3'})
+    with pytest.raises(DuplicateKeyError):
+        items.update_one({'n': 4}, {'$set': {'slug': 's5'}})
+    with pytest.raises(DuplicateKeyError):
+        items.replace_one({'n': 4}, {'n': 4, 'slug': 's6'})
+    assert items.find_one({'n': 4})['slug'] == 's4'
+    items.delete_one({'slug': 's3'})
+    items.insert_one({'slug': 's3', 'n': 30})
+    assert items.find_one({'slug': 's3'})['n'] == 30
+
+
+def test_bulk_write_ordered_stops_at_the_first_error(items):
+    with pytest.raises(BulkWriteError) as raised:
+        items.bulk_write([
+            InsertOne({'slug': 'a', 'n': 100}),
+            InsertOne({'slug': 's1', 'n': 101}),
+            InsertOne({'slug': 'b', 'n': 102}),
+        ])
+    details = raised.value.details
+    assert details['nInserted'] == 1
+    assert [(error['index'], error['code']) for error in details['writeErrors']] == [(1, 11000)]
+    assert items.count_documents({'n': {'$gte': 100}}) == 1
+
+
+def test_bulk_write_unordered_runs_every_operation(items):
+    with pytest.raises(BulkWriteError) as raised:
+        items.bulk_write([
+            InsertOne({'slug': 's1'}),
+            UpdateOne({'n': 2}, {'$set': {'done': True}}),
+            InsertOne({'slug': 's2'}),
+            DeleteOne({'n': 3}),
+            ReplaceOne({'slug': 'fresh'}, {'slug': 'fresh', 'n': 200}, upsert=True),
+        ], ordered=False)
+    details = raised.value.details
+    assert sorted(error['index'] for error in details['writeErrors']) == [0, 2]
+    assert (details['nModified'], details['nRemoved'], details['nUpserted']) == (1, 1, 1)
+    assert items.find_one({'n': 2})['done'] and items.find_one({'n': 3}) is None
+    assert items.find_one({'slug': 'fresh'})['n'] == 200
+
+    result = items.bulk_write([UpdateOne({'n': {'$lt': 2}}, {'$set': {'done': True}}), DeleteOne({'n': 4})])
+    assert (result.modified_count, result.deleted_count) == (1, 1)
+
+
+def test_aggregate_match_group(items):
+    groups = items.aggregate([{'$match': {'n': {'$lt': 6}}}, {'$group': {'_id': '$user_id', 'total': {'$sum': '$n'}}}])
+    assert sorted((group['_id'], group['total']) for group in groups) == [('u1', 9), ('u2', 6)]
+
+
+def test_delete(items):
+    assert items.delete_one({'user_id': 'u1'}).deleted_count == 1
+    assert items.delete_many({'n': {'$in': [2, 4, 6]}}).deleted_count == 3
+    assert items.find_one_and_delete({'slug': 's8'})['n'] == 8
+    assert items.count_documents({}) == 5
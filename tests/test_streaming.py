@@ -0,0 +1,47 @@
+import json
+from bson import ObjectId
+import pytest
+
+
+@pytest.fixture
+def entries(client, headers):
+    for i in range(5):
+        client.post('/entries', json={'title': f'Entry {i}', 'content': f'secret {i}'}, headers=headers)
+
+
+def lines(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_stream_query_returns_ndjson(client, headers, entries):
+    response = client.get('/entries?stream=1', headers=headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    rows = lines(response)
+    assert [row['title'] for row in rows] == [f'Entry {i}' for i in reversed(range(5))]
+    # Entries are decrypted on the way out
+    assert rows[0]['content'] == 'secret 4'
+
+
+def test_accept_header_selects_stream(client, headers, entries):
+    response = client.get('/entries', headers=dict(headers, Accept='application/x-ndjson'))
+    assert response.mimetype == 'application/x-ndjson'
+    assert len(lines(response)) == 5
+
+
+def test_stream_resumes_from_cursor_in_small_batches(make_app, login):
+    app = make_app(STREAM_BATCH_SIZE=2)
+    client = app.test_client()
+    headers = login(client=client)
+    for i in range(5):
+        client.post('/moods', json={'mood': 'calm', 'note': f'note {i}', 'rating': 3}, headers=headers)
+    cursor = client.get('/moods?limit=2', headers=headers).headers['X-Next-Cursor']
+    rows = lines(client.get(f'/moods?stream=1&cursor={cursor}', headers=headers))
+    assert [row['note'] for row in rows] == ['note 2', 'note 1', 'note 0']
+
+
+def test_bson_types_are_json_encoded(client, headers):
+    client.post('/moods', json={'mood': 'calm', 'rating': 3}, headers=headers)
+    row = lines(client.get('/moods?stream=1', headers=headers))[0]
+    assert ObjectId.is_valid(row['_id'])
+    assert row['date'].endswith('Z')
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+from sync import encode_token
+
+
+def sync(client, headers, token):
+    response = client.get(f'/sync?since={token}', headers=headers)
+    assert response.status_code == 200
+    return response
+
+
+def test_changes_and_deletes_since_token(client, headers):
+    token = client.get('/sync', headers=headers).get_json()['next']
+    client.post('/tasks', json={'title': 'Write'}, headers=headers)
+    client.post('/gratitude', json={'content': 'Sun'}, headers=headers)
+    result = sync(client, headers, token).get_json()
+    assert [task['title'] for task in result['changes']['tasks']] == ['Write']
+    assert len(result['changes']['gratitude']) == 1 and not result['more']
+
+    task_id = result['changes']['tasks'][0]['_id']
+    client.delete(f'/tasks/{task_id}', headers=headers)
+    result = sync(client, headers, result['next']).get_json()
+    assert result['deleted'] == [{'resource': 'tasks', 'id': task_id, 'deleted_at': result['deleted'][0]['deleted_at']}]
+
+
+def test_unopened_capsules_are_never_synced(app, client, headers):
+    token = client.get('/sync', headers=headers).get_json()['next']
+    open_date = datetime.utcnow() + timedelta(days=30)
+    client.post('/timecapsule', json={'content': 'sealed secret', 'open_date': open_date.isoformat()}, headers=headers)
+    client.post('/timecapsule', json={'content': 'already open', 'open_date': '2020-01-01T00:00:00'}, headers=headers)
+
+    response = sync(client, headers, token)
+    assert b'sealed secret' not in response.get_data()
+    assert [capsule['content'] for capsule in response.get_json()['changes']['timecapsule']] == ['already open']
+
+    # Opening the capsule bumps updated_at, so it is picked up then
+    app.extensions['scheduler'].run_due(open_date + timedelta(seconds=1))
+    result = sync(client, headers, encode_token(open_date)).get_json()
+    assert [capsule['content'] for capsule in result['changes']['timecapsule']] == ['sealed secret']
+
+
+def test_truncated_changes_resume(make_app, login):
+    app = make_app(SYNC_LIMIT=2)
+    client = app.test_client()
+    headers = login(client=client)
+    token = client.get('/sync', headers=headers).get_json()['next']
+    for title in 'abc':
+        client.post('/tasks', json={'title': title}, headers=headers)
+    result = sync(client, headers, token).get_json()
+    assert result['more'] and len(result['changes']['tasks']) == 2
+    result = sync(client, headers, result['next']).get_json()
+    assert 'c' in [task['title'] for task in result['changes']['tasks']]
+
+
+def test_truncated_changes_sharing_a_timestamp(make_app, login):
+    app = make_app(SYNC_LIMIT=2)
+    client = app.test_client()
+    headers = login(client=client)
+    for title in 'abcde':
+        client.post('/tasks', json={'title': title}, headers=headers)
+    stamp = datetime.utcnow().replace(microsecond=0)
+    app.extensions['mongo'].db.tasks.update_many({}, {'$set': {'updated_at': stamp}})
+    token = encode_token(stamp)
+
+    titles, more = [], True
+    while more:
+        result = sync(client, headers, token).get_json()
+        titles += [task['title'] for task in result['changes']['tasks']]
+        token, more = result['next'], result['more']
+    assert sorted(titles) == list('abcde')
+
+
+def test_bad_and_expired_tokens(client, headers):
+    assert client.get('/sync?since=nonsense', headers=headers).status_code == 400
+    expired = encode_token(datetime.utcnow() - timedelta(days=365))
+    assert client.get(f'/sync?since={expired}', headers=headers).status_code == 410
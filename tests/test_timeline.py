@@ -0,0 +1,81 @@
+from datetime import datetime, time, timedelta
+import pytest
+from timeline import backfill_due_dates, encode_cursor, parse_time_of_day, parse_weekdays
+
+def get(client, headers, **args):
+    response = client.get('/timeline', query_string=args, headers=headers)
+    assert response.status_code == 200
+    return response.get_json(), response.headers.get('X-Next-Cursor')
+
+
+def test_parsers():
+    assert parse_weekdays(['Mon, wednesday', 'FRI', 'someday']) == {0, 2, 4}
+    assert parse_time_of_day('9:30 am') == time(9, 30)
+    assert parse_time_of_day('14:05') == time(14, 5)
+    assert parse_time_of_day('noonish') is None
+
+
+def test_merges_sources_in_time_order(client, headers):
+    client.post('/tasks', json={'title': 'Essay', 'due_date': '2030-01-08T12:00:00'}, headers=headers)
+    client.post('/goals', json={'title': 'Finish', 'due_date': '2030-01-09'}, headers=headers)
+    client.post('/tasks', json={'title': 'Whenever', 'due_date': 'someday'}, headers=headers)
+    client.post('/classes', json={'course_name': 'Maths', 'start_time': '09:00', 'end_time': '10:30',
+                                  'days_of_week': ['Mon', 'Wed']}, headers=headers)
+    client.post('/classes', json={'course_name': 'Study', 'start_time': 'late', 'end_time': '', 'days_of_week': ['Tue']},
+                headers=headers)
+    items, cursor = get(client, headers, **{'from': '2030-01-07', 'to': '2030-01-10'})
+    assert [(item['resource'], item['event']) for item in items] == [
+        ('classes', 'Maths'), ('classes', 'Study'), ('tasks', 'Essay'), ('goals', 'Finish'), ('classes', 'Maths'),
+    ]
+    assert items[0]['end'].startswith('2030-01-07T10:30') and items[1]['all_day']
+    assert cursor is None
+
+
+def test_pages_walk_the_whole_window(client, headers):
+    client.post('/classes', json={'course_name': 'Daily', 'start_time': '08:00', 'end_time': '09:00',
+                                  'days_of_week': ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']}, headers=headers)
+    client.post('/entries', json={'title': 'Today', 'content': 'x'}, headers=headers)
+    client.post('/moods', json={'mood': 'calm'}, headers=headers)
+    window = {'from': (datetime.utcnow() - timedelta(days=3)).date().isoformat(),
+              'to': (datetime.utcnow() + timedelta(days=3)).date().isoformat()}
+    everything, _ = get(client, headers, **window)
+    assert {'entries', 'moods', 'classes'} == {item['resource'] for item in everything}
+
+    pages, cursor = [], None
+    while True:
+        args = dict(window, limit=2, **({'cursor': cursor} if cursor else {}))
+        items, cursor = get(client, headers, **args)
+        pages.extend(items)
+        if not cursor:
+            break
+    assert pages == everything
+
+
+def test_invalid_windows(client, headers):
+    assert client.get('/timeline?from=2030-01-10&to=2030-01-01', headers=headers).status_code == 400
+    assert client.get('/timeline?from=2030-01-01&to=2030-12-01', headers=headers).status_code == 400
+    assert client.get('/timeline?cursor=nope', headers=headers).status_code == 400
+    assert client.get('/timeline?limit=x', headers=headers).status_code == 400
+
+
+# Well-formed cursors whose fields have the wrong types
+@pytest.mark.parametrize('key', [
+    ['2030-01-01', 0, 'abc'],
+    [datetime(2030, 1, 1), '0', 'abc'],
+    [datetime(2030, 1, 1), 1.5, 'abc'],
+    [datetime(2030, 1, 1), 99, 'abc'],
+    [datetime(2030, 1, 1), 0, 7],
+    [datetime(2030, 1, 1), True, 'abc'],
+])
+def test_invalid_cursor_fields(client, headers, key):
+    client.post('/tasks', json={'title': 'Due', 'due_date': '2030-01-02'}, headers=headers)
+    response = client.get('/timeline', query_string={'from': '2030-01-01', 'to': '2030-01-05', 'cursor': encode_cursor(key)},
+                          headers=headers)
+    assert response.status_code == 400
+
+
+def test_backfill_due_dates(app, headers, user_id):
+    tasks = app.extensions['mongo'].db.tasks
+    tasks.insert_one({'user_id': user_id(), 'title': 'Old', 'due_date': '2030-01-08'}, bypass_document_validation=True)
+    assert backfill_due_dates(app.extensions['mongo']) == 1
+    assert tasks.find_one({'title': 'Old'})['due_at'] == datetime(2030, 1, 8)
@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+
+@pytest.fixture
+def task_id(client, headers):
+    client.post('/tasks', json={'title': 'T', 'description': 'keep me', 'due_date': '2030-01-01'}, headers=headers)
+    return client.get('/tasks', headers=headers).get_json()[0]['_id']
+
+
+def get_task(client, headers):
+    return client.get('/tasks', headers=headers).get_json()[0]
+
+
+def test_update_sets_only_the_given_fields(client, headers, task_id):
+    response = client.put(f'/tasks/{task_id}', json={'title': 'T2'}, headers=headers)
+    assert response.get_json() == {'message': 'Task updated successfully', 'version': 1}
+    task = get_task(client, headers)
+    assert (task['title'], task['description'], task['version']) == ('T2', 'keep me', 1)
+
+
+def test_stale_version_is_a_conflict(client, headers, task_id):
+    assert client.put(f'/tasks/{task_id}', json={'title': 'A', 'version': 0}, headers=headers).status_code == 200
+    response = client.put(f'/tasks/{task_id}', json={'title': 'B', 'version': 0}, headers=headers)
+    assert response.status_code == 409
+    assert get_task(client, headers)['title'] == 'A'
+
+
+def test_if_match_header_carries_the_version(client, headers, task_id):
+    assert client.put(f'/tasks/{task_id}', json={'title': 'A'}, headers=dict(headers, **{'If-Match': '"0"'})).status_code == 200
+    assert client.put(f'/tasks/{task_id}', json={'title': 'B'}, headers=dict(headers, **{'If-Match': '"0"'})).status_code == 409
+    assert client.put(f'/tasks/{task_id}', json={'title': 'B'}, headers=dict(headers, **{'If-Match': 'x'})).status_code == 400
+
+
+def test_missing_and_foreign_documents_are_not_found(client, headers, login, task_id):
+    assert client.put(f'/tasks/{"0" * 24}', json={'title': 'A'}, headers=headers).status_code == 404
+    assert client.put('/tasks/not-an-id', json={'title': 'A'}, headers=headers).status_code == 404
+    assert client.put(f'/tasks/{task_id}', json={'title': 'A'}, headers=login('bob')).status_code == 404
+
+
+@pytest.mark.parametrize('resource', ['entries', 'tasks', 'goals', 'habits', 'moods', 'classes', 'gratitude',
+                                      'timecapsule'])
+def test_deleting_missing_and_malformed_ids_is_not_found(client, headers, resource):
+    for object_id in ('0' * 24, 'not-an-id'):
+        assert client.delete(f'/{resource}/{object_id}', headers=headers).status_code == 404
+
+
+def test_only_the_owner_deletes(app, client, headers, login, task_id):
+    assert client.delete(f'/tasks/{task_id}', headers=login('bob')).status_code == 404
+    assert client.delete(f'/tasks/{task_id}', headers=headers).status_code == 200
+    assert client.delete(f'/tasks/{task_id}', headers=headers).status_code == 404
+    assert app.extensions['mongo'].db.tombstones.count_documents({}) == 1
+
+
+def test_invalid_fields_are_rejected(client, headers, task_id):
+    assert client.put(f'/tasks/{task_id}', json={'title': 7}, headers=headers).status_code == 400
+
+
+def test_concurrent_checkins_are_all_counted(app, client, headers):
+    client.post('/habits', json={'title': 'Run', 'frequency': 'daily'}, headers=headers)
+    habit_id = client.get('/habits', headers=headers).get_json()[0]['_id']
+
+    def check_in(_):
+        with app.test_client() as worker:
+            return worker.post(f'/habits/{habit_id}/checkin', json={'amount': 2}, headers=headers).status_code
+
+    with ThreadPoolExecutor(4) as pool:
+        assert set(pool.map(check_in, range(20))) == {200}
+    habit = client.get('/habits', headers=headers).get_json()[0]
+    assert (habit['progress'], habit['version']) == (40, 20)
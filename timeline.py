@@ -0,0 +1,149 @@
+import base64
+import heapq
+import re
+from datetime import datetime, time, timedelta
+from itertools import islice
+from bson import json_util
+from analytics import parse_date
+from archive import Archive
+from models import ArchivedDocument, ClassSchedule, Entry, Goal, Mood, Task, parse_due_date
+
+WEEKDAYS = {name: i for i, name in enumerate(('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun'))}
+TIME_FORMATS = ('%H:%M', '%H:%M:%S', '%I:%M %p', '%I:%M%p', '%I %p')
+
+
+class TimelineError(ValueError):
+    pass
+
+
+# Point-in-time sources: (resource, model, time field, projection, event
+# field). Each is read as one range query over a (user_id, field) index.
+SOURCES = [
+    ('entries', Entry, 'timestamp', {'title': 1, 'tags': 1}, 'title'),
+    ('moods', Mood, 'date', {'mood': 1, 'rating': 1}, 'mood'),
+    ('tasks', Task, 'due_at', {'title': 1, 'is_completed': 1}, 'title'),
+    ('goals', Goal, 'due_at', {'title': 1, 'is_completed': 1}, 'title'),
+]
+# Tie-break between sources at the same instant; classes sort last
+RANK = {resource: i for i, (resource, *_) in enumerate(SOURCES)}
+RANK['classes'] = len(SOURCES)
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json_util.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+
+# The key is compared against every item's, so a field of the wrong type
+# would fail mid-merge rather than here
+def decode_cursor(token):
+    try:
+        at, rank, item_id = json_util.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    except Exception:
+        raise TimelineError('Invalid cursor')
+    if (not isinstance(at, datetime) or at.tzinfo is not None or type(rank) is not int
+            or rank not in RANK.values() or not isinstance(item_id, str)):
+        raise TimelineError('Invalid cursor')
+    return at, rank, item_id
+
+
+# ?from=&to= as ISO dates; defaults to the week starting today
+def parse_window(args, max_days=92):
+    try:
+        start = parse_date(args['from']) if args.get('from') else datetime.combine(datetime.utcnow().date(), time())
+        end = parse_date(args['to']) if args.get('to') else start + timedelta(days=7)
+    except ValueError:
+        raise TimelineError('Invalid date range')
+    if start >= end or end - start > timedelta(days=max_days):
+        raise TimelineError('Invalid date range')
+    return start, end
+
+
+def _documents(mongo, user_id, start, end, limit, after, resource, model, field, projection, event):
+    rank = RANK[resource]
+    query = {'user_id': user_id, field: {'$gte': max(start, after[0]) if after else start, '$lt': end}}
+    cursor = (mongo.db[model.COLLECTION].find(query, dict(projection, **{field: 1}))
+              .sort([(field, 1), ('_id', 1)]).batch_size(limit + 1))
+    for doc in cursor:
+        item_id = str(doc.pop('_id'))
+        key = (doc.pop(field), rank, item_id)
+        if after and key <= after:
+            continue
+        doc.update(id=item_id, resource=resource, date=key[0], event=doc.get(event))
+        yield key, doc
+
+
+def parse_weekdays(value):
+    days = set()
+    for part in re.split(r'[\s,]+', ' '.join(value or [])):
+        day = WEEKDAYS.get(part[:3].lower())
+        if day is not None:
+            days.add(day)
+    return days
+
+
+def parse_time_of_day(value):
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.strptime((value or '').strip().upper(), fmt).time()
+        except ValueError:
+            pass
+    return None
+
+
+# Occurrences of the user's recurring classes, generated a day at a time
+# for the window only. Classes without a readable start time are all-day.
+def _class_occurrences(mongo, user_id, start, end, after):
+    rank = RANK['classes']
+    by_weekday = {day: [] for day in range(7)}
+    for schedule in mongo.db[ClassSchedule.COLLECTION].find({'user_id': user_id}):
+        starts, ends = parse_time_of_day(schedule.get('start_time')), parse_time_of_day(schedule.get('end_time'))
+        for day in parse_weekdays(schedule.get('days_of_week')):
+            by_weekday[day].append((starts or time(), str(schedule['_id']), starts and ends, starts is None, schedule))
+    for slots in by_weekday.values():
+        slots.sort(key=lambda slot: slot[:2])
+
+    day = start.date()
+    while datetime.combine(day, time()) < end:
+        for starts, schedule_id, ends, all_day, schedule in by_weekday[day.weekday()]:
+            at = datetime.combine(day, starts)
+            key = (at, rank, f'{schedule_id}:{day.isoformat()}')
+            if at < start or at >= end or (after and key <= after):
+                continue
+            yield key, {
+                'id': key[2],
+                'resource': 'classes',
+                'class_id': schedule_id,
+                'date': at,
+                'end': datetime.combine(day, ends) if ends else None,
+                'all_day': all_day,
+                'event': schedule.get('course_name'),
+                'location': schedule.get('location'),
+            }
+        day += timedelta(days=1)
+
+
+# Items from every source in [start, end), oldest first, merged lazily so
+# each cursor is only read as far as the page needs. Archived months in the
+# window are restored first. Returns the page and a cursor for the rest, or
+# None.
+def timeline(mongo, user_id, start, end, limit=500, after=None):
+    for _, model, *_ in SOURCES:
+        if issubclass(model, ArchivedDocument):
+            Archive.restore_range(mongo, model, user_id, start, end)
+    sources = [_documents(mongo, user_id, start, end, limit, after, *source) for source in SOURCES]
+    sources.append(_class_occurrences(mongo, user_id, start, end, after))
+    merged = list(islice(heapq.merge(*sources, key=lambda pair: pair[0]), limit + 1))
+    next_cursor = encode_cursor(merged[limit - 1][0]) if len(merged) > limit else None
+    return [item for _, item in merged[:limit]], next_cursor
+
+
+# One-off migration: set due_at on tasks and goals written before it existed
+def backfill_due_dates(mongo, batch_size=500):
+    updated = 0
+    for model in (Task, Goal):
+        collection = mongo.db[model.COLLECTION]
+        query = {'due_at': {'$exists': False}}
+        for doc in collection.find(query, {'due_date': 1}).batch_size(batch_size):
+            collection.update_one({'_id': doc['_id']}, {'$set': {'due_at': parse_due_date(doc.get('due_date'))}})
+            updated += 1
+    return updated
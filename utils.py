@@ -1,12 +1,59 @@
-from cryptography.fernet import Fernet
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from cryptography.fernet import Fernet, InvalidToken
+from metrics import timed
 
 def generate_key():
     return Fernet.generate_key()
 
+# Accepts either a raw Fernet key or a ready-built Fernet/MultiFernet
+def _cipher(key):
+    return Fernet(key) if isinstance(key, (bytes, str)) else key
+
+@timed('encrypt')
 def encrypt_content(content, key):
-    cipher_suite = Fernet(key)
+    cipher_suite = _cipher(key)
     return cipher_suite.encrypt(content.encode('utf-8'))
 
+@timed('decrypt')
 def decrypt_content(encrypted_content, key):
-    cipher_suite = Fernet(key)
+    cipher_suite = _cipher(key)
     return cipher_suite.decrypt(encrypted_content).decode('utf-8')
+
+# Bulk decryption: small batches are decrypted inline; larger ones are split into chunks and
+# fanned out over a shared thread or process pool. Tokens that fail to
+# decrypt come back as None.
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _pool(kind, workers):
+    with _pools_lock:
+        pool = _pools.get((kind, workers))
+        if pool is None:
+            executor = ProcessPoolExecutor if kind == 'process' else ThreadPoolExecutor
+            pool = _pools[(kind, workers)] = executor(max_workers=workers)
+        return pool
+
+def _decrypt_chunk(encrypted_contents, cipher_suite):
+    output = []
+    for encrypted_content in encrypted_contents:
+        try:
+            output.append(cipher_suite.decrypt(encrypted_content).decode('utf-8'))
+        except (InvalidToken, TypeError):
+            output.append(None)
+    return output
+
+@timed('decrypt_many')
+def decrypt_many(encrypted_contents, key, workers=4, executor='thread', chunk_size=128, min_parallel=256):
+    cipher_suite = _cipher(key)
+    encrypted_contents = list(encrypted_contents)
+    if workers <= 1 or len(encrypted_contents) < min_parallel:
+        return _decrypt_chunk(encrypted_contents, cipher_suite)
+
+    chunks = [encrypted_contents[i:i + chunk_size] for i in range(0, len(encrypted_contents), chunk_size)]
+    pool = _pool(executor, workers)
+    output = []
+    for decrypted in pool.map(_decrypt_chunk, chunks, repeat(cipher_suite, len(chunks))):
+        output.extend(decrypted)
+    return output